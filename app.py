@@ -1,4 +1,4 @@
-from flask import Flask, render_template, session, redirect, url_for
+from flask import Flask, render_template, redirect, url_for
 from routes.adminauth import adminauth_bp
 from datetime import datetime
 import os
@@ -11,6 +11,9 @@ from routes.member import member_bp
 from routes.memberauth import memberauth_bp
 from flask_wtf.csrf import CSRFProtect
 from routes.shares import shares_admin_bp
+from routes.dashboard import dashboard_bp
+from query_tracer import init_query_tracer
+from session_store import init_session_store
 
 
 
@@ -19,6 +22,9 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-change-this-in-production')
 
+# Server-side sessions (SESSION_STORE_URL, see session_store.py); the cookie only holds the session id
+init_session_store(app)
+
 # Register blueprints
 app.register_blueprint(adminauth_bp)
 app.register_blueprint(members_bp)
@@ -28,6 +34,10 @@ app.register_blueprint(expense_incomes_bp)
 app.register_blueprint(member_bp)
 app.register_blueprint(memberauth_bp)
 app.register_blueprint(shares_admin_bp)
+app.register_blueprint(dashboard_bp)
+
+# Per-request Supabase query tracer (set QUERY_TRACE=1 in development/staging)
+init_query_tracer(app)
 
 
 # Context processor for template variables
@@ -46,19 +56,6 @@ def format_date(value, format='%b %d, %Y'):
     return value.strftime(format)
 
 
-# Admin dashboard route (protected)
-@app.route('/admin/dashboard')
-def admin_dashboard():
-    if 'admin_logged_in' not in session or not session.get('admin_logged_in'):
-        return redirect(url_for('adminauth.admin_login'))
-    
-    # Check OTP if required
-    if session.get('otp_required') and not session.get('otp_verified', False):
-        return redirect(url_for('adminauth.verify_otp'))
-    
-    return redirect(url_for('members.members_list'))
-
-
 # Home route
 @app.route('/')
 def home():
@@ -72,8 +69,16 @@ def test_env():
         "SUPABASE_KEY": os.environ.get("SUPABASE_KEY")
     }
 
-from waitress import serve
+from server import run_server, register_post_fork, register_worker_exit
+from mail_queue import drain_mail_queue
+from upload_staging import temp_uploads
+
+# Expired registration uploads are swept in every worker from the start, not only once one is staged
+register_post_fork(temp_uploads.start_janitor)
+
+# Pre-fork workers exit with os._exit() and skip atexit, so drain queued mail explicitly
+register_worker_exit(drain_mail_queue)
 
 if __name__ == '__main__':
-    # Remove app.run(), replace with waitress
-    serve(app, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # waitress threads, workers and timeouts are configured in server.py (WAITRESS_*, WEB_WORKERS, ...)
+    run_server(app)
\ No newline at end of file
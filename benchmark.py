@@ -0,0 +1,178 @@
+#benchmark.py
+# Offline benchmark suite: runs the real routes against local_supabase.py (no network)
+#   python benchmark.py --members 10000 --transactions 1000000 --db bench.sqlite
+#   python benchmark.py --db bench.sqlite --output before.json
+#   python benchmark.py --db bench.sqlite --compare before.json
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import statistics
+import contextlib
+from datetime import datetime, timedelta, date
+
+# Never talk to the live project while benchmarking
+os.environ['SUPABASE_URL'] = 'http://127.0.0.1:54321'
+os.environ['SUPABASE_KEY'] = 'local-benchmark-key'
+os.environ['QUERY_TRACE'] = '0'
+
+from local_supabase import LocalSupabase, generate_sacco_data, use_local_supabase
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of timings"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def time_scenario(name, func, iterations=10, warmup=1, quiet=True):
+    """Run func repeatedly and return timing statistics in milliseconds"""
+    sink = io.StringIO()
+    for _ in range(warmup):
+        with contextlib.redirect_stdout(sink if quiet else sys.stdout):
+            func()
+
+    timings = []
+    for _ in range(iterations):
+        sink.seek(0)
+        sink.truncate()
+        with contextlib.redirect_stdout(sink if quiet else sys.stdout):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'scenario': name,
+        'iterations': iterations,
+        'min_ms': round(min(timings), 2),
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'mean_ms': round(statistics.mean(timings), 2)
+    }
+
+
+def load_database(db_path, members, transactions):
+    """Open the benchmark database, generating it on first use"""
+    fresh = db_path == ':memory:' or not os.path.exists(db_path)
+    client = LocalSupabase(db_path)
+    if fresh:
+        generate_sacco_data(client, members=members, savings_transactions=transactions)
+    return client
+
+
+def build_scenarios(client, iterations):
+    """Scenarios exercising dashboard, statements, reports, interest run and member lists"""
+    from app import app
+    from routes import saving, transactions
+
+    use_local_supabase(client)
+    app.config['TESTING'] = True
+
+    # Busiest member gives the worst-case statement
+    busiest = client.conn.execute(
+        'SELECT member_id FROM savings_transactions GROUP BY member_id ORDER BY COUNT(*) DESC LIMIT 1'
+    ).fetchone()[0]
+
+    member_client = app.test_client()
+    with member_client.session_transaction() as s:
+        s['member_logged_in'] = True
+        s['member_id'] = busiest
+        s['member_name'] = 'Benchmark Member'
+
+    admin_client = app.test_client()
+    with admin_client.session_transaction() as s:
+        s['admin_logged_in'] = True
+        s['admin_id'] = 'benchmark-admin'
+        s['admin_name'] = 'Benchmark Admin'
+
+    today = datetime.now().date()
+    statement_start = (today - timedelta(days=365)).isoformat()
+
+    def member_dashboard():
+        response = member_client.get('/member/')
+        assert response.status_code == 200
+
+    def member_statements():
+        response = member_client.get(f'/member/statements?start_date={statement_start}&end_date={today.isoformat()}')
+        assert response.status_code == 200
+
+    def financial_report():
+        with app.test_request_context():
+            transactions.calculate_financial_report(date(today.year - 1, 1, 1), today)
+
+    def members_list():
+        response = admin_client.get('/admin/members/members')
+        assert response.status_code == 200
+
+    def interest_run():
+        # Reset so every iteration does the full monthly run
+        if 'last_interest_calculated' in client.columns('savings_accounts'):
+            client.conn.execute('UPDATE savings_accounts SET last_interest_calculated = NULL')
+        with app.test_request_context():
+            saving.calculate_savings_interest()
+
+    return [
+        ('member_dashboard', member_dashboard, iterations),
+        ('member_statements', member_statements, iterations),
+        ('financial_report', financial_report, iterations),
+        ('members_list', members_list, iterations),
+        ('interest_run', interest_run, 1)
+    ]
+
+
+def print_results(results, baseline=None):
+    """Print a results table, with change against a baseline run if given"""
+    baseline_by_name = {r['scenario']: r for r in (baseline or {}).get('results', [])}
+    print(f"\n{'Scenario':<22}{'min':>10}{'median':>10}{'p95':>10}{'mean':>10}{'vs base':>10}")
+    print('-' * 72)
+    for r in results:
+        change = ''
+        base = baseline_by_name.get(r['scenario'])
+        if base and base['median_ms']:
+            change = f"{(r['median_ms'] - base['median_ms']) / base['median_ms'] * 100:+.1f}%"
+        print(f"{r['scenario']:<22}{r['min_ms']:>10}{r['median_ms']:>10}{r['p95_ms']:>10}{r['mean_ms']:>10}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite')
+    parser.add_argument('--db', default='bench.sqlite', help='SQLite file (generated if missing, :memory: for throwaway)')
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--only', nargs='*', help='Run only these scenarios')
+    parser.add_argument('--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='Compare against a previous JSON result')
+    args = parser.parse_args()
+
+    client = load_database(args.db, args.members, args.transactions)
+    scenarios = build_scenarios(client, args.iterations)
+
+    results = []
+    for name, func, iterations in scenarios:
+        if args.only and name not in args.only:
+            continue
+        print(f"🔄 {name}...")
+        results.append(time_scenario(name, func, iterations=iterations, warmup=0 if name == 'interest_run' else 1))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'generated_at': datetime.now().isoformat(),
+                'members': args.members,
+                'transactions': args.transactions,
+                'results': results
+            }, f, indent=2)
+        print(f"\n✅ Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
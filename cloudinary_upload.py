@@ -2,6 +2,13 @@ import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 import os
+import io
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image, ImageOps
 from werkzeug.utils import secure_filename
 import secrets
 from datetime import datetime
@@ -16,18 +23,55 @@ cloudinary.config(
     api_secret=os.getenv('CLOUDINARY_API_SECRET')
 )
 
+# Parallel document uploads
+UPLOAD_WORKERS = int(os.getenv('CLOUDINARY_UPLOAD_WORKERS', '4'))
+UPLOAD_RETRIES = int(os.getenv('CLOUDINARY_UPLOAD_RETRIES', '2'))
+
+# Local resize/re-encode before upload, mirroring get_upload_transformation().
+# 'fill' only scales to cover the box: the final face-gravity crop stays with Cloudinary.
+PREPROCESS_RULES = {
+    'profile_photo': {'size': (400, 400), 'mode': 'fill', 'format': 'WEBP', 'quality': 85},
+    'id_front': {'size': (800, 600), 'mode': 'limit', 'format': 'JPEG', 'quality': 90},
+    'id_back': {'size': (800, 600), 'mode': 'limit', 'format': 'JPEG', 'quality': 90},
+    'signature': {'size': (300, 150), 'mode': 'fit', 'format': 'PNG'}
+}
+DEFAULT_PREPROCESS_RULE = {'size': (800, 800), 'mode': 'limit', 'format': 'JPEG', 'quality': 85}
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+# Recent uploads by content hash, so the same file is not sent twice
+_upload_cache = OrderedDict()
+_upload_cache_lock = threading.Lock()
+UPLOAD_CACHE_SIZE = 500
+HASH_CHUNK_SIZE = 1024 * 1024
+
 def upload_member_document(file, member_id, document_type):
     """
     Upload member document to Cloudinary
+    file can be an uploaded FileStorage, an open file or a path on disk (streamed from disk)
     Returns: dictionary with upload details or None if failed
     """
     try:
-        if not file or file.filename == '':
+        if isinstance(file, str):
+            name = os.path.basename(file)
+        else:
+            name = getattr(file, 'filename', None) or os.path.basename(getattr(file, 'name', '') or '')
+        if not file or not name:
             return None
         
         # Generate unique filename
-        original_filename = secure_filename(file.filename)
+        original_filename = secure_filename(name)
         file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'jpg'
+        
+        # Shrink and strip EXIF locally; identical content is only uploaded once
+        payload, digest, output_extension = preprocess_document(file, document_type)
+        file_extension = output_extension or file_extension
+        cache_key = (digest, member_id, document_type)
+        with _upload_cache_lock:
+            if cache_key in _upload_cache:
+                _upload_cache.move_to_end(cache_key)
+                print(f"✓ Reusing upload of identical {document_type} for member {member_id}")
+                return dict(_upload_cache[cache_key], original_filename=original_filename)
+        
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         unique_filename = f"{document_type}_{member_id}_{timestamp}_{secrets.token_hex(4)}.{file_extension}"
         
@@ -44,7 +88,7 @@ def upload_member_document(file, member_id, document_type):
         
         # Upload to Cloudinary
         result = cloudinary.uploader.upload(
-            file,
+            payload,
             public_id=f"{folder}/{unique_filename}",
             folder=folder,
             overwrite=True,
@@ -66,13 +110,121 @@ def upload_member_document(file, member_id, document_type):
             'document_type': document_type
         }
         
-        print(f"✅ Document uploaded to Cloudinary: {upload_data['secure_url']}")
+        with _upload_cache_lock:
+            _upload_cache[cache_key] = upload_data
+            while len(_upload_cache) > UPLOAD_CACHE_SIZE:
+                _upload_cache.popitem(last=False)
+        
+        print(f"✅ Document uploaded to Cloudinary: {upload_data['secure_url']} ({upload_data['bytes']} bytes)")
         return upload_data
         
     except Exception as e:
         print(f"❌ Cloudinary upload error: {e}")
         return None
 
+def preprocess_document(file, document_type):
+    """
+    Resize and re-encode an image with Pillow using the per-document rules, dropping EXIF data
+    The source is read straight from the file (Pillow decodes it lazily); files left untouched are
+    hashed in chunks and passed on as the original path or file object
+    Returns: (payload, sha256 hex digest, output extension or None if left untouched)
+    """
+    stream = open(file, 'rb') if isinstance(file, str) else file
+    try:
+        return _preprocess_stream(file, stream, document_type)
+    finally:
+        if stream is not file:
+            stream.close()
+
+def _file_sha256(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def _preprocess_stream(file, stream, document_type):
+    stream.seek(0, io.SEEK_END)
+    original_size = stream.tell()
+    stream.seek(0)
+    
+    rule = PREPROCESS_RULES.get(document_type, DEFAULT_PREPROCESS_RULE)
+    try:
+        with Image.open(stream) as image:
+            # Apply the camera orientation before the EXIF block is dropped
+            image = ImageOps.exif_transpose(image)
+            width, height = rule['size']
+            if rule['mode'] == 'fill':
+                scale = max(width / image.width, height / image.height)
+            else:
+                scale = min(width / image.width, height / image.height)
+            if scale < 1:
+                image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                     Image.LANCZOS)
+            
+            if rule['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            elif rule['format'] in ('PNG', 'WEBP') and image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                image = image.convert('RGBA')
+            
+            output = io.BytesIO()
+            save_options = {'optimize': True}
+            if 'quality' in rule:
+                save_options['quality'] = rule['quality']
+            image.save(output, format=rule['format'], **save_options)
+    except Exception as e:
+        # Not an image Pillow can read (e.g. a PDF): upload as-is
+        print(f"⚠️ Skipping preprocessing for {document_type}: {e}")
+        stream.seek(0)
+        digest = _file_sha256(stream)
+        stream.seek(0)
+        return file, digest, None
+    
+    processed = output.getvalue()
+    print(f"✓ {document_type}: {original_size} -> {len(processed)} bytes")
+    return io.BytesIO(processed), hashlib.sha256(processed).hexdigest(), FORMAT_EXTENSIONS[rule['format']]
+
+def upload_member_documents(member_id, documents, max_workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES, progress=None):
+    """
+    Upload several documents for one member concurrently
+    documents: {document_type: filepath}
+    progress: optional callback(done, total, document_type, ok)
+    Returns: {document_type: upload data or None if it failed after retries}
+    """
+    if not documents:
+        return {}
+    
+    def upload_with_retry(document_type, filepath):
+        for attempt in range(retries + 1):
+            result = upload_member_document(filepath, member_id, document_type)
+            if result:
+                return result
+            if attempt < retries:
+                delay = 2 ** attempt
+                print(f"🔄 Retrying {document_type} upload for member {member_id} in {delay}s")
+                time.sleep(delay)
+        return None
+    
+    results = {}
+    total = len(documents)
+    with ThreadPoolExecutor(max_workers=min(max_workers, total)) as executor:
+        futures = {executor.submit(upload_with_retry, document_type, filepath): document_type
+                   for document_type, filepath in documents.items()}
+        for future in as_completed(futures):
+            document_type = futures[future]
+            try:
+                results[document_type] = future.result()
+            except Exception as e:
+                print(f"❌ Upload of {document_type} failed: {e}")
+                results[document_type] = None
+            
+            ok = results[document_type] is not None
+            if progress:
+                progress(len(results), total, document_type, ok)
+            else:
+                print(f"{'✓' if ok else '✗'} {len(results)}/{total} documents uploaded for member {member_id} ({document_type})")
+    
+    return results
+
 def get_upload_transformation(document_type):
     """
     Get appropriate transformations for different document types
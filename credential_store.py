@@ -0,0 +1,177 @@
+#credential_store.py
+# Short-lived credentials (admin OTPs, password reset tokens) with native expiry.
+# Keeps login/OTP traffic off the admins, members and password_resets tables.
+#   CREDENTIAL_STORE_URL unset          -> in-process store (single worker / development)
+#   CREDENTIAL_STORE_URL=sqlite:///path -> file shared by all workers on one host
+#   CREDENTIAL_STORE_URL=redis://...    -> Redis or any Redis-compatible server
+import os
+import json
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OTP_TTL = int(os.getenv('OTP_TTL_SECONDS', '600'))  # 10 minutes
+RESET_TOKEN_TTL = int(os.getenv('RESET_TOKEN_TTL_SECONDS', '3600'))  # 1 hour
+
+
+class MemoryTTLStore:
+    """Dict with per-key expiry; only visible inside one process"""
+    def __init__(self, sweep_every=500):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.sweep_every = sweep_every
+        self.writes = 0
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl)
+            self.writes += 1
+            if self.writes % self.sweep_every == 0:
+                now = time.time()
+                for k in [k for k, (_, expires) in self.data.items() if expires <= now]:
+                    del self.data[k]
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self.data[key]
+                return None
+            return item[0]
+
+    def pop(self, key):
+        """Get and delete in one step, so a credential can only be used once"""
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None or item[1] <= time.time():
+                return None
+            return item[0]
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class SQLiteTTLStore:
+    """Local stand-in for Redis: a SQLite file the pre-forked workers can share"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS credentials (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS credentials_expires_at ON credentials (expires_at)')
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self.connect()
+        conn.execute('INSERT OR REPLACE INTO credentials (key, value, expires_at) VALUES (?, ?, ?)',
+                     (key, json.dumps(value), now + ttl))
+        conn.execute('DELETE FROM credentials WHERE expires_at <= ?', (now,))
+
+    def get(self, key):
+        row = self.connect().execute('SELECT value FROM credentials WHERE key = ? AND expires_at > ?',
+                                     (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop(self, key):
+        """Get and delete in one step, so a credential can only be used once"""
+        row = self.connect().execute('DELETE FROM credentials WHERE key = ? RETURNING value, expires_at',
+                                     (key,)).fetchone()
+        if not row or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def delete(self, key):
+        self.connect().execute('DELETE FROM credentials WHERE key = ?', (key,))
+
+
+class RedisTTLStore:
+    """Redis (or Valkey/KeyDB/...) backend using SET EX / GETDEL"""
+    def __init__(self, url, prefix='sacco:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CREDENTIAL_STORE_URL points at Redis but the 'redis' package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def pop(self, key):
+        """Get and delete in one step, so a credential can only be used once"""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        raw, _ = pipe.execute()
+        return json.loads(raw) if raw is not None else None
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def create_store(url=None):
+    """Build a store from a CREDENTIAL_STORE_URL-style string"""
+    url = url if url is not None else os.getenv('CREDENTIAL_STORE_URL', '')
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisTTLStore(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteTTLStore(url[len('sqlite:///'):])
+    if url and url != 'memory://':
+        raise ValueError(f"Unsupported CREDENTIAL_STORE_URL: {url}")
+    return MemoryTTLStore()
+
+
+credential_store = create_store()
+
+if isinstance(credential_store, MemoryTTLStore) and os.getenv('WEB_WORKERS', '1') not in ('', '1'):
+    print("⚠️ In-process credential store with several workers: OTPs and reset links only work on the worker "
+          "that issued them. Set CREDENTIAL_STORE_URL to sqlite:///... or redis://...")
+
+
+# Key helpers shared by adminauth and memberauth
+def otp_key(admin_id):
+    return f"otp:admin:{admin_id}"
+
+
+def reset_key(kind, token):
+    return f"reset:{kind}:{token}"
+
+
+def test_credential_store():
+    """Self-test for the in-process and SQLite backends"""
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'credentials.sqlite')
+    for store in (MemoryTTLStore(sweep_every=2), SQLiteTTLStore(path)):
+        store.set(otp_key('a1'), '123456', 60)
+        assert store.get(otp_key('a1')) == '123456'
+        store.set(reset_key('admin', 'tok'), {'email': 'a@b.c'}, 60)
+        assert store.pop(reset_key('admin', 'tok')) == {'email': 'a@b.c'}
+        assert store.pop(reset_key('admin', 'tok')) is None
+        store.set('short', 'x', 0.05)
+        time.sleep(0.1)
+        assert store.get('short') is None
+        store.delete(otp_key('a1'))
+        assert store.get(otp_key('a1')) is None
+    print("✅ credential_store self-test passed")
+
+
+if __name__ == "__main__":
+    test_credential_store()
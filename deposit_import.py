@@ -0,0 +1,382 @@
+#deposit_import.py
+# Bulk cash deposits from a CSV or XLSX sheet (account_number, amount and an optional description).
+# The sheet is validated in one pass and its accounts are resolved with one lookup query per
+# DEPOSIT_IMPORT_LOOKUP_CHUNK account numbers. Valid rows are posted through post_savings_batch()
+# in DEPOSIT_IMPORT_BATCH chunks, so each chunk is one balance update per account plus one bulk
+# insert of savings_transactions. Every import is kept in deposit_imports with a per-row result
+# report, and the file hash stops the same sheet being posted twice: uploading it again only
+# retries the rows an earlier, failed or part-way, import did not post.
+import os
+import csv
+import hashlib
+from io import BytesIO, StringIO
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from postgrest.exceptions import APIError
+from dotenv import load_dotenv
+from ledger import post_savings_batch, PostingError
+
+load_dotenv()
+
+DEPOSIT_IMPORT_BATCH = int(os.getenv('DEPOSIT_IMPORT_BATCH', '200'))
+DEPOSIT_IMPORT_LOOKUP_CHUNK = int(os.getenv('DEPOSIT_IMPORT_LOOKUP_CHUNK', '500'))
+DEPOSIT_IMPORT_MAX_ROWS = int(os.getenv('DEPOSIT_IMPORT_MAX_ROWS', '5000'))
+DEPOSIT_IMPORT_MIN_AMOUNT = Decimal(os.getenv('DEPOSIT_IMPORT_MIN_AMOUNT', '1000'))
+
+# Accepted spellings of each column header (compared lower-case, spaces as underscores)
+COLUMN_ALIASES = {
+    'account_number': {'account_number', 'account', 'account_no', 'savings_account', 'acc_no'},
+    'amount': {'amount', 'deposit', 'amount_ugx', 'deposit_amount'},
+    'description': {'description', 'narration', 'notes', 'details'}
+}
+
+REPORT_COLUMNS = ['Row', 'Account Number', 'Member', 'Member Number', 'Amount (UGX)', 'Status', 'Reference',
+                  'Message']
+
+
+class DepositImportError(Exception):
+    """The sheet as a whole can't be imported (unreadable, no rows, already imported, ...)"""
+
+
+def _header_key(value):
+    name = str(value or '').strip().lower().replace(' ', '_').replace('.', '')
+    for key, aliases in COLUMN_ALIASES.items():
+        if name in aliases:
+            return key
+    return None
+
+
+def _cell_text(value):
+    # Spreadsheets hand back numeric account numbers and amounts as floats
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return '' if value is None else str(value).strip()
+
+
+def _read_csv(data):
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    try:
+        dialect = csv.Sniffer().sniff(text[:2048], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(StringIO(text), dialect))
+
+
+def _read_xlsx(data):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise DepositImportError("XLSX import needs the 'openpyxl' package; save the sheet as CSV instead")
+    try:
+        workbook = load_workbook(BytesIO(data), read_only=True, data_only=True)
+    except Exception as e:
+        raise DepositImportError(f'Could not read the XLSX file: {e}')
+    try:
+        return [list(row) for row in workbook.active.iter_rows(values_only=True)]
+    finally:
+        workbook.close()
+
+
+def read_sheet(filename, data):
+    """Rows of the sheet as dicts with account_number, amount, description and the sheet row number"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.xlsx':
+        table = _read_xlsx(data)
+    elif extension in ('.csv', '.txt'):
+        table = _read_csv(data)
+    else:
+        raise DepositImportError('Upload a .csv or .xlsx file')
+
+    if not table:
+        raise DepositImportError('The file is empty')
+    keys = [_header_key(value) for value in table[0]]
+    missing = [key for key in ('account_number', 'amount') if key not in keys]
+    if missing:
+        raise DepositImportError(f"Missing column(s): {', '.join(missing)}")
+
+    rows = []
+    for number, values in enumerate(table[1:], start=2):
+        row = {key: _cell_text(value) for key, value in zip(keys, values) if key}
+        if not any(row.values()):
+            continue
+        row['row'] = number
+        rows.append(row)
+    return rows
+
+
+def validate_rows(client, rows):
+    """Check every row and resolve its account.
+
+    Returns (entries, results): entries are the rows that can be posted, each with its account;
+    results has one dict per row in sheet order, rejected rows already carrying their message.
+    """
+    results = []
+    candidates = []
+    for row in rows:
+        result = {'row': row['row'], 'account_number': row.get('account_number', ''), 'member_name': '',
+                  'member_number': '', 'amount': row.get('amount', ''), 'status': 'rejected', 'reference': '',
+                  'message': ''}
+        results.append(result)
+        if not result['account_number']:
+            result['message'] = 'Account number is missing'
+            continue
+        try:
+            amount = Decimal(result['amount'].replace(',', '').replace('UGX', '').strip())
+        except InvalidOperation:
+            result['message'] = 'Amount is not a number'
+            continue
+        if not amount.is_finite():
+            result['message'] = 'Amount is not a number'
+            continue
+        if amount.as_tuple().exponent < -2:
+            result['message'] = 'Amount has more than 2 decimal places'
+            continue
+        if amount < DEPOSIT_IMPORT_MIN_AMOUNT:
+            result['message'] = f'Amount is below the minimum deposit of UGX {DEPOSIT_IMPORT_MIN_AMOUNT:,.0f}'
+            continue
+        result['amount'] = str(amount)
+        candidates.append((result, amount, row.get('description', '')))
+
+    numbers = list(dict.fromkeys(result['account_number'] for result, _, _ in candidates))
+    accounts = {}
+    for i in range(0, len(numbers), DEPOSIT_IMPORT_LOOKUP_CHUNK):
+        response = client.table('savings_accounts')\
+            .select('id, account_number, member_id, status, members(full_name, member_number)')\
+            .in_('account_number', numbers[i:i + DEPOSIT_IMPORT_LOOKUP_CHUNK])\
+            .execute()
+        for account in response.data or []:
+            accounts[account['account_number']] = account
+
+    entries = []
+    for result, amount, description in candidates:
+        account = accounts.get(result['account_number'])
+        if not account:
+            result['message'] = 'Savings account not found'
+            continue
+        member = account.get('members') or {}
+        result['member_name'] = member.get('full_name') or ''
+        result['member_number'] = member.get('member_number') or ''
+        if account.get('status') != 'active':
+            result['message'] = f"Savings account is {account.get('status') or 'not active'}"
+            continue
+        result['status'] = 'pending'
+        entries.append({'result': result, 'account': account, 'amount': amount, 'description': description})
+    return entries, results
+
+
+def _resume_import(client, previous):
+    """Claim an earlier import of the same sheet for a retry of its unposted rows.
+
+    Returns the results it already posted, keyed by sheet row number.
+    """
+    if previous['status'] == 'processing':
+        raise DepositImportError('This file is already being imported')
+    results = previous.get('results') or []
+    posted = {result['row']: result for result in results if result['status'] == 'posted'}
+    if previous['status'] == 'completed' and not any(result['status'] == 'failed' for result in results):
+        raise DepositImportError(f"This file was already imported on {previous['created_at'][:16].replace('T', ' ')}")
+    # Conditional on the status read above, so two tellers retrying at once can't both post
+    claimed = client.table('deposit_imports')\
+        .update({'status': 'processing', 'completed_at': None})\
+        .eq('id', previous['id'])\
+        .eq('status', previous['status'])\
+        .execute()
+    if not claimed.data:
+        raise DepositImportError('This file is already being imported')
+    return posted
+
+
+def import_deposits(client, filename, data, imported_by=None, description=''):
+    """Validate and post a deposit sheet; returns the deposit_imports row (with results).
+
+    A sheet whose earlier import failed or left rows unposted is retried in place: rows it
+    already posted are kept as they are and only the others are validated and posted again.
+    The returned row also carries posted_this_run, the results posted by this call.
+    """
+    rows = read_sheet(filename, data)
+    if not rows:
+        raise DepositImportError('The file has no deposit rows')
+    if len(rows) > DEPOSIT_IMPORT_MAX_ROWS:
+        raise DepositImportError(f'The file has {len(rows):,} rows; split it into files of at most '
+                                 f'{DEPOSIT_IMPORT_MAX_ROWS:,} rows')
+
+    file_hash = hashlib.sha256(data).hexdigest()
+    existing = client.table('deposit_imports')\
+        .select('id, status, created_at, results')\
+        .eq('file_hash', file_hash)\
+        .limit(1)\
+        .execute()
+    if existing.data:
+        record = existing.data[0]
+        already_posted = _resume_import(client, record)
+    else:
+        already_posted = {}
+        try:
+            record = client.table('deposit_imports').insert({
+                'filename': filename,
+                'file_hash': file_hash,
+                'status': 'processing',
+                'total_rows': len(rows),
+                'imported_by': imported_by
+            }).execute().data[0]
+        except APIError as e:
+            # Unique file_hash: another teller uploaded the same sheet at the same moment
+            if e.code == '23505':
+                raise DepositImportError('This file is already being imported')
+            raise
+
+    status = 'failed'
+    try:
+        entries, results = validate_rows(client, [row for row in rows if row['row'] not in already_posted])
+    except Exception:
+        client.table('deposit_imports').update({'status': status}).eq('id', record['id']).execute()
+        raise
+    results = sorted(results + list(already_posted.values()), key=lambda result: result['row'])
+
+    reference_prefix = f"DEP{datetime.now().strftime('%Y%m%d')}{record['id'][:6].upper()}"
+    try:
+        for i in range(0, len(entries), DEPOSIT_IMPORT_BATCH):
+            chunk = entries[i:i + DEPOSIT_IMPORT_BATCH]
+            now = datetime.now().isoformat()
+            for entry in chunk:
+                entry['result']['reference'] = f"{reference_prefix}{entry['result']['row']:05d}"
+            try:
+                post_savings_batch(client, [{
+                    'savings_account_id': entry['account']['id'],
+                    'amount': entry['amount'],
+                    'transaction': {
+                        'member_id': entry['account']['member_id'],
+                        'transaction_type': 'deposit',
+                        'currency': 'UGX',
+                        'payment_method': 'cash',
+                        'reference_number': entry['result']['reference'],
+                        'description': entry['description'] or description or 'Bulk cash deposit',
+                        'processed_by': imported_by,
+                        'status': 'completed',
+                        'created_at': now
+                    }
+                } for entry in chunk])
+            except PostingError as e:
+                # e.g. an account closed since the lookup; the rest of the sheet still goes through
+                for entry in chunk:
+                    entry['result'].update({'status': 'failed', 'reference': '', 'message': str(e)})
+                continue
+            for entry in chunk:
+                entry['result']['status'] = 'posted'
+        status = 'completed'
+    finally:
+        for result in results:
+            if result['status'] == 'pending':
+                result.update({'status': 'failed', 'reference': '', 'message': 'Not posted (import stopped)'})
+        posted = [result for result in results if result['status'] == 'posted']
+        record = client.table('deposit_imports').update({
+            'status': status,
+            'posted_rows': len(posted),
+            'rejected_rows': len(results) - len(posted),
+            'total_amount': str(sum((Decimal(result['amount']) for result in posted), Decimal('0'))),
+            'results': results,
+            'completed_at': datetime.now().isoformat()
+        }).eq('id', record['id']).execute().data[0]
+    record['posted_this_run'] = [entry['result'] for entry in entries if entry['result']['status'] == 'posted']
+    return record
+
+
+def report_csv(record):
+    """The per-row results of an import as CSV text"""
+    si = StringIO()
+    cw = csv.writer(si)
+    cw.writerow(REPORT_COLUMNS)
+    for result in record.get('results') or []:
+        cw.writerow([result['row'], result['account_number'], result['member_name'], result['member_number'],
+                     result['amount'], result['status'], result['reference'], result['message']])
+    return si.getvalue()
+
+
+def test_deposit_import():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=50, savings_transactions=200)
+    accounts = client.table('savings_accounts').select('id, account_number, current_balance')\
+        .eq('status', 'active').limit(3).execute().data
+    client.table('savings_accounts').update({'status': 'dormant'}).eq('id', accounts[2]['id']).execute()
+
+    sheet = '\n'.join([
+        'Account Number,Amount,Description',
+        f"{accounts[0]['account_number']},\"50,000\",Market day",
+        f"{accounts[1]['account_number']},20000,",
+        f"{accounts[0]['account_number']},15000,Second deposit",
+        ',,',
+        'SAV-NOPE,10000,',
+        f"{accounts[1]['account_number']},abc,",
+        f"{accounts[1]['account_number']},500,",
+        f"{accounts[2]['account_number']},10000,",
+        f"{accounts[1]['account_number']},NaN,",
+        f"{accounts[1]['account_number']},1000.505,"
+    ]).encode()
+    record = import_deposits(client, 'market_day.csv', sheet, imported_by='adm-1')
+    assert record['status'] == 'completed' and record['total_rows'] == 9, record
+    assert record['posted_rows'] == 3 and Decimal(str(record['total_amount'])) == 85000
+    messages = {result['row']: result['message'] for result in record['results'] if result['status'] != 'posted'}
+    assert messages == {6: 'Savings account not found', 7: 'Amount is not a number',
+                        8: 'Amount is below the minimum deposit of UGX 1,000',
+                        9: 'Savings account is dormant', 10: 'Amount is not a number',
+                        11: 'Amount has more than 2 decimal places'}, messages
+
+    after = client.table('savings_accounts').select('current_balance').eq('id', accounts[0]['id']).execute().data[0]
+    assert Decimal(str(after['current_balance'])) - Decimal(str(accounts[0]['current_balance'])) == 65000
+    posted = client.table('savings_transactions').select('reference_number, balance_after')\
+        .eq('savings_account_id', accounts[0]['id']).eq('description', 'Second deposit').execute().data
+    assert len(posted) == 1 and Decimal(str(posted[0]['balance_after'])) == Decimal(str(after['current_balance']))
+
+    try:
+        import_deposits(client, 'market_day_copy.csv', sheet)
+        assert False, 'same sheet imported twice'
+    except DepositImportError:
+        pass
+    try:
+        import_deposits(client, 'bad.csv', b'member,amount\nx,1000\n')
+        assert False, 'sheet without account_number accepted'
+    except DepositImportError as e:
+        assert 'account_number' in str(e)
+    report = report_csv(record).splitlines()
+    assert len(report) == 10 and report[0].startswith('Row,Account Number')
+
+    # A chunk that fails to post is retried by uploading the same sheet again
+    global post_savings_batch
+    real_post_savings_batch = post_savings_batch
+    calls = []
+
+    def flaky_post_savings_batch(client, entries):
+        calls.append(len(entries))
+        if len(calls) == 1:
+            raise PostingError('Savings account is locked')
+        return real_post_savings_batch(client, entries)
+
+    retry_sheet = '\n'.join([
+        'account,amount',
+        *[f"{accounts[i % 2]['account_number']},{1000 * (i + 1)}" for i in range(DEPOSIT_IMPORT_BATCH + 2)]
+    ]).encode()
+    post_savings_batch = flaky_post_savings_batch
+    try:
+        record = import_deposits(client, 'retry.csv', retry_sheet)
+        assert record['status'] == 'completed' and record['posted_rows'] == 2, record['posted_rows']
+        retried = import_deposits(client, 'retry.csv', retry_sheet)
+    finally:
+        post_savings_batch = real_post_savings_batch
+    assert retried['id'] == record['id'] and retried['posted_rows'] == DEPOSIT_IMPORT_BATCH + 2
+    assert len(retried['posted_this_run']) == DEPOSIT_IMPORT_BATCH and calls[-1] == DEPOSIT_IMPORT_BATCH
+    assert [result['row'] for result in retried['results']] == list(range(2, DEPOSIT_IMPORT_BATCH + 4))
+    try:
+        import_deposits(client, 'retry.csv', retry_sheet)
+        assert False, 'fully posted sheet imported again'
+    except DepositImportError as e:
+        assert 'already imported' in str(e)
+    print("✅ deposit_import self-test passed")
+
+
+if __name__ == "__main__":
+    test_deposit_import()
@@ -0,0 +1,209 @@
+#dividends.py
+# Dividend declarations: allocate a pool to every shareholder and pay it in bulk.
+# compute_dividend() in supabase_functions.sql rebuilds holdings from share_transactions and
+# allocates the whole pool in one set-based statement (pro rata on the period end, or weighted by
+# the average daily holding over the period); post_dividend() pays it as savings credits (one
+# balance update per account) or whole-share top-ups. Posting is claimed on the declaration's
+# status, so each declaration is paid once. Cash for members without a savings account is held
+# as 'no_account' and paid with pay_dividend_remainders() once they have one.
+#   python dividends.py --members 20000 --transactions 5000   -> timing for an annual run
+import time
+import argparse
+from datetime import date
+from decimal import Decimal
+from postgrest.exceptions import APIError
+
+DIVIDEND_METHODS = {'pro_rata': 'Pro rata (holding at period end)',
+                    'time_weighted': 'Time weighted (average holding over the period)'}
+DIVIDEND_PAYOUTS = {'savings': 'Credit to savings', 'shares': 'Top up shares (remainder to savings)'}
+
+
+class DividendError(Exception):
+    """Declaration refused by the database (not found, already posted, no share price, ...)"""
+
+
+def _call(client, function, params):
+    try:
+        result = client.rpc(function, params).execute().data
+    except APIError as e:
+        if e.code == 'P0001':
+            raise DividendError(e.message)
+        raise
+    return result[0] if isinstance(result, list) else result
+
+
+def declare_dividend(client, title, period_start, period_end, total_amount, method='time_weighted',
+                     payout='savings', declared_by=None):
+    """Create a draft declaration; returns the new row"""
+    total_amount = Decimal(str(total_amount))
+    if method not in DIVIDEND_METHODS or payout not in DIVIDEND_PAYOUTS:
+        raise DividendError('Unknown dividend method or payout')
+    if total_amount <= 0:
+        raise DividendError('Dividend amount must be greater than zero')
+    if str(period_end) < str(period_start):
+        raise DividendError('Period end must be on or after period start')
+    response = client.table('dividend_declarations').insert({
+        'title': title,
+        'period_start': str(period_start),
+        'period_end': str(period_end),
+        'total_amount': str(total_amount),
+        'method': method,
+        'payout': payout,
+        'status': 'draft',
+        'declared_by': declared_by
+    }).execute()
+    return response.data[0]
+
+
+def compute_dividend(client, declaration_id):
+    """(Re)allocate the pool; returns the updated declaration with shareholders and allocated_amount"""
+    return _call(client, 'compute_dividend', {'p_declaration_id': declaration_id})
+
+
+def post_dividend(client, declaration_id, posted_by=None):
+    """Pay a computed declaration; raises DividendError if it was already posted"""
+    return _call(client, 'post_dividend', {'p_declaration_id': declaration_id, 'p_posted_by': posted_by})
+
+
+def pay_dividend_remainders(client, declaration_id, paid_by=None):
+    """Pay held-back cash of a posted declaration to members who have opened a savings account since"""
+    return _call(client, 'pay_dividend_remainders', {'p_declaration_id': declaration_id, 'p_paid_by': paid_by})
+
+
+def unpaid_remainders(client, declaration_id):
+    """Number of allocations whose cash is waiting for a savings account"""
+    response = client.table('dividend_allocations')\
+        .select('id', count='exact')\
+        .eq('declaration_id', declaration_id)\
+        .eq('status', 'no_account')\
+        .limit(1)\
+        .execute()
+    return response.count or 0
+
+
+def share_award_members(client, declaration_id, page_size=1000):
+    """Ids of members who were awarded shares by a declaration, read page by page"""
+    offset = 0
+    while True:
+        rows = client.table('dividend_allocations')\
+            .select('member_id')\
+            .eq('declaration_id', declaration_id)\
+            .gt('shares_awarded', 0)\
+            .order('member_id')\
+            .range(offset, offset + page_size - 1)\
+            .execute().data or []
+        for row in rows:
+            yield row['member_id']
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def dividend_allocations(client, declaration_id, page=1, per_page=50):
+    """One page of allocations, largest first, and the total number of allocations"""
+    from_index = (page - 1) * per_page
+    response = client.table('dividend_allocations')\
+        .select('member_id, weight, amount, shares_awarded, cash_amount, status, members(full_name, member_number)',
+                count='exact')\
+        .eq('declaration_id', declaration_id)\
+        .order('amount', desc=True)\
+        .range(from_index, from_index + per_page - 1)\
+        .execute()
+    return response.data or [], response.count or 0
+
+
+def test_dividends(members=500, transactions=2000, verbose=False):
+    """Self-test against the local stand-in; returns compute and post timings"""
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=members, savings_transactions=transactions)
+    year_start, year_end = date(date.today().year - 1, 1, 1), date(date.today().year - 1, 12, 31)
+
+    # Time-weighted: a member who bought mid-year earns about half of one who held all year
+    holders = client.table('members').select('id').limit(2).execute().data
+    client.table('share_transactions').delete().in_('member_id', [m['id'] for m in holders]).execute()
+    for holder in holders:
+        client.table('members').update({'shares_owned': 100}).eq('id', holder['id']).execute()
+    client.insert_rows('share_transactions', [{
+        'member_id': holders[1]['id'], 'shares': 100, 'price_per_share': 1000.0, 'transaction_type': 'purchase',
+        'transaction_date': date(year_start.year, 7, 2).isoformat()
+    }])
+
+    declaration = declare_dividend(client, 'Test dividend', year_start, year_end, members * 20000)
+    start = time.perf_counter()
+    computed = compute_dividend(client, declaration['id'])
+    compute_seconds = time.perf_counter() - start
+    assert computed['status'] == 'computed' and Decimal(str(computed['allocated_amount'])) <= members * 20000
+    allocations, total = dividend_allocations(client, declaration['id'], per_page=members)
+    assert total == computed['shareholders'] and total > 0
+    amounts = {a['member_id']: Decimal(str(a['amount'])) for a in allocations}
+    ratio = amounts[holders[1]['id']] / amounts[holders[0]['id']]
+    assert Decimal('0.45') < ratio < Decimal('0.55'), ratio
+
+    account = client.table('savings_accounts').select('id, current_balance')\
+        .eq('member_id', holders[0]['id']).execute().data[0]
+    start = time.perf_counter()
+    posted = post_dividend(client, declaration['id'], 'adm-1')
+    post_seconds = time.perf_counter() - start
+    assert posted['savings_credits'] == total
+    after = client.table('savings_accounts').select('current_balance').eq('id', account['id']).execute().data[0]
+    assert Decimal(str(after['current_balance'])) - Decimal(str(account['current_balance'])) == amounts[holders[0]['id']]
+    try:
+        post_dividend(client, declaration['id'], 'adm-1')
+        assert False, 'dividend paid twice'
+    except DividendError:
+        pass
+
+    # Share top-ups: whole shares at the period-end price, remainder to savings
+    declaration = declare_dividend(client, 'Bonus shares', year_start, year_end, members * 20000, 'pro_rata',
+                                   'shares')
+    computed = compute_dividend(client, declaration['id'])
+    before = client.table('members').select('shares_owned').eq('id', holders[0]['id']).execute().data[0]
+    post_dividend(client, declaration['id'])
+    allocation = client.table('dividend_allocations').select('shares_awarded, cash_amount, amount')\
+        .eq('declaration_id', declaration['id']).eq('member_id', holders[0]['id']).execute().data[0]
+    price = Decimal(str(computed['share_price']))
+    assert Decimal(str(allocation['cash_amount'])) < price
+    after = client.table('members').select('shares_owned').eq('id', holders[0]['id']).execute().data[0]
+    assert after['shares_owned'] - before['shares_owned'] == allocation['shares_awarded'] > 0
+    assert holders[0]['id'] in set(share_award_members(client, declaration['id'], page_size=7))
+
+    # No savings account: the shares are still awarded, the cash waits until an account exists
+    client.table('savings_accounts').delete().eq('member_id', holders[1]['id']).execute()
+    declaration = declare_dividend(client, 'More shares', year_start, year_end, members * 20000 + 333, 'pro_rata',
+                                   'shares')
+    compute_dividend(client, declaration['id'])
+    before = client.table('members').select('shares_owned').eq('id', holders[1]['id']).execute().data[0]
+    posted = post_dividend(client, declaration['id'])
+    allocation = client.table('dividend_allocations').select('shares_awarded, cash_amount, status')\
+        .eq('declaration_id', declaration['id']).eq('member_id', holders[1]['id']).execute().data[0]
+    after = client.table('members').select('shares_owned').eq('id', holders[1]['id']).execute().data[0]
+    assert after['shares_owned'] - before['shares_owned'] == allocation['shares_awarded'] > 0
+    assert allocation['status'] == 'no_account' and Decimal(str(allocation['cash_amount'])) > 0
+    assert posted['unpaid_remainders'] == unpaid_remainders(client, declaration['id']) >= 1
+    client.insert_rows('savings_accounts', [{'member_id': holders[1]['id'], 'current_balance': 0.0,
+                                             'available_balance': 0.0}])
+    paid = pay_dividend_remainders(client, declaration['id'])
+    assert paid['savings_credits'] >= 1 and unpaid_remainders(client, declaration['id']) == 0
+    credited = client.table('savings_accounts').select('current_balance')\
+        .eq('member_id', holders[1]['id']).execute().data[0]
+    assert Decimal(str(credited['current_balance'])) == Decimal(str(allocation['cash_amount']))
+    references = [t['reference_number'] for t in client.table('savings_transactions').select('reference_number')
+                  .eq('transaction_type', 'dividend').execute().data]
+    assert len(references) == len(set(references))
+    if verbose:
+        print(f"{members:,} members: compute {compute_seconds * 1000:.0f} ms, post {post_seconds * 1000:.0f} ms")
+    print("✅ dividends self-test passed")
+    return compute_seconds, post_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dividend engine self-test and timing')
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--transactions', type=int, default=2000)
+    args = parser.parse_args()
+    test_dividends(args.members, args.transactions, verbose=True)
+
+
+if __name__ == "__main__":
+    main()
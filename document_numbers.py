@@ -0,0 +1,125 @@
+#document_numbers.py
+# Expense/income numbers (EXP-YYYYMM-NNNN, INC-YYYYMMDD-NNN) handed out from blocks reserved
+# in the document_counters table (reserve_document_numbers() in supabase_functions.sql).
+# One RPC reserves DOCUMENT_NUMBER_BLOCK numbers; the rest come from memory with no queries.
+# Numbers left in a block when a worker stops are skipped, so sequences can have gaps.
+import os
+import time
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DOCUMENT_NUMBER_BLOCK = int(os.getenv('DOCUMENT_NUMBER_BLOCK', '20'))
+DOCUMENT_NUMBER_RETRIES = int(os.getenv('DOCUMENT_NUMBER_RETRIES', '2'))
+
+
+class DocumentNumberAllocator:
+    """Per-process blocks of counter values, one block per scope (e.g. EXP-202501)"""
+    def __init__(self, block_size=DOCUMENT_NUMBER_BLOCK):
+        self.block_size = block_size
+        self.blocks = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def reserve(self, client, scope, count, retries=DOCUMENT_NUMBER_RETRIES):
+        """Reserve count values in the database; returns the first one.
+        Transient RPC errors are retried; after that the error is raised (there is no other numbering scheme)."""
+        for attempt in range(retries + 1):
+            try:
+                response = client.rpc('reserve_document_numbers', {'p_scope': scope, 'p_count': count}).execute()
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"Reserving {scope} numbers failed, retrying: {e}")
+                time.sleep(0.2 * 2 ** attempt)
+        last_value = response.data
+        if isinstance(last_value, list):
+            last_value = last_value[0] if last_value else None
+        if isinstance(last_value, dict):
+            last_value = next(iter(last_value.values()))
+        if last_value is None:
+            raise RuntimeError(f"reserve_document_numbers returned nothing for {scope}")
+        return int(last_value) - count + 1
+
+    def allocate(self, client, scope, count=1):
+        """Next count values for scope, reserving a new block only when the current one runs out"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # Blocks must not be shared with a forked parent
+                self.blocks = {}
+                self.pid = os.getpid()
+
+            values = []
+            while len(values) < count:
+                block = self.blocks.get(scope)
+                if not block or block[0] > block[1]:
+                    # Old scopes (last month/day) are never needed again
+                    self.blocks = {s: b for s, b in self.blocks.items() if s[:3] != scope[:3]}
+                    size = max(self.block_size, count - len(values))
+                    first = self.reserve(client, scope, size)
+                    block = self.blocks[scope] = [first, first + size - 1]
+                take = min(count - len(values), block[1] - block[0] + 1)
+                values.extend(range(block[0], block[0] + take))
+                block[0] += take
+            return values
+
+
+allocator = DocumentNumberAllocator()
+
+
+def next_expense_numbers(client, count=1, when=None):
+    """count expense numbers for the month of `when` (default now)"""
+    scope = f"EXP-{(when or datetime.now()).strftime('%Y%m')}"
+    return [f"{scope}-{value:04d}" for value in allocator.allocate(client, scope, count)]
+
+
+def next_income_numbers(client, count=1, when=None):
+    """count income numbers for the day of `when` (default now)"""
+    scope = f"INC-{(when or datetime.now()).strftime('%Y%m%d')}"
+    return [f"{scope}-{value:03d}" for value in allocator.allocate(client, scope, count)]
+
+
+def test_document_numbers():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase
+    client = LocalSupabase()
+    calls = []
+    handler = client.rpc_functions['reserve_document_numbers']
+    client.register_rpc('reserve_document_numbers', lambda c, **p: calls.append(p) or handler(c, **p))
+
+    test_allocator = DocumentNumberAllocator(block_size=5)
+    when = datetime(2025, 1, 15)
+    numbers = [f"EXP-202501-{v:04d}" for v in test_allocator.allocate(client, 'EXP-202501', 7)]
+    assert numbers[0] == 'EXP-202501-0001' and numbers[-1] == 'EXP-202501-0007'
+    assert len(calls) == 1  # bulk request reserves one block big enough
+    assert test_allocator.allocate(client, 'EXP-202501')[0] == 8
+    assert [test_allocator.allocate(client, 'EXP-202501')[0] for _ in range(4)] == [9, 10, 11, 12]
+    assert len(calls) == 2  # 8-12 came from a single block
+
+    # A second worker gets its own block, never a duplicate
+    other = DocumentNumberAllocator(block_size=5)
+    assert other.allocate(client, 'EXP-202501')[0] == 13
+    assert next_income_numbers(client, 2, when) == ['INC-20250115-001', 'INC-20250115-002']
+
+    # A transient failure is retried; a persistent one is raised
+    failures = [RuntimeError('connection reset')]
+    def flaky(c, **p):
+        if failures:
+            raise failures.pop()
+        return handler(c, **p)
+    client.register_rpc('reserve_document_numbers', flaky)
+    assert DocumentNumberAllocator().allocate(client, 'EXP-202502')[0] == 1
+    client.register_rpc('reserve_document_numbers', lambda c, **p: 1 / 0)
+    try:
+        DocumentNumberAllocator().reserve(client, 'EXP-202503', 1, retries=1)
+        raise AssertionError('reservation error swallowed')
+    except ZeroDivisionError:
+        pass
+    print("✅ document_numbers self-test passed")
+
+
+if __name__ == "__main__":
+    test_document_numbers()
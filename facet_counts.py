@@ -0,0 +1,114 @@
+#facet_counts.py
+# Per-status counts for the admin list pages (loan applications, loan repayments, members),
+# under the page's current search. status_facets() in supabase_functions.sql answers with one
+# GROUP BY, so the filter badges are accurate without transferring any rows. Results are cached
+# per process for a few seconds, keyed by list and search text.
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FACET_TTL = int(os.getenv('FACET_TTL_SECONDS', '15'))
+FACET_CACHE_SIZE = int(os.getenv('FACET_CACHE_SIZE', '500'))
+
+# Statuses shown as filter badges, in display order (lists known to status_facets())
+FACET_STATUSES = {
+    'loan_applications': ['pending', 'approved', 'rejected', 'disbursed'],
+    'loan_repayments': ['pending', 'partial', 'paid', 'overdue'],
+    'members': ['active', 'pending', 'suspended', 'terminated']
+}
+
+
+class FacetCounter:
+    """Short-lived cache of status_facets() results"""
+    def __init__(self, ttl=FACET_TTL, capacity=FACET_CACHE_SIZE):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, client, list_name, search):
+        response = client.rpc('status_facets', {'p_list': list_name, 'p_search': search or None}).execute()
+        counts = response.data
+        if isinstance(counts, list):
+            counts = counts[0] if counts else {}
+        return {status: int(count) for status, count in (counts or {}).items()}
+
+    def counts(self, client, list_name, search=''):
+        """{status: count} for a list page; every status in FACET_STATUSES is present"""
+        key = (list_name, (search or '').strip().lower())
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > now:
+                self.cache.move_to_end(key)
+                return entry[1]
+
+        counts = dict.fromkeys(FACET_STATUSES.get(list_name, []), 0)
+        counts.update(self.load(client, list_name, key[1]))
+        with self.lock:
+            self.cache[key] = (now + self.ttl, counts)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return counts
+
+    def invalidate(self, list_name=None):
+        with self.lock:
+            if list_name is None:
+                self.cache.clear()
+            else:
+                for key in [k for k in self.cache if k[0] == list_name]:
+                    del self.cache[key]
+
+
+facet_counter = FacetCounter()
+
+
+def status_counts(client, list_name, search=''):
+    """Cached status counts; an empty dict if they can't be loaded, so list pages still render"""
+    try:
+        return facet_counter.counts(client, list_name, search)
+    except Exception as e:
+        print(f"Error loading {list_name} status counts: {e}")
+        return {}
+
+
+def test_facet_counts():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=60, savings_transactions=100)
+    calls = []
+    handler = client.rpc_functions['status_facets']
+    client.register_rpc('status_facets', lambda c, **p: calls.append(p) or handler(c, **p))
+
+    counter = FacetCounter(ttl=0.5)
+    applications = client.table('loan_applications').select('status').execute().data
+    counts = counter.counts(client, 'loan_applications')
+    assert sum(counts.values()) == len(applications)
+    assert counts['pending'] == sum(1 for a in applications if a['status'] == 'pending')
+
+    # Search narrows the counts the same way the list query does
+    member = client.table('members').select('id, full_name, member_number').limit(1).execute().data[0]
+    counts = counter.counts(client, 'members', member['member_number'])
+    assert sum(counts.values()) == 1, counts
+    repayments = client.table('loan_repayments').select('id').eq('member_id', member['id']).execute().data
+    counts = counter.counts(client, 'loan_repayments', member['full_name'].upper())
+    assert sum(counts.values()) >= len(repayments)
+
+    # Cached until the TTL runs out
+    calls.clear()
+    counter.counts(client, 'loan_applications')
+    assert not calls
+    time.sleep(0.6)
+    counter.counts(client, 'loan_applications')
+    assert len(calls) == 1
+    print("✅ facet_counts self-test passed")
+
+
+if __name__ == "__main__":
+    test_facet_counts()
@@ -0,0 +1,209 @@
+#kpi_service.py
+# Counters for the admin overview (members, loans, repayments, savings, shares, expenses).
+# admin_kpis() in supabase_functions.sql computes them with one grouped query per table in a single
+# round-trip. Results are cached per process with short TTLs and refreshed by a background thread
+# shortly before they expire, so the overview renders from memory while someone is watching it.
+import os
+import time
+import threading
+from decimal import Decimal
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+
+KPI_TTL = int(os.getenv('KPI_TTL_SECONDS', '60'))
+KPI_ACTIVITY_TTL = int(os.getenv('KPI_ACTIVITY_TTL_SECONDS', '30'))
+# Groups nobody has looked at for this long are no longer refreshed in the background
+KPI_IDLE_AFTER = int(os.getenv('KPI_IDLE_AFTER_SECONDS', '600'))
+
+MONEY_KPIS = {'total_loan_amount', 'total_due', 'total_paid', 'today_income', 'month_income',
+              'last_month_income', 'total_savings', 'month_expenses'}
+
+
+def calculate_percentage_change(current, previous):
+    """Calculate percentage change"""
+    if previous == 0:
+        return 100 if current > 0 else 0
+    return ((current - previous) / previous) * 100
+
+
+class KPIService:
+    """Cached dashboard counters with background refresh"""
+    def __init__(self, ttls=None):
+        self.ttls = ttls or {'counters': KPI_TTL, 'activity': KPI_ACTIVITY_TTL}
+        self.loaders = {'counters': self.load_counters, 'activity': self.load_activity}
+        self.cache = {}
+        self.last_access = {}
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.client = None
+        self.refresher_pid = None
+
+    # Loaders
+    def load_counters(self):
+        today = datetime.now().date()
+        month_start = today.replace(day=1)
+        last_month_start = (month_start - timedelta(days=1)).replace(day=1)
+        response = self.client.rpc('admin_kpis', {
+            'p_today': today.isoformat(),
+            'p_month_start': month_start.isoformat(),
+            'p_last_month_start': last_month_start.isoformat()
+        }).execute()
+        raw = response.data[0] if isinstance(response.data, list) else response.data
+
+        kpis = {key: Decimal(str(value or 0)) if key in MONEY_KPIS else int(value or 0) for key, value in raw.items()}
+        kpis['repayment_rate'] = float(kpis['total_paid'] / kpis['total_due'] * 100) if kpis['total_due'] > 0 else 0
+        kpis['net_profit'] = kpis['month_income'] - kpis['month_expenses']
+        kpis['income_growth'] = calculate_percentage_change(float(kpis['month_income']), float(kpis['last_month_income']))
+        kpis['member_growth'] = calculate_percentage_change(kpis['new_members_this_month'], kpis['new_members_last_month'])
+        return kpis
+
+    def load_activity(self):
+        today = datetime.now().date()
+        recent_members = self.client.table('members')\
+            .select('id, full_name, member_number, created_at')\
+            .order('created_at', desc=True)\
+            .limit(5)\
+            .execute()
+        recent_loans = self.client.table('loan_applications')\
+            .select('id, account_number, loan_amount, status, created_at, members(full_name)')\
+            .order('created_at', desc=True)\
+            .limit(5)\
+            .execute()
+        recent_repayments = self.client.table('loan_repayments')\
+            .select('id, due_amount, paid_amount, status, paid_date, members(full_name)')\
+            .in_('status', ['paid', 'partial'])\
+            .order('paid_date', desc=True)\
+            .limit(5)\
+            .execute()
+        upcoming_due = self.client.table('loan_repayments')\
+            .select('id, due_date, due_amount, members(full_name, member_number)')\
+            .gte('due_date', today.isoformat())\
+            .lte('due_date', (today + timedelta(days=7)).isoformat())\
+            .eq('status', 'pending')\
+            .order('due_date')\
+            .limit(10)\
+            .execute()
+        return {
+            'recent_members': recent_members.data or [],
+            'recent_loans': recent_loans.data or [],
+            'recent_repayments': recent_repayments.data or [],
+            'upcoming_due': upcoming_due.data or []
+        }
+
+    # Cache
+    def refresh(self, name):
+        value = self.loaders[name]()
+        now = time.time()
+        entry = {'value': value, 'loaded_at': now, 'expires_at': now + self.ttls[name]}
+        with self.lock:
+            self.cache[name] = entry
+            self.refreshing.discard(name)
+        return entry
+
+    def get_entry(self, client, name):
+        """Cache entry (value, loaded_at, expires_at) for a group; stale entries are served while a
+        refresh runs in the background"""
+        self.client = client
+        self.start_refresher()
+        now = time.time()
+        self.last_access[name] = now
+        entry = self.cache.get(name)
+        if entry is None:
+            return self.refresh(name)
+        if entry['expires_at'] <= now:
+            self.refresh_async(name)
+        return entry
+
+    def get(self, client, name):
+        """Cached group value"""
+        return self.get_entry(client, name)['value']
+
+    def refresh_async(self, name):
+        with self.lock:
+            if name in self.refreshing:
+                return
+            self.refreshing.add(name)
+        threading.Thread(target=self.refresh_quietly, args=(name,), daemon=True).start()
+
+    def refresh_quietly(self, name):
+        try:
+            self.refresh(name)
+        except Exception as e:
+            with self.lock:
+                self.refreshing.discard(name)
+            print(f"Error refreshing {name} KPIs: {e}")
+
+    def refresher(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            for name, entry in list(self.cache.items()):
+                if now - self.last_access.get(name, 0) > KPI_IDLE_AFTER:
+                    continue
+                # Refresh in the last fifth of the TTL so viewers never wait for a query
+                if entry['expires_at'] - now < self.ttls[name] / 5:
+                    self.refresh_async(name)
+
+    def start_refresher(self):
+        """Start the background refresher once per process (again after a fork)"""
+        if self.refresher_pid != os.getpid():
+            with self.lock:
+                if self.refresher_pid != os.getpid():
+                    self.refresher_pid = os.getpid()
+                    self.cache, self.refreshing = {}, set()
+                    threading.Thread(target=self.refresher, name='kpi-refresher', daemon=True).start()
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(name, None)
+
+    def overview(self, client):
+        """Everything the admin overview page shows"""
+        counters = self.get_entry(client, 'counters')
+        activity = self.get(client, 'activity')
+        return {
+            'kpis': counters['value'],
+            'generated_at': datetime.fromtimestamp(counters['loaded_at']),
+            **activity
+        }
+
+
+kpi_service = KPIService()
+
+
+def test_kpi_service():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=50, savings_transactions=500)
+    calls = []
+    handler = client.rpc_functions['admin_kpis']
+    client.register_rpc('admin_kpis', lambda c, **p: calls.append(p) or handler(c, **p))
+
+    service = KPIService(ttls={'counters': 0.5, 'activity': 0.5})
+    overview = service.overview(client)
+    kpis = overview['kpis']
+    assert kpis['total_members'] == 50, kpis
+    members = client.table('members').select('shares_owned').execute().data
+    assert kpis['total_shares'] == sum(m['shares_owned'] or 0 for m in members)
+    assert len(overview['recent_members']) == 5
+
+    # Cached: no second RPC while fresh, background refresh before expiry
+    service.overview(client)
+    assert len(calls) == 1
+
+    # An invalidation between the two lookups must not break the page
+    service.invalidate('activity')
+    assert service.overview(client)['generated_at']
+    time.sleep(1.5)
+    assert len(calls) >= 2, calls
+    print("✅ kpi_service self-test passed")
+
+
+if __name__ == "__main__":
+    test_kpi_service()
@@ -0,0 +1,217 @@
+#ledger.py
+# Balance postings for savings and loan accounts, and share holdings.
+# post_savings_entry()/post_loan_entry()/post_share_entry() in supabase_functions.sql lock the
+# account (or member) row, apply the amount, and insert (or complete) the ledger row in one
+# transaction, returning both balances. One round-trip per movement, and concurrent postings can
+# no longer overwrite each other.
+from decimal import Decimal
+from postgrest.exceptions import APIError
+
+
+class PostingError(Exception):
+    """Posting refused by the database (account missing, insufficient funds, ...)"""
+
+
+def _jsonable(values):
+    return {k: str(v) if isinstance(v, Decimal) else v for k, v in values.items()}
+
+
+def _call(client, function, params):
+    try:
+        result = client.rpc(function, params).execute().data
+    except APIError as e:
+        # RAISE EXCEPTION in the posting functions arrives as P0001 with a readable message
+        if e.code == 'P0001':
+            raise PostingError(e.message)
+        raise
+    return result[0] if isinstance(result, list) else result
+
+
+def _post(client, function, params):
+    result = _call(client, function, params)
+    return {
+        'transaction_id': result.get('transaction_id'),
+        'balance_before': Decimal(str(result['balance_before'])),
+        'balance_after': Decimal(str(result['balance_after']))
+    }
+
+
+def post_savings_entry(client, account_id, amount, transaction, transaction_id=None, require_funds=False):
+    """Add amount (negative for withdrawals) to a savings account and record it in savings_transactions.
+
+    transaction holds the ledger row's columns; savings_account_id and the balances are filled in.
+    With transaction_id the existing row (e.g. a pending PesaPal deposit) is completed instead.
+    require_funds refuses postings that would take available_balance below zero.
+    """
+    return _post(client, 'post_savings_entry', {
+        'p_account_id': account_id,
+        'p_amount': str(amount),
+        'p_transaction': _jsonable(transaction),
+        'p_transaction_id': transaction_id,
+        'p_require_funds': require_funds
+    })
+
+
+def post_loan_entry(client, amount, transaction, account_id=None, member_id=None, floor_zero=False,
+                    require_balance=False, transaction_id=None):
+    """Add amount (negative for repayments) to a loan account and insert the loan_transactions row.
+
+    The account is found by account_id, or by member_id. available_limit is recalculated as
+    credit_limit - current_balance. floor_zero stops the balance at zero; require_balance refuses
+    repayments larger than the outstanding balance. With transaction_id the existing row (e.g. a
+    pending PesaPal repayment) is completed instead.
+    """
+    return _post(client, 'post_loan_entry', {
+        'p_account_id': account_id,
+        'p_member_id': member_id,
+        'p_amount': str(amount),
+        'p_transaction': _jsonable(transaction),
+        'p_floor_zero': floor_zero,
+        'p_require_balance': require_balance,
+        'p_transaction_id': transaction_id
+    })
+
+
+def post_share_entry(client, member_id, shares, transaction=None, transaction_id=None):
+    """Add shares (negative for sales) to a member's holding; holdings never go below zero.
+
+    With transaction, the share_transactions row is inserted in the same transaction (member_id
+    is filled in). With transaction_id the member's existing, not yet posted row (e.g. a PesaPal
+    purchase) is posted instead. The share register totals follow through the trigger on members.
+    """
+    result = _call(client, 'post_share_entry', {
+        'p_member_id': member_id,
+        'p_shares': int(shares),
+        'p_transaction': _jsonable(transaction) if transaction is not None else None,
+        'p_transaction_id': transaction_id
+    })
+    return {
+        'transaction_id': result.get('transaction_id'),
+        'shares_before': int(result['shares_before']),
+        'shares_after': int(result['shares_after'])
+    }
+
+
+def post_savings_batch(client, entries):
+    """Post many savings movements in one transaction (post_savings_batch() in the database).
+
+    entries are dicts with savings_account_id, amount and transaction (the ledger row's columns).
+    Each account's balance is updated once and the savings_transactions rows are inserted in
+    bulk with running balances. All-or-nothing: a missing account refuses the whole batch.
+    """
+    result = _call(client, 'post_savings_batch', {
+        'p_entries': [{
+            'savings_account_id': entry['savings_account_id'],
+            'amount': str(entry['amount']),
+            'transaction': _jsonable(entry.get('transaction') or {})
+        } for entry in entries]
+    })
+    return {
+        'accounts': int(result['accounts']),
+        'transactions': int(result['transactions']),
+        'total_amount': Decimal(str(result['total_amount'] or 0))
+    }
+
+
+def test_ledger():
+    """Self-test against the local stand-in, including concurrent postings"""
+    import threading
+    from local_supabase import LocalSupabase
+    client = LocalSupabase()
+    client.insert_rows('savings_accounts', [{'id': 'sa-1', 'member_id': 'm-1', 'current_balance': 1000.0,
+                                             'available_balance': 1000.0}])
+    client.insert_rows('loan_accounts', [{'id': 'la-1', 'member_id': 'm-1', 'current_balance': 0.0,
+                                          'credit_limit': 1000000.0, 'available_limit': 1000000.0}])
+
+    posting = post_savings_entry(client, 'sa-1', Decimal('500'), {'transaction_type': 'deposit', 'amount': Decimal('500'),
+                                                                  'reference_number': 'T-1', 'status': 'completed'})
+    assert posting['balance_before'] == 1000 and posting['balance_after'] == 1500
+    try:
+        post_savings_entry(client, 'sa-1', Decimal('-2000'), {'transaction_type': 'withdrawal'}, require_funds=True)
+        assert False, 'overdraft allowed'
+    except PostingError:
+        pass
+
+    threads = [threading.Thread(target=post_savings_entry, args=(client, 'sa-1', Decimal('10'),
+                                                                 {'transaction_type': 'deposit'}))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    account = client.table('savings_accounts').select('current_balance').eq('id', 'sa-1').execute().data[0]
+    assert Decimal(str(account['current_balance'])) == 1700
+    assert len(client.table('savings_transactions').select('id').execute().data) == 21
+
+    post_loan_entry(client, Decimal('300000'), {'transaction_type': 'disbursement'}, member_id='m-1')
+    posting = post_loan_entry(client, Decimal('-500000'), {'transaction_type': 'repayment'}, member_id='m-1',
+                              floor_zero=True)
+    assert posting['balance_after'] == 0
+    loan = client.table('loan_accounts').select('available_limit').eq('id', 'la-1').execute().data[0]
+    assert Decimal(str(loan['available_limit'])) == 1000000
+    try:
+        post_loan_entry(client, Decimal('-1'), {'transaction_type': 'manual_repayment'}, account_id='la-1',
+                        require_balance=True)
+        assert False, 'repayment above balance allowed'
+    except PostingError:
+        pass
+
+    client.insert_rows('members', [{'id': 'm-1', 'full_name': 'Test Member', 'member_number': 'MEM000001',
+                                     'shares_owned': 5}])
+    posting = post_share_entry(client, 'm-1', 10, {'shares': 10, 'transaction_type': 'purchase'})
+    assert posting['shares_before'] == 5 and posting['shares_after'] == 15 and posting['transaction_id']
+    try:
+        post_share_entry(client, 'm-1', -20)
+        assert False, 'sold more shares than owned'
+    except PostingError:
+        pass
+
+    batch = post_savings_batch(client, [
+        {'savings_account_id': 'sa-1', 'amount': Decimal('100'), 'transaction': {'transaction_type': 'deposit'}},
+        {'savings_account_id': 'sa-1', 'amount': Decimal('50'), 'transaction': {'transaction_type': 'deposit'}}
+    ])
+    assert batch == {'accounts': 1, 'transactions': 2, 'total_amount': Decimal('150')}, batch
+    rows = client.table('savings_transactions').select('amount, balance_after').eq('amount', 50).execute().data
+    assert Decimal(str(rows[0]['balance_after'])) == 1850
+    try:
+        post_savings_batch(client, [{'savings_account_id': 'sa-1', 'amount': Decimal('1')},
+                                    {'savings_account_id': 'sa-missing', 'amount': Decimal('1')}])
+        assert False, 'batch with a missing account posted'
+    except PostingError:
+        pass
+
+    # Completing a pending row only posts once, and only on its own account / member
+    client.insert_rows('savings_transactions', [{'id': 'st-pending', 'savings_account_id': 'sa-1',
+                                                 'transaction_type': 'deposit', 'status': 'pending'}])
+    client.insert_rows('loan_transactions', [{'id': 'lt-pending', 'loan_account_id': 'la-1',
+                                              'transaction_type': 'repayment', 'payment_method': 'pesapal'}])
+    client.insert_rows('share_transactions', [{'id': 'sh-pending', 'member_id': 'm-1', 'shares': 2}])
+    post_loan_entry(client, Decimal('1000'), {'transaction_type': 'disbursement'}, account_id='la-1')
+    replays = [
+        lambda: post_savings_entry(client, 'sa-1', Decimal('40'), {'status': 'completed'}, transaction_id='st-pending'),
+        lambda: post_loan_entry(client, Decimal('-40'), {'payment_method': 'pesapal_completed'}, account_id='la-1',
+                                transaction_id='lt-pending'),
+        lambda: post_share_entry(client, 'm-1', 2, transaction_id='sh-pending')
+    ]
+    for replay in replays:
+        replay()
+        try:
+            replay()
+            assert False, 'pending row posted twice'
+        except PostingError:
+            pass
+    account = client.table('savings_accounts').select('current_balance').eq('id', 'sa-1').execute().data[0]
+    loan = client.table('loan_accounts').select('current_balance').eq('id', 'la-1').execute().data[0]
+    member = client.table('members').select('shares_owned').eq('id', 'm-1').execute().data[0]
+    assert Decimal(str(account['current_balance'])) == 1890 and Decimal(str(loan['current_balance'])) == 960
+    assert member['shares_owned'] == 17
+    try:
+        post_savings_entry(client, 'sa-1', Decimal('40'), {}, transaction_id='st-missing')
+        assert False, 'unknown transaction posted'
+    except PostingError:
+        pass
+    print("✅ ledger self-test passed")
+
+
+if __name__ == "__main__":
+    test_ledger()
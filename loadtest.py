@@ -0,0 +1,473 @@
+#loadtest.py
+# End-to-end load test against waitress with local stand-ins for Supabase, PesaPal, SMTP and Cloudinary
+#   python loadtest.py --users 50 --duration 60 --output month_end.json
+#   python loadtest.py --users 50 --duration 60 --compare month_end.json
+#   python loadtest.py serve --port 5055          (server only, drive it from another machine)
+#   python loadtest.py run --url http://host:5055 (client only)
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import smtplib
+import argparse
+import threading
+import subprocess
+from email import message_from_string
+from datetime import datetime, timedelta
+
+# Never talk to the live project while load testing
+os.environ['SUPABASE_URL'] = 'http://127.0.0.1:54321'
+os.environ['SUPABASE_KEY'] = 'local-loadtest-key'
+
+import requests
+
+from benchmark import percentile, load_database
+
+LOADTEST_ADMIN_EMAIL = 'admin{}@loadtest.local'
+LOADTEST_ADMIN_PASSWORD = 'loadtest'
+LOADTEST_ADMIN_COUNT = 50
+SCENARIOS = ['member_login', 'admin_login_otp', 'dashboard', 'deposit', 'statement_download', 'admin_report']
+
+# Simulated latency of the external services (seconds)
+STUB_LATENCY = {
+    'pesapal': float(os.getenv('STUB_PESAPAL_LATENCY', '0.3')),
+    'smtp': float(os.getenv('STUB_SMTP_LATENCY', '0.8')),
+    'cloudinary': float(os.getenv('STUB_CLOUDINARY_LATENCY', '0.5'))
+}
+
+# Last OTP "delivered" to each address by the SMTP stub
+_outbox = {}
+_outbox_lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# Stand-ins for the external services
+# ---------------------------------------------------------------------------
+
+class StubSMTP:
+    """Drop-in for smtplib.SMTP that records messages instead of sending them"""
+    def __init__(self, host='', port=0, *args, **kwargs):
+        time.sleep(STUB_LATENCY['smtp'] / 2)  # connect + TLS handshake
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.quit()
+
+    def ehlo(self, *args):
+        return 250, b'OK'
+
+    def starttls(self, *args, **kwargs):
+        return 220, b'Ready'
+
+    def login(self, user, password):
+        return 235, b'Accepted'
+
+    def noop(self):
+        return 250, b'OK'
+
+    def send_message(self, msg, *args, **kwargs):
+        time.sleep(STUB_LATENCY['smtp'] / 2)
+        body = ''
+        for part in msg.walk():
+            if part.get_content_type() == 'text/html':
+                body = part.get_payload(decode=True).decode('utf-8', 'ignore')
+        otp = re.search(r'class="otp-code">\s*(\d+)\s*<', body)
+        with _outbox_lock:
+            _outbox[msg['To']] = {'otp': otp.group(1) if otp else None, 'subject': msg['Subject'],
+                                  'sent_at': time.time()}
+        return {}
+
+    def sendmail(self, from_addr, to_addrs, msg, *args, **kwargs):
+        return self.send_message(message_from_string(msg))
+
+    def quit(self):
+        return 221, b'Bye'
+
+    def close(self):
+        pass
+
+
+def install_stubs(base_url):
+    """Replace PesaPal, SMTP and Cloudinary with local stand-ins"""
+    import cloudinary.uploader
+    from pesapal import PesaPal
+
+    def authenticate(self):
+        self.token = 'stub-token'
+        return self.token
+
+    def submit_order(self, amount, reference_id, callback_url, email, first_name, last_name):
+        time.sleep(STUB_LATENCY['pesapal'])
+        order_tracking_id = str(uuid.uuid4())
+        # The stub "pays" instantly and sends the member straight back to the callback
+        return {
+            'order_tracking_id': order_tracking_id,
+            'redirect_url': f"{callback_url}?OrderTrackingId={order_tracking_id}&OrderMerchantReference={reference_id}",
+            'reference_id': reference_id,
+            'raw_response': {'status': '200'}
+        }
+
+    def verify_transaction_status(self, order_tracking_id):
+        time.sleep(STUB_LATENCY['pesapal'])
+        return {
+            'order_tracking_id': order_tracking_id,
+            'status': '200',
+            'payment_status_description': 'Completed',
+            'payment_method': 'MobileMoney',
+            'amount': None,
+            'currency': 'UGX',
+            'payment_date': datetime.now().isoformat(),
+            'raw_response': {}
+        }
+
+    def upload(file, **options):
+        time.sleep(STUB_LATENCY['cloudinary'])
+        public_id = options.get('public_id') or str(uuid.uuid4())
+        return {
+            'public_id': public_id,
+            'secure_url': f"{base_url}/_stub/cloudinary/{public_id}",
+            'url': f"{base_url}/_stub/cloudinary/{public_id}",
+            'format': 'jpg',
+            'width': 800,
+            'height': 600,
+            'bytes': 0
+        }
+
+    PesaPal.authenticate = authenticate
+    PesaPal.submit_order = submit_order
+    PesaPal.verify_transaction_status = verify_transaction_status
+    smtplib.SMTP = StubSMTP
+    cloudinary.uploader.upload = upload
+    cloudinary.uploader.destroy = lambda public_id, **options: {'result': 'ok'}
+
+
+def ensure_loadtest_admins(client, count=LOADTEST_ADMIN_COUNT):
+    """Admin accounts with OTP enabled, one per concurrent admin user"""
+    from werkzeug.security import generate_password_hash
+
+    existing = client.table('admins').select('email').like('email', '%@loadtest.local').execute()
+    existing_emails = {a['email'] for a in existing.data}
+    password_hash = generate_password_hash(LOADTEST_ADMIN_PASSWORD)
+
+    new_admins = [{
+        'email': LOADTEST_ADMIN_EMAIL.format(i),
+        'name': f'Load Test Admin {i}',
+        'role': 'admin',
+        'status': 'active',
+        'otp_enabled': True,
+        'login_count': 0,
+        'password_hash': password_hash,
+        'otp_code': None,
+        'otp_expires_at': None,
+        'last_login': None
+    } for i in range(count) if LOADTEST_ADMIN_EMAIL.format(i) not in existing_emails]
+
+    if new_admins:
+        client.table('admins').insert(new_admins).execute()
+
+
+def create_server_app(db_path, members, transactions, base_url):
+    """The real app wired to the local database and stubbed services"""
+    from local_supabase import use_local_supabase
+    from flask import jsonify, request
+
+    client = load_database(db_path, members, transactions)
+    install_stubs(base_url)
+
+    from app import app
+    use_local_supabase(client)
+    ensure_loadtest_admins(client)
+
+    @app.route('/_stub/outbox/<path:email>')
+    def stub_outbox(email):
+        with _outbox_lock:
+            return jsonify(_outbox.get(email, {}))
+
+    @app.route('/_stub/members')
+    def stub_members():
+        limit = int(request.args.get('limit', 100))
+        rows = client.table('members')\
+            .select('email')\
+            .eq('account_status', 'active')\
+            .limit(limit)\
+            .execute()
+        return jsonify([r['email'] for r in rows.data])
+
+    return app
+
+
+def run_server(args):
+    """Serve the stubbed app with waitress"""
+    from waitress import serve
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    app = create_server_app(args.db, args.members, args.transactions, base_url)
+    print(f"✅ Load-test server on {base_url} (threads={args.threads})", flush=True)
+
+    # Route debug prints are very chatty; keep them out of the timings
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    serve(app, host='0.0.0.0', port=args.port, threads=args.threads, _quiet=True)
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    """Collects latency samples per step"""
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, step, elapsed_ms, ok):
+        with self.lock:
+            self.samples.setdefault(step, []).append(elapsed_ms)
+            if not ok:
+                self.errors[step] = self.errors.get(step, 0) + 1
+
+
+class VirtualUser:
+    """One simulated member and admin, each with its own cookie session"""
+    def __init__(self, base_url, index, email, recorder, timeout=60):
+        self.base_url = base_url
+        self.email = email
+        self.admin_email = LOADTEST_ADMIN_EMAIL.format(index % LOADTEST_ADMIN_COUNT)
+        self.recorder = recorder
+        self.timeout = timeout
+        self.member_http = requests.Session()
+        self.admin_http = requests.Session()
+        self.logged_in = False
+        self.admin_logged_in = False
+
+    def step(self, name, method, path, http=None, expect=(200, 302), **kwargs):
+        url = path if path.startswith('http') else f"{self.base_url}{path}"
+        start = time.perf_counter()
+        try:
+            response = (http or self.member_http).request(method, url, allow_redirects=False,
+                                                          timeout=self.timeout, **kwargs)
+            ok = response.status_code in expect
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(name, (time.perf_counter() - start) * 1000, ok)
+        return response
+
+    # Scenarios
+    def member_login(self):
+        self.member_http = requests.Session()
+        response = self.step('member_login', 'POST', '/member/login', data={'email': self.email, 'password': '123'})
+        self.logged_in = response is not None and response.status_code == 302 \
+            and 'login' not in response.headers.get('Location', '')
+
+    def admin_login_otp(self):
+        self.admin_http = requests.Session()
+        requested_at = time.time()
+        self.step('admin_login', 'POST', '/admin/login', http=self.admin_http,
+                  data={'email': self.admin_email, 'password': LOADTEST_ADMIN_PASSWORD})
+        # OTP mail goes out from the background queue, so wait for it to arrive
+        deadline = time.time() + self.timeout
+        while True:
+            outbox = self.admin_http.get(f"{self.base_url}/_stub/outbox/{self.admin_email}", timeout=self.timeout).json()
+            if outbox.get('sent_at', 0) >= requested_at or time.time() > deadline:
+                break
+            time.sleep(0.1)
+        response = self.step('admin_verify_otp', 'POST', '/admin/verify-otp', http=self.admin_http,
+                             expect=(302,), data={'otp': outbox.get('otp') or ''})
+        self.admin_logged_in = response is not None and response.status_code == 302
+
+    def dashboard(self):
+        if not self.logged_in:
+            self.member_login()
+        for path in ('/member/', '/member/savings', '/member/loans', '/member/shares'):
+            self.step(f"page {path}", 'GET', path, expect=(200,))
+
+    def deposit(self):
+        if not self.logged_in:
+            self.member_login()
+        response = self.step('deposit_initiate', 'POST', '/member/initiate-deposit',
+                             data={'amount': random.choice(['10000', '50000', '100000'])}, expect=(302,))
+        if response is not None and 'OrderTrackingId' in response.headers.get('Location', ''):
+            self.step('deposit_callback', 'GET', response.headers['Location'], expect=(302,))
+
+    def statement_download(self):
+        if not self.logged_in:
+            self.member_login()
+        today = datetime.now().date()
+        self.step('statement_download', 'POST', '/member/download-statement', expect=(200,), data={
+            'statement_type': 'combined',
+            'start_date': (today - timedelta(days=90)).isoformat(),
+            'end_date': today.isoformat()
+        })
+
+    def admin_report(self):
+        if not self.admin_logged_in:
+            self.admin_login_otp()
+        today = datetime.now().date()
+        self.step('admin_report', 'GET',
+                  f"/admin/expense_incomes/reports?start_date={today.year}-01-01&end_date={today.isoformat()}",
+                  http=self.admin_http, expect=(200,))
+
+
+def run_load(base_url, users, duration, scenarios, ramp_up=0, think_time=0.0, seed=42):
+    """Drive the server with concurrent virtual users and summarise latencies"""
+    emails = requests.get(f"{base_url}/_stub/members?limit={users}", timeout=30).json()
+    if not emails:
+        raise RuntimeError('No active members available on the load-test server')
+
+    recorder = Recorder()
+    deadline = time.time() + duration
+    rng = random.Random(seed)
+
+    def user_loop(index):
+        user = VirtualUser(base_url, index, emails[index % len(emails)], recorder)
+        user_rng = random.Random(rng.random())
+        while time.time() < deadline:
+            getattr(user, user_rng.choice(scenarios))()
+            if think_time:
+                time.sleep(user_rng.uniform(0, think_time * 2))
+
+    threads = []
+    started = time.time()
+    for i in range(users):
+        thread = threading.Thread(target=user_loop, args=(i,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if ramp_up:
+            time.sleep(ramp_up / users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    results = []
+    for step, samples in sorted(recorder.samples.items()):
+        results.append({
+            'step': step,
+            'requests': len(samples),
+            'errors': recorder.errors.get(step, 0),
+            'rps': round(len(samples) / elapsed, 2),
+            'p50_ms': round(percentile(samples, 50), 1),
+            'p90_ms': round(percentile(samples, 90), 1),
+            'p95_ms': round(percentile(samples, 95), 1),
+            'p99_ms': round(percentile(samples, 99), 1),
+            'max_ms': round(max(samples), 1)
+        })
+    total = sum(r['requests'] for r in results)
+    return {
+        'users': users,
+        'duration_s': round(elapsed, 1),
+        'total_requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'results': results
+    }
+
+
+def print_load_results(summary, baseline=None):
+    """Print per-step latency percentiles and throughput"""
+    base = {r['step']: r for r in (baseline or {}).get('results', [])}
+    print(f"\n{summary['users']} users, {summary['duration_s']}s, "
+          f"{summary['total_requests']} requests, {summary['throughput_rps']} req/s")
+    print(f"{'Step':<24}{'reqs':>7}{'errs':>6}{'req/s':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}{'p95 vs base':>13}")
+    print('-' * 103)
+    for r in summary['results']:
+        change = ''
+        if r['step'] in base and base[r['step']]['p95_ms']:
+            change = f"{(r['p95_ms'] - base[r['step']]['p95_ms']) / base[r['step']]['p95_ms'] * 100:+.1f}%"
+        print(f"{r['step']:<24}{r['requests']:>7}{r['errors']:>6}{r['rps']:>8}{r['p50_ms']:>9}"
+              f"{r['p90_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['max_ms']:>9}{change:>13}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return None
+
+
+def wait_for_server(base_url, timeout=600):
+    """Wait until the server answers (data generation can take a while)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/_stub/members?limit=1", timeout=5).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def run_client(args):
+    summary = run_load(args.url, args.users, args.duration, args.scenarios or SCENARIOS,
+                       ramp_up=args.ramp_up, think_time=args.think_time)
+    summary['revision'] = git_revision()
+    summary['generated_at'] = datetime.now().isoformat()
+    summary['stub_latency'] = STUB_LATENCY
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_load_results(summary, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"\n✅ Results written to {args.output}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test with stubbed external services')
+    parser.add_argument('mode', nargs='?', choices=['all', 'serve', 'run'], default='all')
+    parser.add_argument('--url', help='Server to drive in run mode')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--threads', type=int, default=4, help='waitress threads for the server')
+    parser.add_argument('--db', default='bench.sqlite')
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=60)
+    parser.add_argument('--ramp-up', type=float, default=5)
+    parser.add_argument('--think-time', type=float, default=0.0)
+    parser.add_argument('--scenarios', nargs='*', choices=SCENARIOS)
+    parser.add_argument('--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='Compare against a previous JSON result')
+    parser.add_argument('--verbose', action='store_true', help='Keep server debug output')
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        run_server(args)
+        return
+
+    if args.mode == 'run':
+        if not args.url:
+            parser.error('--url is required in run mode')
+        run_client(args)
+        return
+
+    # Start the server in its own process so client threads don't share its GIL
+    args.url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), 'serve',
+        '--port', str(args.port), '--threads', str(args.threads), '--db', args.db,
+        '--members', str(args.members), '--transactions', str(args.transactions)
+    ])
+    try:
+        print("🔄 Waiting for load-test server...")
+        if not wait_for_server(args.url):
+            print("❌ Load-test server did not start")
+            return
+        run_client(args)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
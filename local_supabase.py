@@ -0,0 +1,1675 @@
+#local_supabase.py
+import json
+import uuid
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+try:
+    from postgrest.exceptions import APIError
+except ImportError:
+    class APIError(Exception):
+        def __init__(self, error):
+            super().__init__(error.get('message'))
+            self.code = error.get('code')
+            self.message = error.get('message')
+
+
+# Foreign key used to embed a related table, e.g. select('*, members(full_name)')
+EMBED_KEYS = {
+    'members': 'member_id',
+    'admins': 'admin_id',
+    'loan_products': 'loan_product_id',
+    'loan_applications': 'loan_application_id',
+    'loan_accounts': 'loan_account_id',
+    'savings_accounts': 'savings_account_id',
+    'expense_categories': 'category_id',
+    'income_categories': 'category_id'
+}
+
+# Columns indexed by generate_sacco_data()
+DEFAULT_INDEXES = {
+    'members': ['email', 'phone_number', 'member_number', 'account_status', 'created_at'],
+    'savings_accounts': ['member_id', 'account_number', 'status'],
+    'loan_accounts': ['member_id', 'account_number', 'status'],
+    'savings_transactions': ['member_id', 'savings_account_id', 'created_at', 'reference_number'],
+    'loan_applications': ['member_id', 'status', 'created_at'],
+    'loan_transactions': ['loan_account_id', 'member_id', 'created_at'],
+    'loan_repayments': ['member_id', 'loan_application_id', 'status', 'due_date', 'paid_date'],
+    'share_transactions': ['member_id', 'transaction_date'],
+    'expenses': ['payment_date', 'status'],
+    'other_incomes': ['payment_date', 'status'],
+    'member_incomes': ['payment_date']
+}
+
+
+class LocalResponse:
+    """Same shape as postgrest's APIResponse"""
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+    def __repr__(self):
+        return f"LocalResponse(data={self.data!r}, count={self.count!r})"
+
+
+def _split_top_level(text, sep=','):
+    """Split on sep, ignoring separators inside parentheses"""
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == sep and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def _parse_select(columns):
+    """Parse a PostgREST select string into plain columns and embeds"""
+    plain, embeds = [], []
+    for item in _split_top_level(columns or '*'):
+        if '(' in item and item.endswith(')'):
+            name, inner = item[:-1].split('(', 1)
+            inner_join = '!inner' in name
+            name = name.split('!')[0].strip()
+            alias = None
+            if ':' in name:
+                alias, name = [p.strip() for p in name.split(':', 1)]
+            embeds.append({'table': name, 'alias': alias or name, 'columns': inner, 'inner': inner_join})
+        else:
+            plain.append(item.strip())
+    return plain, embeds
+
+
+def _to_db_value(value):
+    """Convert Python values into something SQLite can store"""
+    if isinstance(value, bool):
+        return 1 if value else 0
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _parse_filter_value(operator, raw):
+    """Turn a PostgREST filter value string into a Python value"""
+    if operator == 'in':
+        inner = raw.strip()
+        if inner.startswith('(') and inner.endswith(')'):
+            inner = inner[1:-1]
+        return [v.strip().strip('"') for v in inner.split(',') if v.strip()]
+    if operator == 'is':
+        return {'null': None, 'true': True, 'false': False}.get(raw.lower(), raw)
+    return raw
+
+
+class LocalQueryBuilder:
+    """In-process stand-in for the Supabase/PostgREST query builder"""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table_name = table
+        self.operation = 'select'
+        self.columns = '*'
+        self.count_mode = None
+        self.payload = None
+        self.on_conflict = 'id'
+        self.filters = []
+        self.ordering = []
+        self.limit_count = None
+        self.offset_count = 0
+        self.single_mode = None
+
+    # Operations
+    def select(self, *columns, count=None, head=False):
+        self.operation = 'select'
+        self.columns = ','.join(columns) if columns else '*'
+        self.count_mode = count
+        return self
+
+    def insert(self, data, count=None, returning='representation', upsert=False, default_to_null=True):
+        self.operation = 'upsert' if upsert else 'insert'
+        self.payload = data
+        return self
+
+    def upsert(self, data, on_conflict='id', ignore_duplicates=False, **kwargs):
+        self.operation = 'upsert'
+        self.payload = data
+        self.on_conflict = on_conflict or 'id'
+        return self
+
+    def update(self, data, count=None, returning='representation'):
+        self.operation = 'update'
+        self.payload = data
+        return self
+
+    def delete(self, count=None, returning='representation'):
+        self.operation = 'delete'
+        return self
+
+    # Filters
+    def _add(self, column, operator, value):
+        self.filters.append(('where', column, operator, value))
+        return self
+
+    def eq(self, column, value):
+        return self._add(column, 'eq', value)
+
+    def neq(self, column, value):
+        return self._add(column, 'neq', value)
+
+    def gt(self, column, value):
+        return self._add(column, 'gt', value)
+
+    def gte(self, column, value):
+        return self._add(column, 'gte', value)
+
+    def lt(self, column, value):
+        return self._add(column, 'lt', value)
+
+    def lte(self, column, value):
+        return self._add(column, 'lte', value)
+
+    def like(self, column, pattern):
+        return self._add(column, 'like', pattern)
+
+    def ilike(self, column, pattern):
+        return self._add(column, 'ilike', pattern)
+
+    def is_(self, column, value):
+        return self._add(column, 'is', value)
+
+    def in_(self, column, values):
+        return self._add(column, 'in', list(values))
+
+    def filter(self, column, operator, criteria):
+        return self._add(column, operator, _parse_filter_value(operator, str(criteria)))
+
+    def match(self, query):
+        for column, value in query.items():
+            self.eq(column, value)
+        return self
+
+    def or_(self, filters, reference_table=None):
+        conditions = []
+        for part in _split_top_level(filters):
+            column, operator, raw = part.split('.', 2) if part.count('.') >= 2 else (part, 'eq', '')
+            # Embedded columns such as members.full_name.ilike.%x%
+            if operator not in ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'like', 'ilike', 'is', 'in'):
+                column = f"{column}.{operator}"
+                operator, raw = raw.split('.', 1)
+            conditions.append((column, operator, _parse_filter_value(operator, raw)))
+        self.filters.append(('or', conditions))
+        return self
+
+    # Modifiers
+    def order(self, column, desc=False, nullsfirst=None, foreign_table=None):
+        if not foreign_table:
+            self.ordering.append((column, desc))
+        return self
+
+    def limit(self, size, foreign_table=None):
+        if not foreign_table:
+            self.limit_count = size
+        return self
+
+    def range(self, start, end, foreign_table=None):
+        self.offset_count = start
+        self.limit_count = end - start + 1
+        return self
+
+    def single(self):
+        self.single_mode = 'single'
+        return self
+
+    def maybe_single(self):
+        self.single_mode = 'maybe'
+        return self
+
+    # SQL translation
+    def _condition_sql(self, column, operator, value):
+        quoted = f'"{column}"'
+        if operator == 'in':
+            if not value:
+                return '0', []
+            return f"{quoted} IN ({','.join('?' for _ in value)})", [_to_db_value(v) for v in value]
+        if operator == 'is':
+            if value is None:
+                return f"{quoted} IS NULL", []
+            return f"{quoted} IS ?", [_to_db_value(value)]
+        if operator in ('like', 'ilike'):
+            return f"{quoted} LIKE ?", [str(value).replace('*', '%')]
+        sql_operator = {'eq': '=', 'neq': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}[operator]
+        if isinstance(value, str) and value.lower() in ('true', 'false') and \
+                self.client.column_type(self.table_name, column) == 'bool':
+            value = value.lower() == 'true'
+        return f"{quoted} {sql_operator} ?", [_to_db_value(value)]
+
+    def _where(self):
+        """Build the WHERE clause; filters on embedded columns are applied in Python"""
+        clauses, params, python_filters = [], [], []
+        known = self.client.columns(self.table_name)
+        for item in self.filters:
+            if item[0] == 'where':
+                _, column, operator, value = item
+                if '.' in column or column not in known:
+                    if '.' in column:
+                        python_filters.append([(column, operator, value)])
+                        continue
+                    # Unknown column never matches, as PostgREST would error
+                    clauses.append('0')
+                    continue
+                sql, values = self._condition_sql(column, operator, value)
+                clauses.append(sql)
+                params.extend(values)
+            else:
+                conditions = item[1]
+                if any('.' in c[0] for c in conditions):
+                    python_filters.append(conditions)
+                    continue
+                parts = []
+                for column, operator, value in conditions:
+                    if column not in known:
+                        continue
+                    sql, values = self._condition_sql(column, operator, value)
+                    parts.append(sql)
+                    params.extend(values)
+                clauses.append(f"({' OR '.join(parts)})" if parts else '0')
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        return where, params, python_filters
+
+    def execute(self):
+        with self.client.lock:
+            if self.operation == 'select':
+                return self._execute_select()
+            if self.operation == 'insert':
+                return self._execute_insert()
+            if self.operation == 'upsert':
+                return self._execute_upsert()
+            if self.operation == 'update':
+                return self._execute_update()
+            return self._execute_delete()
+
+    def _execute_select(self):
+        if not self.client.table_exists(self.table_name):
+            return self._finish([], 0)
+
+        where, params, python_filters = self._where()
+        known = self.client.columns(self.table_name)
+        order = ''
+        order_parts = [f'"{c}" {"DESC" if d else "ASC"}' for c, d in self.ordering if c in known]
+        if order_parts:
+            order = f" ORDER BY {', '.join(order_parts)}"
+
+        paging = ''
+        if not python_filters and self.limit_count is not None:
+            paging = f" LIMIT {int(self.limit_count)} OFFSET {int(self.offset_count)}"
+
+        sql = f'SELECT * FROM "{self.table_name}"{where}{order}{paging}'
+        rows = self.client.fetch(self.table_name, sql, params)
+
+        plain, embeds = _parse_select(self.columns)
+        rows = self.client.embed(self.table_name, rows, embeds)
+
+        if python_filters:
+            rows = [row for row in rows if all(_match_any(row, conditions) for conditions in python_filters)]
+
+        count = None
+        if self.count_mode:
+            if python_filters:
+                count = len(rows)
+            else:
+                count = self.client.conn.execute(
+                    f'SELECT COUNT(*) FROM "{self.table_name}"{where}', params
+                ).fetchone()[0]
+
+        if python_filters and self.limit_count is not None:
+            rows = rows[self.offset_count:self.offset_count + self.limit_count]
+
+        if '*' not in plain:
+            keep = set(plain) | {e['alias'] for e in embeds}
+            rows = [{k: v for k, v in row.items() if k in keep} for row in rows]
+
+        return self._finish(rows, count)
+
+    def _finish(self, rows, count=None):
+        if self.single_mode:
+            if len(rows) == 1:
+                return LocalResponse(rows[0], count)
+            if self.single_mode == 'maybe' and not rows:
+                return LocalResponse(None, count)
+            raise APIError({
+                'code': 'PGRST116',
+                'message': 'JSON object requested, multiple (or no) rows returned',
+                'details': f'The result contains {len(rows)} rows',
+                'hint': None
+            })
+        return LocalResponse(rows, count)
+
+    def _execute_insert(self):
+        records = self.payload if isinstance(self.payload, list) else [self.payload]
+        inserted = self.client.insert_rows(self.table_name, records)
+        return self._finish(inserted)
+
+    def _execute_upsert(self):
+        records = self.payload if isinstance(self.payload, list) else [self.payload]
+        conflict_columns = [c.strip() for c in self.on_conflict.split(',')]
+        results = []
+        for record in records:
+            existing = []
+            if all(record.get(c) is not None for c in conflict_columns) and self.client.table_exists(self.table_name):
+                builder = LocalQueryBuilder(self.client, self.table_name).select('*')
+                for column in conflict_columns:
+                    builder.eq(column, record[column])
+                existing = builder._execute_select().data
+            if existing:
+                builder = LocalQueryBuilder(self.client, self.table_name).update(record)
+                for column in conflict_columns:
+                    builder.eq(column, record[column])
+                results.extend(builder._execute_update().data)
+            else:
+                results.extend(self.client.insert_rows(self.table_name, [record]))
+        return self._finish(results)
+
+    def _execute_update(self):
+        if not self.client.table_exists(self.table_name):
+            return self._finish([])
+        self.client.ensure_columns(self.table_name, self.payload)
+        where, params, python_filters = self._where()
+        rows = self.client.fetch(self.table_name, f'SELECT * FROM "{self.table_name}"{where}', params)
+        ids = [r['id'] for r in rows if all(_match_any(r, conditions) for conditions in python_filters)]
+        if ids:
+            assignments = ', '.join(f'"{k}" = ?' for k in self.payload)
+            values = [_to_db_value(v) for v in self.payload.values()]
+            for chunk in _chunks(ids, 500):
+                self.client.conn.execute(
+                    f'UPDATE "{self.table_name}" SET {assignments} WHERE id IN ({",".join("?" for _ in chunk)})',
+                    values + chunk
+                )
+            self.client.commit()
+        updated = []
+        for chunk in _chunks(ids, 500):
+            updated.extend(self.client.fetch(
+                self.table_name,
+                f'SELECT * FROM "{self.table_name}" WHERE id IN ({",".join("?" for _ in chunk)})',
+                chunk
+            ))
+        return self._finish(updated)
+
+    def _execute_delete(self):
+        if not self.client.table_exists(self.table_name):
+            return self._finish([])
+        where, params, _ = self._where()
+        rows = self.client.fetch(self.table_name, f'SELECT * FROM "{self.table_name}"{where}', params)
+        self.client.conn.execute(f'DELETE FROM "{self.table_name}"{where}', params)
+        self.client.commit()
+        return self._finish(rows)
+
+
+class LocalRPCBuilder:
+    """Builder returned by LocalSupabase.rpc()"""
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params or {}
+
+    def execute(self):
+        handler = self.client.rpc_functions.get(self.name)
+        if handler is None:
+            raise APIError({
+                'code': 'PGRST202',
+                'message': f'Could not find the function public.{self.name}',
+                'details': None,
+                'hint': None
+            })
+        with self.client.lock:
+            return LocalResponse(handler(self.client, **self.params))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _lookup(row, column):
+    """Read a possibly embedded column such as members.full_name"""
+    value = row
+    for part in column.split('.'):
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _match_condition(row, column, operator, value):
+    actual = _lookup(row, column)
+    if operator == 'is':
+        return actual is value or actual == value
+    if operator == 'in':
+        return str(actual) in [str(v) for v in value]
+    if actual is None:
+        return False
+    if operator in ('like', 'ilike'):
+        pattern = str(value).replace('*', '%').strip('%').lower()
+        return pattern in str(actual).lower()
+    actual, value = str(actual), str(value)
+    return {
+        'eq': actual == value, 'neq': actual != value,
+        'gt': actual > value, 'gte': actual >= value,
+        'lt': actual < value, 'lte': actual <= value
+    }[operator]
+
+
+def _match_any(row, conditions):
+    return any(_match_condition(row, *condition) for condition in conditions)
+
+
+# Python twins of the functions in supabase_functions.sql
+def _rpc_reserve_document_numbers(client, p_scope, p_count=1):
+    client.ensure_columns('document_counters', {'scope': p_scope, 'last_value': 0})
+    row = client.conn.execute(
+        'INSERT INTO document_counters (id, scope, last_value) VALUES (?, ?, ?) '
+        'ON CONFLICT (id) DO UPDATE SET last_value = last_value + excluded.last_value '
+        'RETURNING last_value',
+        (p_scope, p_scope, p_count)
+    ).fetchone()
+    client.commit()
+    return int(row[0])
+
+
+def _rpc_claim_processed_order(client, p_order_tracking_id, p_kind, p_member_id=None, p_amount=None,
+                               p_stale_seconds=900):
+    now = datetime.now()
+    record = {
+        'order_tracking_id': p_order_tracking_id, 'kind': p_kind, 'member_id': p_member_id,
+        'amount': p_amount, 'status': 'processing', 'claimed_at': now.isoformat(), 'processed_at': None
+    }
+    client.ensure_columns('processed_orders', record)
+    columns = ['id'] + list(record)
+    row = client.conn.execute(
+        f'INSERT INTO processed_orders ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)}) '
+        'ON CONFLICT (id) DO UPDATE SET kind = excluded.kind, member_id = excluded.member_id, '
+        'amount = excluded.amount, claimed_at = excluded.claimed_at '
+        "WHERE processed_orders.status = 'processing' AND processed_orders.claimed_at < ? RETURNING id",
+        [p_order_tracking_id] + list(record.values()) + [(now - timedelta(seconds=p_stale_seconds)).isoformat()]
+    ).fetchone()
+    client.commit()
+    return row is not None
+
+
+def _rpc_approve_loan_application(client, p_application_id, p_approved_by, p_remarks, p_monthly_installment,
+                                  p_total_repayable, p_schedule, p_description, p_ip_address=None, p_user_agent=None):
+    now = datetime.now().isoformat()
+    with client.transaction():
+        updated = client.table('loan_applications').update({
+            'status': 'approved',
+            'approved_by': p_approved_by,
+            'approved_at': now,
+            'remarks': p_remarks,
+            'monthly_installment': p_monthly_installment,
+            'total_repayable': p_total_repayable,
+            'updated_at': now
+        }).eq('id', p_application_id).eq('status', 'pending').execute().data
+        if not updated:
+            raise APIError({'code': 'P0001', 'message': 'Application already processed', 'details': None, 'hint': None})
+        client.insert_rows('loan_repayments', [dict(
+            installment, loan_application_id=p_application_id, member_id=updated[0]['member_id'],
+            status='pending', created_at=now, updated_at=now
+        ) for installment in p_schedule])
+        client.insert_rows('loan_activity_log', [{
+            'loan_application_id': p_application_id,
+            'action': 'application_approved',
+            'description': p_description,
+            'performed_by': p_approved_by,
+            'ip_address': p_ip_address,
+            'user_agent': p_user_agent,
+            'created_at': now
+        }])
+    return len(p_schedule)
+
+
+def _posting_error(message):
+    return APIError({'code': 'P0001', 'message': message, 'details': None, 'hint': None})
+
+
+def _rpc_post_savings_entry(client, p_account_id, p_amount, p_transaction, p_transaction_id=None,
+                            p_require_funds=False):
+    amount = Decimal(str(p_amount))
+    with client.transaction():
+        accounts = client.table('savings_accounts').select('id, current_balance, available_balance')\
+            .eq('id', p_account_id).execute().data
+        if not accounts:
+            raise _posting_error('Savings account not found')
+        if p_transaction_id:
+            pending = client.table('savings_transactions').select('savings_account_id, status')\
+                .eq('id', p_transaction_id).execute().data
+            if not pending or pending[0]['savings_account_id'] != p_account_id:
+                raise _posting_error('Savings transaction not found for this account')
+            if pending[0]['status'] != 'pending':
+                raise _posting_error(f"Savings transaction is already {pending[0]['status'] or 'posted'}")
+        before = Decimal(str(accounts[0]['current_balance'] or 0))
+        available = Decimal(str(accounts[0]['available_balance'] or 0)) + amount
+        if p_require_funds and available < 0:
+            raise _posting_error(f'Insufficient funds. Available: UGX {available - amount:,.0f}')
+        after = before + amount
+        client.table('savings_accounts').update({
+            'current_balance': float(after),
+            'available_balance': float(available),
+            'updated_at': datetime.now().isoformat()
+        }).eq('id', p_account_id).execute()
+
+        row = dict(p_transaction, savings_account_id=p_account_id, balance_before=str(before), balance_after=str(after))
+        if p_transaction_id:
+            client.table('savings_transactions').update(row).eq('id', p_transaction_id).execute()
+            transaction_id = p_transaction_id
+        else:
+            transaction_id = client.insert_rows('savings_transactions', [row])[0]['id']
+    return {'transaction_id': transaction_id, 'balance_before': str(before), 'balance_after': str(after)}
+
+
+def _rpc_post_loan_entry(client, p_amount, p_transaction, p_account_id=None, p_member_id=None,
+                         p_floor_zero=False, p_require_balance=False, p_transaction_id=None):
+    amount = Decimal(str(p_amount))
+    with client.transaction():
+        query = client.table('loan_accounts').select('id, current_balance, credit_limit')
+        query = query.eq('id', p_account_id) if p_account_id else query.eq('member_id', p_member_id)
+        accounts = query.execute().data
+        if not accounts:
+            raise _posting_error('Member does not have a loan account')
+        account = accounts[0]
+        if p_transaction_id:
+            pending = client.table('loan_transactions').select('loan_account_id, payment_method')\
+                .eq('id', p_transaction_id).execute().data
+            if not pending or pending[0]['loan_account_id'] != account['id']:
+                raise _posting_error('Loan transaction not found for this account')
+            if pending[0]['payment_method'] not in ('pesapal', 'pesapal_pending'):
+                raise _posting_error(f"Loan transaction is not pending ({pending[0]['payment_method'] or 'posted'})")
+        before = Decimal(str(account['current_balance'] or 0))
+        after = before + amount
+        if p_floor_zero:
+            after = max(Decimal('0'), after)
+        if p_require_balance and after < 0:
+            raise _posting_error(f'Repayment amount ({-amount}) exceeds current balance ({before})')
+        client.table('loan_accounts').update({
+            'current_balance': str(after),
+            'available_limit': str(Decimal(str(account.get('credit_limit') or 0)) - after),
+            'updated_at': datetime.now().isoformat()
+        }).eq('id', account['id']).execute()
+
+        row = dict(p_transaction, loan_account_id=account['id'], balance_before=str(before), balance_after=str(after))
+        if p_transaction_id:
+            client.table('loan_transactions').update(row).eq('id', p_transaction_id).execute()
+            transaction_id = p_transaction_id
+        else:
+            transaction_id = client.insert_rows('loan_transactions', [row])[0]['id']
+    return {'transaction_id': transaction_id, 'balance_before': str(before), 'balance_after': str(after)}
+
+
+def _rpc_admin_kpis(client, p_today, p_month_start, p_last_month_start):
+    def one(table, sql, params=()):
+        if not client.table_exists(table):
+            return {}
+        return client.fetch(table, sql, params)[0]
+
+    kpis = {}
+    kpis.update(one('members', """
+        SELECT COUNT(*) AS total_members,
+               SUM(account_status = 'active') AS active_members,
+               SUM(account_status = 'pending') AS pending_members,
+               SUM(created_at >= ?) AS new_members_this_month,
+               SUM(created_at >= ? AND created_at < ?) AS new_members_last_month,
+               SUM(COALESCE(shares_owned, 0)) AS total_shares,
+               SUM(COALESCE(shares_owned, 0) > 0) AS shareholders
+        FROM members""", (p_month_start, p_last_month_start, p_month_start)))
+    kpis.update(one('loan_applications', """
+        SELECT SUM(status = 'disbursed') AS active_loans,
+               SUM(CASE WHEN status = 'disbursed' THEN loan_amount ELSE 0 END) AS total_loan_amount,
+               SUM(status = 'pending') AS pending_loans
+        FROM loan_applications"""))
+    kpis.update(one('loan_repayments', """
+        SELECT SUM(COALESCE(due_amount, 0)) AS total_due,
+               SUM(COALESCE(paid_amount, 0)) AS total_paid,
+               SUM(CASE WHEN paid_date = ? THEN paid_amount ELSE 0 END) AS today_income,
+               SUM(CASE WHEN paid_date >= ? THEN paid_amount ELSE 0 END) AS month_income,
+               SUM(CASE WHEN paid_date >= ? AND paid_date < ? THEN paid_amount ELSE 0 END) AS last_month_income
+        FROM loan_repayments""", (p_today, p_month_start, p_last_month_start, p_month_start)))
+    kpis.update(one('savings_accounts', """
+        SELECT COUNT(*) AS savings_accounts, SUM(COALESCE(current_balance, 0)) AS total_savings
+        FROM savings_accounts"""))
+    kpis.update(one('expenses', """
+        SELECT SUM(amount) AS month_expenses
+        FROM expenses
+        WHERE status = 'approved' AND payment_date >= ?""", (p_month_start,)))
+    return kpis
+
+
+def _rpc_status_facets(client, p_list, p_search=None):
+    lists = {
+        'loan_applications': ('a.status', """loan_applications a
+            LEFT JOIN members m ON m.id = a.member_id""", ['a.account_number', 'm.full_name']),
+        'loan_repayments': ('r.status', """loan_repayments r
+            LEFT JOIN members m ON m.id = r.member_id
+            LEFT JOIN loan_applications a ON a.id = r.loan_application_id""", ['m.full_name', 'a.account_number']),
+        'members': ('account_status', 'members', ['full_name', 'email', 'phone_number', 'member_number'])
+    }
+    if p_list not in lists:
+        raise APIError({'code': 'P0001', 'message': f'Unknown facet list {p_list}', 'details': None, 'hint': None})
+    if not client.table_exists(p_list):
+        return {}
+    status, source, search_columns = lists[p_list]
+    where, params = '', ()
+    if p_search:
+        where = 'WHERE ' + ' OR '.join(f'{column} LIKE ?' for column in search_columns)
+        params = (f'%{p_search}%',) * len(search_columns)
+    rows = client.fetch(p_list, f"""
+        SELECT COALESCE({status}, 'unknown') AS status, COUNT(*) AS total
+        FROM {source}
+        {where}
+        GROUP BY 1""", params)
+    return {row['status']: row['total'] for row in rows}
+
+def _share_register_top(client, limit):
+    return client.fetch('members', """
+        SELECT id, full_name, member_number, shares_owned
+        FROM members
+        WHERE shares_owned > 0
+        ORDER BY shares_owned DESC, member_number
+        LIMIT ?""", (limit,))
+
+
+def _build_share_register(client, top_n=None):
+    existing = client.table('share_register').select('top_n').eq('id', 1).execute().data \
+        if client.table_exists('share_register') else []
+    top_n = top_n or (existing[0]['top_n'] if existing else 10)
+    register = {'total_shares': 0, 'shareholders': 0, 'total_members': 0, 'top_n': top_n, 'top_shareholders': [],
+                'updated_at': datetime.now().isoformat()}
+    if client.table_exists('members'):
+        register.update(client.fetch('members', """
+            SELECT COALESCE(SUM(shares_owned), 0) AS total_shares, COALESCE(SUM(shares_owned > 0), 0) AS shareholders,
+                   COUNT(*) AS total_members
+            FROM members""")[0])
+        register['top_shareholders'] = _share_register_top(client, top_n)
+    if existing:
+        client.table('share_register').update(register).eq('id', 1).execute()
+    else:
+        client.insert_rows('share_register', [dict(register, id=1)])
+    return dict(register, id=1)
+
+
+def _rpc_refresh_share_register(client, p_top_n=None):
+    with client.transaction():
+        return _build_share_register(client, p_top_n)
+
+
+def _sync_share_register(client, member_id, before, after):
+    # Stands in for the share_register_sync() trigger on members
+    registers = client.table('share_register').select('*').eq('id', 1).execute().data \
+        if client.table_exists('share_register') else []
+    if not registers:
+        _build_share_register(client)
+        return
+    register = registers[0]
+    top = register['top_shareholders'] or []
+    changes = {
+        'total_shares': register['total_shares'] + after - before,
+        'shareholders': register['shareholders'] + (after > 0) - (before > 0),
+        'updated_at': datetime.now().isoformat()
+    }
+    if any(m['id'] == member_id for m in top) or \
+            (after > 0 and (len(top) < register['top_n'] or after >= top[-1]['shares_owned'])):
+        changes['top_shareholders'] = _share_register_top(client, register['top_n'])
+    client.table('share_register').update(changes).eq('id', 1).execute()
+
+
+def _rpc_post_share_entry(client, p_member_id, p_shares, p_transaction=None, p_transaction_id=None):
+    with client.transaction():
+        members = client.table('members').select('id, shares_owned').eq('id', p_member_id).execute().data
+        if not members:
+            raise _posting_error('Member not found')
+        client.ensure_columns('share_transactions', {'member_id': '', 'posted_at': ''})
+        if p_transaction_id:
+            pending = client.table('share_transactions').select('member_id, posted_at')\
+                .eq('id', p_transaction_id).execute().data
+            if not pending or pending[0]['member_id'] != p_member_id:
+                raise _posting_error('Share transaction not found for this member')
+            if pending[0]['posted_at']:
+                raise _posting_error('Share transaction was already posted')
+        before = int(members[0]['shares_owned'] or 0)
+        after = before + int(p_shares)
+        if after < 0:
+            raise _posting_error(f'Member only owns {before} shares')
+        client.table('members').update({
+            'shares_owned': after,
+            'updated_at': datetime.now().isoformat()
+        }).eq('id', p_member_id).execute()
+        _sync_share_register(client, p_member_id, before, after)
+
+        transaction_id = p_transaction_id
+        if p_transaction_id:
+            client.table('share_transactions').update(dict(p_transaction or {}, posted_at=datetime.now().isoformat()))\
+                .eq('id', p_transaction_id).execute()
+        elif p_transaction is not None:
+            transaction_id = client.insert_rows('share_transactions', [dict(
+                p_transaction, member_id=p_member_id, posted_at=datetime.now().isoformat())])[0]['id']
+    return {'transaction_id': transaction_id, 'shares_before': before, 'shares_after': after}
+
+
+def _rpc_monthly_share_statistics(client, p_since=None, p_transaction_type='purchase'):
+    if not client.table_exists('share_transactions'):
+        return []
+    return client.fetch('share_transactions', """
+        SELECT substr(transaction_date, 1, 7) AS month,
+               COALESCE(SUM(shares), 0) AS total_shares,
+               COALESCE(SUM(COALESCE(total_amount, shares * price_per_share)), 0) AS total_amount,
+               COUNT(*) AS transaction_count,
+               CASE WHEN SUM(shares) > 0
+                    THEN SUM(COALESCE(total_amount, shares * price_per_share)) * 1.0 / SUM(shares)
+                    ELSE 0 END AS average_price
+        FROM share_transactions
+        WHERE transaction_type = ? AND (? IS NULL OR transaction_date >= ?)
+        GROUP BY 1
+        ORDER BY 1 DESC""", (p_transaction_type, p_since, p_since))
+
+
+def _savings_batch(client, entries):
+    if not entries:
+        return {'accounts': 0, 'transactions': 0, 'total_amount': 0}
+    account_ids = list(dict.fromkeys(e['savings_account_id'] for e in entries))
+    balances = {}
+    for i in range(0, len(account_ids), 500):
+        chunk = account_ids[i:i + 500]
+        for row in client.fetch('savings_accounts', f"""
+                SELECT id, current_balance FROM savings_accounts
+                WHERE id IN ({','.join('?' for _ in chunk)})""", chunk):
+            balances[row['id']] = Decimal(str(row['current_balance'] or 0))
+    if len(balances) != len(account_ids):
+        raise _posting_error('Savings account not found')
+
+    totals = dict.fromkeys(account_ids, Decimal('0'))
+    rows = []
+    for entry in entries:
+        amount = Decimal(str(entry['amount']))
+        before = balances[entry['savings_account_id']] + totals[entry['savings_account_id']]
+        totals[entry['savings_account_id']] += amount
+        rows.append(dict(entry.get('transaction') or {}, savings_account_id=entry['savings_account_id'],
+                         amount=str(amount), balance_before=str(before), balance_after=str(before + amount)))
+    client.insert_rows('savings_transactions', rows)
+    now = datetime.now().isoformat()
+    client.conn.executemany("""
+        UPDATE savings_accounts
+        SET current_balance = current_balance + ?, available_balance = available_balance + ?, updated_at = ?
+        WHERE id = ?""", [(float(total), float(total), now, account_id) for account_id, total in totals.items()])
+    return {'accounts': len(totals), 'transactions': len(rows), 'total_amount': str(sum(totals.values()))}
+
+
+def _rpc_post_savings_batch(client, p_entries):
+    with client.transaction():
+        return _savings_batch(client, p_entries)
+
+
+def _rpc_compute_dividend(client, p_declaration_id):
+    with client.transaction():
+        declarations = client.table('dividend_declarations').select('*').eq('id', p_declaration_id).execute().data
+        if not declarations:
+            raise _posting_error('Dividend declaration not found')
+        d = declarations[0]
+        if d['status'] == 'posted':
+            raise _posting_error('Dividend has already been posted')
+
+        start, end = d['period_start'][:10], d['period_end'][:10]
+        days = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+        prices = client.table('share_value').select('value_per_share').lte('effective_date', end)\
+            .order('effective_date', desc=True).limit(1).execute().data if client.table_exists('share_value') else []
+        price = Decimal(str(prices[0]['value_per_share'])) if prices else None
+        if d['payout'] == 'shares' and not price:
+            raise _posting_error(f'No share price on or before {end}')
+
+        unfinished = """AND NOT EXISTS (SELECT 1 FROM share_payment_sessions s
+                                        WHERE s.reference_id = t.reference AND s.status <> 'completed')""" \
+            if client.table_exists('share_payment_sessions') else ''
+        moves = f"""
+            SELECT t.member_id, substr(t.transaction_date, 1, 10) AS day,
+                   CASE WHEN t.transaction_type = 'sale' THEN -ABS(t.shares) ELSE t.shares END AS delta
+            FROM share_transactions t
+            WHERE substr(t.transaction_date, 1, 10) > ? {unfinished}""" \
+            if client.table_exists('share_transactions') else 'SELECT NULL AS member_id, NULL AS day, 0 AS delta WHERE ? IS NULL'
+        held = client.fetch('members', f"""
+            SELECT m.id AS member_id,
+                   COALESCE(m.shares_owned, 0) - COALESCE(SUM(CASE WHEN mv.day > ? THEN mv.delta END), 0) AS closing,
+                   COALESCE(SUM(CASE WHEN mv.day <= ? THEN mv.delta * (julianday(mv.day) - julianday(?)) END), 0) AS shift
+            FROM members m
+            LEFT JOIN ({moves}) mv ON mv.member_id = m.id
+            GROUP BY m.id""", (end, end, start, start))
+
+        weights = {}
+        for row in held:
+            closing = Decimal(str(row['closing']))
+            weight = closing if d['method'] == 'pro_rata' else (closing * days - Decimal(str(row['shift']))) / days
+            if weight > 0:
+                weights[row['member_id']] = weight
+        total_weight = sum(weights.values())
+        accounts = {}
+        for row in client.fetch('savings_accounts', 'SELECT member_id, id FROM savings_accounts ORDER BY created_at'):
+            accounts.setdefault(row['member_id'], row['id'])
+
+        pool = Decimal(str(d['total_amount']))
+        allocations = []
+        for member_id, weight in weights.items():
+            amount = (pool * weight / total_weight).to_integral_value(rounding='ROUND_FLOOR')
+            if amount <= 0:
+                continue
+            shares = int(amount // price) if d['payout'] == 'shares' else 0
+            cash = amount - shares * (price or 0)
+            account_id = accounts.get(member_id)
+            allocations.append({
+                'declaration_id': p_declaration_id, 'member_id': member_id, 'savings_account_id': account_id,
+                'weight': str(weight.quantize(Decimal('0.0001'))), 'amount': str(amount), 'shares_awarded': shares,
+                'cash_amount': str(cash), 'status': 'no_account' if cash > 0 and not account_id else 'pending',
+                'paid_at': None
+            })
+        if client.table_exists('dividend_allocations'):
+            client.table('dividend_allocations').delete().eq('declaration_id', p_declaration_id).execute()
+        client.insert_rows('dividend_allocations', allocations)
+
+        changes = {
+            'status': 'computed',
+            'share_price': str(price) if price is not None else None,
+            'shareholders': len(allocations),
+            'total_weight': str(sum((Decimal(a['weight']) for a in allocations), Decimal('0'))),
+            'allocated_amount': str(sum((Decimal(a['amount']) for a in allocations), Decimal('0'))),
+            'computed_at': datetime.now().isoformat()
+        }
+        return client.table('dividend_declarations').update(changes).eq('id', p_declaration_id).execute().data[0]
+
+
+def _rpc_post_dividend(client, p_declaration_id, p_posted_by=None):
+    with client.transaction():
+        now = datetime.now().isoformat()
+        claimed = client.table('dividend_declarations').update({
+            'status': 'posted', 'posted_by': p_posted_by, 'posted_at': now
+        }).eq('id', p_declaration_id).eq('status', 'computed').execute().data
+        if not claimed:
+            raise _posting_error('Dividend has already been posted or has not been computed')
+        d = claimed[0]
+        reference = f"DIV-{p_declaration_id[:8].upper()}"
+        allocations = client.table('dividend_allocations').select('*')\
+            .eq('declaration_id', p_declaration_id).in_('status', ['pending', 'no_account']).execute().data
+
+        savings = _savings_batch(client, [_dividend_credit(a, d, p_posted_by, now)
+                                          for a in sorted(allocations, key=lambda a: a['savings_account_id'] or '')
+                                          if a['status'] == 'pending' and Decimal(str(a['cash_amount'])) > 0])
+
+        top_ups = [a for a in allocations if a['shares_awarded'] > 0]
+        if top_ups:
+            client.conn.executemany("""
+                UPDATE members SET shares_owned = COALESCE(shares_owned, 0) + ?, updated_at = ? WHERE id = ?""",
+                [(a['shares_awarded'], now, a['member_id']) for a in top_ups])
+            client.insert_rows('share_transactions', [{
+                'member_id': a['member_id'], 'shares': a['shares_awarded'], 'price_per_share': d['share_price'],
+                'total_amount': float(Decimal(str(d['share_price'])) * a['shares_awarded']),
+                'currency': 'UGX', 'transaction_type': 'dividend', 'reference': reference,
+                'notes': f"Dividend: {d['title']}", 'payment_method': 'dividend', 'transaction_date': now,
+                'processed_by': p_posted_by, 'updated_at': now
+            } for a in top_ups])
+            # The members trigger keeps the register current in the database; rebuild it here
+            _build_share_register(client)
+
+        client.table('dividend_allocations').update({'status': 'paid', 'paid_at': now})\
+            .eq('declaration_id', p_declaration_id).eq('status', 'pending').execute()
+    return {'declaration_id': p_declaration_id, 'savings_credits': savings['transactions'],
+            'savings_amount': savings['total_amount'], 'share_top_ups': len(top_ups),
+            'unpaid_remainders': sum(a['status'] == 'no_account' for a in allocations)}
+
+
+def _dividend_credit(allocation, declaration, processed_by, now):
+    return {
+        'savings_account_id': allocation['savings_account_id'],
+        'amount': allocation['cash_amount'],
+        'transaction': {
+            'member_id': allocation['member_id'], 'transaction_type': 'dividend', 'currency': 'UGX',
+            'reference_number': f"DIV-{allocation['id'].replace('-', '').upper()}",
+            'description': f"Dividend: {declaration['title']}",
+            'processed_by': processed_by, 'status': 'completed', 'created_at': now
+        }
+    }
+
+
+def _rpc_pay_dividend_remainders(client, p_declaration_id, p_paid_by=None):
+    with client.transaction():
+        declarations = client.table('dividend_declarations').select('*').eq('id', p_declaration_id).execute().data
+        if not declarations or declarations[0]['status'] != 'posted':
+            raise _posting_error('Dividend has not been posted')
+        d = declarations[0]
+        now = datetime.now().isoformat()
+        accounts = {}
+        for row in client.fetch('savings_accounts', 'SELECT member_id, id FROM savings_accounts ORDER BY created_at'):
+            accounts.setdefault(row['member_id'], row['id'])
+        waiting = client.table('dividend_allocations').select('*')\
+            .eq('declaration_id', p_declaration_id).eq('status', 'no_account').execute().data
+        payable = [dict(a, savings_account_id=accounts[a['member_id']]) for a in waiting if a['member_id'] in accounts]
+        client.conn.executemany("""
+            UPDATE dividend_allocations SET savings_account_id = ?, status = 'paid', paid_at = ? WHERE id = ?""",
+            [(a['savings_account_id'], now, a['id']) for a in payable])
+        savings = _savings_batch(client, [_dividend_credit(a, d, p_paid_by, now)
+                                          for a in sorted(payable, key=lambda a: a['savings_account_id'])])
+    return {'declaration_id': p_declaration_id, 'savings_credits': savings['transactions'],
+            'savings_amount': savings['total_amount'], 'unpaid_remainders': len(waiting) - len(payable)}
+
+
+def _rpc_member_contact_matches(client, p_emails, p_phones):
+    if not client.table_exists('members') or not (p_emails or p_phones):
+        return []
+    emails, phones = list(p_emails or []), list(p_phones or [])
+    return client.fetch('members', f"""
+        SELECT LOWER(email) AS email, phone_number, member_number FROM members
+        WHERE LOWER(email) IN ({','.join('?' for _ in emails) or 'NULL'})
+           OR phone_number IN ({','.join('?' for _ in phones) or 'NULL'})""", emails + phones)
+
+
+def _rpc_onboard_member_batch(client, p_import_id, p_limit=200, p_performed_by=None):
+    with client.transaction():
+        pending = client.table('member_import_rows').select('id, email, phone_number, member_data')\
+            .eq('import_id', p_import_id).eq('status', 'pending').order('row_number').limit(p_limit).execute().data
+        # Contacts registered since the import was staged; client.transaction() holds the client
+        # lock, which serializes concurrent batches the way the advisory locks do in the database
+        matches = _rpc_member_contact_matches(client, [(row['email'] or '').lower() for row in pending],
+                                              [row['phone_number'] for row in pending]) if pending else []
+        by_email = {match['email']: match['member_number'] for match in matches}
+        by_phone = {match['phone_number']: match['member_number'] for match in matches}
+        duplicates = []
+        for row in pending:
+            if (row['email'] or '').lower() in by_email:
+                duplicates.append((f"Email already registered ({by_email[(row['email'] or '').lower()]})", row['id']))
+            elif row['phone_number'] in by_phone:
+                duplicates.append((f"Phone number already registered ({by_phone[row['phone_number']]})", row['id']))
+        if duplicates:
+            client.conn.executemany("""
+                UPDATE member_import_rows SET status = 'duplicate', message = ? WHERE id = ?""", duplicates)
+            client.conn.execute("""
+                UPDATE member_imports SET duplicate_rows = duplicate_rows + ?, updated_at = ? WHERE id = ?""",
+                (len(duplicates), datetime.now().isoformat(), p_import_id))
+            taken = {row_id for _, row_id in duplicates}
+            pending = [row for row in pending if row['id'] not in taken]
+        if pending:
+            now = datetime.now()
+            # The members trigger numbers new members in the database
+            last = client.fetch('members', """
+                SELECT MAX(CAST(SUBSTR(member_number, 4) AS INTEGER)) AS n FROM members
+                WHERE member_number LIKE 'MEM%'""")[0]['n'] if 'member_number' in client.columns('members') else None
+            members = [dict(row['member_data'], id=str(uuid.uuid4()), member_number=f"MEM{(last or 0) + i + 1:06d}")
+                       for i, row in enumerate(pending)]
+            client.insert_rows('members', members)
+            suffix = now.strftime('%H%M%S')
+            client.insert_rows('savings_accounts', [{
+                'member_id': m['id'], 'account_number': f"SAV{m['id'][:8].upper()}{suffix}",
+                'account_name': f"Savings - {m['full_name']}", 'account_type': 'regular', 'current_balance': 0.0,
+                'available_balance': 0.0, 'minimum_balance': 1000.0, 'interest_rate': 3.0, 'status': 'active',
+                'opened_at': now.isoformat(), 'updated_at': now.isoformat()
+            } for m in members])
+            client.insert_rows('loan_accounts', [{
+                'member_id': m['id'], 'account_number': f"LOAN{m['id'][:8].upper()}{suffix}", 'credit_limit': 100000.0,
+                'current_balance': 0.0, 'available_limit': 100000.0, 'interest_rate': 12.0,
+                'max_loan_amount': 5000000.0, 'min_loan_amount': 10000.0, 'repayment_period_months': 12,
+                'status': 'active', 'credit_score': 700, 'opened_at': now.isoformat(), 'updated_at': now.isoformat()
+            } for m in members])
+            client.insert_rows('member_audit_log', [{
+                'member_id': m['id'], 'action': 'bulk_onboarded',
+                'description': f"Member and accounts created by bulk import {p_import_id}",
+                'performed_by': p_performed_by
+            } for m in members])
+            client.ensure_columns('member_import_rows', {'member_id': '', 'member_number': ''})
+            client.conn.executemany("""
+                UPDATE member_import_rows SET status = 'created', member_id = ?, member_number = ? WHERE id = ?""",
+                [(m['id'], m['member_number'], row['id']) for m, row in zip(members, pending)])
+            client.conn.execute("""
+                UPDATE member_imports SET created_rows = created_rows + ?, updated_at = ? WHERE id = ?""",
+                (len(members), now.isoformat(), p_import_id))
+            # The members triggers keep the register (member count included) current in the database
+            _build_share_register(client)
+        remaining = client.fetch('member_import_rows', """
+            SELECT COUNT(*) AS n FROM member_import_rows WHERE import_id = ? AND status = 'pending'""",
+            [p_import_id])[0]['n']
+    return {'created': len(pending), 'duplicates': len(duplicates), 'remaining': remaining}
+
+
+def _rpc_statement_activity(client, p_start, p_end, p_after=None, p_limit=500):
+    if not client.table_exists('members'):
+        return []
+    query = client.table('members').select('id, full_name, member_number, email, phone_number')\
+        .eq('account_status', 'active')
+    if p_after:
+        query = query.gt('id', p_after)
+    page = query.order('id').limit(p_limit).execute().data
+    ids = [m['id'] for m in page]
+    until = (date.fromisoformat(str(p_end)[:10]) + timedelta(days=1)).isoformat()
+
+    def grouped(table, select, date_column, upper, operator):
+        rows = {}
+        if not client.table_exists(table):
+            return rows
+        query = client.table(table).select(select).in_('member_id', ids).gte(date_column, str(p_start))
+        for row in getattr(query, operator)(date_column, upper).order(date_column, desc=True).execute().data:
+            rows.setdefault(row['member_id'], []).append(row)
+        return rows
+
+    def first(table):
+        if not client.table_exists(table):
+            return {}
+        accounts = {}
+        for row in client.table(table).select('*').in_('member_id', ids).execute().data:
+            accounts.setdefault(row['member_id'], row)
+        return accounts
+
+    def total(rows, transaction_type):
+        return float(sum(Decimal(str(r['amount'])) for r in rows if r.get('transaction_type') == transaction_type))
+
+    savings_accounts, loan_accounts = first('savings_accounts'), first('loan_accounts')
+    savings = grouped('savings_transactions', '*', 'created_at', until, 'lt')
+    loans = grouped('loan_transactions', '*', 'created_at', until, 'lt')
+    repayments = grouped('loan_repayments', '*, loan_applications(loan_amount, purpose)', 'paid_date',
+                         str(p_end)[:10], 'lte')
+    return [{
+        'member': member,
+        'savings_account': savings_accounts.get(member['id']),
+        'loan_account': loan_accounts.get(member['id']),
+        'savings_transactions': savings.get(member['id'], []),
+        'loan_transactions': loans.get(member['id'], []),
+        'repayments': repayments.get(member['id'], []),
+        'total_deposits': total(savings.get(member['id'], []), 'deposit'),
+        'total_withdrawals': total(savings.get(member['id'], []), 'withdrawal'),
+        'total_repayments': total(loans.get(member['id'], []), 'repayment'),
+        'total_disbursements': total(loans.get(member['id'], []), 'disbursement')
+    } for member in page]
+
+
+def _statement_list(client, table, columns, date_column, p_member_id, since, until, p_before, p_before_id, p_limit,
+                    extra=''):
+    if not client.table_exists(table):
+        return []
+    available = client.columns(table)
+    select = ', '.join(f't."{c}"' if c in available else f'NULL AS "{c}"' for c in columns)
+    sql = f"""SELECT {select}{extra} FROM "{table}" t WHERE t.member_id = ? AND t.{date_column} >= ?
+              AND t.{date_column} < ?"""
+    params = [p_member_id, since, until]
+    if p_before:
+        sql += f" AND (t.{date_column} < ? OR (t.{date_column} = ? AND t.id < ?))"
+        params += [p_before, p_before, p_before_id]
+    return client.fetch(table, f"{sql} ORDER BY t.{date_column} DESC, t.id DESC LIMIT ?", params + [p_limit])
+
+
+def _rpc_statement_transactions(client, p_member_id, p_kind, p_start, p_end, p_before=None, p_before_id=None,
+                                p_limit=50):
+    until = (date.fromisoformat(str(p_end)[:10]) + timedelta(days=1)).isoformat()
+    if p_kind == 'repayments':
+        purpose = ", (SELECT purpose FROM loan_applications a WHERE a.id = t.loan_application_id) AS purpose" \
+            if client.table_exists('loan_applications') and 'purpose' in client.columns('loan_applications') else \
+            ", NULL AS purpose"
+        return _statement_list(client, 'loan_repayments', ['id', 'installment_number', 'due_date', 'paid_date',
+                                                           'due_amount', 'paid_amount', 'status'],
+                               'paid_date', p_member_id, str(p_start), until, p_before, p_before_id, p_limit, purpose)
+    if p_kind not in ('savings', 'loan', 'all'):
+        raise _posting_error(f"Unknown statement list {p_kind}")
+    columns = ['id', 'created_at', 'transaction_type', 'amount', 'description', 'reference_number']
+    rows = []
+    for table, source in (('savings_transactions', 'savings'), ('loan_transactions', 'loan')):
+        if p_kind in (source, 'all'):
+            rows += [dict(row, source=source) for row in _statement_list(
+                client, table, columns, 'created_at', p_member_id, str(p_start), until, p_before, p_before_id,
+                p_limit)]
+    rows.sort(key=lambda r: (r['created_at'] or '', r['id']), reverse=True)
+    return rows[:p_limit]
+
+
+def _rpc_statement_summary(client, p_member_id, p_start, p_end, p_sample=0):
+    until = (date.fromisoformat(str(p_end)[:10]) + timedelta(days=1)).isoformat()
+
+    def account(table):
+        if not client.table_exists(table):
+            return None
+        rows = client.table(table).select('*').eq('member_id', p_member_id).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def totals(table, date_column, upper, sums):
+        if not client.table_exists(table):
+            return dict({'count': 0}, **{name: 0 for name in sums})
+        select = ', '.join(f"COALESCE(SUM({expression}), 0) AS {name}" for name, expression in sums.items())
+        return client.fetch(table, f"""
+            SELECT COUNT(*) AS count, {select} FROM "{table}"
+            WHERE member_id = ? AND {date_column} >= ? AND {date_column} < ?""",
+                            (p_member_id, str(p_start), upper))[0]
+
+    summary = {
+        'savings_account': account('savings_accounts'),
+        'loan_account': account('loan_accounts'),
+        'savings': totals('savings_transactions', 'created_at', until, {
+            'deposits': "CASE WHEN transaction_type = 'deposit' THEN amount END",
+            'withdrawals': "CASE WHEN transaction_type = 'withdrawal' THEN amount END"}),
+        'loan': totals('loan_transactions', 'created_at', until, {
+            'repayments': "CASE WHEN transaction_type = 'repayment' THEN amount END",
+            'disbursements': "CASE WHEN transaction_type = 'disbursement' THEN amount END"}),
+        'repayments': totals('loan_repayments', 'paid_date', until, {'paid': 'paid_amount'}),
+        'samples': None
+    }
+    if p_sample:
+        summary['samples'] = {kind: _rpc_statement_transactions(client, p_member_id, kind, p_start, p_end,
+                                                                p_limit=p_sample)
+                              for kind in ('savings', 'loan', 'repayments')}
+    return summary
+
+
+LOCAL_RPC_FUNCTIONS = {
+    'reserve_document_numbers': _rpc_reserve_document_numbers,
+    'claim_processed_order': _rpc_claim_processed_order,
+    'approve_loan_application': _rpc_approve_loan_application,
+    'post_savings_entry': _rpc_post_savings_entry,
+    'post_loan_entry': _rpc_post_loan_entry,
+    'admin_kpis': _rpc_admin_kpis,
+    'status_facets': _rpc_status_facets,
+    'refresh_share_register': _rpc_refresh_share_register,
+    'post_share_entry': _rpc_post_share_entry,
+    'monthly_share_statistics': _rpc_monthly_share_statistics,
+    'post_savings_batch': _rpc_post_savings_batch,
+    'compute_dividend': _rpc_compute_dividend,
+    'post_dividend': _rpc_post_dividend,
+    'pay_dividend_remainders': _rpc_pay_dividend_remainders,
+    'member_contact_matches': _rpc_member_contact_matches,
+    'onboard_member_batch': _rpc_onboard_member_batch,
+    'statement_activity': _rpc_statement_activity,
+    'statement_transactions': _rpc_statement_transactions,
+    'statement_summary': _rpc_statement_summary
+}
+
+
+class LocalSupabase:
+    """SQLite-backed stand-in for the Supabase client (table() and rpc() only)"""
+
+    def __init__(self, db_path=':memory:'):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.lock = threading.RLock()
+        self.rpc_functions = dict(LOCAL_RPC_FUNCTIONS)
+        self._columns = {}
+        self._column_types = {}
+        self._in_batch = False
+        self._load_schema()
+
+    def _load_schema(self):
+        # Reopen an existing database file (e.g. one built by generate_sacco_data)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS _column_types (tbl TEXT, col TEXT, kind TEXT, PRIMARY KEY (tbl, col))')
+        tables = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != '_column_types'").fetchall()
+        for (table,) in tables:
+            info = self.conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            self._columns[table] = [c[1] for c in info]
+        for table, column, kind in self.conn.execute('SELECT tbl, col, kind FROM _column_types'):
+            self._column_types[(table, column)] = kind
+
+    # Supabase client API
+    def table(self, name):
+        return LocalQueryBuilder(self, name)
+
+    def from_(self, name):
+        return self.table(name)
+
+    def rpc(self, name, params=None, **kwargs):
+        return LocalRPCBuilder(self, name, params)
+
+    def register_rpc(self, name, handler):
+        """Register a Python implementation of a database function"""
+        self.rpc_functions[name] = handler
+
+    # Schema helpers
+    def table_exists(self, table):
+        return table in self._columns
+
+    def columns(self, table):
+        return self._columns.get(table, [])
+
+    def column_type(self, table, column):
+        return self._column_types.get((table, column))
+
+    def ensure_columns(self, table, record):
+        """Create the table and any new columns seen in record"""
+        if table not in self._columns:
+            self.conn.execute(f'CREATE TABLE "{table}" (id TEXT PRIMARY KEY)')
+            self._columns[table] = ['id']
+        for column, value in record.items():
+            if column in self._columns[table]:
+                continue
+            if isinstance(value, bool):
+                affinity, kind = 'INTEGER', 'bool'
+            elif isinstance(value, (int, float)):
+                affinity, kind = 'NUMERIC', 'number'
+            elif isinstance(value, (dict, list)):
+                affinity, kind = 'TEXT', 'json'
+            else:
+                affinity, kind = 'TEXT', 'text'
+            self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {affinity}')
+            self.conn.execute('INSERT OR REPLACE INTO _column_types VALUES (?, ?, ?)', (table, column, kind))
+            self._columns[table].append(column)
+            self._column_types[(table, column)] = kind
+
+    def create_index(self, table, column):
+        if column in self.columns(table):
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON "{table}" ("{column}")')
+            self.commit()
+
+    def commit(self):
+        if not self._in_batch:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """All-or-nothing block for RPC twins (mirrors a plpgsql function body)"""
+        with self.lock:
+            self.conn.commit()
+            self._in_batch = True
+            try:
+                yield
+            except Exception:
+                self.conn.rollback()
+                # Columns added inside the block were rolled back too
+                self._columns, self._column_types = {}, {}
+                self._load_schema()
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                self._in_batch = False
+
+    # Row helpers
+    def fetch(self, table, sql, params=()):
+        cursor = self.conn.execute(sql, params)
+        names = [d[0] for d in cursor.description]
+        rows = []
+        for values in cursor.fetchall():
+            row = {}
+            for name, value in zip(names, values):
+                kind = self._column_types.get((table, name))
+                if kind == 'bool' and value is not None:
+                    value = bool(value)
+                elif kind == 'json' and isinstance(value, str):
+                    value = json.loads(value)
+                row[name] = value
+            rows.append(row)
+        return rows
+
+    def insert_rows(self, table, records):
+        """Insert records, filling id and created_at like the database defaults"""
+        if not records:
+            return []
+        now = datetime.now().isoformat()
+        prepared = []
+        for record in records:
+            row = dict(record)
+            row.setdefault('id', str(uuid.uuid4()))
+            row.setdefault('created_at', now)
+            prepared.append(row)
+
+        for row in prepared:
+            self.ensure_columns(table, row)
+
+        # Group by column set so executemany can be used for bulk inserts
+        groups = {}
+        for row in prepared:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+        for columns, rows in groups.items():
+            sql = f'INSERT INTO "{table}" ({",".join(f"{chr(34)}{c}{chr(34)}" for c in columns)}) ' \
+                  f'VALUES ({",".join("?" for _ in columns)})'
+            try:
+                self.conn.executemany(sql, [[_to_db_value(r[c]) for c in columns] for r in rows])
+            except sqlite3.IntegrityError as e:
+                raise APIError({'code': '23505', 'message': f'duplicate key value violates unique constraint: {e}',
+                                'details': None, 'hint': None})
+        self.commit()
+
+        columns = self.columns(table)
+        return [{c: row.get(c) for c in columns} for row in prepared]
+
+    def embed(self, table, rows, embeds):
+        """Attach related rows for select('*, other_table(...)')"""
+        if not rows or not embeds:
+            return rows
+
+        for spec in embeds:
+            related = spec['table']
+            if not self.table_exists(related):
+                for row in rows:
+                    row[spec['alias']] = None
+                continue
+
+            plain, nested = _parse_select(spec['columns'])
+            fk = EMBED_KEYS.get(related, f"{related.rstrip('s')}_id")
+            reverse_fk = EMBED_KEYS.get(table, f"{table.rstrip('s')}_id")
+
+            if fk in self.columns(table):
+                # Many-to-one: rows point at the related table
+                keys = list({row.get(fk) for row in rows if row.get(fk) is not None})
+                related_rows = {}
+                for chunk in _chunks(keys, 900):
+                    found = self.fetch(related, f'SELECT * FROM "{related}" WHERE id IN ({",".join("?" for _ in chunk)})', chunk)
+                    for item in self.embed(related, found, nested):
+                        related_rows[item['id']] = item
+                for row in rows:
+                    item = related_rows.get(row.get(fk))
+                    if item is not None and '*' not in plain:
+                        item = {k: v for k, v in item.items() if k in plain or k in [n['alias'] for n in nested]}
+                    row[spec['alias']] = item
+            elif reverse_fk in self.columns(related):
+                # One-to-many: related rows point back at this table
+                keys = list({row['id'] for row in rows})
+                grouped = {}
+                for chunk in _chunks(keys, 900):
+                    found = self.fetch(related, f'SELECT * FROM "{related}" WHERE "{reverse_fk}" IN ({",".join("?" for _ in chunk)})', chunk)
+                    for item in self.embed(related, found, nested):
+                        grouped.setdefault(item[reverse_fk], []).append(item)
+                for row in rows:
+                    row[spec['alias']] = grouped.get(row['id'], [])
+            else:
+                for row in rows:
+                    row[spec['alias']] = None
+
+            if spec['inner']:
+                rows = [row for row in rows if row.get(spec['alias'])]
+
+        return rows
+
+    def bulk_insert(self, table, records, batch_size=5000):
+        """Insert many rows inside one transaction (used by the data generator)"""
+        self._in_batch = True
+        try:
+            for chunk in _chunks(records, batch_size):
+                self.insert_rows(table, chunk)
+        finally:
+            self._in_batch = False
+            self.conn.commit()
+
+
+def generate_sacco_data(client, members=10000, savings_transactions=1000000, seed=42, months=24):
+    """Populate the local database with realistic SACCO volumes"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    start = now - timedelta(days=30 * months)
+
+    def random_date():
+        return (start + timedelta(seconds=rng.randint(0, int((now - start).total_seconds())))).isoformat()
+
+    first_names = ['John', 'Mary', 'Peter', 'Sarah', 'David', 'Grace', 'Joseph', 'Ruth', 'Moses', 'Esther',
+                   'Paul', 'Agnes', 'Robert', 'Florence', 'Isaac', 'Harriet', 'Samuel', 'Prossy', 'Brian', 'Annet']
+    last_names = ['Okello', 'Nakato', 'Mugisha', 'Namubiru', 'Ssempala', 'Achieng', 'Kato', 'Nabirye',
+                  'Tumusiime', 'Atim', 'Wasswa', 'Nansubuga', 'Byaruhanga', 'Akello', 'Lubega']
+
+    print(f"🔄 Generating {members:,} members...")
+    member_rows, savings_rows, loan_rows = [], [], []
+    for i in range(members):
+        member_id = str(uuid.uuid4())
+        created = random_date()
+        name = f"{rng.choice(first_names)} {rng.choice(last_names)}"
+        member_rows.append({
+            'id': member_id,
+            'member_number': f"MEM{i + 1:06d}",
+            'full_name': name,
+            'email': f"member{i + 1}@example.com",
+            'phone_number': f"+2567{i:08d}",
+            'account_status': rng.choices(['active', 'inactive', 'suspended', 'pending'], [85, 8, 2, 5])[0],
+            'shares_owned': rng.randint(0, 200),
+            'password_hash': None,
+            'default_password_used': True,
+            'created_at': created,
+            'updated_at': created
+        })
+        savings_rows.append({
+            'id': str(uuid.uuid4()),
+            'member_id': member_id,
+            'account_number': f"SAV{member_id[:8]}{i:06d}",
+            'account_name': f"Savings - {name}",
+            'account_type': 'regular',
+            'current_balance': 0.0,
+            'available_balance': 0.0,
+            'minimum_balance': 1000.0,
+            'interest_rate': 3.0,
+            'status': 'active',
+            'opened_at': created,
+            'created_at': created,
+            'updated_at': created
+        })
+        loan_rows.append({
+            'id': str(uuid.uuid4()),
+            'member_id': member_id,
+            'account_number': f"LOAN{member_id[:8]}{i:06d}",
+            'credit_limit': 5000000.0,
+            'current_balance': 0.0,
+            'available_limit': 5000000.0,
+            'interest_rate': 12.0,
+            'max_loan_amount': 5000000.0,
+            'min_loan_amount': 10000.0,
+            'repayment_period_months': 12,
+            'status': 'active',
+            'credit_score': 700,
+            'opened_at': created,
+            'created_at': created,
+            'updated_at': created
+        })
+
+    client.bulk_insert('members', member_rows)
+    client.bulk_insert('loan_accounts', loan_rows)
+
+    print(f"🔄 Generating {savings_transactions:,} savings transactions...")
+    balances = {acc['id']: Decimal('0') for acc in savings_rows}
+    batch = []
+    for n in range(savings_transactions):
+        index = rng.randrange(members)
+        account = savings_rows[index]
+        balance = balances[account['id']]
+        if balance > 50000 and rng.random() < 0.25:
+            tx_type, amount = 'withdrawal', Decimal(rng.randrange(10000, int(balance) // 2, 1000))
+        else:
+            tx_type, amount = 'deposit', Decimal(rng.randrange(5000, 500000, 1000))
+        new_balance = balance + amount if tx_type == 'deposit' else balance - amount
+        balances[account['id']] = new_balance
+        batch.append({
+            'savings_account_id': account['id'],
+            'member_id': account['member_id'],
+            'transaction_type': tx_type,
+            'amount': float(amount),
+            'currency': 'UGX',
+            'payment_method': rng.choice(['cash', 'pesapal', 'mobile_money']),
+            'reference_number': f"TXN{n:09d}",
+            'description': f"{tx_type.title()} transaction",
+            'balance_before': float(balance),
+            'balance_after': float(new_balance),
+            'status': 'completed',
+            'created_at': random_date()
+        })
+        if len(batch) >= 50000:
+            client.bulk_insert('savings_transactions', batch)
+            batch = []
+            print(f"   ✓ {n + 1:,} transactions")
+    client.bulk_insert('savings_transactions', batch)
+
+    for account in savings_rows:
+        account['current_balance'] = float(balances[account['id']])
+        account['available_balance'] = float(balances[account['id']])
+    client.bulk_insert('savings_accounts', savings_rows)
+
+    print("🔄 Generating loans, shares and finance records...")
+    loan_products = [
+        {'id': str(uuid.uuid4()), 'name': 'Development Loan', 'interest_rate': 12.0, 'status': 'active'},
+        {'id': str(uuid.uuid4()), 'name': 'Emergency Loan', 'interest_rate': 18.0, 'status': 'active'},
+        {'id': str(uuid.uuid4()), 'name': 'School Fees Loan', 'interest_rate': 10.0, 'status': 'active'}
+    ]
+    client.bulk_insert('loan_products', loan_products)
+
+    applications, repayments, loan_transactions = [], [], []
+    for member, loan_account in zip(member_rows, loan_rows):
+        if rng.random() > 0.3:
+            continue
+        application_id = str(uuid.uuid4())
+        loan_amount = Decimal(rng.randrange(500000, 5000000, 50000))
+        months_term = rng.choice([6, 12, 18, 24])
+        created = random_date()
+        applications.append({
+            'id': application_id,
+            'member_id': member['id'],
+            'loan_product_id': rng.choice(loan_products)['id'],
+            'account_number': f"LA{application_id[:8].upper()}",
+            'loan_amount': float(loan_amount),
+            'interest_rate': 12.0,
+            'repayment_period': months_term,
+            'purpose': 'Business expansion',
+            'status': rng.choice(['pending', 'approved', 'disbursed', 'rejected']),
+            'created_at': created
+        })
+        loan_transactions.append({
+            'loan_account_id': loan_account['id'],
+            'member_id': member['id'],
+            'transaction_type': 'disbursement',
+            'amount': float(loan_amount),
+            'balance_before': 0.0,
+            'balance_after': float(loan_amount),
+            'payment_method': 'cash',
+            'reference_number': f"DISB-{application_id[:8].upper()}",
+            'created_at': created
+        })
+        installment = (loan_amount * Decimal('1.12') / months_term).quantize(Decimal('0.01'))
+        for m in range(months_term):
+            due = (datetime.fromisoformat(created) + timedelta(days=30 * (m + 1)))
+            paid = due < now and rng.random() < 0.8
+            repayments.append({
+                'loan_application_id': application_id,
+                'member_id': member['id'],
+                'installment_number': m + 1,
+                'due_date': due.date().isoformat(),
+                'due_amount': float(installment),
+                'principal_amount': float((loan_amount / months_term).quantize(Decimal('0.01'))),
+                'interest_amount': float((installment - loan_amount / months_term).quantize(Decimal('0.01'))),
+                'paid_amount': float(installment) if paid else '0',
+                'paid_date': due.date().isoformat() if paid else None,
+                'payment_method': 'cash' if paid else None,
+                'reference_number': f"REP-{application_id[:8].upper()}-{m + 1}" if paid else None,
+                'status': 'paid' if paid else 'pending'
+            })
+    client.bulk_insert('loan_applications', applications)
+    client.bulk_insert('loan_repayments', repayments)
+    client.bulk_insert('loan_transactions', loan_transactions)
+
+    client.bulk_insert('share_value', [
+        {'value_per_share': 1000 + 50 * m, 'currency': 'UGX',
+         'effective_date': (start + timedelta(days=30 * m)).date().isoformat()}
+        for m in range(0, months, 3)
+    ])
+    share_rows = []
+    for member in member_rows:
+        for _ in range(rng.randint(0, 4)):
+            shares = rng.randint(1, 50)
+            share_rows.append({
+                'member_id': member['id'],
+                'shares': shares,
+                'price_per_share': 1000.0,
+                'total_amount': float(shares * 1000),
+                'currency': 'UGX',
+                'transaction_type': rng.choices(['purchase', 'sale'], [9, 1])[0],
+                'payment_method': 'cash',
+                'transaction_date': random_date()
+            })
+    client.bulk_insert('share_transactions', share_rows)
+
+    expense_categories = [{'id': str(uuid.uuid4()), 'name': n, 'status': 'active'}
+                          for n in ['Rent', 'Salaries', 'Utilities', 'Stationery', 'Transport']]
+    income_categories = [{'id': str(uuid.uuid4()), 'name': n, 'status': 'active'}
+                         for n in ['Bank Interest', 'Donations', 'Penalties']]
+    client.bulk_insert('expense_categories', expense_categories)
+    client.bulk_insert('income_categories', income_categories)
+    client.bulk_insert('expenses', [{
+        'expense_number': f"EXP-{i:06d}",
+        'category_id': rng.choice(expense_categories)['id'],
+        'amount': float(rng.randrange(10000, 2000000, 1000)),
+        'payment_date': random_date()[:10],
+        'payment_method': 'cash',
+        'description': 'Operating expense',
+        'status': 'approved'
+    } for i in range(months * 40)])
+    client.bulk_insert('other_incomes', [{
+        'income_number': f"INC-{i:06d}",
+        'category_id': rng.choice(income_categories)['id'],
+        'amount': float(rng.randrange(10000, 1000000, 1000)),
+        'payment_date': random_date()[:10],
+        'status': 'approved'
+    } for i in range(months * 10)])
+    client.bulk_insert('member_incomes', [{
+        'member_id': rng.choice(member_rows)['id'],
+        'amount': float(rng.choice([20000, 50000, 100000])),
+        'income_type': rng.choice(['registration_fee', 'membership_fee', 'penalty']),
+        'payment_date': random_date()[:10]
+    } for _ in range(members)])
+
+    for table, columns in DEFAULT_INDEXES.items():
+        for column in columns:
+            client.create_index(table, column)
+
+    print(f"✅ Local SACCO data ready ({client.db_path})")
+    return member_rows
+
+
+def use_local_supabase(client, modules=None):
+    """Point every loaded route module at the local client"""
+    import sys
+    patched = []
+    for name, module in list(sys.modules.items()):
+        if modules is not None and name not in modules:
+            continue
+        if (name.startswith('routes.') or name in ('send_otp', 'sendotp')) and hasattr(module, 'supabase'):
+            module.supabase = client
+            patched.append(name)
+    return patched
+
+
+def test_local_supabase():
+    """Exercise the query builder against a small generated dataset"""
+    client = LocalSupabase()
+    generate_sacco_data(client, members=50, savings_transactions=500)
+
+    members = client.table('members').select('*', count='exact').order('created_at', desc=True).limit(10).execute()
+    assert len(members.data) == 10 and members.count == 50
+
+    member = client.table('members').select('id, full_name').eq('member_number', 'MEM000001').single().execute().data
+    txs = client.table('savings_transactions')\
+        .select('*, savings_accounts(account_number, members(full_name))')\
+        .eq('member_id', member['id'])\
+        .order('created_at', desc=True)\
+        .execute()
+    assert all(t['savings_accounts']['members']['full_name'] == member['full_name'] for t in txs.data)
+
+    found = client.table('members').select('id').or_('email.eq.member2@example.com,phone_number.eq.+256700000002').execute()
+    assert len(found.data) == 2
+
+    client.table('members').update({'account_status': 'suspended'}).eq('id', member['id']).execute()
+    assert client.table('members').select('account_status').eq('id', member['id']).single().execute().data['account_status'] == 'suspended'
+
+    try:
+        client.table('members').select('*').eq('id', 'missing').single().execute()
+        raise AssertionError('single() should fail on no rows')
+    except APIError:
+        pass
+
+    print("✅ Local Supabase test passed")
+
+
+if __name__ == "__main__":
+    test_local_supabase()
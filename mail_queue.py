@@ -0,0 +1,308 @@
+#mail_queue.py
+# Outgoing mail: pooled SMTP connections and a background send queue with retry/backoff.
+# Routes call enqueue_email() and return straight away; worker threads do the SMTP work.
+import os
+import time
+import queue
+import atexit
+import smtplib
+import threading
+from string import Formatter
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '2'))
+SMTP_MAX_IDLE = int(os.getenv('SMTP_MAX_IDLE', '240'))  # Gmail drops idle sessions after ~5 min
+SMTP_TIMEOUT = int(os.getenv('SMTP_TIMEOUT', '30'))
+MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', '2'))
+MAIL_MAX_RETRIES = int(os.getenv('MAIL_MAX_RETRIES', '4'))
+MAIL_RETRY_BACKOFF = float(os.getenv('MAIL_RETRY_BACKOFF', '2'))
+# MAIL_SYNC=1 sends inline (CLI scripts, debugging)
+MAIL_SYNC = os.getenv('MAIL_SYNC', '0') == '1'
+
+
+class EmailTemplate:
+    """HTML email template split once into literal chunks and placeholders"""
+    def __init__(self, subject, html):
+        self.subject = subject
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(html):
+            # {{ }} in the CSS collapses to a single brace here, so render() never re-parses it
+            self.parts.append((literal, field))
+
+    def render(self, **context):
+        return ''.join(literal + (str(context[field]) if field is not None else '')
+                       for literal, field in self.parts)
+
+
+def build_message(sender, to_email, subject, html_body):
+    """MIME message for an HTML email"""
+    msg = MIMEMultipart('alternative')
+    msg['From'] = sender
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html_body, 'html'))
+    return msg
+
+
+class SMTPConnectionPool:
+    """Keeps logged-in SMTP connections open and reconnects them when they go stale"""
+    def __init__(self, host, port, username, password, size=SMTP_POOL_SIZE, max_idle=SMTP_MAX_IDLE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        server.starttls()
+        server.ehlo()
+        server.login(self.username, self.password)
+        print(f"✓ SMTP connection opened to {self.host}:{self.port}")
+        return server
+
+    def healthy(self, server, last_used):
+        if time.time() - last_used > self.max_idle:
+            return False
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if self.healthy(server, last_used):
+                    return server
+                self.discard(server)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        if broken:
+            self.discard(server)
+        else:
+            self.idle.put((server, time.time()))
+        self.slots.release()
+
+    def discard(self, server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def send(self, msg):
+        server = self.acquire()
+        try:
+            server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPAuthenticationError, OSError):
+            self.release(server, broken=True)
+            raise
+        except Exception:
+            # Recipient/data errors leave the session usable
+            self.release(server)
+            raise
+        self.release(server)
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(server)
+
+
+class MailQueue:
+    """Background worker threads draining a queue of outgoing messages"""
+    def __init__(self, workers=MAIL_WORKERS, max_retries=MAIL_MAX_RETRIES, backoff=MAIL_RETRY_BACKOFF):
+        self.jobs = queue.Queue()
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.threads = []
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"mail-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def pool_for(self, account):
+        with self.pools_lock:
+            if account not in self.pools:
+                self.pools[account] = SMTPConnectionPool(*account)
+            return self.pools[account]
+
+    def enqueue(self, account, msg, label='email'):
+        with self.pending_lock:
+            self.pending += 1
+        self.jobs.put({'account': account, 'msg': msg, 'label': label, 'attempt': 0})
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            self.deliver(job)
+
+    def deliver(self, job):
+        try:
+            self.pool_for(job['account']).send(job['msg'])
+            self.stats['sent'] += 1
+            print(f"✓ {job['label']} sent to {job['msg']['To']}")
+        except Exception as e:
+            job['attempt'] += 1
+            if job['attempt'] <= self.max_retries and not isinstance(e, smtplib.SMTPRecipientsRefused):
+                delay = self.backoff ** job['attempt']
+                self.stats['retried'] += 1
+                print(f"⚠️ {job['label']} to {job['msg']['To']} failed ({e}), retry {job['attempt']} in {delay:.0f}s")
+                # Re-queue later so a slow retry doesn't hold up other mail
+                timer = threading.Timer(delay, self.jobs.put, args=(job,))
+                timer.daemon = True
+                timer.start()
+                return
+            self.stats['failed'] += 1
+            print(f"✗ Giving up on {job['label']} to {job['msg']['To']}: {e}")
+        with self.pending_lock:
+            self.pending -= 1
+
+    def flush(self, timeout=10):
+        """Wait (up to timeout seconds) for queued mail to go out"""
+        deadline = time.time() + timeout
+        while self.pending and time.time() < deadline:
+            time.sleep(0.05)
+        return self.pending == 0
+
+    def shutdown(self, timeout=10):
+        self.flush(timeout)
+        for _ in self.threads:
+            self.jobs.put(None)
+        for pool in self.pools.values():
+            pool.close()
+
+
+_mail_queue = None
+_mail_queue_pid = None
+_mail_queue_lock = threading.Lock()
+
+
+def get_mail_queue():
+    """Per-process mail queue, started on first use (and again after a fork)"""
+    global _mail_queue, _mail_queue_pid
+    if _mail_queue is None or _mail_queue_pid != os.getpid():
+        with _mail_queue_lock:
+            if _mail_queue is None or _mail_queue_pid != os.getpid():
+                _mail_queue = MailQueue()
+                _mail_queue.start()
+                _mail_queue_pid = os.getpid()
+    return _mail_queue
+
+
+def enqueue_email(account, to_email, template, label='email', **context):
+    """Render a pre-built template and hand it to the background sender.
+
+    account is (smtp_server, smtp_port, email_address, email_password).
+    Returns True once queued (or sent, with MAIL_SYNC=1).
+    """
+    try:
+        msg = build_message(f"LUNSERK SACCO <{account[2]}>", to_email, template.subject, template.render(**context))
+        if MAIL_SYNC:
+            get_mail_queue().pool_for(account).send(msg)
+            print(f"✓ {label} sent to {to_email}")
+            return True
+        get_mail_queue().enqueue(account, msg, label)
+        return True
+    except Exception as e:
+        print(f"✗ Failed to queue {label} for {to_email}: {e}")
+        return False
+
+
+@atexit.register
+def drain_mail_queue(timeout=5):
+    """Send what is still queued in this process and stop the worker threads"""
+    global _mail_queue
+    with _mail_queue_lock:
+        queue, _mail_queue = (_mail_queue, None) if _mail_queue_pid == os.getpid() else (None, _mail_queue)
+    if queue is not None:
+        queue.shutdown(timeout=timeout)
+
+
+def test_mail_queue():
+    """Self-test with an in-memory SMTP server"""
+    sent = []
+    connections = []
+
+    class FakeSMTP:
+        fail_next = 1
+
+        def __init__(self, host, port, timeout=None):
+            connections.append(self)
+
+        def ehlo(self):
+            return 250, b'OK'
+
+        def starttls(self):
+            return 220, b'Ready'
+
+        def login(self, user, password):
+            return 235, b'Accepted'
+
+        def noop(self):
+            return 250, b'OK'
+
+        def send_message(self, msg):
+            if FakeSMTP.fail_next:
+                FakeSMTP.fail_next -= 1
+                raise smtplib.SMTPServerDisconnected('dropped')
+            sent.append(msg)
+
+        def quit(self):
+            pass
+
+    real_smtp = smtplib.SMTP
+    smtplib.SMTP = FakeSMTP
+    try:
+        template = EmailTemplate("Code", "<style>p {{ color: red; }}</style><p class=\"otp-code\">{otp_code}</p>")
+        assert template.render(otp_code='123456') == '<style>p { color: red; }</style><p class="otp-code">123456</p>'
+
+        mail = MailQueue(workers=2, backoff=0.01)
+        mail.start()
+        account = ('smtp.test', 587, 'sacco@test', 'secret')
+        for i in range(20):
+            msg = build_message('sacco@test', f'user{i}@test', template.subject, template.render(otp_code=i))
+            mail.enqueue(account, msg, 'OTP email')
+        assert mail.flush(timeout=5)
+        assert len(sent) == 20, len(sent)
+        assert mail.stats['retried'] == 1 and mail.stats['failed'] == 0
+        # One broken connection replaced, the rest reused
+        assert len(connections) <= 3, len(connections)
+        mail.shutdown()
+    finally:
+        smtplib.SMTP = real_smtp
+    print("✅ mail_queue self-test passed")
+
+
+if __name__ == "__main__":
+    test_mail_queue()
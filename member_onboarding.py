@@ -0,0 +1,508 @@
+#member_onboarding.py
+# Bulk onboarding of an existing member register: a CSV, plus an optional ZIP of ID cards and photos.
+# stage_import() validates every line and dedupes it against existing emails and phone numbers
+# with one member_contact_matches() call, then stores the lines in member_import_rows.
+# run_import() calls onboard_member_batch() in supabase_functions.sql until no pending rows are
+# left. Each call creates ONBOARDING_BATCH members with their savings and loan accounts in one
+# transaction. Document uploads then run ONBOARDING_UPLOAD_WORKERS members at a time.
+# Progress lives in the database, so an interrupted import resumes from the first pending row.
+import os
+import csv
+import zipfile
+import hashlib
+import mimetypes
+import threading
+from io import StringIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from postgrest.exceptions import APIError
+from werkzeug.utils import secure_filename
+from dotenv import load_dotenv
+from upload_staging import temp_uploads, TempUploadQuotaError
+
+load_dotenv()
+
+ONBOARDING_BATCH = int(os.getenv('ONBOARDING_BATCH', '200'))
+ONBOARDING_MAX_ROWS = int(os.getenv('ONBOARDING_MAX_ROWS', '20000'))
+ONBOARDING_UPLOAD_WORKERS = int(os.getenv('ONBOARDING_UPLOAD_WORKERS', '8'))
+# Uploaded documents are recorded on the members every this many members
+ONBOARDING_DOCUMENT_FLUSH = 50
+MEMBERSHIP_FEE_AMOUNT = '50000.00'
+
+# Columns taken from the register, in the same shape add_member() stores them
+MEMBER_COLUMNS = ['full_name', 'email', 'phone_number', 'date_of_birth', 'gender', 'shares_owned', 'nin_number',
+                  'national_id', 'contact_address', 'emergency_contact_name', 'emergency_contact_phone',
+                  'emergency_contact_relationship']
+REQUIRED_COLUMNS = ['full_name', 'email', 'phone_number', 'date_of_birth']
+# Document columns hold file names inside the ZIP
+DOCUMENT_COLUMNS = {'id_front': 'id_front_url', 'id_back': 'id_back_url', 'profile_photo': 'profile_photo_url'}
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y')
+
+REPORT_COLUMNS = ['Row', 'Full Name', 'Email', 'Phone Number', 'Status', 'Member Number', 'Documents', 'Message']
+
+_running = set()
+_running_lock = threading.Lock()
+
+
+class OnboardingError(Exception):
+    """The register as a whole can't be imported (unreadable, no rows, already imported, ...)"""
+
+
+def _read_register(data):
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    reader = csv.reader(StringIO(text))
+    header = next(reader, None)
+    if not header:
+        raise OnboardingError('The file is empty')
+    keys = [str(name).strip().lower().replace(' ', '_') for name in header]
+    missing = [column for column in REQUIRED_COLUMNS if column not in keys]
+    if missing:
+        raise OnboardingError(f"Missing column(s): {', '.join(missing)}")
+
+    rows = []
+    for number, values in enumerate(reader, start=2):
+        row = {key: value.strip() for key, value in zip(keys, values)}
+        if any(row.values()):
+            rows.append((number, row))
+    return rows
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _validate(row):
+    """member_data for a register line, or (None, message)"""
+    missing = [column for column in REQUIRED_COLUMNS if not row.get(column)]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+    email = row['email'].lower()
+    if '@' not in email:
+        return None, 'Invalid email address'
+    date_of_birth = _parse_date(row['date_of_birth'])
+    if not date_of_birth:
+        return None, 'Date of birth must be YYYY-MM-DD or DD/MM/YYYY'
+    try:
+        shares_owned = int(row.get('shares_owned') or 0)
+    except ValueError:
+        return None, 'Shares owned must be a whole number'
+
+    member_data = {column: row.get(column) or None for column in MEMBER_COLUMNS}
+    member_data.update({'email': email, 'date_of_birth': date_of_birth, 'shares_owned': shares_owned,
+                        'gender': (row.get('gender') or '').lower() or None})
+    return member_data, None
+
+
+def _stage_documents(import_id, archive, staged_rows):
+    """Copy the files the register refers to out of the ZIP into temp_uploads/<import_id>"""
+    entries = {os.path.basename(name).lower(): name for name in archive.namelist() if not name.endswith('/')}
+    temp_uploads.stage(import_id)
+    total = 0
+    for staged in staged_rows:
+        documents, notes = {}, []
+        for document_type, reference in staged.pop('document_files').items():
+            entry = entries.get(os.path.basename(reference).lower())
+            if not entry:
+                notes.append(f"{document_type} file {reference} not in ZIP")
+                continue
+            filename = secure_filename(f"{staged['row_number']}_{document_type}_{os.path.basename(entry)}")
+            with archive.open(entry) as stream:
+                filepath, file_size = temp_uploads.save_file(import_id, filename, stream)
+            documents[document_type] = {
+                'filename': filename,
+                'filepath': filepath,
+                'content_type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                'file_size': file_size
+            }
+        if documents:
+            staged.update({'documents': documents, 'documents_status': 'pending'})
+            total += len(documents)
+        if notes:
+            staged['message'] = '; '.join(notes)
+    return total
+
+
+def stage_import(client, filename, data, documents=None, imported_by=None, fee_paid=True):
+    """Validate and dedupe a register; returns the member_imports row (nothing is created yet)"""
+    rows = _read_register(data)
+    if not rows:
+        raise OnboardingError('The file has no member rows')
+    if len(rows) > ONBOARDING_MAX_ROWS:
+        raise OnboardingError(f'The file has {len(rows):,} rows; split it into files of at most '
+                              f'{ONBOARDING_MAX_ROWS:,} rows')
+
+    file_hash = hashlib.sha256(data).hexdigest()
+    existing = client.table('member_imports')\
+        .select('id, status')\
+        .eq('file_hash', file_hash)\
+        .limit(1)\
+        .execute()
+    if existing.data:
+        raise OnboardingError('This register was already imported' if existing.data[0]['status'] == 'completed'
+                              else 'This register is already being imported; resume it from the import page')
+
+    now = datetime.now().isoformat()
+    staged_rows = []
+    for number, row in rows:
+        member_data, message = _validate(row)
+        staged = {'row_number': number, 'status': 'rejected' if message else 'pending', 'message': message,
+                  'full_name': row.get('full_name'), 'email': (row.get('email') or '').lower(),
+                  'phone_number': row.get('phone_number'), 'member_data': None, 'documents': {},
+                  'documents_status': 'none',
+                  'document_files': {t: row[t] for t in DOCUMENT_COLUMNS if row.get(t)}}
+        if member_data:
+            member_data.update({
+                'membership_fee_amount': MEMBERSHIP_FEE_AMOUNT,
+                'membership_fee_paid': bool(fee_paid),
+                'membership_paid_at': now if fee_paid else None,
+                'registered_by': imported_by,
+                'created_at': now,
+                'updated_at': now
+            })
+            staged['member_data'] = member_data
+        staged_rows.append(staged)
+
+    # Duplicates inside the file, then against existing members in one call
+    seen = {}
+    for staged in staged_rows:
+        if staged['status'] != 'pending':
+            continue
+        for key in (('email', staged['email']), ('phone_number', staged['phone_number'])):
+            if key in seen:
+                staged.update({'status': 'duplicate', 'message': f"Same {key[0].replace('_', ' ')} as row {seen[key]}"})
+                break
+        else:
+            seen[('email', staged['email'])] = seen[('phone_number', staged['phone_number'])] = staged['row_number']
+
+    pending = [staged for staged in staged_rows if staged['status'] == 'pending']
+    response = client.rpc('member_contact_matches', {
+        'p_emails': [staged['email'] for staged in pending],
+        'p_phones': [staged['phone_number'] for staged in pending]
+    }).execute()
+    by_email, by_phone = {}, {}
+    for match in response.data or []:
+        by_email[match['email']] = by_phone[match['phone_number']] = match['member_number']
+    for staged in pending:
+        if staged['email'] in by_email:
+            staged.update({'status': 'duplicate', 'message': f"Email already registered ({by_email[staged['email']]})"})
+        elif staged['phone_number'] in by_phone:
+            staged.update({'status': 'duplicate',
+                           'message': f"Phone number already registered ({by_phone[staged['phone_number']]})"})
+
+    try:
+        record = client.table('member_imports').insert({
+            'filename': filename,
+            'file_hash': file_hash,
+            'status': 'processing',
+            'total_rows': len(staged_rows),
+            'created_rows': 0,
+            'duplicate_rows': sum(1 for staged in staged_rows if staged['status'] == 'duplicate'),
+            'rejected_rows': sum(1 for staged in staged_rows if staged['status'] == 'rejected'),
+            'documents_total': 0,
+            'documents_uploaded': 0,
+            'documents_failed': 0,
+            'fee_paid': bool(fee_paid),
+            'imported_by': imported_by,
+            'updated_at': now
+        }).execute().data[0]
+    except APIError as e:
+        if e.code == '23505':
+            raise OnboardingError('This register is already being imported')
+        raise
+
+    try:
+        documents_total = 0
+        with_files = [staged for staged in staged_rows if staged['status'] == 'pending' and staged['document_files']]
+        if with_files and documents:
+            try:
+                with zipfile.ZipFile(documents) as archive:
+                    documents_total = _stage_documents(record['id'], archive, with_files)
+            except zipfile.BadZipFile:
+                raise OnboardingError('The documents file is not a valid ZIP archive')
+            except TempUploadQuotaError as e:
+                raise OnboardingError(str(e))
+        elif with_files:
+            for staged in with_files:
+                staged['message'] = 'Documents listed but no ZIP uploaded'
+        for staged in staged_rows:
+            staged.pop('document_files', None)
+            staged['import_id'] = record['id']
+        for i in range(0, len(staged_rows), 1000):
+            client.table('member_import_rows').insert(staged_rows[i:i + 1000]).execute()
+        if documents_total:
+            record = client.table('member_imports').update({'documents_total': documents_total})\
+                .eq('id', record['id']).execute().data[0]
+    except Exception:
+        # Nothing was created yet: drop the import so the register can be uploaded again
+        client.table('member_imports').delete().eq('id', record['id']).execute()
+        temp_uploads.discard(record['id'])
+        raise
+    return record
+
+
+def upload_import_documents(client, import_id, workers=ONBOARDING_UPLOAD_WORKERS):
+    """Upload the staged documents of created members; returns (uploaded, failed) document counts"""
+    from cloudinary_upload import upload_member_documents
+    rows = client.table('member_import_rows')\
+        .select('id, member_id, documents')\
+        .eq('import_id', import_id)\
+        .eq('status', 'created')\
+        .eq('documents_status', 'pending')\
+        .execute().data or []
+    if not rows:
+        return 0, 0
+
+    counts = {'uploaded': 0, 'failed': 0}
+    done = []
+
+    def upload(row):
+        staged = {t: info for t, info in row['documents'].items() if os.path.exists(info['filepath'])}
+        results = upload_member_documents(row['member_id'], {t: info['filepath'] for t, info in staged.items()},
+                                          max_workers=1, progress=lambda *args: None)
+        return row, staged, results
+
+    def flush():
+        now = datetime.now().isoformat()
+        doc_rows, ok_ids, failed_ids = [], [], []
+        for row, staged, results in done:
+            update_data = {}
+            for document_type, upload_result in results.items():
+                if not upload_result:
+                    continue
+                doc_rows.append({
+                    'member_id': row['member_id'],
+                    'document_type': document_type,
+                    'cloudinary_public_id': upload_result['public_id'],
+                    'cloudinary_url': upload_result['secure_url'],
+                    'file_name': staged[document_type]['filename'],
+                    'file_size': staged[document_type]['file_size'],
+                    'file_type': staged[document_type]['content_type'],
+                    'created_at': now
+                })
+                update_data[DOCUMENT_COLUMNS[document_type]] = upload_result['secure_url']
+            if update_data:
+                client.table('members').update(update_data).eq('id', row['member_id']).execute()
+            uploaded = len(update_data)
+            counts['uploaded'] += uploaded
+            counts['failed'] += len(row['documents']) - uploaded
+            (ok_ids if uploaded == len(row['documents']) else failed_ids).append(row['id'])
+        if doc_rows:
+            client.table('member_documents').insert(doc_rows).execute()
+        for status, ids in (('uploaded', ok_ids), ('failed', failed_ids)):
+            if ids:
+                client.table('member_import_rows').update({'documents_status': status}).in_('id', ids).execute()
+        client.table('member_imports').update({
+            'documents_uploaded': counts['uploaded'] + already['documents_uploaded'],
+            'documents_failed': counts['failed'] + already['documents_failed'],
+            'updated_at': now
+        }).eq('id', import_id).execute()
+        done.clear()
+
+    already = client.table('member_imports').select('documents_uploaded, documents_failed')\
+        .eq('id', import_id).execute().data[0]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(rows)))) as executor:
+        futures = [executor.submit(upload, row) for row in rows]
+        for future in as_completed(futures):
+            try:
+                done.append(future.result())
+            except Exception as e:
+                print(f"Error uploading onboarding documents: {e}")
+            if len(done) >= ONBOARDING_DOCUMENT_FLUSH:
+                flush()
+    flush()
+    return counts['uploaded'], counts['failed']
+
+
+def run_import(client, import_id, performed_by=None, batch_size=ONBOARDING_BATCH):
+    """Create the pending members of an import batch by batch, then upload their documents.
+
+    Safe to call again after an interruption: it continues with the rows still pending.
+    """
+    status = 'failed'
+    try:
+        while True:
+            response = client.rpc('onboard_member_batch', {
+                'p_import_id': import_id,
+                'p_limit': batch_size,
+                'p_performed_by': performed_by
+            }).execute()
+            result = response.data[0] if isinstance(response.data, list) else response.data
+            if not result['created'] and not result.get('duplicates'):
+                break
+        upload_import_documents(client, import_id)
+        pending = client.table('member_import_rows')\
+            .select('id', count='exact')\
+            .eq('import_id', import_id)\
+            .eq('status', 'pending')\
+            .limit(1)\
+            .execute()
+        # Rows still pending are being created by another worker; it completes the import
+        status = 'processing' if pending.count else 'completed'
+    finally:
+        changes = {'status': status, 'updated_at': datetime.now().isoformat()}
+        if status == 'completed':
+            changes['completed_at'] = changes['updated_at']
+        record = client.table('member_imports').update(changes).eq('id', import_id).execute().data[0]
+    if status == 'completed' and not record['documents_total'] - record['documents_uploaded'] - record['documents_failed']:
+        temp_uploads.discard(import_id)
+    return record
+
+
+def is_running(import_id):
+    with _running_lock:
+        return import_id in _running
+
+
+def start_import(client, import_id, performed_by=None):
+    """Run an import in a background thread; False if this process is already running it"""
+    with _running_lock:
+        if import_id in _running:
+            return False
+        _running.add(import_id)
+
+    def worker():
+        try:
+            run_import(client, import_id, performed_by)
+        except Exception as e:
+            print(f"Error running member import {import_id}: {e}")
+        finally:
+            with _running_lock:
+                _running.discard(import_id)
+
+    threading.Thread(target=worker, name=f"member-import-{import_id[:8]}", daemon=True).start()
+    return True
+
+
+def import_rows(client, import_id, status=None, page=1, per_page=50):
+    """One page of an import's rows in register order, and the number of matching rows"""
+    from_index = (page - 1) * per_page
+    query = client.table('member_import_rows')\
+        .select('row_number, status, message, full_name, email, phone_number, documents_status, member_id, '
+                'member_number', count='exact')\
+        .eq('import_id', import_id)
+    if status:
+        query = query.eq('status', status)
+    response = query.order('row_number').range(from_index, from_index + per_page - 1).execute()
+    return response.data or [], response.count or 0
+
+
+def report_csv(client, import_id):
+    """Every row of an import with its outcome, as CSV text"""
+    si = StringIO()
+    cw = csv.writer(si)
+    cw.writerow(REPORT_COLUMNS)
+    page = 1
+    while True:
+        rows, total = import_rows(client, import_id, page=page, per_page=1000)
+        for row in rows:
+            cw.writerow([row['row_number'], row['full_name'], row['email'], row['phone_number'], row['status'],
+                         row['member_number'] or '', row['documents_status'], row['message'] or ''])
+        if page * 1000 >= total:
+            break
+        page += 1
+    return si.getvalue()
+
+
+def test_member_onboarding():
+    """Self-test against the local stand-in, with an interrupted run that is resumed"""
+    import io
+    import tempfile
+    import cloudinary_upload
+    from upload_staging import TempUploadStore
+    from local_supabase import LocalSupabase, generate_sacco_data
+    global temp_uploads
+    temp_uploads = TempUploadStore(base_dir=tempfile.mkdtemp())
+    client = LocalSupabase()
+    generate_sacco_data(client, members=20, savings_transactions=50)
+    existing = client.table('members').select('email, phone_number').limit(1).execute().data[0]
+
+    lines = ['Full Name,Email,Phone Number,Date of Birth,Gender,Shares Owned,ID Front']
+    lines += [f"Member {i},reg{i}@register.test,+2568000{i:05d},15/0{1 + i % 9}/1990,Female,{i % 3},"
+              f"{'front_%d.jpg' % i if i < 3 else ''}" for i in range(450)]
+    lines += [f"Dup Email,{existing['email'].upper()},+256799999999,1990-01-01,,,",
+              'Dup Row,reg1@register.test,+256788888888,1990-01-01,,,',
+              'No Birthday,nobday@example.com,+256777777777,,,,',
+              'Bad Date,bad@example.com,+256766666666,1990-31-31,,,']
+    register = '\n'.join(lines).encode()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        for i in range(2):
+            z.writestr(f"scans/front_{i}.jpg", b'fake image %d' % i)
+    archive.seek(0)
+
+    record = stage_import(client, 'register.csv', register, archive, imported_by='adm-1')
+    assert record['total_rows'] == 454 and record['duplicate_rows'] == 2 and record['rejected_rows'] == 2, record
+    assert record['documents_total'] == 2
+    try:
+        stage_import(client, 'register_copy.csv', register)
+        assert False, 'same register staged twice'
+    except OnboardingError:
+        pass
+
+    # A member registered on the members page after staging takes row 451's email
+    client.table('members').update({'email': 'reg449@register.test'}).eq('email', existing['email']).execute()
+
+    # First run stops after one batch, as if the worker died; the second run resumes
+    uploads = []
+    cloudinary_upload.upload_member_document = lambda path, member_id, document_type: uploads.append(path) or {
+        'public_id': f"members/{member_id}/{document_type}", 'secure_url': f"https://example.com/{member_id}.jpg"}
+    handler = client.rpc_functions['onboard_member_batch']
+    calls = []
+
+    def dying(c, **params):
+        calls.append(params)
+        if len(calls) == 2:
+            raise RuntimeError('worker stopped')
+        return handler(c, **params)
+    client.register_rpc('onboard_member_batch', dying)
+    try:
+        run_import(client, record['id'], batch_size=200)
+        assert False, 'interruption not raised'
+    except RuntimeError:
+        pass
+    partial = client.table('member_imports').select('*').eq('id', record['id']).execute().data[0]
+    assert partial['created_rows'] == 200 and partial['status'] == 'failed', partial
+
+    record = run_import(client, record['id'], batch_size=200)
+    assert record['status'] == 'completed' and record['created_rows'] == 449, record
+    assert record['duplicate_rows'] == 3, record
+    duplicates, _ = import_rows(client, record['id'], status='duplicate')
+    assert any(r['row_number'] == 451 and r['message'].startswith('Email already registered') for r in duplicates)
+    assert record['documents_uploaded'] == 2 and len(uploads) == 2
+    rows, total = import_rows(client, record['id'], status='created', per_page=5)
+    assert total == 449 and rows[0]['member_number'].startswith('MEM')
+    member = client.table('members').select('id, id_front_url, date_of_birth, membership_fee_paid')\
+        .eq('id', rows[0]['member_id']).execute().data[0]
+    assert member['id_front_url'] and member['date_of_birth'] == '1990-01-15' and member['membership_fee_paid']
+    for table in ('savings_accounts', 'loan_accounts'):
+        accounts = client.table(table).select('account_number').eq('member_id', member['id']).execute().data
+        assert len(accounts) == 1 and accounts[0]['account_number'][:3] in ('SAV', 'LOA'), accounts
+    rejected, _ = import_rows(client, record['id'], status='rejected')
+    assert [r['message'] for r in rejected] == ['Missing date_of_birth',
+                                                'Date of birth must be YYYY-MM-DD or DD/MM/YYYY']
+    assert len(report_csv(client, record['id']).splitlines()) == 455
+
+    # Two registers staged with the same new contact and onboarded at once create it only once
+    racing = [stage_import(client, f'race_{i}.csv', (
+        'Full Name,Email,Phone Number,Date of Birth\n'
+        f"Race {i},race@register.test,+25675590{i:04d},1990-01-01\n").encode()) for i in range(2)]
+    threads = [threading.Thread(target=run_import, args=(client, r['id'])) for r in racing]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    created = client.table('members').select('id').eq('email', 'race@register.test').execute().data
+    assert len(created) == 1, created
+    print("✅ member_onboarding self-test passed")
+
+
+if __name__ == "__main__":
+    test_member_onboarding()
@@ -0,0 +1,162 @@
+#member_statements.py
+# Data behind the member statements page and preview, served as JSON by routes/member.py.
+# statement_summary() in supabase_functions.sql returns the accounts and period totals from one
+# aggregate query; statement_transactions() returns a list in keyset pages (newest first), so a
+# long date range is fetched a page at a time instead of every row up front. Cursors are opaque
+# to the browser: the sort value and id of the last row it has, base64-encoded.
+import os
+import json
+import base64
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from postgrest.exceptions import APIError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STATEMENT_API_PAGE_SIZE = int(os.getenv('STATEMENT_API_PAGE_SIZE', '25'))
+STATEMENT_API_MAX_PAGE = 200
+# Longest range a member can request (the PDF download has no limit)
+STATEMENT_MAX_DAYS = int(os.getenv('STATEMENT_MAX_DAYS', '3660'))
+STATEMENT_LISTS = ('all', 'savings', 'loan', 'repayments')
+
+MONEY_FIELDS = {'savings': ('deposits', 'withdrawals'), 'loan': ('repayments', 'disbursements'),
+                'repayments': ('paid',)}
+
+
+class StatementError(Exception):
+    """Bad statement request (dates, list name or cursor)"""
+
+
+def statement_period(start_date=None, end_date=None):
+    """(start, end) dates from query arguments, defaulting to the last 30 days"""
+    today = datetime.now().date()
+    try:
+        start = date.fromisoformat(start_date) if start_date else today - timedelta(days=30)
+        end = date.fromisoformat(end_date) if end_date else today
+    except ValueError:
+        raise StatementError('Dates must be in YYYY-MM-DD format')
+    if start > end:
+        raise StatementError('Start date must be before end date')
+    if (end - start).days > STATEMENT_MAX_DAYS:
+        raise StatementError(f'Statement periods are limited to {STATEMENT_MAX_DAYS} days')
+    return start, end
+
+
+def encode_cursor(row, statement_list):
+    value = row['paid_date'] if statement_list == 'repayments' else row['created_at']
+    return base64.urlsafe_b64encode(json.dumps([value, row['id']]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise StatementError('Invalid cursor')
+    return str(value), str(row_id)
+
+
+def statement_summary(client, member_id, start, end, sample=0):
+    """Accounts and period totals (counts, and Decimal sums) in one round-trip.
+
+    With sample, the newest `sample` rows of the savings, loan and repayment lists come along too.
+    """
+    data = client.rpc('statement_summary', {
+        'p_member_id': member_id,
+        'p_start': start.isoformat(),
+        'p_end': end.isoformat(),
+        'p_sample': sample
+    }).execute().data
+    summary = data[0] if isinstance(data, list) else data
+    for group, fields in MONEY_FIELDS.items():
+        totals = summary.get(group) or {}
+        summary[group] = dict({'count': int(totals.get('count') or 0)},
+                              **{field: Decimal(str(totals.get(field) or 0)) for field in fields})
+    summary['savings_account'] = summary.get('savings_account') or {}
+    summary['loan_account'] = summary.get('loan_account') or {}
+    summary['samples'] = summary.get('samples') or {'savings': [], 'loan': [], 'repayments': []}
+    return summary
+
+
+def statement_page(client, member_id, statement_list, start, end, cursor=None, limit=STATEMENT_API_PAGE_SIZE):
+    """One page of a statement list: {'items': [...], 'next_cursor': str or None}"""
+    if statement_list not in STATEMENT_LISTS:
+        raise StatementError(f'Unknown statement list {statement_list}')
+    limit = max(1, min(int(limit), STATEMENT_API_MAX_PAGE))
+    before, before_id = decode_cursor(cursor) if cursor else (None, None)
+    try:
+        rows = client.rpc('statement_transactions', {
+            'p_member_id': member_id,
+            'p_kind': statement_list,
+            'p_start': start.isoformat(),
+            'p_end': end.isoformat(),
+            'p_before': before,
+            'p_before_id': before_id,
+            # One extra row tells whether another page exists
+            'p_limit': limit + 1
+        }).execute().data or []
+    except APIError as e:
+        # A tampered cursor fails the casts in the database
+        if e.code in ('22P02', '22007', '22008'):
+            raise StatementError('Invalid cursor')
+        raise
+    if rows and isinstance(rows[0], list):
+        rows = rows[0]
+    items = rows[:limit]
+    return {
+        'items': items,
+        'next_cursor': encode_cursor(items[-1], statement_list) if len(rows) > limit else None
+    }
+
+
+def test_member_statements():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=20, savings_transactions=2000, months=6)
+    member = client.table('loan_transactions').select('member_id').limit(1).execute().data[0]
+    member_id = member['member_id']
+    start, end = statement_period((date.today() - timedelta(days=200)).isoformat(), date.today().isoformat())
+
+    savings = client.table('savings_transactions').select('id, amount, transaction_type')\
+        .eq('member_id', member_id).execute().data
+    summary = statement_summary(client, member_id, start, end, sample=3)
+    assert summary['savings']['count'] == len(savings) > 25
+    assert summary['savings']['deposits'] == sum(Decimal(str(t['amount'])) for t in savings
+                                                 if t['transaction_type'] == 'deposit')
+    assert summary['loan']['count'] == 1 and summary['loan']['disbursements'] > 0
+    assert summary['savings_account']['member_id'] == member_id
+    assert len(summary['samples']['savings']) == 3
+
+    # Walking the cursor returns every row exactly once, newest first
+    for statement_list, expected in (('savings', len(savings)), ('all', len(savings) + 1)):
+        seen, cursor = [], None
+        while True:
+            page = statement_page(client, member_id, statement_list, start, end, cursor, limit=7)
+            seen += page['items']
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        assert len(seen) == expected and len({r['id'] for r in seen}) == expected
+        assert [r['created_at'] for r in seen] == sorted((r['created_at'] for r in seen), reverse=True)
+    assert seen[0]['id'] == summary['samples']['savings'][0]['id'] or seen[0]['source'] == 'loan'
+
+    repayments = statement_page(client, member_id, 'repayments', start, end, limit=2)
+    if repayments['next_cursor']:
+        following = statement_page(client, member_id, 'repayments', start, end, repayments['next_cursor'], 2)
+        assert following['items'][0]['paid_date'] <= repayments['items'][-1]['paid_date']
+
+    for bad in (lambda: statement_period('2025-02-01', '2025-01-01'),
+                lambda: statement_period('yesterday'),
+                lambda: statement_page(client, member_id, 'shares', start, end),
+                lambda: statement_page(client, member_id, 'savings', start, end, cursor='not-a-cursor')):
+        try:
+            bad()
+            assert False, 'bad statement request accepted'
+        except StatementError:
+            pass
+    print("✅ member_statements self-test passed")
+
+
+if __name__ == "__main__":
+    test_member_statements()
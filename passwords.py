@@ -0,0 +1,94 @@
+#passwords.py
+# Password hashing policy: one hash check per login, with transparent upgrade of old hashes.
+#   python passwords.py                  -> logins/second per core for the current method
+#   python passwords.py --methods scrypt pbkdf2:sha256:600000 pbkdf2:sha256:260000
+import os
+import time
+import argparse
+import statistics
+from multiprocessing import Pool
+from werkzeug.security import check_password_hash, generate_password_hash
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+
+# Full parameter prefix of a fresh hash ("scrypt:32768:8:1", "pbkdf2:sha256:600000", ...)
+CURRENT_HASH_PARAMS = generate_password_hash('', method=PASSWORD_HASH_METHOD).split('$', 1)[0]
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with other parameters than PASSWORD_HASH_METHOD"""
+    return password_hash.split('$', 1)[0] != CURRENT_HASH_PARAMS
+
+
+def verify_password(password_hash, password):
+    """Check a password with a single hash computation.
+
+    Returns (correct, new_hash); new_hash is set when the stored hash should be upgraded.
+    """
+    if not password_hash or not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash):
+        return True, hash_password(password)
+    return True, None
+
+
+def _time_logins(args):
+    method, rounds = args
+    stored = generate_password_hash('correct horse battery staple', method=method)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        check_password_hash(stored, 'correct horse battery staple')
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_hash_cost(methods, rounds=20, processes=None):
+    """Time one login verification per method, on one core and on all cores"""
+    processes = processes or os.cpu_count() or 1
+    results = []
+    for method in methods:
+        single = _time_logins((method, rounds))
+        per_core = 1 / statistics.median(single)
+
+        start = time.perf_counter()
+        with Pool(processes) as pool:
+            pool.map(_time_logins, [(method, rounds)] * processes)
+        all_cores = processes * rounds / (time.perf_counter() - start)
+
+        results.append({
+            'method': generate_password_hash('', method=method).split('$', 1)[0],
+            'median_ms': round(statistics.median(single) * 1000, 1),
+            'logins_per_sec_per_core': round(per_core, 1),
+            'logins_per_sec_all_cores': round(all_cores, 1),
+            'processes': processes
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Password hash cost benchmark')
+    parser.add_argument('--methods', nargs='*', default=[PASSWORD_HASH_METHOD])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--processes', type=int, help='Defaults to the number of CPU cores')
+    args = parser.parse_args()
+
+    results = benchmark_hash_cost(args.methods, args.rounds, args.processes)
+    print(f"\n{'Method':<28}{'ms/login':>10}{'logins/s/core':>16}{'logins/s total':>16}")
+    print('-' * 70)
+    for r in results:
+        print(f"{r['method']:<28}{r['median_ms']:>10}{r['logins_per_sec_per_core']:>16}"
+              f"{r['logins_per_sec_all_cores']:>16}")
+    print(f"\n(total = {results[0]['processes']} processes; current policy: {CURRENT_HASH_PARAMS})")
+
+
+if __name__ == "__main__":
+    main()
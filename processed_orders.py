@@ -0,0 +1,212 @@
+#processed_orders.py
+# Index of PesaPal orders that have already been settled, keyed by order_tracking_id.
+# Payment callbacks check it before calling GetTransactionStatus, so browser refreshes and
+# repeated redirects cost an in-process LRU hit (or one indexed query) instead of a PesaPal
+# call and more writes. claim() goes through claim_processed_order() in supabase_functions.sql,
+# so only one request can settle an order even when several workers receive the same callback.
+# A claim that is still 'processing' after PROCESSED_ORDER_CLAIM_TIMEOUT seconds is treated as
+# abandoned (the worker died between claim and settle) and can be claimed again. Callbacks call
+# settle() as soon as the posting returns and release() only for a failure before it, so a
+# write that fails after the money moved can never hand the order to another claim.
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROCESSED_ORDER_CACHE_SIZE = int(os.getenv('PROCESSED_ORDER_CACHE_SIZE', '5000'))
+PROCESSED_ORDER_CLAIM_TIMEOUT = int(os.getenv('PROCESSED_ORDER_CLAIM_TIMEOUT', '900'))
+PROCESSED_ORDER_SETTLE_RETRIES = int(os.getenv('PROCESSED_ORDER_SETTLE_RETRIES', '2'))
+
+
+class ProcessedOrderIndex:
+    """processed_orders table with an LRU of settled orders in front of it"""
+    def __init__(self, capacity=PROCESSED_ORDER_CACHE_SIZE, claim_timeout=PROCESSED_ORDER_CLAIM_TIMEOUT):
+        self.capacity = capacity
+        self.claim_timeout = claim_timeout
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'queries': 0}
+
+    def remember(self, order_tracking_id, record):
+        with self.lock:
+            self.cache[order_tracking_id] = record
+            self.cache.move_to_end(order_tracking_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def lookup(self, client, order_tracking_id):
+        """The settled record for an order, or None if it still needs processing"""
+        with self.lock:
+            record = self.cache.get(order_tracking_id)
+            if record is not None:
+                self.cache.move_to_end(order_tracking_id)
+                self.stats['hits'] += 1
+                return record
+
+        # Settled orders never change, so only positive answers are cached
+        self.stats['queries'] += 1
+        response = client.table('processed_orders')\
+            .select('order_tracking_id, kind, amount, status, processed_at')\
+            .eq('order_tracking_id', order_tracking_id)\
+            .eq('status', 'settled')\
+            .limit(1)\
+            .execute()
+        if not response.data:
+            return None
+        self.remember(order_tracking_id, response.data[0])
+        return response.data[0]
+
+    def claim(self, client, order_tracking_id, kind, member_id=None, amount=None):
+        """True if this request may settle the order, False if another request has settled it or is
+        still settling it (see lookup() to tell the two apart)"""
+        response = client.rpc('claim_processed_order', {
+            'p_order_tracking_id': order_tracking_id,
+            'p_kind': kind,
+            'p_member_id': member_id,
+            'p_amount': str(amount) if amount is not None else None,
+            'p_stale_seconds': self.claim_timeout
+        }).execute()
+        claimed = response.data
+        if isinstance(claimed, list):
+            claimed = claimed[0] if claimed else False
+        return bool(claimed)
+
+    def settle(self, client, order_tracking_id, retries=PROCESSED_ORDER_SETTLE_RETRIES):
+        """Mark a claimed order as settled; call it as soon as its posting has returned"""
+        processed_at = datetime.now().isoformat()
+        record = {'order_tracking_id': order_tracking_id}
+        for attempt in range(retries + 1):
+            try:
+                response = client.table('processed_orders')\
+                    .update({'status': 'settled', 'processed_at': processed_at})\
+                    .eq('order_tracking_id', order_tracking_id)\
+                    .execute()
+                if response.data:
+                    record = response.data[0]
+                break
+            except Exception as e:
+                # The claim stays in place, so the order still can't be settled twice
+                print(f"Error marking order {order_tracking_id} as settled (attempt {attempt + 1}): {e}")
+                if attempt < retries:
+                    time.sleep(0.2 * 2 ** attempt)
+        record.update({'status': 'settled', 'processed_at': processed_at})
+        self.remember(order_tracking_id, record)
+
+    def release(self, client, order_tracking_id):
+        """Drop a claim whose posting failed, so the next callback can retry it.
+
+        Only for failures before the posting: once settle() has run this is a no-op, and the
+        conditional delete never touches a settled row.
+        """
+        with self.lock:
+            if order_tracking_id in self.cache:
+                return  # already settled; later steps failing must not reopen it
+        try:
+            client.table('processed_orders')\
+                .delete()\
+                .eq('order_tracking_id', order_tracking_id)\
+                .eq('status', 'processing')\
+                .execute()
+        except Exception as e:
+            print(f"Error releasing claim on order {order_tracking_id}: {e}")
+
+
+processed_orders = ProcessedOrderIndex()
+
+
+def test_processed_orders():
+    """Self-test against the local stand-in"""
+    from local_supabase import LocalSupabase
+    client = LocalSupabase()
+    index = ProcessedOrderIndex(capacity=2)
+
+    assert index.lookup(client, 'order-1') is None
+    assert index.claim(client, 'order-1', 'deposit', 'member-1', 5000)
+    assert not index.claim(client, 'order-1', 'deposit', 'member-1', 5000)  # second worker loses
+    assert index.lookup(client, 'order-1') is None  # claimed but not settled yet
+    index.settle(client, 'order-1')
+    assert index.lookup(client, 'order-1')['status'] == 'settled'
+
+    # A claim abandoned mid-settlement is taken over once it is stale
+    assert index.claim(client, 'order-4', 'balance')
+    assert not index.claim(client, 'order-4', 'balance')
+    stale = ProcessedOrderIndex(claim_timeout=0)
+    assert stale.claim(client, 'order-4', 'balance')
+    stale.settle(client, 'order-4')
+    assert not stale.claim(client, 'order-4', 'balance')  # settled orders are never reclaimed
+
+    # A failed settlement can be retried
+    assert index.claim(client, 'order-2', 'shares')
+    index.release(client, 'order-2')
+    assert index.claim(client, 'order-2', 'shares')
+    index.settle(client, 'order-2')
+
+    # Evicted orders are found again in the table
+    index.claim(client, 'order-3', 'repayment')
+    index.settle(client, 'order-3')
+    assert 'order-1' not in index.cache
+    queries = index.stats['queries']
+    assert index.lookup(client, 'order-1')['kind'] == 'deposit'
+    assert index.stats['queries'] == queries + 1
+    assert index.lookup(client, 'order-1') and index.stats['queries'] == queries + 1
+    print("✅ processed_orders self-test passed")
+
+
+def test_callback_replay():
+    """A deposit callback whose step after the posting fails is replayed without posting twice"""
+    from decimal import Decimal
+    from app import app
+    from local_supabase import LocalSupabase, generate_sacco_data, use_local_supabase
+    import routes.saving as saving_routes
+    client = LocalSupabase()
+    generate_sacco_data(client, members=5, savings_transactions=10)
+    use_local_supabase(client)
+    account = client.table('savings_accounts').select('id, member_id, current_balance').limit(1).execute().data[0]
+    deposit = client.table('deposit_requests').insert({
+        'savings_account_id': account['id'], 'amount': 25000, 'reference_number': 'DEP-REPLAY',
+        'description': 'PesaPal deposit', 'status': 'pending'}).execute().data[0]
+
+    class CompletedPesaPal:
+        def verify_transaction_status(self, order_tracking_id):
+            return {'payment_status_description': 'Completed'}
+
+    real_pesapal, real_table = saving_routes.PesaPal, client.table
+
+    def failing_table(name):
+        query = real_table(name)
+        if name == 'deposit_requests' and failing_table.armed:
+            query.update = lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError('connection reset'))
+        return query
+    failing_table.armed = True
+
+    saving_routes.PesaPal = CompletedPesaPal
+    client.table = failing_table
+    try:
+        with app.test_client() as browser:
+            with browser.session_transaction() as s:
+                s['admin_logged_in'], s['admin_id'] = True, 'a'
+            url = f"/admin/savings/deposit/{deposit['id']}/pesapal-callback?OrderTrackingId=order-replay"
+            browser.get(url)
+            failing_table.armed = False
+            # The redirect replayed on a worker whose LRU has never seen the order
+            processed_orders.cache.clear()
+            browser.get(url)
+    finally:
+        saving_routes.PesaPal, client.table = real_pesapal, real_table
+
+    after = client.table('savings_accounts').select('current_balance').eq('id', account['id']).execute().data[0]
+    assert Decimal(str(after['current_balance'])) - Decimal(str(account['current_balance'])) == 25000
+    posted = client.table('savings_transactions').select('id').eq('pesapal_order_id', 'order-replay').execute().data
+    assert len(posted) == 1, posted
+    order = client.table('processed_orders').select('status').eq('order_tracking_id', 'order-replay').execute().data
+    assert order[0]['status'] == 'settled', order
+    print("✅ processed_orders callback replay test passed")
+
+
+if __name__ == "__main__":
+    test_processed_orders()
+    test_callback_replay()
@@ -0,0 +1,298 @@
+#query_tracer.py
+import os
+import time
+import threading
+from collections import deque, Counter
+from datetime import datetime
+from dotenv import load_dotenv
+from flask import g, request, jsonify, has_request_context
+from markupsafe import escape
+
+load_dotenv()
+
+# Tracer settings (development / staging only)
+QUERY_TRACE_ENABLED = os.getenv('QUERY_TRACE', '0').lower() in ('1', 'true', 'yes')
+QUERY_TRACE_PANEL = os.getenv('QUERY_TRACE_PANEL', '0').lower() in ('1', 'true', 'yes')
+QUERY_TRACE_LOOP_THRESHOLD = int(os.getenv('QUERY_TRACE_LOOP_THRESHOLD', '3'))
+QUERY_TRACE_HISTORY = int(os.getenv('QUERY_TRACE_HISTORY', '100'))
+
+# Reports of the most recent traced requests
+_recent_reports = deque(maxlen=QUERY_TRACE_HISTORY)
+_reports_lock = threading.Lock()
+_local = threading.local()
+_patched = False
+
+
+def _describe_builder(builder):
+    """Extract method, table and filters from a postgrest request builder"""
+    # Newer postgrest keeps the request details on builder.request
+    source = getattr(builder, 'request', builder)
+    method = getattr(source, 'http_method', 'GET')
+    path = str(getattr(source, 'path', '') or '').split('?')[0].rstrip('/')
+    table = path.rsplit('/', 1)[-1] if path else 'unknown'
+    if '/rpc/' in path:
+        table = f"rpc:{table}"
+
+    filters = []
+    params = getattr(source, 'params', None)
+    if params is not None:
+        try:
+            items = params.multi_items()
+        except AttributeError:
+            items = list(dict(params).items())
+        filters = sorted((str(k), str(v)) for k, v in items)
+
+    return method, table, filters
+
+
+def _count_rows(response):
+    """Number of rows returned by an execute() call"""
+    data = getattr(response, 'data', None)
+    if data is None:
+        return 0
+    if isinstance(data, list):
+        return len(data)
+    return 1
+
+
+def _record_query(builder, response, elapsed_ms, error=None):
+    """Store one executed query on the current request"""
+    if not has_request_context() or not hasattr(g, 'query_trace'):
+        return
+
+    method, table, filters = _describe_builder(builder)
+    g.query_trace.append({
+        'method': method,
+        'table': table,
+        'filters': filters,
+        'rows': _count_rows(response) if response is not None else 0,
+        'elapsed_ms': round(elapsed_ms, 2),
+        'error': str(error) if error else None
+    })
+
+
+def _wrap_execute(original_execute):
+    """Wrap a builder's execute() so every call is timed and recorded"""
+    def traced_execute(self, *args, **kwargs):
+        # Nested execute() calls (e.g. maybe_single -> single) are recorded once
+        if getattr(_local, 'depth', 0) > 0:
+            return original_execute(self, *args, **kwargs)
+
+        _local.depth = 1
+        start = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = original_execute(self, *args, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _local.depth = 0
+            _record_query(self, response, (time.perf_counter() - start) * 1000, error)
+
+    traced_execute.__wrapped__ = original_execute
+    return traced_execute
+
+
+def install_query_tracer():
+    """Patch the postgrest sync request builders used by the Supabase client"""
+    global _patched
+    if _patched:
+        return True
+
+    try:
+        from postgrest._sync import request_builder
+    except ImportError as e:
+        print(f"❌ Query tracer could not import postgrest: {e}")
+        return False
+
+    for class_name in ('SyncQueryRequestBuilder', 'SyncSingleRequestBuilder', 'SyncMaybeSingleRequestBuilder'):
+        builder_class = getattr(request_builder, class_name, None)
+        if builder_class is None or 'execute' not in builder_class.__dict__:
+            continue
+        builder_class.execute = _wrap_execute(builder_class.__dict__['execute'])
+
+    _patched = True
+    print("✅ Supabase query tracer installed")
+    return True
+
+
+def analyze_queries(queries, loop_threshold=None):
+    """Find repeated identical queries and loops of similar queries"""
+    loop_threshold = loop_threshold or QUERY_TRACE_LOOP_THRESHOLD
+
+    # Identical: same method, table and filter values
+    identical = Counter(
+        (q['method'], q['table'], tuple(q['filters'])) for q in queries
+    )
+    duplicates = [
+        {'method': method, 'table': table, 'filters': list(filters), 'count': count}
+        for (method, table, filters), count in identical.items()
+        if count > 1
+    ]
+
+    # Similar: same method, table and filter columns but different values (N+1 loops)
+    shapes = Counter(
+        (q['method'], q['table'], tuple(k for k, _ in q['filters'])) for q in queries
+    )
+    loops = []
+    for (method, table, columns), count in shapes.items():
+        distinct = sum(
+            1 for key in identical
+            if key[0] == method and key[1] == table and tuple(k for k, _ in key[2]) == columns
+        )
+        if count >= loop_threshold and distinct > 1:
+            loops.append({
+                'method': method,
+                'table': table,
+                'columns': list(columns),
+                'count': count,
+                'distinct': distinct
+            })
+
+    return duplicates, loops
+
+
+def build_report(endpoint, path, queries, total_ms):
+    """Summarise the queries made during one request"""
+    duplicates, loops = analyze_queries(queries)
+    return {
+        'endpoint': endpoint,
+        'path': path,
+        'timestamp': datetime.now().isoformat(),
+        'query_count': len(queries),
+        'query_ms': round(sum(q['elapsed_ms'] for q in queries), 2),
+        'request_ms': round(total_ms, 2),
+        'rows': sum(q['rows'] for q in queries),
+        'duplicates': duplicates,
+        'loops': loops,
+        'queries': queries
+    }
+
+
+def print_report(report):
+    """Write a request report to the log"""
+    flag = '⚠️' if report['duplicates'] or report['loops'] else '✓'
+    print(f"{flag} [query-trace] {report['endpoint']} {report['path']} - "
+          f"{report['query_count']} queries, {report['rows']} rows, "
+          f"{report['query_ms']}ms in db / {report['request_ms']}ms total")
+
+    for dup in report['duplicates']:
+        print(f"   🔁 duplicate x{dup['count']}: {dup['method']} {dup['table']} {dup['filters']}")
+
+    for loop in report['loops']:
+        print(f"   🔄 possible N+1 x{loop['count']} ({loop['distinct']} distinct): "
+              f"{loop['method']} {loop['table']} by {loop['columns']}")
+
+
+def render_panel(report):
+    """Small HTML panel appended to pages when QUERY_TRACE_PANEL is on"""
+    # Filter values carry user input (search terms, emails), so every cell is escaped
+    rows = ''.join(
+        f"<tr><td>{i}</td><td>{escape(q['method'])}</td><td>{escape(q['table'])}</td>"
+        f"<td>{escape('&'.join(f'{k}={v}' for k, v in q['filters']))}</td>"
+        f"<td>{escape(q['rows'])}</td><td>{escape(q['elapsed_ms'])}</td></tr>"
+        for i, q in enumerate(report['queries'], 1)
+    )
+    warnings = ''.join(
+        f"<li>Duplicate x{d['count']}: {escape(d['method'])} {escape(d['table'])}</li>" for d in report['duplicates']
+    ) + ''.join(
+        f"<li>Possible N+1 x{l['count']}: {escape(l['method'])} {escape(l['table'])} by "
+        f"{escape(', '.join(l['columns']))}</li>"
+        for l in report['loops']
+    )
+
+    return f"""
+    <div id="query-trace-panel" style="position:fixed;bottom:0;left:0;right:0;max-height:40vh;overflow:auto;
+         background:#111827;color:#e5e7eb;font:12px monospace;padding:8px;z-index:99999;">
+        <strong>{report['query_count']} queries</strong> · {report['rows']} rows ·
+        {report['query_ms']}ms db / {report['request_ms']}ms total
+        <ul style="color:#fbbf24;margin:4px 0;">{warnings}</ul>
+        <table style="width:100%;border-collapse:collapse;">
+            <tr><th>#</th><th>Method</th><th>Table</th><th>Filters</th><th>Rows</th><th>ms</th></tr>
+            {rows}
+        </table>
+    </div>
+    """
+
+
+def get_recent_reports():
+    """Reports of the most recent traced requests, newest first"""
+    with _reports_lock:
+        return list(reversed(_recent_reports))
+
+
+def init_query_tracer(app):
+    """Register the tracer hooks on the Flask app if QUERY_TRACE is enabled"""
+    if not QUERY_TRACE_ENABLED:
+        return False
+
+    if not install_query_tracer():
+        return False
+
+    from routes.adminauth import admin_login_required
+
+    @app.before_request
+    def start_query_trace():
+        g.query_trace = []
+        g.query_trace_start = time.perf_counter()
+
+    @app.after_request
+    def finish_query_trace(response):
+        if not hasattr(g, 'query_trace') or request.path.startswith('/static'):
+            return response
+
+        total_ms = (time.perf_counter() - g.query_trace_start) * 1000
+        report = build_report(request.endpoint, request.path, g.query_trace, total_ms)
+
+        with _reports_lock:
+            _recent_reports.append(report)
+        print_report(report)
+
+        response.headers['X-Query-Count'] = str(report['query_count'])
+        response.headers['X-Query-Time-Ms'] = str(report['query_ms'])
+
+        if (QUERY_TRACE_PANEL and response.mimetype == 'text/html'
+                and not response.direct_passthrough and response.status_code == 200):
+            body = response.get_data(as_text=True)
+            if '</body>' in body:
+                body = body.replace('</body>', render_panel(report) + '</body>', 1)
+                response.set_data(body)
+
+        return response
+
+    @app.route('/debug/query-traces')
+    @admin_login_required
+    def query_traces():
+        """Recent per-request query reports (filter values include emails and tokens: admins only)"""
+        return jsonify({'success': True, 'reports': get_recent_reports()})
+
+    return True
+
+
+def test_query_tracer():
+    """Check duplicate and N+1 detection on a sample trace"""
+    queries = [
+        {'method': 'GET', 'table': 'members', 'filters': [('id', 'eq.1'), ('select', '*')], 'rows': 1, 'elapsed_ms': 40.0, 'error': None},
+        {'method': 'GET', 'table': 'members', 'filters': [('id', 'eq.1'), ('select', '*')], 'rows': 1, 'elapsed_ms': 38.0, 'error': None},
+    ] + [
+        {'method': 'GET', 'table': 'expense_categories', 'filters': [('id', f'eq.{i}'), ('select', 'name')], 'rows': 1, 'elapsed_ms': 20.0, 'error': None}
+        for i in range(5)
+    ]
+
+    report = build_report('members.member_details', '/admin/members/1', queries, 250.0)
+    print_report(report)
+
+    assert len(report['duplicates']) == 1
+    assert report['loops'][0]['table'] == 'expense_categories'
+
+    report['queries'][0]['filters'] = [('full_name', 'ilike.*<script>alert(1)</script>*')]
+    panel = render_panel(report)
+    assert '<script>' not in panel and '&lt;script&gt;' in panel
+    print("✅ Query tracer test passed")
+
+
+if __name__ == "__main__":
+    test_query_tracer()
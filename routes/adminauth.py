@@ -1,11 +1,13 @@
 import os
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from functools import wraps
-from werkzeug.security import check_password_hash, generate_password_hash
 from supabase import create_client, Client
-from datetime import datetime, timedelta
+from datetime import datetime
 import secrets
 from send_otp import send_otp_email, save_otp_to_db, generate_otp, send_password_reset_email
+from credential_store import credential_store, otp_key, reset_key, RESET_TOKEN_TTL
+from session_store import cache_admin_profile, get_admin_profile, regenerate_session
+from passwords import verify_password, hash_password
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -50,20 +52,26 @@ def admin_login():
             if response.data and len(response.data) > 0:
                 admin = response.data[0]
                 
-                # Verify password
-                if check_password_hash(admin['password_hash'], password):
-                    # Set session
+                # Verify password (one hash check; old hash parameters are upgraded)
+                password_correct, new_hash = verify_password(admin.get('password_hash'), password)
+                if password_correct:
+                    # Set session (new session id)
+                    regenerate_session(session)
                     session['admin_id'] = admin['id']
                     session['admin_email'] = admin['email']
                     session['admin_name'] = admin.get('name', 'Admin')
                     session['admin_role'] = admin.get('role', 'admin')
                     session['admin_logged_in'] = True
+                    cache_admin_profile(admin)
                     
                     # Update last login
-                    supabase.table('admins').update({
+                    login_update = {
                         'last_login': datetime.utcnow().isoformat(),
                         'login_count': admin.get('login_count', 0) + 1
-                    }).eq('id', admin['id']).execute()
+                    }
+                    if new_hash:
+                        login_update['password_hash'] = new_hash
+                    supabase.table('admins').update(login_update).eq('id', admin['id']).execute()
                     
                     # Set session expiration
                     if remember:
@@ -93,7 +101,7 @@ def admin_login():
                     # Log login activity
                     log_admin_activity(admin['id'], 'login', 'Admin logged in')
                     
-                    return redirect(url_for('admin_dashboard'))
+                    return redirect(url_for('dashboard.admin_dashboard'))
                 else:
                     flash('Invalid email or password', 'error')
             else:
@@ -135,17 +143,9 @@ def forgot_password():
             if response.data and len(response.data) > 0:
                 admin = response.data[0]
                 
-                # Generate password reset token
+                # Generate password reset token (expires on its own after RESET_TOKEN_TTL)
                 reset_token = secrets.token_urlsafe(32)
-                token_expiry = (datetime.utcnow() + timedelta(hours=1)).isoformat()
-                
-                # Save token to database
-                supabase.table('password_resets').upsert({
-                    'email': email,
-                    'token': reset_token,
-                    'expires_at': token_expiry,
-                    'used': False
-                }).execute()
+                credential_store.set(reset_key('admin', reset_token), {'email': email}, RESET_TOKEN_TTL)
                 
                 # Send password reset email
                 reset_link = url_for('adminauth.reset_password', token=reset_token, _external=True)
@@ -186,26 +186,24 @@ def reset_password(token):
             return render_template('admin/reset_password.html', token=token)
         
         try:
-            # Verify token
-            response = supabase.table('password_resets').select('*').eq('token', token).eq('used', False).gte('expires_at', datetime.utcnow().isoformat()).execute()
+            # Claim the token atomically, so two submits can't both use it
+            reset_record = credential_store.pop(reset_key('admin', token))
             
-            if response.data and len(response.data) > 0:
-                reset_record = response.data[0]
+            if reset_record:
                 email = reset_record['email']
                 
                 # Update admin password
-                password_hash = generate_password_hash(password)
-                
-                supabase.table('admins').update({
-                    'password_hash': password_hash,
-                    'updated_at': datetime.utcnow().isoformat()
-                }).eq('email', email).execute()
+                password_hash = hash_password(password)
                 
-                # Mark token as used
-                supabase.table('password_resets').update({
-                    'used': True,
-                    'used_at': datetime.utcnow().isoformat()
-                }).eq('token', token).execute()
+                try:
+                    supabase.table('admins').update({
+                        'password_hash': password_hash,
+                        'updated_at': datetime.utcnow().isoformat()
+                    }).eq('email', email).execute()
+                except Exception:
+                    # The password was not changed; give the token back for another attempt
+                    credential_store.set(reset_key('admin', token), reset_record, RESET_TOKEN_TTL)
+                    raise
                 
                 # Get admin ID for logging
                 admin_response = supabase.table('admins').select('id').eq('email', email).execute()
@@ -225,9 +223,7 @@ def reset_password(token):
     
     # GET request - verify token
     try:
-        response = supabase.table('password_resets').select('email').eq('token', token).eq('used', False).gte('expires_at', datetime.utcnow().isoformat()).execute()
-        
-        if not response.data:
+        if not credential_store.get(reset_key('admin', token)):
             flash('Invalid or expired reset link', 'error')
             return redirect(url_for('adminauth.forgot_password'))
     except Exception as e:
@@ -251,42 +247,28 @@ def verify_otp():
             return render_template('admin/verify_otp.html')
         
         try:
-            # Verify OTP from database
-            response = supabase.table('admins').select('otp_code, otp_expires_at').eq('id', session['admin_id']).execute()
+            # Verify OTP from the credential store (expired codes are already gone)
+            stored_otp = credential_store.get(otp_key(session['admin_id']))
             
-            if response.data and len(response.data) > 0:
-                admin_otp = response.data[0]
-                
-                # Check if OTP exists and is valid
-                if admin_otp.get('otp_code') and admin_otp.get('otp_expires_at'):
-                    expiry_time = datetime.fromisoformat(admin_otp['otp_expires_at'].replace('Z', '+00:00'))
+            if stored_otp:
+                if secrets.compare_digest(stored_otp, otp):
+                    # OTP is single use
+                    credential_store.delete(otp_key(session['admin_id']))
                     
-                    if datetime.utcnow() > expiry_time:
-                        flash('OTP has expired. Please request a new one.', 'error')
-                        return render_template('admin/verify_otp.html')
+                    # Set OTP verified flag (new session id for the fully signed-in session)
+                    regenerate_session(session, keep=True)
+                    session['otp_verified'] = True
+                    session.pop('otp_required', None)
                     
-                    if admin_otp['otp_code'] == otp:
-                        # Clear OTP from database
-                        supabase.table('admins').update({
-                            'otp_code': None,
-                            'otp_expires_at': None
-                        }).eq('id', session['admin_id']).execute()
-                        
-                        # Set OTP verified flag
-                        session['otp_verified'] = True
-                        session.pop('otp_required', None)
-                        
-                        # Log successful OTP verification
-                        log_admin_activity(session['admin_id'], 'otp_verified', 'OTP verification successful')
-                        
-                        flash('OTP verified successfully!', 'success')
-                        return redirect(url_for('admin_dashboard'))
-                    else:
-                        flash('Invalid OTP code', 'error')
+                    # Log successful OTP verification
+                    log_admin_activity(session['admin_id'], 'otp_verified', 'OTP verification successful')
+                    
+                    flash('OTP verified successfully!', 'success')
+                    return redirect(url_for('dashboard.admin_dashboard'))
                 else:
-                    flash('No valid OTP found. Please request a new one.', 'error')
+                    flash('Invalid OTP code', 'error')
             else:
-                flash('Error verifying OTP. Please try again.', 'error')
+                flash('OTP has expired or was not found. Please request a new one.', 'error')
                 
         except Exception as e:
             print(f"OTP verification error: {e}")
@@ -300,12 +282,10 @@ def resend_otp():
         return jsonify({'success': False, 'message': 'Session expired'}), 401
     
     try:
-        # Get admin details
-        response = supabase.table('admins').select('email, name').eq('id', session['admin_id']).execute()
+        # Get admin details (cached at login)
+        admin = get_admin_profile(supabase, session['admin_id'])
         
-        if response.data and len(response.data) > 0:
-            admin = response.data[0]
-            
+        if admin:
             # Generate new OTP
             otp_code = generate_otp()
             
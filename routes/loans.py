@@ -8,6 +8,8 @@ import json
 from decimal import Decimal
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from ledger import post_loan_entry, PostingError
+from facet_counts import status_counts
 
 load_dotenv()
 
@@ -262,16 +264,12 @@ def loan_applications():
         response = query.execute()
         applications = response.data if response.data else []
         
-        # Get counts by status
-        counts_res = supabase.table('loan_applications')\
-            .select('status', count='exact')\
-            .execute()
-        
         return render_template('admin/loans/applications.html',
                              applications=applications,
                              status=status,
                              search=search,
-                             total_count=len(applications))
+                             total_count=len(applications),
+                             status_counts=status_counts(supabase, 'loan_applications', search))
         
     except Exception as e:
         print(f"Error fetching loan applications: {e}")
@@ -343,7 +341,7 @@ def approve_application(application_id):
     try:
         # Get application
         app_res = supabase.table('loan_applications')\
-            .select('*')\
+            .select('id, status, loan_amount, interest_rate, repayment_period_months')\
             .eq('id', application_id)\
             .single()\
             .execute()
@@ -357,17 +355,6 @@ def approve_application(application_id):
         if application['status'] != 'pending':
             return jsonify({'success': False, 'message': 'Application already processed'}), 400
         
-        # Update application status
-        update_data = {
-            'status': 'approved',
-            'approved_by': session.get('admin_id'),
-            'approved_at': datetime.now().isoformat(),
-            'remarks': request.form.get('remarks', ''),
-            'updated_at': datetime.now().isoformat()
-        }
-        
-        supabase.table('loan_applications').update(update_data).eq('id', application_id).execute()
-        
         # Create repayment schedule
         schedule, monthly_payment, total_repayable = calculate_loan_schedule(
             Decimal(application['loan_amount']),
@@ -375,16 +362,6 @@ def approve_application(application_id):
             application['repayment_period_months']
         )
         
-        # Update with calculated amounts
-        supabase.table('loan_applications')\
-            .update({
-                'monthly_installment': str(monthly_payment),
-                'total_repayable': str(total_repayable)
-            })\
-            .eq('id', application_id)\
-            .execute()
-        
-        # Create repayment schedule in database
         start_date = datetime.now() + timedelta(days=30)  # First payment due in 30 days
         repayment_data = []
         
@@ -392,24 +369,25 @@ def approve_application(application_id):
             due_date = start_date + timedelta(days=30*i)
             
             repayment_data.append({
-                'loan_application_id': application_id,
-                'member_id': application['member_id'],
                 'installment_number': installment['installment_number'],
                 'due_date': due_date.date().isoformat(),
                 'due_amount': str(installment['due_amount']),
                 'principal_amount': str(installment['principal']),
-                'interest_amount': str(installment['interest']),
-                'status': 'pending',
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
+                'interest_amount': str(installment['interest'])
             })
         
-        if repayment_data:
-            supabase.table('loan_repayments').insert(repayment_data).execute()
-        
-        # Log activity
-        log_loan_activity(application_id, 'application_approved', 
-                         f'Loan application approved by admin. Amount: {application["loan_amount"]}')
+        # Status, amounts, schedule and activity log are written in one database transaction
+        supabase.rpc('approve_loan_application', {
+            'p_application_id': application_id,
+            'p_approved_by': session.get('admin_id'),
+            'p_remarks': request.form.get('remarks', ''),
+            'p_monthly_installment': str(monthly_payment),
+            'p_total_repayable': str(total_repayable),
+            'p_schedule': repayment_data,
+            'p_description': f'Loan application approved by admin. Amount: {application["loan_amount"]}',
+            'p_ip_address': request.remote_addr,
+            'p_user_agent': request.headers.get('User-Agent')
+        }).execute()
         
         return jsonify({
             'success': True,
@@ -486,18 +464,6 @@ def disburse_loan(application_id):
         if application['status'] != 'approved':
             return jsonify({'success': False, 'message': 'Only approved applications can be disbursed'}), 400
         
-        # Get member's loan account
-        loan_account_res = supabase.table('loan_accounts')\
-            .select('*')\
-            .eq('member_id', application['member_id'])\
-            .single()\
-            .execute()
-        
-        if not loan_account_res.data:
-            return jsonify({'success': False, 'message': 'Member loan account not found'}), 404
-        
-        loan_account = loan_account_res.data
-        
         # Get disbursement details
         disbursement_method = request.form.get('disbursement_method', '')
         reference_number = request.form.get('reference_number', '')
@@ -521,36 +487,38 @@ def disburse_loan(application_id):
             'updated_at': datetime.now().isoformat()
         }
         
-        supabase.table('loan_applications').update(update_data).eq('id', application_id).execute()
-        
-        # Update loan account balance
-        current_balance = Decimal(loan_account.get('current_balance', '0') or '0')
-        new_balance = current_balance + loan_amount
-        
-        supabase.table('loan_accounts')\
-            .update({
-                'current_balance': str(new_balance),
-                'available_limit': str(Decimal(loan_account.get('credit_limit', '0') or '0') - new_balance),
-                'updated_at': datetime.now().isoformat()
-            })\
-            .eq('id', loan_account['id'])\
+        # Only one disbursement per application, even if two admins submit together
+        claim_res = supabase.table('loan_applications')\
+            .update(update_data)\
+            .eq('id', application_id)\
+            .eq('status', 'approved')\
             .execute()
         
-        # Create transaction record
+        if not claim_res.data:
+            return jsonify({'success': False, 'message': 'Only approved applications can be disbursed'}), 400
+        
+        # Update the member's loan account balance and create transaction record in one posting
         transaction_data = {
-    'loan_account_id': loan_account['id'],  # Changed from member_id
-    'transaction_type': 'disbursement',
-    'amount': str(loan_amount),
-    'balance_before': str(current_balance),
-    'balance_after': str(new_balance),
-    'reference_number': reference_number,
-    'description': f'Loan disbursement - {application.get("purpose", "")}',
-    'payment_method': disbursement_method,
-    'processed_by': session.get('admin_id'),
-    'created_at': datetime.now().isoformat()
-}
+            'transaction_type': 'disbursement',
+            'amount': str(loan_amount),
+            'reference_number': reference_number,
+            'description': f'Loan disbursement - {application.get("purpose", "")}',
+            'payment_method': disbursement_method,
+            'processed_by': session.get('admin_id'),
+            'created_at': datetime.now().isoformat()
+        }
         
-        supabase.table('loan_transactions').insert(transaction_data).execute()
+        try:
+            post_loan_entry(supabase, loan_amount, transaction_data, member_id=application['member_id'])
+        except Exception as e:
+            # Put the application back so it can be disbursed again
+            supabase.table('loan_applications')\
+                .update({'status': 'approved', 'disbursed_at': None})\
+                .eq('id', application_id)\
+                .execute()
+            if isinstance(e, PostingError):
+                return jsonify({'success': False, 'message': 'Member loan account not found'}), 404
+            raise
         
         # Log activity
         log_loan_activity(application_id, 'loan_disbursed', 
@@ -589,11 +557,6 @@ def loan_repayments():
         response = query.execute()
         repayments = response.data if response.data else []
         
-        # Get summary statistics
-        summary_res = supabase.table('loan_repayments')\
-            .select('status', count='exact')\
-            .execute()
-        
         # Calculate totals
         total_due = sum(Decimal(r.get('due_amount', '0') or '0') for r in repayments)
         total_paid = sum(Decimal(r.get('paid_amount', '0') or '0') for r in repayments)
@@ -603,7 +566,8 @@ def loan_repayments():
                              status=status,
                              search=search,
                              total_due=total_due,
-                             total_paid=total_paid)
+                             total_paid=total_paid,
+                             status_counts=status_counts(supabase, 'loan_repayments', search))
         
     except Exception as e:
         print(f"Error fetching loan repayments: {e}")
@@ -666,45 +630,42 @@ def record_repayment(repayment_id):
             'updated_at': datetime.now().isoformat()
         }
         
-        supabase.table('loan_repayments').update(update_data).eq('id', repayment_id).execute()
-        
-        # Get loan account
-        loan_account_res = supabase.table('loan_accounts')\
-            .select('*')\
-            .eq('member_id', repayment['member_id'])\
-            .single()\
+        claim_res = supabase.table('loan_repayments')\
+            .update(update_data)\
+            .eq('id', repayment_id)\
+            .neq('status', 'paid')\
             .execute()
         
-        if loan_account_res.data:
-            loan_account = loan_account_res.data
-            
-            # Update loan account balance
-            current_balance = Decimal(loan_account.get('current_balance', '0') or '0')
-            new_balance = max(Decimal('0'), current_balance - Decimal(repayment['principal_amount']))
-            
-            supabase.table('loan_accounts')\
-                .update({
-                    'current_balance': str(new_balance),
-                    'available_limit': str(Decimal(loan_account.get('credit_limit', '0') or '0') - new_balance),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', loan_account['id'])\
-                .execute()
-            
-            # Create transaction record
-            transaction_data = {
-                    'loan_account_id': loan_account['id'],  # Changed from member_id
-                    'transaction_type': 'repayment',
-                    'amount': str(paid_amount),
-                    'balance_before': str(current_balance),
-                    'balance_after': str(new_balance),
-                    'reference_number': reference_number,
-                    'description': f'Loan repayment - Installment #{repayment["installment_number"]}',
-                    'payment_method': payment_method,
-                    'processed_by': session.get('admin_id'),
-                    'created_at': datetime.now().isoformat()
-                }
-            supabase.table('loan_transactions').insert(transaction_data).execute()
+        if not claim_res.data:
+            return jsonify({'success': False, 'message': 'Repayment already recorded as paid'}), 400
+        
+        # Reduce the loan account balance by the principal and create transaction record in one posting
+        transaction_data = {
+            'transaction_type': 'repayment',
+            'amount': str(paid_amount),
+            'reference_number': reference_number,
+            'description': f'Loan repayment - Installment #{repayment["installment_number"]}',
+            'payment_method': payment_method,
+            'processed_by': session.get('admin_id'),
+            'created_at': datetime.now().isoformat()
+        }
+        
+        try:
+            post_loan_entry(supabase, -Decimal(repayment['principal_amount']), transaction_data,
+                            member_id=repayment['member_id'], floor_zero=True)
+        except PostingError as e:
+            # Members without a loan account only get the repayment record
+            print(f"Repayment {repayment_id} not posted to a loan account: {e}")
+        except Exception:
+            # Nothing was posted: put the repayment back so it can be recorded again
+            try:
+                supabase.table('loan_repayments')\
+                    .update({key: repayment.get(key) for key in update_data})\
+                    .eq('id', repayment_id)\
+                    .execute()
+            except Exception as e:
+                print(f"Error releasing repayment {repayment_id}: {e}")
+            raise
             
         # Log activity
         log_loan_activity(repayment['loan_application_id'], 'repayment_recorded', 
@@ -952,19 +913,6 @@ def add_repayment():
             
             member = member_res.data
             
-            # Get member's loan account
-            loan_account_res = supabase.table('loan_accounts')\
-                .select('*')\
-                .eq('member_id', member_id)\
-                .single()\
-                .execute()
-            
-            if not loan_account_res.data:
-                flash('Member does not have a loan account', 'error')
-                return redirect(url_for('loans.add_repayment'))
-            
-            loan_account = loan_account_res.data
-            
             # If loan application is specified, get details
             loan_application = None
             if loan_application_id:
@@ -976,32 +924,10 @@ def add_repayment():
                 
                 loan_application = app_res.data if app_res.data else None
             
-            # Update loan account balance
-            current_balance = Decimal(loan_account.get('current_balance', '0') or '0')
-            
-            if current_balance < amount:
-                flash(f'Repayment amount ({amount}) exceeds current balance ({current_balance})', 'error')
-                return redirect(url_for('loans.add_repayment'))
-            
-            new_balance = current_balance - amount
-            
-            # Update loan account
-            supabase.table('loan_accounts')\
-                .update({
-                    'current_balance': str(new_balance),
-                    'available_limit': str(Decimal(loan_account.get('credit_limit', '0') or '0') - new_balance),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', loan_account['id'])\
-                .execute()
-            
             # Create transaction record - FIXED: using correct column names
             transaction_data = {
-                'loan_account_id': loan_account['id'],  # Changed from member_id to loan_account_id
                 'transaction_type': 'manual_repayment',
                 'amount': str(amount),
-                'balance_before': str(current_balance),
-                'balance_after': str(new_balance),
                 'reference_number': reference_number,
                 'description': f'Manual repayment - {remarks}' if remarks else 'Manual loan repayment',
                 'payment_method': payment_method,
@@ -1012,10 +938,12 @@ def add_repayment():
             if loan_application_id:
                 transaction_data['loan_application_id'] = loan_application_id
             
-            transaction_res = supabase.table('loan_transactions').insert(transaction_data).execute()
-            
-            if not transaction_res.data:
-                flash('Failed to create transaction record', 'error')
+            # Update loan account balance and insert the transaction in one posting; the database
+            # refuses members without a loan account and repayments above the current balance
+            try:
+                post_loan_entry(supabase, -amount, transaction_data, member_id=member_id, require_balance=True)
+            except PostingError as e:
+                flash(str(e), 'error')
                 return redirect(url_for('loans.add_repayment'))
             
             # Create repayment record if loan application is specified
@@ -6,9 +6,12 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from dotenv import load_dotenv
 from pesapal import PesaPal
+from session_store import get_member_profile, invalidate_member_profile
+from processed_orders import processed_orders
+from ledger import post_savings_entry, post_loan_entry, post_share_entry, PostingError
 import uuid
-from io import BytesIO
-from xhtml2pdf import pisa
+from statement_renderer import render_statement
+from member_statements import statement_period, statement_summary, statement_page, StatementError
 from flask import Response
 import base64
 
@@ -37,33 +40,9 @@ def member_login_required(f):
 
 
 def generate_statement_pdf(data):
-    """Generate PDF from HTML template"""
+    """Render a statement PDF with the configured backend (STATEMENT_RENDERER)"""
     try:
-        # Ensure all required keys exist
-        data.setdefault('member', {})
-        data.setdefault('savings_account', {})
-        data.setdefault('loan_account', {})
-        data.setdefault('savings_transactions', [])
-        data.setdefault('loan_transactions', [])
-        data.setdefault('repayments', [])
-        data.setdefault('total_deposits', 0)
-        data.setdefault('total_withdrawals', 0)
-        data.setdefault('total_repayments', 0)
-        data.setdefault('total_disbursements', 0)
-        
-        # Render HTML template
-        html = render_template('member/statement_pdf.html', **data)
-        
-        # Create PDF
-        pdf = BytesIO()
-        pisa_status = pisa.CreatePDF(html, dest=pdf)
-        
-        if pisa_status.err:
-            raise Exception(f"PDF generation error: {pisa_status.err}")
-        
-        pdf.seek(0)
-        return pdf.getvalue()
-        
+        return render_statement(data)
     except Exception as e:
         print(f"Error in PDF generation: {e}")
         raise
@@ -80,13 +59,7 @@ def dashboard():
         print(f"DEBUG: Loading dashboard for member_id: {member_id}")
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('*')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         print(f"DEBUG: Member data: {member}")
         
         # Get savings account - with default values
@@ -229,6 +202,7 @@ def update_profile():
             .update(update_data)\
             .eq('id', member_id)\
             .execute()
+        invalidate_member_profile(member_id)
         
         flash('Profile updated successfully', 'success')
         return redirect(url_for('member.profile'))
@@ -246,13 +220,7 @@ def savings():
         member_id = session['member_id']
         
         # Get member details for PesaPal payment
-        member_res = supabase.table('members')\
-            .select('*')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Get savings account
         savings_res = supabase.table('savings_accounts')\
@@ -299,13 +267,7 @@ def initiate_deposit():
             return redirect(url_for('member.savings'))
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('full_name, email, phone_number')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Get savings account
         savings_res = supabase.table('savings_accounts')\
@@ -406,6 +368,7 @@ def initiate_deposit():
 @member_login_required
 def deposit_callback():
     """Handle PesaPal callback for deposit"""
+    claimed = False
     try:
         order_tracking_id = request.args.get('OrderTrackingId')
         merchant_reference = request.args.get('OrderMerchantReference')  # Get merchant reference
@@ -414,6 +377,11 @@ def deposit_callback():
             flash('Invalid payment callback', 'error')
             return redirect(url_for('member.savings'))
         
+        # Orders already settled never go back to PesaPal
+        if processed_orders.lookup(supabase, order_tracking_id):
+            flash('This deposit was already processed successfully!', 'info')
+            return redirect(url_for('member.savings'))
+        
         # Get payment session
         payment_session_res = supabase.table('savings_payment_sessions')\
             .select('*')\
@@ -430,7 +398,6 @@ def deposit_callback():
         member_id = payment_session['member_id']
         savings_account_id = payment_session['savings_account_id']
         amount = Decimal(payment_session['amount'])
-        balance_before = Decimal(payment_session['balance_before'])
         original_reference = payment_session['reference_id']
         
         # Verify payment with PesaPal
@@ -451,50 +418,24 @@ def deposit_callback():
             normalized_status = 'failed'
         
         if normalized_status == 'completed':
-            # Check if transaction already exists to avoid duplicates
-            existing_transaction_res = supabase.table('savings_transactions')\
-                .select('*')\
-                .eq('reference_number', original_reference)\
-                .eq('status', 'completed')\
-                .execute()
-            
-            if existing_transaction_res.data:
-                # Transaction already processed
-                flash(f'Deposit of UGX {amount:,.0f} was already processed successfully!', 'info')
+            # Claim the order so it is settled exactly once
+            claimed = processed_orders.claim(supabase, order_tracking_id, 'deposit', member_id, amount)
+            if not claimed:
+                if processed_orders.lookup(supabase, order_tracking_id):
+                    flash(f'Deposit of UGX {amount:,.0f} was already processed successfully!', 'info')
+                else:
+                    # Another request holds the claim and has not finished settling yet
+                    flash('This payment is still being processed. Please check again in a few minutes.', 'info')
                 return redirect(url_for('member.savings'))
             
-            # Update savings account balance
-            savings_res = supabase.table('savings_accounts')\
-                .select('current_balance, available_balance')\
-                .eq('id', savings_account_id)\
-                .single()\
-                .execute()
-            
-            savings_account = savings_res.data
-            new_balance = Decimal(savings_account['current_balance']) + amount
-            new_available = Decimal(savings_account['available_balance']) + amount
-            
-            # Update account balances
-            supabase.table('savings_accounts')\
-                .update({
-                    'current_balance': str(new_balance),
-                    'available_balance': str(new_available),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', savings_account_id)\
-                .execute()
-            
-            # Update the original pending transaction to completed
-            supabase.table('savings_transactions')\
-                .update({
-                    'status': 'completed',
-                    'balance_before': str(balance_before),
-                    'balance_after': str(new_balance),
-                    'pesapal_order_id': order_tracking_id,
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', transaction_id)\
-                .execute()
+            # Credit the account and complete the original pending transaction in one posting
+            post_savings_entry(supabase, savings_account_id, amount, {
+                'status': 'completed',
+                'pesapal_order_id': order_tracking_id,
+                'updated_at': datetime.now().isoformat()
+            }, transaction_id=transaction_id)
+            # Posted: from here on the claim never goes back, whatever fails below
+            processed_orders.settle(supabase, order_tracking_id)
             
             # If merchant_reference is different, update it
             if merchant_reference and merchant_reference != original_reference:
@@ -510,10 +451,13 @@ def deposit_callback():
                     # It's okay if we can't update, keep the original
             
             # Clear payment session
-            supabase.table('savings_payment_sessions')\
-                .delete()\
-                .eq('order_tracking_id', order_tracking_id)\
-                .execute()
+            try:
+                supabase.table('savings_payment_sessions')\
+                    .delete()\
+                    .eq('order_tracking_id', order_tracking_id)\
+                    .execute()
+            except Exception as e:
+                print(f"Error clearing payment session for settled order {order_tracking_id}: {e}")
             
             flash(f'Deposit of UGX {amount:,.0f} completed successfully!', 'success')
             
@@ -547,6 +491,9 @@ def deposit_callback():
             
     except Exception as e:
         print(f"Error in deposit callback: {e}")
+        if claimed:
+            # Nothing was posted yet (settle() makes a later release a no-op), so the next callback retries
+            processed_orders.release(supabase, order_tracking_id)
         flash('Error processing payment callback', 'error')
         return redirect(url_for('member.savings'))
     
@@ -690,13 +637,7 @@ def pay_repayment():
             return redirect(url_for('member.loans'))
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('full_name, email, phone_number')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Get loan account for reference
         loan_res = supabase.table('loan_accounts')\
@@ -801,6 +742,7 @@ def pay_repayment():
 @member_login_required
 def repayment_callback():
     """Handle PesaPal callback for loan repayment"""
+    claimed = False
     try:
         order_tracking_id = request.args.get('OrderTrackingId')
         merchant_reference = request.args.get('OrderMerchantReference')
@@ -809,6 +751,11 @@ def repayment_callback():
             flash('Invalid payment callback', 'error')
             return redirect(url_for('member.loans'))
         
+        # Orders already settled never go back to PesaPal
+        if processed_orders.lookup(supabase, order_tracking_id):
+            flash('This payment was already processed!', 'info')
+            return redirect(url_for('member.loans'))
+        
         # Get payment session
         payment_session_res = supabase.table('loan_payment_sessions')\
             .select('*')\
@@ -827,7 +774,6 @@ def repayment_callback():
         loan_account_id = payment_session['loan_account_id']
         loan_application_id = payment_session['loan_application_id']
         amount = Decimal(payment_session['amount'])
-        balance_before = Decimal(payment_session['balance_before'])
         payment_type = payment_session['payment_type']
         installment_number = payment_session['installment_number']
         
@@ -849,91 +795,69 @@ def repayment_callback():
             normalized_status = 'failed'
         
         if normalized_status == 'completed':
-            # Check if transaction already processed by looking at payment_method
-            existing_transaction_res = supabase.table('loan_transactions')\
-                .select('*')\
-                .eq('id', transaction_id)\
-                .execute()
-            
-            existing_transaction = existing_transaction_res.data[0] if existing_transaction_res.data else None
-            
-            if existing_transaction and existing_transaction.get('payment_method') == 'pesapal_completed':
-                flash(f'Payment of UGX {amount:,.0f} was already processed!', 'info')
+            # Claim the order so it is settled exactly once
+            claimed = processed_orders.claim(supabase, order_tracking_id, 'repayment', member_id, amount)
+            if not claimed:
+                if processed_orders.lookup(supabase, order_tracking_id):
+                    flash(f'Payment of UGX {amount:,.0f} was already processed!', 'info')
+                else:
+                    # Another request holds the claim and has not finished settling yet
+                    flash('This payment is still being processed. Please check again in a few minutes.', 'info')
                 return redirect(url_for('member.loans'))
             
-            # Update loan account balance
-            loan_res = supabase.table('loan_accounts')\
-                .select('current_balance, available_limit')\
-                .eq('id', loan_account_id)\
-                .single()\
-                .execute()
-            
-            loan_account = loan_res.data
-            new_balance = Decimal(loan_account['current_balance']) - amount
-            new_available = Decimal(loan_account['available_limit']) + amount
-            
-            # Update account balances
-            supabase.table('loan_accounts')\
-                .update({
-                    'current_balance': str(new_balance),
-                    'available_limit': str(new_available),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', loan_account_id)\
-                .execute()
-            
-            # Update the transaction using payment_method
-            supabase.table('loan_transactions')\
-                .update({
-                    'balance_before': str(balance_before),
-                    'balance_after': str(new_balance),
-                    'payment_method': 'pesapal_completed',
-                    'reference_number': merchant_reference or payment_session['reference_id'],
-                    'description': f'Repayment for installment #{installment_number} completed via PesaPal'
-                })\
-                .eq('id', transaction_id)\
-                .execute()
-            
-            # Update repayment record
-            repayment_res = supabase.table('loan_repayments')\
-                .select('paid_amount, due_amount')\
-                .eq('id', repayment_id)\
-                .single()\
-                .execute()
+            # Reduce the loan balance and complete the pending transaction in one posting
+            post_loan_entry(supabase, -amount, {
+                'payment_method': 'pesapal_completed',
+                'reference_number': merchant_reference or payment_session['reference_id'],
+                'description': f'Repayment for installment #{installment_number} completed via PesaPal'
+            }, account_id=loan_account_id, transaction_id=transaction_id)
+            # Posted: from here on the claim never goes back, whatever fails below
+            processed_orders.settle(supabase, order_tracking_id)
             
-            repayment = repayment_res.data
-            current_paid = Decimal(repayment['paid_amount'])
-            new_paid = current_paid + amount
-            due_amount = Decimal(repayment['due_amount'])
-            
-            # Determine new status
-            if new_paid >= due_amount:
-                new_status = 'paid'
-            elif new_paid > 0:
-                new_status = 'partial'
-            else:
-                new_status = 'pending'
-            
-            supabase.table('loan_repayments')\
-                .update({
-                    'paid_amount': str(new_paid),
-                    'paid_date': datetime.now().date().isoformat(),
-                    'payment_method': 'pesapal',
-                    'reference_number': merchant_reference or payment_session['reference_id'],
-                    'status': new_status,
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', repayment_id)\
-                .execute()
-            
-            # Update payment session
-            supabase.table('loan_payment_sessions')\
-                .update({
-                    'status': 'completed',
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('order_tracking_id', order_tracking_id)\
-                .execute()
+            try:
+                # Update repayment record
+                repayment_res = supabase.table('loan_repayments')\
+                    .select('paid_amount, due_amount')\
+                    .eq('id', repayment_id)\
+                    .single()\
+                    .execute()
+                
+                repayment = repayment_res.data
+                current_paid = Decimal(repayment['paid_amount'])
+                new_paid = current_paid + amount
+                due_amount = Decimal(repayment['due_amount'])
+                
+                # Determine new status
+                if new_paid >= due_amount:
+                    new_status = 'paid'
+                elif new_paid > 0:
+                    new_status = 'partial'
+                else:
+                    new_status = 'pending'
+                
+                supabase.table('loan_repayments')\
+                    .update({
+                        'paid_amount': str(new_paid),
+                        'paid_date': datetime.now().date().isoformat(),
+                        'payment_method': 'pesapal',
+                        'reference_number': merchant_reference or payment_session['reference_id'],
+                        'status': new_status,
+                        'updated_at': datetime.now().isoformat()
+                    })\
+                    .eq('id', repayment_id)\
+                    .execute()
+                
+                # Update payment session
+                supabase.table('loan_payment_sessions')\
+                    .update({
+                        'status': 'completed',
+                        'updated_at': datetime.now().isoformat()
+                    })\
+                    .eq('order_tracking_id', order_tracking_id)\
+                    .execute()
+            except Exception as e:
+                # The loan is already credited; the installment has to be corrected by hand
+                print(f"Error updating repayment {repayment_id} for settled order {order_tracking_id}: {e}")
             
             flash(f'Payment of UGX {amount:,.0f} for installment #{installment_number} completed successfully!', 'success')
             
@@ -983,6 +907,9 @@ def repayment_callback():
             
     except Exception as e:
         print(f"Error in repayment callback: {e}")
+        if claimed:
+            # Nothing was posted yet (settle() makes a later release a no-op), so the next callback retries
+            processed_orders.release(supabase, order_tracking_id)
         flash('Error processing payment callback', 'error')
         return redirect(url_for('member.loans'))
 
@@ -1006,13 +933,7 @@ def apply_loan():
             return redirect(url_for('member.loans'))
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('member_number')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Get loan product
         product_res = supabase.table('loan_products')\
@@ -1106,13 +1027,7 @@ def pay_total_balance():
             return redirect(url_for('member.loans'))
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('full_name, email, phone_number')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Create transaction record WITHOUT status column
         transaction_id = str(uuid.uuid4())
@@ -1204,6 +1119,7 @@ def pay_total_balance():
 @member_login_required
 def balance_callback():
     """Handle PesaPal callback for loan balance payment"""
+    claimed = False
     try:
         order_tracking_id = request.args.get('OrderTrackingId')
         merchant_reference = request.args.get('OrderMerchantReference')
@@ -1212,6 +1128,11 @@ def balance_callback():
             flash('Invalid payment callback', 'error')
             return redirect(url_for('member.loans'))
         
+        # Orders already settled never go back to PesaPal
+        if processed_orders.lookup(supabase, order_tracking_id):
+            flash('This payment was already processed!', 'info')
+            return redirect(url_for('member.loans'))
+        
         # Get payment session
         payment_session_res = supabase.table('loan_payment_sessions')\
             .select('*')\
@@ -1228,7 +1149,6 @@ def balance_callback():
         member_id = payment_session['member_id']
         loan_account_id = payment_session['loan_account_id']
         amount = Decimal(payment_session['amount'])
-        balance_before = Decimal(payment_session['balance_before'])
         
         # Verify payment with PesaPal
         pesapal = PesaPal()
@@ -1248,59 +1168,37 @@ def balance_callback():
             normalized_status = 'failed'
         
         if normalized_status == 'completed':
-            # Check if transaction already processed by looking at payment_method
-            existing_transaction_res = supabase.table('loan_transactions')\
-                .select('*')\
-                .eq('id', transaction_id)\
-                .execute()
-            
-            existing_transaction = existing_transaction_res.data[0] if existing_transaction_res.data else None
-            
-            if existing_transaction and existing_transaction.get('payment_method') == 'pesapal_completed':
-                flash(f'Payment of UGX {amount:,.0f} was already processed!', 'info')
+            # Claim the order so it is settled exactly once
+            claimed = processed_orders.claim(supabase, order_tracking_id, 'balance', member_id, amount)
+            if not claimed:
+                if processed_orders.lookup(supabase, order_tracking_id):
+                    flash(f'Payment of UGX {amount:,.0f} was already processed!', 'info')
+                else:
+                    # Another request holds the claim and has not finished settling yet
+                    flash('This payment is still being processed. Please check again in a few minutes.', 'info')
                 return redirect(url_for('member.loans'))
             
-            # Update loan account balance
-            loan_res = supabase.table('loan_accounts')\
-                .select('current_balance, available_limit')\
-                .eq('id', loan_account_id)\
-                .single()\
-                .execute()
-            
-            loan_account = loan_res.data
-            new_balance = Decimal(loan_account['current_balance']) - amount
-            new_available = Decimal(loan_account['available_limit']) + amount
-            
-            # Update account balances
-            supabase.table('loan_accounts')\
-                .update({
-                    'current_balance': str(new_balance),
-                    'available_limit': str(new_available),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', loan_account_id)\
-                .execute()
-            
-            # Update the transaction using payment_method field
-            supabase.table('loan_transactions')\
-                .update({
-                    'balance_before': str(balance_before),
-                    'balance_after': str(new_balance),
-                    'reference_number': merchant_reference or payment_session['reference_id'],
-                    'payment_method': 'pesapal_completed',
-                    'description': f'Loan balance payment completed via PesaPal'
-                })\
-                .eq('id', transaction_id)\
-                .execute()
+            # Reduce the loan balance and complete the pending transaction in one posting
+            posting = post_loan_entry(supabase, -amount, {
+                'reference_number': merchant_reference or payment_session['reference_id'],
+                'payment_method': 'pesapal_completed',
+                'description': f'Loan balance payment completed via PesaPal'
+            }, account_id=loan_account_id, transaction_id=transaction_id)
+            new_balance = posting['balance_after']
+            # Posted: from here on the claim never goes back, whatever fails below
+            processed_orders.settle(supabase, order_tracking_id)
             
             # Update payment session status
-            supabase.table('loan_payment_sessions')\
-                .update({
-                    'status': 'completed',
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('order_tracking_id', order_tracking_id)\
-                .execute()
+            try:
+                supabase.table('loan_payment_sessions')\
+                    .update({
+                        'status': 'completed',
+                        'updated_at': datetime.now().isoformat()
+                    })\
+                    .eq('order_tracking_id', order_tracking_id)\
+                    .execute()
+            except Exception as e:
+                print(f"Error completing payment session for settled order {order_tracking_id}: {e}")
             
             flash(f'Payment of UGX {amount:,.0f} completed successfully! Your loan balance is now UGX {new_balance:,.0f}', 'success')
             
@@ -1350,6 +1248,9 @@ def balance_callback():
             
     except Exception as e:
         print(f"Error in balance callback: {e}")
+        if claimed:
+            # Nothing was posted yet (settle() makes a later release a no-op), so the next callback retries
+            processed_orders.release(supabase, order_tracking_id)
         flash('Error processing payment callback', 'error')
         return redirect(url_for('member.loans'))
     
@@ -1358,179 +1259,94 @@ def balance_callback():
 @member_bp.route('/statements')
 @member_login_required
 def statements():
-    """Account statements"""
+    """Account statements: accounts and period totals; the transaction lists load from statements_transactions()"""
+    member_id = session['member_id']
     try:
-        member_id = session['member_id']
-        
-        # Initialize variables with defaults
-        member = {}
-        savings_account = {}
-        loan_accounts = []
-        savings_transactions = []
-        loan_transactions = []
-        repayments = []
-        total_savings_deposits = Decimal(0)
-        total_savings_withdrawals = Decimal(0)
-        total_loan_repayments = Decimal(0)
-        total_loan_disbursements = Decimal(0)
-
-        # --- MEMBER DETAILS ---
-        try:
-            member_res = supabase.table('members') \
-                .select('*') \
-                .eq('id', member_id) \
-                .single() \
-                .execute()
-            
-            member = member_res.data or {}
-        except Exception as e:
-            print(f"Error getting member details: {e}")
-            member = {
-                'full_name': session.get('member_name', 'Member'),
-                'member_number': session.get('member_number', ''),
-                'email': session.get('member_email', '')
-            }
-
-        # --- SAVINGS ACCOUNT ---
-        try:
-            savings_res = supabase.table('savings_accounts') \
-                .select('*') \
-                .eq('member_id', member_id) \
-                .single() \
-                .execute()
-            
-            savings_account = savings_res.data or {}
-        except Exception as e:
-            print(f"Error getting savings account: {e}")
-            savings_account = {}
-
-        # --- LOAN ACCOUNTS (MAY BE MULTIPLE) ---
-        try:
-            loan_res = supabase.table('loan_accounts') \
-                .select('id, account_number, current_balance, status') \
-                .eq('member_id', member_id) \
-                .execute()
-            
-            loan_accounts = loan_res.data or []
-            loan_account_ids = [acc['id'] for acc in loan_accounts]
-        except Exception as e:
-            print(f"Error getting loan accounts: {e}")
-            loan_accounts = []
-            loan_account_ids = []
-
-        # --- DATE RANGE ---
-        start_date = request.args.get(
-            'start_date',
-            (datetime.now() - timedelta(days=30)).date().isoformat()
-        )
-        end_date = request.args.get(
-            'end_date',
-            datetime.now().date().isoformat()
-        )
-
-        # --- SAVINGS TRANSACTIONS ---
-        if savings_account:
-            try:
-                savings_res = supabase.table('savings_transactions') \
-                    .select('*') \
-                    .eq('member_id', member_id) \
-                    .gte('created_at', start_date) \
-                    .lte('created_at', end_date) \
-                    .order('created_at', desc=True) \
-                    .execute()
-
-                savings_transactions = savings_res.data or []
-
-                for t in savings_transactions:
-                    amount = Decimal(t.get('amount', '0'))
-                    if t.get('transaction_type') == 'deposit':
-                        total_savings_deposits += amount
-                    elif t.get('transaction_type') == 'withdrawal':
-                        total_savings_withdrawals += amount
-
-            except Exception as e:
-                print(f"Error getting savings transactions: {e}")
-                savings_transactions = []
-
-        # --- LOAN TRANSACTIONS (BY loan_account_id) ---
-        if loan_account_ids:
-            try:
-                loan_tx_res = supabase.table('loan_transactions') \
-                    .select('*') \
-                    .in_('loan_account_id', loan_account_ids) \
-                    .gte('created_at', start_date) \
-                    .lte('created_at', end_date) \
-                    .order('created_at', desc=True) \
-                    .execute()
-
-                loan_transactions = loan_tx_res.data or []
+        member = get_member_profile(supabase, member_id) or {}
+    except Exception as e:
+        print(f"Error getting member details: {e}")
+        member = {
+            'full_name': session.get('member_name', 'Member'),
+            'member_number': session.get('member_number', ''),
+            'email': session.get('member_email', '')
+        }
 
-                for t in loan_transactions:
-                    amount = Decimal(t.get('amount', '0'))
-                    if t.get('transaction_type') == 'repayment':
-                        total_loan_repayments += amount
-                    elif t.get('transaction_type') == 'disbursement':
-                        total_loan_disbursements += amount
+    try:
+        start, end = statement_period(request.args.get('start_date'), request.args.get('end_date'))
+    except StatementError as e:
+        flash(str(e), 'error')
+        start, end = statement_period()
 
-            except Exception as e:
-                print(f"Error getting loan transactions: {e}")
-                loan_transactions = []
+    try:
+        summary = statement_summary(supabase, member_id, start, end)
+    except Exception as e:
+        print(f"Error loading statements: {e}")
+        flash('Error loading statements', 'error')
+        summary = {
+            'savings_account': {}, 'loan_account': {},
+            'savings': {'count': 0, 'deposits': 0, 'withdrawals': 0},
+            'loan': {'count': 0, 'repayments': 0, 'disbursements': 0},
+            'repayments': {'count': 0, 'paid': 0}
+        }
 
-            # --- REPAYMENTS (OPTIONAL EXTRA) ---
-            try:
-                repayments_res = supabase.table('loan_repayments') \
-                    .select('*, loan_applications(loan_amount, purpose)') \
-                    .eq('member_id', member_id) \
-                    .gte('paid_date', start_date) \
-                    .lte('paid_date', end_date) \
-                    .order('paid_date', desc=True) \
-                    .execute()
+    return render_template(
+        'member/statements.html',
+        member=member,
+        savings_account=summary['savings_account'],
+        loan_account=summary['loan_account'],
+        start_date=start.isoformat(),
+        end_date=end.isoformat(),
+        savings_count=summary['savings']['count'],
+        loan_count=summary['loan']['count'],
+        repayment_count=summary['repayments']['count'],
+        total_savings_deposits=summary['savings']['deposits'],
+        total_savings_withdrawals=summary['savings']['withdrawals'],
+        total_loan_repayments=summary['loan']['repayments'],
+        total_loan_disbursements=summary['loan']['disbursements']
+    )
 
-                repayments = repayments_res.data or []
 
-            except Exception as e:
-                print(f"Error getting repayments: {e}")
-                repayments = []
+@member_bp.route('/statements/summary')
+@member_login_required
+def statements_summary():
+    """Accounts and period totals for start_date..end_date as JSON"""
+    try:
+        start, end = statement_period(request.args.get('start_date'), request.args.get('end_date'))
+        summary = statement_summary(supabase, session['member_id'], start, end)
+        return jsonify({
+            'success': True,
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'savings_account': summary['savings_account'],
+            'loan_account': summary['loan_account'],
+            'savings': summary['savings'],
+            'loan': summary['loan'],
+            'repayments': summary['repayments']
+        })
+    except StatementError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        print(f"Error loading statement summary: {e}")
+        return jsonify({'success': False, 'message': 'Error loading statement'}), 500
 
-        return render_template(
-            'member/statements.html',
-            member=member,
-            savings_account=savings_account,
-            loan_account=loan_accounts,   # now supports multiple loans
-            start_date=start_date,
-            end_date=end_date,
-            savings_transactions=savings_transactions,
-            loan_transactions=loan_transactions,
-            repayments=repayments,
-            total_savings_deposits=total_savings_deposits,
-            total_savings_withdrawals=total_savings_withdrawals,
-            total_loan_repayments=total_loan_repayments,
-            total_loan_disbursements=total_loan_disbursements
-        )
 
+@member_bp.route('/statements/transactions')
+@member_login_required
+def statements_transactions():
+    """One page of a statement list (list=all|savings|loan|repayments); pass next_cursor back as cursor"""
+    try:
+        start, end = statement_period(request.args.get('start_date'), request.args.get('end_date'))
+        page = statement_page(supabase, session['member_id'], request.args.get('list', 'all'), start, end,
+                              cursor=request.args.get('cursor'),
+                              limit=request.args.get('limit', 25, type=int))
+        return jsonify({'success': True, **page})
+    except StatementError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
-        print(f"Error loading statements: {e}")
-        flash('Error loading statements', 'error')
+        print(f"Error loading statement transactions: {e}")
+        return jsonify({'success': False, 'message': 'Error loading transactions'}), 500
 
-        return render_template(
-            'member/statements.html',
-            member={'full_name': session.get('member_name', 'Member'),
-                    'member_number': session.get('member_number', ''),
-                    'email': session.get('member_email', '')},
-            savings_account={},
-            loan_account={},
-            start_date=(datetime.now() - timedelta(days=30)).date().isoformat(),
-            end_date=datetime.now().date().isoformat(),
-            savings_transactions=[],
-            loan_transactions=[],
-            repayments=[],
-            total_savings_deposits=0,
-            total_savings_withdrawals=0,
-            total_loan_repayments=0,
-            total_loan_disbursements=0
-        )
 
-        
 @member_bp.route('/download-statement', methods=['POST'])
 @member_login_required
 def download_statement():
@@ -1542,13 +1358,7 @@ def download_statement():
         end_date = request.form.get('end_date', datetime.now().date().isoformat())
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('*')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data if member_res.data else {}
+        member = get_member_profile(supabase, member_id) or {}
         
         # Get savings account
         savings_res = supabase.table('savings_accounts')\
@@ -1646,122 +1456,42 @@ def download_statement():
         flash('Error generating statement', 'error')
         return redirect(url_for('member.statements'))
 
-def generate_statement_pdf(data):
-    """Generate PDF from HTML template"""
-    try:
-        # Render HTML template
-        html = render_template('member/statement_pdf.html', **data)
-        
-        # Create PDF
-        pdf = BytesIO()
-        pisa_status = pisa.CreatePDF(html, dest=pdf)
-        
-        if pisa_status.err:
-            raise Exception(f"PDF generation error: {pisa_status.err}")
-        
-        pdf.seek(0)
-        return pdf.getvalue()
-        
-    except Exception as e:
-        print(f"Error in PDF generation: {e}")
-        raise
-    
 @member_bp.route('/preview-statement', methods=['POST'])
 @member_login_required
 def preview_statement():
-    """Preview statement before download"""
+    """Preview statement before download: totals and the newest rows of each list in one query"""
     try:
         member_id = session['member_id']
         statement_type = request.form.get('statement_type', 'combined')
-        start_date = request.form.get(
-            'start_date',
-            (datetime.now() - timedelta(days=30)).date().isoformat()
-        )
-        end_date = request.form.get(
-            'end_date',
-            datetime.now().date().isoformat()
-        )
-
-        # ---- MEMBER DETAILS ----
-        member_res = supabase.table('members') \
-            .select('*') \
-            .eq('id', member_id) \
-            .single() \
-            .execute()
-        member = member_res.data or {}
-
-        # ---- SAVINGS ACCOUNT ----
-        savings_res = supabase.table('savings_accounts') \
-            .select('*') \
-            .eq('member_id', member_id) \
-            .single() \
-            .execute()
-        savings_account = savings_res.data or {}
-
-        # ---- LOAN ACCOUNT ---- (single loan per member)
-        loan_res = supabase.table('loan_accounts') \
-            .select('*') \
-            .eq('member_id', member_id) \
-            .single() \
-            .execute()
-        loan_account = loan_res.data or {}
-        loan_account_id = loan_account.get('id')  # for transactions
-
-        transactions_data = {
-            'member': member,
-            'savings_account': savings_account,
-            'loan_account': loan_account,
-            'start_date': start_date,
-            'end_date': end_date,
-            'statement_type': statement_type
-        }
-
-        # ---- SAVINGS TRANSACTIONS ----
-        if statement_type in ['combined', 'savings'] and savings_account:
-            savings_tx = supabase.table('savings_transactions') \
-                .select('*') \
-                .eq('member_id', member_id) \
-                .gte('created_at', start_date) \
-                .lte('created_at', end_date) \
-                .order('created_at', desc=True) \
-                .limit(5) \
-                .execute()
-            transactions_data['savings_transactions'] = savings_tx.data or []
-
-        # ---- LOAN TRANSACTIONS ----
-        if statement_type in ['combined', 'loan'] and loan_account_id:
-            loan_tx = supabase.table('loan_transactions') \
-                .select('*') \
-                .eq('loan_account_id', loan_account_id) \
-                .gte('created_at', start_date) \
-                .lte('created_at', end_date) \
-                .order('created_at', desc=True) \
-                .limit(5) \
-                .execute()
-            transactions_data['loan_transactions'] = loan_tx.data or []
-
-            # ---- REPAYMENTS ----
-            repayments_tx = supabase.table('loan_repayments') \
-                .select('*, loan_applications(loan_amount, purpose)') \
-                .eq('member_id', member_id) \
-                .gte('paid_date', start_date) \
-                .lte('paid_date', end_date) \
-                .order('paid_date', desc=True) \
-                .limit(5) \
-                .execute()
-            transactions_data['repayments'] = repayments_tx.data or []
+        start, end = statement_period(request.form.get('start_date'), request.form.get('end_date'))
+        summary = statement_summary(supabase, member_id, start, end, sample=3)
 
-        # ---- RENDER PREVIEW ----
-        html = render_template('member/statement_preview.html', **transactions_data)
+        html = render_template(
+            'member/statement_preview.html',
+            member=get_member_profile(supabase, member_id) or {},
+            savings_account=summary['savings_account'],
+            loan_account=summary['loan_account'],
+            start_date=start.isoformat(),
+            end_date=end.isoformat(),
+            statement_type=statement_type,
+            savings_transactions=summary['samples']['savings'],
+            loan_transactions=summary['samples']['loan'],
+            repayments=summary['samples']['repayments'],
+            savings_count=summary['savings']['count'],
+            loan_count=summary['loan']['count'],
+            repayment_count=summary['repayments']['count']
+        )
 
         return jsonify({
             'success': True,
             'html': html,
             'statement_type': statement_type,
-            'start_date': start_date,
-            'end_date': end_date
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat()
         })
 
+    except StatementError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         print(f"Error previewing statement: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -1776,13 +1506,7 @@ def shares():
         member_id = session['member_id']
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('full_name, email, shares_owned')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Get current share value
         share_value_res = supabase.table('share_value')\
@@ -1840,13 +1564,7 @@ def purchase_shares():
         total_amount = price_per_share * shares_to_buy
         
         # Get member details
-        member_res = supabase.table('members')\
-            .select('full_name, email, phone_number')\
-            .eq('id', member_id)\
-            .single()\
-            .execute()
-        
-        member = member_res.data
+        member = get_member_profile(supabase, member_id)
         
         # Create share transaction record WITHOUT total_amount (it's generated)
         transaction_id = str(uuid.uuid4())
@@ -1957,6 +1675,7 @@ def purchase_shares():
 @member_login_required
 def share_payment_callback():
     """Handle PesaPal callback for share purchase"""
+    claimed = False
     try:
         order_tracking_id = request.args.get('OrderTrackingId')
         merchant_reference = request.args.get('OrderMerchantReference')
@@ -1965,6 +1684,11 @@ def share_payment_callback():
             flash('Invalid payment callback', 'error')
             return redirect(url_for('member.shares'))
         
+        # Orders already settled never go back to PesaPal
+        if processed_orders.lookup(supabase, order_tracking_id):
+            flash('This share purchase was already processed!', 'info')
+            return redirect(url_for('member.shares'))
+        
         # Get payment session
         payment_session_res = supabase.table('share_payment_sessions')\
             .select('*')\
@@ -2000,36 +1724,30 @@ def share_payment_callback():
             normalized_status = 'failed'
         
         if normalized_status == 'completed':
-            # Check if already processed
-            existing_session_res = supabase.table('share_payment_sessions')\
-                .select('*')\
-                .eq('order_tracking_id', order_tracking_id)\
-                .eq('status', 'completed')\
-                .execute()
-            
-            if existing_session_res.data:
-                flash(f'Purchase of {shares_to_buy} shares was already processed!', 'info')
+            # Claim the order so it is settled exactly once
+            claimed = processed_orders.claim(supabase, order_tracking_id, 'shares', member_id, total_amount)
+            if not claimed:
+                if processed_orders.lookup(supabase, order_tracking_id):
+                    flash(f'Purchase of {shares_to_buy} shares was already processed!', 'info')
+                else:
+                    # Another request holds the claim and has not finished settling yet
+                    flash('This payment is still being processed. Please check again in a few minutes.', 'info')
                 return redirect(url_for('member.shares'))
             
-            # Get current member shares
-            member_res = supabase.table('members')\
-                .select('shares_owned')\
-                .eq('id', member_id)\
-                .single()\
-                .execute()
-            
-            member_data = member_res.data
-            current_shares = member_data.get('shares_owned', 0)
-            new_shares = current_shares + shares_to_buy
-            
-            # Update member shares
-            supabase.table('members')\
-                .update({
-                    'shares_owned': new_shares,
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', member_id)\
+            # Add the shares by posting the share_transactions row created for this session
+            share_transaction = supabase.table('share_transactions')\
+                .select('id')\
+                .eq('reference', payment_session['reference_id'])\
+                .eq('member_id', member_id)\
+                .limit(1)\
                 .execute()
+            if not share_transaction.data:
+                raise PostingError(f"Share transaction {payment_session['reference_id']} not found")
+            new_shares = post_share_entry(supabase, member_id, shares_to_buy,
+                                          transaction_id=share_transaction.data[0]['id'])['shares_after']
+            # Posted: from here on the claim never goes back, whatever fails below
+            processed_orders.settle(supabase, order_tracking_id)
+            invalidate_member_profile(member_id)
             
             # Update share transaction (don't try to update total_amount if it's generated)
             update_data = {
@@ -2038,20 +1756,23 @@ def share_payment_callback():
                 'updated_at': datetime.now().isoformat()
             }
             
-            # Try to update, but don't include total_amount
-            supabase.table('share_transactions')\
-                .update(update_data)\
-                .eq('reference', payment_session['reference_id'])\
-                .execute()
-            
-            # Update payment session
-            supabase.table('share_payment_sessions')\
-                .update({
-                    'status': 'completed',
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('order_tracking_id', order_tracking_id)\
-                .execute()
+            try:
+                # Try to update, but don't include total_amount
+                supabase.table('share_transactions')\
+                    .update(update_data)\
+                    .eq('reference', payment_session['reference_id'])\
+                    .execute()
+                
+                # Update payment session
+                supabase.table('share_payment_sessions')\
+                    .update({
+                        'status': 'completed',
+                        'updated_at': datetime.now().isoformat()
+                    })\
+                    .eq('order_tracking_id', order_tracking_id)\
+                    .execute()
+            except Exception as e:
+                print(f"Error completing share purchase records for settled order {order_tracking_id}: {e}")
             
             flash(f'Successfully purchased {shares_to_buy} shares for UGX {total_amount:,.0f}! You now own {new_shares} shares.', 'success')
             
@@ -2092,5 +1813,8 @@ def share_payment_callback():
             
     except Exception as e:
         print(f"Error in share payment callback: {e}")
+        if claimed:
+            # Nothing was posted yet (settle() makes a later release a no-op), so the next callback retries
+            processed_orders.release(supabase, order_tracking_id)
         flash('Error processing payment callback', 'error')
         return redirect(url_for('member.shares'))
\ No newline at end of file
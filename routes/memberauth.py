@@ -2,14 +2,16 @@
 import os
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
 from supabase import create_client, Client
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import uuid
 import json
 from decimal import Decimal
 from dotenv import load_dotenv
 from postgrest.exceptions import APIError
+from credential_store import credential_store, reset_key, RESET_TOKEN_TTL
+from session_store import cache_member_profile, invalidate_member_profile, regenerate_session
+from passwords import verify_password, hash_password
 
 load_dotenv()
 
@@ -41,7 +43,8 @@ def get_member_by_email(email):
     """Safely get member by email with password hash"""
     try:
         response = supabase.table('members')\
-            .select('id, email, full_name, account_status, member_number, password_hash, default_password_used')\
+            .select('id, email, full_name, account_status, member_number, password_hash, default_password_used, '
+                    'phone_number, shares_owned, created_at, updated_at')\
             .eq('email', email)\
             .execute()
         
@@ -74,10 +77,9 @@ def get_member_by_id(member_id):
         print(f"Error fetching member by ID: {e}")
         return None
 
-def check_member_password(member, password):
-    """Check if password is correct for member"""
+def check_member_password(member, password, rehash=False):
+    """Check if password is correct for member (one hash computation)"""
     password_hash = member.get('password_hash')
-    default_password_used = member.get('default_password_used', False)
     
     # If no password set yet, check against default "123"
     if not password_hash:
@@ -85,14 +87,22 @@ def check_member_password(member, password):
             return True, True  # Password correct, is default
         return False, False
     
-    # If password is set, check it
-    if check_password_hash(password_hash, password):
-        # Check if they're using default password (should be hashed version of "123")
-        if default_password_used and check_password_hash(password_hash, "123"):
-            return True, True  # Password correct, is default
-        return True, False  # Password correct, not default
+    password_correct, new_hash = verify_password(password_hash, password)
+    if not password_correct:
+        return False, False
     
-    return False, False
+    # Upgrade hashes made with older parameters while we have the plain password
+    if rehash and new_hash:
+        try:
+            supabase.table('members')\
+                .update({'password_hash': new_hash})\
+                .eq('id', member['id'])\
+                .execute()
+        except Exception as e:
+            print(f"Password rehash error: {e}")
+    
+    # default_password_used is set whenever the hash is reset to "123" (see members.reset_member_password)
+    return True, bool(member.get('default_password_used', False))
 
 # Routes
 @memberauth_bp.route('/login', methods=['GET', 'POST'])
@@ -124,20 +134,17 @@ def member_login():
             return render_template('member/login.html')
 
         # Check password
-        password_correct, is_default = check_member_password(member, password)
+        password_correct, is_default = check_member_password(member, password, rehash=True)
         
         if not password_correct:
             flash('Invalid email or password', 'error')
             return render_template('member/login.html')
 
-        # Fetch full member details
-        full_member = get_member_by_id(member['id'])
-        if not full_member:
-            flash('Error fetching member details. Please try again.', 'error')
-            return render_template('member/login.html')
+        # Keep the profile for the member pages (no select('*') per page)
+        cache_member_profile(member)
 
-        # Create login session
-        session.clear()
+        # Create login session (new session id)
+        regenerate_session(session)
         session['member_logged_in'] = True
         session['member_id'] = member['id']
         session['member_email'] = member['email']
@@ -200,7 +207,7 @@ def change_password():
             return render_template('member/change_password.html')
         
         # Hash new password
-        new_password_hash = generate_password_hash(new_password)
+        new_password_hash = hash_password(new_password)
         
         # Update password in database
         try:
@@ -212,8 +219,10 @@ def change_password():
                 })\
                 .eq('id', session['member_id'])\
                 .execute()
+            invalidate_member_profile(session['member_id'])
             
-            # Update session
+            # Update session (new session id once the default password is gone)
+            regenerate_session(session, keep=True)
             session['requires_password_change'] = False
             
             flash('Password changed successfully', 'success')
@@ -261,7 +270,7 @@ def update_password():
             return render_template('member/update_password.html')
         
         # Hash new password
-        new_password_hash = generate_password_hash(new_password)
+        new_password_hash = hash_password(new_password)
         
         # Update password in database
         try:
@@ -273,6 +282,7 @@ def update_password():
                 })\
                 .eq('id', session['member_id'])\
                 .execute()
+            invalidate_member_profile(session['member_id'])
             
             flash('Password updated successfully', 'success')
             return redirect(url_for('member.dashboard'))
@@ -313,16 +323,10 @@ def forgot_password():
         
         # Generate reset token
         reset_token = str(uuid.uuid4())
-        expires_at = (get_current_utc_time() + timedelta(hours=1)).isoformat()
         
         try:
-            # Save reset token
-            supabase.table('password_resets').insert({
-                'member_id': member['id'],
-                'reset_token': reset_token,
-                'expires_at': expires_at,
-                'used': False
-            }).execute()
+            # Save reset token (expires on its own after RESET_TOKEN_TTL)
+            credential_store.set(reset_key('member', reset_token), {'member_id': member['id']}, RESET_TOKEN_TTL)
             
             # You could create a function in sendotp.py for reset emails
             # send_password_reset_email(member['email'], reset_token, member['full_name'])
@@ -356,25 +360,19 @@ def reset_password(token):
         # Check token validity
         current_time = get_current_utc_time()
         try:
-            token_res = supabase.table('password_resets')\
-                .select('*')\
-                .eq('reset_token', token)\
-                .eq('used', False)\
-                .gt('expires_at', current_time.isoformat())\
-                .execute()
+            # Claimed atomically, so two submits can't both use the token
+            token_row = credential_store.pop(reset_key('member', token))
                 
-            if not token_res.data:
+            if not token_row:
                 flash('Invalid or expired reset token', 'error')
                 return redirect(url_for('memberauth.forgot_password'))
-                
-            token_row = token_res.data[0]
             
         except Exception as e:
             flash('Error validating reset token', 'error')
             return redirect(url_for('memberauth.forgot_password'))
         
         # Hash new password
-        new_password_hash = generate_password_hash(new_password)
+        new_password_hash = hash_password(new_password)
         
         try:
             # Update member password
@@ -386,17 +384,14 @@ def reset_password(token):
                 })\
                 .eq('id', token_row['member_id'])\
                 .execute()
-            
-            # Mark token as used
-            supabase.table('password_resets')\
-                .update({'used': True})\
-                .eq('id', token_row['id'])\
-                .execute()
+            invalidate_member_profile(token_row['member_id'])
             
             flash('Password reset successfully. Please login with your new password.', 'success')
             return redirect(url_for('memberauth.member_login'))
             
         except Exception as e:
+            # The password was not changed; give the token back so the member can try again
+            credential_store.set(reset_key('member', token), token_row, RESET_TOKEN_TTL)
             flash('Failed to reset password. Please try again.', 'error')
             print(f"Password reset error: {e}")
             return render_template('member/reset_password.html', token=token)
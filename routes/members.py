@@ -1,16 +1,20 @@
 import os
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app
 from functools import wraps
-from werkzeug.security import generate_password_hash
 from supabase import create_client, Client
 from datetime import datetime, timedelta
 import uuid
 import json
 from decimal import Decimal
-from cloudinary_upload import upload_member_document, validate_image_file
+from cloudinary_upload import upload_member_documents, validate_image_file
+from session_store import invalidate_member_profile
+from passwords import hash_password
+from facet_counts import status_counts
+from upload_staging import temp_uploads, TempUploadQuotaError
+from member_onboarding import (stage_import, start_import, is_running, import_rows, OnboardingError,
+                               ONBOARDING_MAX_ROWS, report_csv as onboarding_report_csv)
 from pesapal import PesaPal
 from werkzeug.utils import secure_filename
-import shutil
 
 
 # Load environment variables
@@ -193,9 +197,12 @@ def add_member():
             # Generate unique ID for this registration
             registration_id = str(uuid.uuid4())
             
-            # Create temp directory for file storage
-            temp_dir = os.path.join('temp_uploads', registration_id)
-            os.makedirs(temp_dir, exist_ok=True)
+            # Reserve temp storage for the files (indexed, expires after TEMP_UPLOAD_TTL)
+            try:
+                temp_dir = temp_uploads.stage(registration_id)
+            except TempUploadQuotaError as e:
+                flash(str(e), 'error')
+                return render_template('admin/members/add_member.html', form_data=member_data)
             
             # Handle file uploads - save to temporary storage
             file_fields = {
@@ -211,20 +218,24 @@ def add_member():
                     is_valid, message = validate_image_file(file)
                     if not is_valid:
                         # Clean up temp directory
-                        shutil.rmtree(temp_dir, ignore_errors=True)
+                        temp_uploads.discard(registration_id)
                         flash(f"Invalid {field}: {message}", 'error')
                         return render_template('admin/members/add_member.html', form_data=member_data)
                     
-                    # Save file to temp directory
+                    # Stream file to temp directory
                     filename = secure_filename(f"{field}_{file.filename}")
-                    filepath = os.path.join(temp_dir, filename)
-                    file.save(filepath)
+                    try:
+                        filepath, file_size = temp_uploads.save_file(registration_id, filename, file.stream)
+                    except TempUploadQuotaError as e:
+                        temp_uploads.discard(registration_id)
+                        flash(str(e), 'error')
+                        return render_template('admin/members/add_member.html', form_data=member_data)
                     
                     uploaded_files_metadata[field] = {
                         'filename': filename,
                         'filepath': filepath,
                         'content_type': file.content_type,
-                        'file_size': os.path.getsize(filepath)
+                        'file_size': file_size
                     }
             
             # Store minimal data in session
@@ -386,59 +397,10 @@ def process_cash_payment():
         
         # Handle file uploads if they exist
         files_metadata = registration.get('files_metadata', {})
-        temp_dir = os.path.join('temp_uploads', registration_id)
-        
-        for field, file_info in files_metadata.items():
-            filepath = file_info.get('filepath')
-            
-            if filepath and os.path.exists(filepath):
-                # Upload to Cloudinary
-                try:
-                    with open(filepath, 'rb') as f:
-                        upload_result = upload_member_document(f, member_id, field)
-                    
-                    if upload_result:
-                        # Save to member_documents table
-                        doc_data = {
-                            'member_id': member_id,
-                            'document_type': field,
-                            'cloudinary_public_id': upload_result['public_id'],
-                            'cloudinary_url': upload_result['secure_url'],
-                            'file_name': file_info['filename'],
-                            'file_size': file_info['file_size'],
-                            'file_type': file_info['content_type'],
-                            'created_at': datetime.now().isoformat()
-                        }
-                        
-                        supabase.table('member_documents').insert(doc_data).execute()
-                        
-                        # Update member record with URL
-                        update_data = {}
-                        if field == 'profile_photo':
-                            update_data['profile_photo_url'] = upload_result['secure_url']
-                        elif field == 'id_front':
-                            update_data['id_front_url'] = upload_result['secure_url']
-                        elif field == 'id_back':
-                            update_data['id_back_url'] = upload_result['secure_url']
-                        
-                        if update_data:
-                            supabase.table('members').update(update_data).eq('id', member_id).execute()
-                except Exception as e:
-                    print(f"Error uploading file {field}: {e}")
-                    # Continue with other files even if one fails
-        
-        # Clean up temp files
-        if os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            except Exception as e:
-                print(f"Error cleaning up temp directory {temp_dir}: {e}")
         
-        # Mark registration as processed
-        supabase.table('temp_registrations')\
-            .update({'processed': True})\
-            .eq('registration_id', registration_id)\
-            .execute()
+        # Upload all staged documents in parallel, then update the member once; the registration
+        # is marked processed and its temp files removed unless some uploads failed
+        finish_registration_documents(registration_id, member_id, files_metadata)
         
         # Clear session data
         session.pop('pending_member', None)
@@ -463,12 +425,10 @@ def process_cash_payment():
         # Clean up temp files on error too
         registration_id = request.form.get('registration_id') or (request.get_json(silent=True) or {}).get('registration_id')
         if registration_id:
-            temp_dir = os.path.join('temp_uploads', registration_id)
-            if os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except Exception as cleanup_error:
-                    print(f"Error cleaning up temp directory on error: {cleanup_error}")
+            try:
+                temp_uploads.discard(registration_id)
+            except Exception as cleanup_error:
+                print(f"Error cleaning up temp directory on error: {cleanup_error}")
         
         return jsonify({'success': False, 'message': f'Error processing cash payment: {str(e)}'}), 500
     
@@ -633,6 +593,109 @@ def create_member_accounts(member_id, member_data):
         traceback.print_exc()
         return False
 
+def save_member_documents(member_id, files_metadata):
+    """Upload staged registration files concurrently and record them on the member.
+
+    Returns the fields that did not upload (or could not be recorded), so their staged files can
+    be kept for a retry.
+    """
+    staged = {field: info for field, info in files_metadata.items()
+              if info.get('filepath') and os.path.exists(info['filepath'])}
+    if not staged:
+        return []
+    
+    results = upload_member_documents(member_id, {field: info['filepath'] for field, info in staged.items()})
+    
+    url_columns = {
+        'profile_photo': 'profile_photo_url',
+        'id_front': 'id_front_url',
+        'id_back': 'id_back_url'
+    }
+    doc_rows = []
+    update_data = {}
+    for field, upload_result in results.items():
+        if not upload_result:
+            continue
+        file_info = staged[field]
+        doc_rows.append({
+            'member_id': member_id,
+            'document_type': field,
+            'cloudinary_public_id': upload_result['public_id'],
+            'cloudinary_url': upload_result['secure_url'],
+            'file_name': file_info['filename'],
+            'file_size': file_info['file_size'],
+            'file_type': file_info['content_type'],
+            'created_at': datetime.now().isoformat()
+        })
+        if field in url_columns:
+            update_data[url_columns[field]] = upload_result['secure_url']
+    
+    failed = [field for field, upload_result in results.items() if not upload_result]
+    try:
+        if doc_rows:
+            supabase.table('member_documents').insert(doc_rows).execute()
+        if update_data:
+            supabase.table('members').update(update_data).eq('id', member_id).execute()
+    except Exception as e:
+        print(f"Error saving documents for member {member_id}: {e}")
+        failed = list(results)
+    
+    if failed:
+        log_member_activity(member_id, 'document_upload_failed', f"Failed to upload: {', '.join(failed)}")
+    return failed
+
+def finish_registration_documents(registration_id, member_id, files_metadata):
+    """Upload a registration's documents and mark it processed.
+
+    The staged files are removed only once every document is uploaded; failed ones stay staged
+    (until the upload TTL) and listed on the registration, so retry_member_documents can upload them.
+    Returns the fields that failed.
+    """
+    failed = save_member_documents(member_id, files_metadata)
+    if not failed:
+        temp_uploads.discard(registration_id)
+    supabase.table('temp_registrations')\
+        .update({
+            'processed': True,
+            'member_id': member_id,
+            'files_metadata': {field: files_metadata[field] for field in failed}
+        })\
+        .eq('registration_id', registration_id)\
+        .execute()
+    return failed
+
+@members_bp.route('/member/<member_id>/retry-documents', methods=['POST'])
+@admin_login_required
+def retry_member_documents(member_id):
+    """Upload the documents a registration could not upload the first time"""
+    try:
+        registrations = supabase.table('temp_registrations')\
+            .select('registration_id, files_metadata')\
+            .eq('member_id', member_id)\
+            .eq('processed', True)\
+            .execute()
+        
+        pending = [r for r in registrations.data or [] if r.get('files_metadata')]
+        if not pending:
+            flash('No documents are waiting to be uploaded', 'info')
+            return redirect(url_for('members.member_details', member_id=member_id))
+        
+        failed = []
+        for registration in pending:
+            failed += finish_registration_documents(registration['registration_id'], member_id,
+                                                    registration['files_metadata'])
+        
+        if failed:
+            flash(f"Could not upload: {', '.join(failed)}. Try again later.", 'warning')
+        else:
+            flash('Documents uploaded successfully', 'success')
+        return redirect(url_for('members.member_details', member_id=member_id))
+        
+    except Exception as e:
+        print(f"Error retrying document uploads: {e}")
+        flash('Error uploading documents', 'error')
+        return redirect(url_for('members.member_details', member_id=member_id))
+
 @members_bp.route('/pesapal-callback', methods=['GET'])
 def pesapal_callback():
     try:
@@ -740,59 +803,9 @@ def pesapal_callback():
             supabase.table('membership_payments').insert(payment_record).execute()
             
             # Handle file uploads
-            temp_dir = os.path.join('temp_uploads', registration_id)
-            
-            for field, file_info in files_metadata.items():
-                filepath = file_info.get('filepath')
-                
-                if filepath and os.path.exists(filepath):
-                    # Upload to Cloudinary
-                    try:
-                        with open(filepath, 'rb') as f:
-                            upload_result = upload_member_document(f, member_id, field)
-                        
-                        if upload_result:
-                            # Save to member_documents table
-                            doc_data = {
-                                'member_id': member_id,
-                                'document_type': field,
-                                'cloudinary_public_id': upload_result['public_id'],
-                                'cloudinary_url': upload_result['secure_url'],
-                                'file_name': file_info['filename'],
-                                'file_size': file_info['file_size'],
-                                'file_type': file_info['content_type'],
-                                'created_at': datetime.now().isoformat()
-                            }
-                            
-                            supabase.table('member_documents').insert(doc_data).execute()
-                            
-                            # Update member record with URL
-                            update_data = {}
-                            if field == 'profile_photo':
-                                update_data['profile_photo_url'] = upload_result['secure_url']
-                            elif field == 'id_front':
-                                update_data['id_front_url'] = upload_result['secure_url']
-                            elif field == 'id_back':
-                                update_data['id_back_url'] = upload_result['secure_url']
-                            
-                            if update_data:
-                                supabase.table('members').update(update_data).eq('id', member_id).execute()
-                    except Exception as e:
-                        print(f"Error uploading file {field}: {e}")
-                        # Continue with other files even if one fails
-            
-            # Clean up temp files
-            if os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except Exception as e:
-                    print(f"Error cleaning up temp directory {temp_dir}: {e}")
-            
-            # Mark registration as processed
-            supabase.table('temp_registrations')\
-                .update({'processed': True})\
-                .eq('registration_id', registration_id)\
-                .execute()
+            # Upload all staged documents in parallel, then update the member once; the registration
+            # is marked processed and its temp files removed unless some uploads failed
+            finish_registration_documents(registration_id, member_id, files_metadata)
             
             # Clear payment session
             supabase.table('payment_sessions')\
@@ -823,6 +836,143 @@ def pesapal_callback():
         return redirect(url_for('members.add_member'))
     
     
+@members_bp.route('/import', methods=['GET', 'POST'])
+@admin_login_required
+def bulk_import():
+    """Onboard members in bulk from a register CSV (and a ZIP of their documents)"""
+    if request.method == 'POST':
+        register = request.files.get('register')
+        documents = request.files.get('documents')
+        if not register or not register.filename:
+            flash('Choose the member register CSV to import', 'error')
+            return redirect(url_for('members.bulk_import'))
+        
+        try:
+            admin_id = session.get('admin_id')
+            record = stage_import(supabase, secure_filename(register.filename), register.read(),
+                                  documents=documents.stream if documents and documents.filename else None,
+                                  imported_by=admin_id,
+                                  fee_paid=request.form.get('fee_paid') == 'on')
+            start_import(supabase, record['id'], admin_id)
+            flash(f"Importing {record['total_rows'] - record['duplicate_rows'] - record['rejected_rows']} members "
+                  f"({record['duplicate_rows']} duplicates and {record['rejected_rows']} invalid rows skipped)", 'success')
+            return redirect(url_for('members.bulk_import_detail', import_id=record['id']))
+        except OnboardingError as e:
+            flash(str(e), 'error')
+        except Exception as e:
+            print(f"Error importing members: {e}")
+            import traceback
+            traceback.print_exc()
+            flash('Error importing members', 'error')
+        return redirect(url_for('members.bulk_import'))
+    
+    try:
+        imports_res = supabase.table('member_imports')\
+            .select('id, filename, status, total_rows, created_rows, duplicate_rows, rejected_rows, created_at')\
+            .order('created_at', desc=True)\
+            .limit(20)\
+            .execute()
+        imports = imports_res.data if imports_res.data else []
+    except Exception as e:
+        print(f"Error loading member imports: {e}")
+        imports = []
+    
+    return render_template('admin/members/bulk_import.html', imports=imports, max_rows=ONBOARDING_MAX_ROWS)
+
+@members_bp.route('/import/<import_id>')
+@admin_login_required
+def bulk_import_detail(import_id):
+    """Progress and per-row outcome of a member import"""
+    try:
+        import_res = supabase.table('member_imports')\
+            .select('*')\
+            .eq('id', import_id)\
+            .execute()
+        
+        if not import_res.data:
+            flash('Member import not found', 'error')
+            return redirect(url_for('members.bulk_import'))
+        
+        status_filter = request.args.get('status', '')
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = 50
+        rows, total_rows = import_rows(supabase, import_id, status_filter or None, page, per_page)
+        
+        return render_template('admin/members/bulk_import_detail.html',
+                             record=import_res.data[0],
+                             rows=rows,
+                             running=is_running(import_id),
+                             status_filter=status_filter,
+                             page=page,
+                             per_page=per_page,
+                             total_pages=(total_rows + per_page - 1) // per_page,
+                             total_rows=total_rows)
+        
+    except Exception as e:
+        print(f"Error loading member import: {e}")
+        flash('Error loading member import', 'error')
+        return redirect(url_for('members.bulk_import'))
+
+@members_bp.route('/import/<import_id>/progress')
+@admin_login_required
+def bulk_import_progress(import_id):
+    """Counters for the progress bar on the import page"""
+    try:
+        import_res = supabase.table('member_imports')\
+            .select('status, total_rows, created_rows, duplicate_rows, rejected_rows, documents_total, '
+                    'documents_uploaded, documents_failed')\
+            .eq('id', import_id)\
+            .execute()
+        
+        if not import_res.data:
+            return jsonify({'success': False, 'message': 'Member import not found'}), 404
+        
+        return jsonify({'success': True, 'running': is_running(import_id), **import_res.data[0]})
+        
+    except Exception as e:
+        print(f"Error loading member import progress: {e}")
+        return jsonify({'success': False, 'message': 'Error loading progress'}), 500
+
+@members_bp.route('/import/<import_id>/resume', methods=['POST'])
+@admin_login_required
+def resume_bulk_import(import_id):
+    """Continue an interrupted import from the first row still pending"""
+    try:
+        if start_import(supabase, import_id, session.get('admin_id')):
+            flash('Import resumed', 'success')
+        else:
+            flash('This import is already running', 'info')
+    except Exception as e:
+        print(f"Error resuming member import: {e}")
+        flash('Error resuming import', 'error')
+    return redirect(url_for('members.bulk_import_detail', import_id=import_id))
+
+@members_bp.route('/import/<import_id>/report')
+@admin_login_required
+def bulk_import_report(import_id):
+    """Download the per-row outcome of a member import as CSV"""
+    try:
+        import_res = supabase.table('member_imports')\
+            .select('filename')\
+            .eq('id', import_id)\
+            .execute()
+        
+        if not import_res.data:
+            flash('Member import not found', 'error')
+            return redirect(url_for('members.bulk_import'))
+        
+        from flask import make_response
+        output = make_response(onboarding_report_csv(supabase, import_id))
+        report_name = os.path.splitext(import_res.data[0]['filename'])[0] or 'members'
+        output.headers["Content-Disposition"] = f"attachment; filename={report_name}_results.csv"
+        output.headers["Content-type"] = "text/csv"
+        return output
+        
+    except Exception as e:
+        print(f"Error exporting member import report: {e}")
+        flash('Error exporting member import report', 'error')
+        return redirect(url_for('members.bulk_import_detail', import_id=import_id))
+
 @members_bp.route('/members')
 @admin_login_required
 def members_list():
@@ -881,14 +1031,12 @@ def members_list():
         response = query.execute()
         members = response.data if response.data else []
         
-        # Get counts for status filter
-        counts_response = supabase.table('members').select('account_status', count='exact').execute()
-        
         return render_template('admin/members/list.html', 
                              members=members,
                              search=search,
                              status=status,
-                             total_count=len(members))
+                             total_count=len(members),
+                             status_counts=status_counts(supabase, 'members', search))
         
     except Exception as e:
         print(f"Error fetching members list: {e}")
@@ -936,6 +1084,14 @@ def member_details(member_id):
         docs_res = supabase.table('member_documents').select('*').eq('member_id', member_id).execute()
         documents = docs_res.data if docs_res.data else []
         
+        # Registration documents that failed to upload and can be retried
+        retry_res = supabase.table('temp_registrations')\
+            .select('files_metadata')\
+            .eq('member_id', member_id)\
+            .eq('processed', True)\
+            .execute()
+        pending_documents = [field for r in retry_res.data or [] for field in (r.get('files_metadata') or {})]
+        
         # Get membership payment history
         membership_payments_res = supabase.table('membership_payments').select('*').eq('member_id', member_id).order('created_at', desc=True).execute()
         membership_payments = membership_payments_res.data if membership_payments_res.data else []
@@ -1012,6 +1168,7 @@ def member_details(member_id):
                              savings_account=savings_account,
                              loan_account=loan_account,
                              documents=documents,
+                             pending_documents=pending_documents,
                              payments=all_payments,  # Changed from membership_payments to all_payments
                              shares_owned=members.data.get('shares_owned') if members.data else 0,
                              member_loans=member_loans,
@@ -1032,13 +1189,14 @@ def member_details(member_id):
 def reset_member_password(member_id):
     try:
         # Reset to default password '123'
-        default_password_hash = generate_password_hash('123')
+        default_password_hash = hash_password('123')
         
         supabase.table('members').update({
             'password_hash': default_password_hash,
             'default_password_used': True,
             'updated_at': datetime.now().isoformat()
         }).eq('id', member_id).execute()
+        invalidate_member_profile(member_id)
         
         # Log activity
         log_member_activity(member_id, 'password_reset', 'Password reset to default by admin')
@@ -1065,6 +1223,7 @@ def update_member_status(member_id):
             'account_status': new_status,
             'updated_at': datetime.now().isoformat()
         }).eq('id', member_id).execute()
+        invalidate_member_profile(member_id)
         
         # Log activity
         log_member_activity(member_id, 'status_update', f'Status changed to {new_status}')
@@ -1114,6 +1273,7 @@ def check_membership_expiry():
                     'account_status': 'suspended',
                     'updated_at': datetime.now().isoformat()
                 }).eq('id', member['id']).execute()
+                invalidate_member_profile(member['id'])
                 
                 # Log activity
                 log_member_activity(member['id'], 'membership_expired', 
@@ -1127,29 +1287,13 @@ def check_membership_expiry():
         return 0
 
 def cleanup_temp_files():
-    """Clean up temp files older than 24 hours"""
+    """Evict all expired staged registrations (the janitor thread does this in the background)"""
     try:
-        temp_base = 'temp_uploads'
-        if not os.path.exists(temp_base):
-            return
-        
-        cutoff_time = datetime.now() - timedelta(hours=24)
-        
-        for dir_name in os.listdir(temp_base):
-            dir_path = os.path.join(temp_base, dir_name)
-            if os.path.isdir(dir_path):
-                # Check creation time
-                dir_time = datetime.fromtimestamp(os.path.getctime(dir_path))
-                if dir_time < cutoff_time:
-                    shutil.rmtree(dir_path, ignore_errors=True)
-                    print(f"Cleaned up old temp directory: {dir_path}")
+        while temp_uploads.evict_expired():
+            pass
     except Exception as e:
         print(f"Error cleaning up temp files: {e}")
 
-# Register cleanup on exit
-import atexit
-atexit.register(cleanup_temp_files)
-
 # Also add a route to manually trigger cleanup
 @members_bp.route('/cleanup-temp-files')
 def cleanup_temp_files_endpoint():
@@ -1169,7 +1313,7 @@ def cleanup_temp_files_endpoint():
             .lt('created_at', (datetime.now() - timedelta(hours=24)).isoformat())\
             .execute()
         
-        return jsonify({'success': True, 'message': 'Cleanup completed'})
+        return jsonify({'success': True, 'message': 'Cleanup completed', 'temp_uploads': temp_uploads.usage()})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
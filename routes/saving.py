@@ -11,6 +11,9 @@ from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
 import shutil
 from pesapal import PesaPal
+from ledger import post_savings_entry, PostingError
+from processed_orders import processed_orders
+from deposit_import import import_deposits, report_csv, DepositImportError, DEPOSIT_IMPORT_MAX_ROWS
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -340,8 +343,8 @@ def process_cash_deposit(deposit_id):
         deposit = deposit_res.data
         account = deposit['savings_accounts']
         
-        # Update deposit status
-        supabase.table('deposit_requests')\
+        # Update deposit status (only once, even if two admins process it together)
+        claim_res = supabase.table('deposit_requests')\
             .update({
                 'status': 'completed',
                 'confirmed_by': session.get('admin_id'),
@@ -349,24 +352,14 @@ def process_cash_deposit(deposit_id):
                 'updated_at': datetime.now().isoformat()
             })\
             .eq('id', deposit_id)\
+            .eq('status', 'processing')\
             .execute()
         
-        # Update account balance
-        new_balance = Decimal(str(account['current_balance'])) + Decimal(str(deposit['amount']))
-        new_available = Decimal(str(account['available_balance'])) + Decimal(str(deposit['amount']))
-        
-        supabase.table('savings_accounts')\
-            .update({
-                'current_balance': float(new_balance),
-                'available_balance': float(new_available),
-                'updated_at': datetime.now().isoformat()
-            })\
-            .eq('id', account['id'])\
-            .execute()
+        if not claim_res.data:
+            return jsonify({'success': False, 'message': 'Deposit request not found or already processed'}), 400
         
-        # Create transaction record
+        # Update account balance and create transaction record in one posting
         transaction_data = {
-            'savings_account_id': account['id'],
             'member_id': account['member_id'],
             'transaction_type': 'deposit',
             'amount': deposit['amount'],
@@ -374,14 +367,20 @@ def process_cash_deposit(deposit_id):
             'payment_method': 'cash',
             'reference_number': deposit['reference_number'],
             'description': deposit.get('description', 'Cash deposit'),
-            'balance_before': float(account['current_balance']),
-            'balance_after': float(new_balance),
             'processed_by': session.get('admin_id'),
             'status': 'completed',
             'created_at': datetime.now().isoformat()
         }
         
-        supabase.table('savings_transactions').insert(transaction_data).execute()
+        try:
+            post_savings_entry(supabase, account['id'], Decimal(str(deposit['amount'])), transaction_data)
+        except Exception:
+            # Put the request back so it can be processed again
+            supabase.table('deposit_requests')\
+                .update({'status': 'processing', 'confirmed_by': None, 'confirmed_at': None})\
+                .eq('id', deposit_id)\
+                .execute()
+            raise
         
         # Log activity
         log_savings_activity(account['id'], 'cash_deposit', 
@@ -395,6 +394,128 @@ def process_cash_deposit(deposit_id):
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'Error processing cash deposit: {str(e)}'}), 500
 
+@savings_bp.route('/deposit/import', methods=['GET', 'POST'])
+@admin_login_required
+def bulk_deposits():
+    """Import cash deposits from a CSV/XLSX sheet"""
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or XLSX file to import', 'error')
+            return redirect(url_for('savings.bulk_deposits'))
+        
+        try:
+            admin_id = session.get('admin_id')
+            record = import_deposits(supabase, secure_filename(upload.filename), upload.read(),
+                                     imported_by=admin_id,
+                                     description=request.form.get('description', '').strip())
+            
+            # One audit row per account credited by this upload, written in a single insert
+            posted_accounts = {}
+            for result in record['posted_this_run']:
+                posted_accounts.setdefault(result['account_number'], []).append(Decimal(result['amount']))
+            if posted_accounts:
+                try:
+                    accounts_res = supabase.table('savings_accounts')\
+                        .select('id, account_number')\
+                        .in_('account_number', list(posted_accounts))\
+                        .execute()
+                    supabase.table('savings_audit_log').insert([{
+                        'savings_account_id': account['id'],
+                        'action': 'bulk_cash_deposit',
+                        'description': f"Bulk cash deposit of UGX {sum(posted_accounts[account['account_number']]):,.0f} "
+                                       f"({record['filename']})",
+                        'performed_by': admin_id,
+                        'ip_address': request.remote_addr,
+                        'user_agent': request.headers.get('User-Agent'),
+                        'created_at': datetime.now().isoformat()
+                    } for account in accounts_res.data or []]).execute()
+                except Exception as e:
+                    print(f"Failed to log bulk deposit activity: {e}")
+            
+            flash(f"Imported {record['posted_rows']} deposits (UGX {Decimal(str(record['total_amount'])):,.0f}); "
+                  f"{record['rejected_rows']} rows not posted", 'success' if not record['rejected_rows'] else 'warning')
+            return redirect(url_for('savings.bulk_deposit_detail', import_id=record['id']))
+            
+        except DepositImportError as e:
+            flash(str(e), 'error')
+        except Exception as e:
+            print(f"Error importing deposits: {e}")
+            import traceback
+            traceback.print_exc()
+            flash('Error importing deposits', 'error')
+        return redirect(url_for('savings.bulk_deposits'))
+    
+    try:
+        imports_res = supabase.table('deposit_imports')\
+            .select('id, filename, status, total_rows, posted_rows, rejected_rows, total_amount, created_at')\
+            .order('created_at', desc=True)\
+            .limit(20)\
+            .execute()
+        imports = imports_res.data if imports_res.data else []
+    except Exception as e:
+        print(f"Error loading deposit imports: {e}")
+        imports = []
+    
+    return render_template('admin/savings/bulk_deposits.html', imports=imports, max_rows=DEPOSIT_IMPORT_MAX_ROWS)
+
+@savings_bp.route('/deposit/import/<import_id>')
+@admin_login_required
+def bulk_deposit_detail(import_id):
+    """Per-row results of a deposit import"""
+    try:
+        import_res = supabase.table('deposit_imports')\
+            .select('*')\
+            .eq('id', import_id)\
+            .execute()
+        
+        if not import_res.data:
+            flash('Deposit import not found', 'error')
+            return redirect(url_for('savings.bulk_deposits'))
+        
+        record = import_res.data[0]
+        status_filter = request.args.get('status', '')
+        results = record.get('results') or []
+        if status_filter:
+            results = [result for result in results if result['status'] == status_filter]
+        
+        return render_template('admin/savings/bulk_deposit_detail.html',
+                             record=record,
+                             results=results,
+                             status_filter=status_filter)
+        
+    except Exception as e:
+        print(f"Error loading deposit import: {e}")
+        flash('Error loading deposit import', 'error')
+        return redirect(url_for('savings.bulk_deposits'))
+
+@savings_bp.route('/deposit/import/<import_id>/report')
+@admin_login_required
+def bulk_deposit_report(import_id):
+    """Download the result report of a deposit import as CSV"""
+    try:
+        import_res = supabase.table('deposit_imports')\
+            .select('filename, results')\
+            .eq('id', import_id)\
+            .execute()
+        
+        if not import_res.data:
+            flash('Deposit import not found', 'error')
+            return redirect(url_for('savings.bulk_deposits'))
+        
+        from flask import make_response
+        record = import_res.data[0]
+        output = make_response(report_csv(record))
+        report_name = os.path.splitext(record['filename'])[0] or 'deposits'
+        output.headers["Content-Disposition"] = f"attachment; filename={report_name}_results.csv"
+        output.headers["Content-type"] = "text/csv"
+        return output
+        
+    except Exception as e:
+        print(f"Error exporting deposit import report: {e}")
+        flash('Error exporting deposit import report', 'error')
+        return redirect(url_for('savings.bulk_deposit_detail', import_id=import_id))
+
 @savings_bp.route('/deposit/<deposit_id>/process-pesapal')
 @admin_login_required
 def process_pesapal_deposit(deposit_id):
@@ -468,6 +589,7 @@ def process_pesapal_deposit(deposit_id):
 @savings_bp.route('/deposit/<deposit_id>/pesapal-callback')
 def pesapal_deposit_callback(deposit_id):
     """Handle PesaPal callback for deposit"""
+    claimed = False
     try:
         order_tracking_id = request.args.get('OrderTrackingId')
         
@@ -475,6 +597,11 @@ def pesapal_deposit_callback(deposit_id):
             flash('Invalid payment callback', 'error')
             return redirect(url_for('savings.deposits'))
         
+        # Orders already settled never go back to PesaPal
+        if processed_orders.lookup(supabase, order_tracking_id):
+            flash('This deposit was already processed', 'info')
+            return redirect(url_for('savings.deposits'))
+        
         # Verify payment with PesaPal
         pesapal = PesaPal()
         payment_status = pesapal.verify_transaction_status(order_tracking_id)
@@ -500,53 +627,54 @@ def pesapal_deposit_callback(deposit_id):
         # Normalize payment status
         payment_status_desc = payment_status.get('payment_status_description', '').upper()
         if 'COMPLETED' in payment_status_desc:
-            # Update deposit status
-            supabase.table('deposit_requests')\
-                .update({
-                    'status': 'completed',
-                    'pesapal_status': 'completed',
-                    'pesapal_response': payment_status,
-                    'confirmed_at': datetime.now().isoformat(),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', deposit_id)\
-                .execute()
-            
-            # Update account balance
-            new_balance = Decimal(str(account['current_balance'])) + Decimal(str(deposit['amount']))
-            new_available = Decimal(str(account['available_balance'])) + Decimal(str(deposit['amount']))
+            amount = Decimal(str(deposit['amount']))
             
-            supabase.table('savings_accounts')\
-                .update({
-                    'current_balance': float(new_balance),
-                    'available_balance': float(new_available),
-                    'updated_at': datetime.now().isoformat()
-                })\
-                .eq('id', account['id'])\
-                .execute()
+            # Claim the order so it is settled exactly once
+            claimed = processed_orders.claim(supabase, order_tracking_id, 'deposit', account['member_id'], amount)
+            if not claimed:
+                if processed_orders.lookup(supabase, order_tracking_id):
+                    flash('This deposit was already processed', 'info')
+                else:
+                    # Another request holds the claim and has not finished settling yet
+                    flash('This payment is still being processed. Please check again in a few minutes.', 'info')
+                return redirect(url_for('savings.deposits'))
             
-            # Create transaction record
+            # Credit the account and create the transaction record in one posting
             transaction_data = {
-                'savings_account_id': account['id'],
                 'member_id': account['member_id'],
                 'transaction_type': 'deposit',
-                'amount': deposit['amount'],
+                'amount': amount,
                 'currency': 'UGX',
                 'payment_method': 'pesapal',
                 'reference_number': deposit['reference_number'],
                 'pesapal_order_id': order_tracking_id,
                 'description': deposit.get('description', 'PesaPal deposit'),
-                'balance_before': float(account['current_balance']),
-                'balance_after': float(new_balance),
                 'status': 'completed',
                 'created_at': datetime.now().isoformat()
             }
             
-            supabase.table('savings_transactions').insert(transaction_data).execute()
+            post_savings_entry(supabase, account['id'], amount, transaction_data)
+            # Posted: from here on the claim never goes back, whatever fails below
+            processed_orders.settle(supabase, order_tracking_id)
+            
+            # Update deposit status
+            try:
+                supabase.table('deposit_requests')\
+                    .update({
+                        'status': 'completed',
+                        'pesapal_status': 'completed',
+                        'pesapal_response': payment_status,
+                        'confirmed_at': datetime.now().isoformat(),
+                        'updated_at': datetime.now().isoformat()
+                    })\
+                    .eq('id', deposit_id)\
+                    .execute()
+            except Exception as e:
+                print(f"Error completing deposit request {deposit_id} for settled order {order_tracking_id}: {e}")
             
             # Log activity
             log_savings_activity(account['id'], 'pesapal_deposit', 
-                                f'PesaPal deposit of UGX {deposit["amount"]:,.0f} completed')
+                                f'PesaPal deposit of UGX {amount:,.0f} completed')
             
             flash('PesaPal deposit completed successfully', 'success')
             return redirect(url_for('savings.account_details', account_id=account['id']))
@@ -572,6 +700,9 @@ def pesapal_deposit_callback(deposit_id):
             
     except Exception as e:
         print(f"Error in PesaPal deposit callback: {e}")
+        if claimed:
+            # Nothing was posted yet (settle() makes a later release a no-op), so the next callback retries
+            processed_orders.release(supabase, order_tracking_id)
         flash('Error processing payment callback', 'error')
         return redirect(url_for('savings.deposits'))
 
@@ -743,8 +874,8 @@ def approve_withdrawal(withdrawal_id):
         if withdrawal_amount > available_balance:
             return jsonify({'success': False, 'message': f'Insufficient funds. Available: UGX {available_balance:,.0f}'}), 400
         
-        # Update withdrawal status
-        supabase.table('withdrawal_requests')\
+        # Update withdrawal status (only once, even if two admins approve it together)
+        claim_res = supabase.table('withdrawal_requests')\
             .update({
                 'status': 'completed',
                 'approved_by': session.get('admin_id'),
@@ -752,24 +883,15 @@ def approve_withdrawal(withdrawal_id):
                 'updated_at': datetime.now().isoformat()
             })\
             .eq('id', withdrawal_id)\
+            .eq('status', 'pending')\
             .execute()
         
-        # Update account balance
-        new_balance = Decimal(str(account['current_balance'])) - withdrawal_amount
-        new_available = Decimal(str(account['available_balance'])) - withdrawal_amount
-        
-        supabase.table('savings_accounts')\
-            .update({
-                'current_balance': float(new_balance),
-                'available_balance': float(new_available),
-                'updated_at': datetime.now().isoformat()
-            })\
-            .eq('id', account['id'])\
-            .execute()
+        if not claim_res.data:
+            return jsonify({'success': False, 'message': 'Withdrawal request not found or already processed'}), 400
         
-        # Create transaction record
+        # Update account balance and create transaction record in one posting;
+        # the database re-checks the available balance under a row lock
         transaction_data = {
-            'savings_account_id': account['id'],
             'member_id': account['member_id'],
             'transaction_type': 'withdrawal',
             'amount': float(withdrawal_amount),
@@ -777,14 +899,25 @@ def approve_withdrawal(withdrawal_id):
             'payment_method': withdrawal['withdrawal_method'],
             'reference_number': withdrawal['reference_number'],
             'description': withdrawal.get('description', 'Cash withdrawal'),
-            'balance_before': float(account['current_balance']),
-            'balance_after': float(new_balance),
             'processed_by': session.get('admin_id'),
             'status': 'completed',
             'created_at': datetime.now().isoformat()
         }
         
-        supabase.table('savings_transactions').insert(transaction_data).execute()
+        try:
+            posting = post_savings_entry(supabase, account['id'], -withdrawal_amount, transaction_data,
+                                         require_funds=True)
+        except Exception as e:
+            # Put the request back so it can be approved again
+            supabase.table('withdrawal_requests')\
+                .update({'status': 'pending', 'approved_by': None, 'approved_at': None})\
+                .eq('id', withdrawal_id)\
+                .execute()
+            if isinstance(e, PostingError):
+                return jsonify({'success': False, 'message': str(e)}), 400
+            raise
+        
+        new_balance = posting['balance_after']
         
         # Log activity
         log_savings_activity(account['id'], 'withdrawal_approved', 
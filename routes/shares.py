@@ -2,10 +2,17 @@ import os
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from functools import wraps
 from supabase import create_client, Client
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from decimal import Decimal
 import uuid
 from dotenv import load_dotenv
+from session_store import invalidate_member_profile
+from share_register import get_share_register
+from ledger import post_share_entry, PostingError
+from kpi_service import kpi_service
+from dividends import (declare_dividend, compute_dividend, post_dividend, pay_dividend_remainders,
+                       unpaid_remainders, share_award_members, dividend_allocations,
+                       DividendError, DIVIDEND_METHODS, DIVIDEND_PAYOUTS)
 
 load_dotenv()
 
@@ -57,21 +64,13 @@ def manage_shares():
         
         current_share_value = share_value_res.data[0] if share_value_res.data else None
         
-        # Get total shares statistics
-        stats_res = supabase.table('members')\
-            .select('shares_owned')\
-            .execute()
-        
-        members = stats_res.data if stats_res.data else []
-        total_shares = sum(m.get('shares_owned', 0) for m in members)
-        total_members = len(members)
-        members_with_shares = sum(1 for m in members if m.get('shares_owned', 0) > 0)
-        
-        # Calculate total share value
-        if current_share_value:
-            total_share_value = total_shares * Decimal(str(current_share_value['value_per_share']))
-        else:
-            total_share_value = Decimal('0')
+        # Share register totals and top shareholders (one row, maintained on every share change)
+        register = get_share_register(supabase, current_share_value['value_per_share'] if current_share_value else None)
+        total_shares = register['total_shares']
+        members_with_shares = register['shareholders']
+        total_share_value = register['share_capital']
+        top_shareholders = register['top_shareholders']
+        total_members = register['total_members']
         
         # Get recent share transactions
         transactions_res = supabase.table('share_transactions')\
@@ -82,19 +81,11 @@ def manage_shares():
         
         transactions = transactions_res.data if transactions_res.data else []
         
-        # Get top shareholders
-        top_shareholders_res = supabase.table('members')\
-            .select('id, full_name, member_number, shares_owned')\
-            .order('shares_owned', desc=True)\
-            .limit(10)\
-            .execute()
-        
-        top_shareholders = top_shareholders_res.data if top_shareholders_res.data else []
-        
-        # Get share value history
+        # Get share value history (the dashboard lists the latest 10)
         value_history_res = supabase.table('share_value')\
             .select('*')\
             .order('effective_date', desc=True)\
+            .limit(10)\
             .execute()
         
         value_history = value_history_res.data if value_history_res.data else []
@@ -322,18 +313,15 @@ def manual_share_purchase():
         
         # Get member details
         member_res = supabase.table('members')\
-            .select('shares_owned, full_name, member_number')\
+            .select('full_name, member_number')\
             .eq('id', member_id)\
             .single()\
             .execute()
         
         member = member_res.data
-        current_shares = member.get('shares_owned', 0)
-        new_shares = current_shares + shares
         
-        # Create share transaction record
+        # Share transaction record
         transaction_data = {
-            'member_id': member_id,
             'shares': shares,
             'price_per_share': str(price_per_share),
             'currency': share_value['currency'],
@@ -347,16 +335,9 @@ def manual_share_purchase():
             'updated_at': datetime.now().isoformat()
         }
         
-        supabase.table('share_transactions').insert(transaction_data).execute()
-        
-        # Update member's shares
-        supabase.table('members')\
-            .update({
-                'shares_owned': new_shares,
-                'updated_at': datetime.now().isoformat()
-            })\
-            .eq('id', member_id)\
-            .execute()
+        # Add the shares and record the transaction in one step
+        post_share_entry(supabase, member_id, shares, transaction_data)
+        invalidate_member_profile(member_id)
         
         # Log activity
         log_admin_activity(admin_id, 'manual_share_purchase',
@@ -365,6 +346,9 @@ def manual_share_purchase():
         flash(f'Successfully recorded purchase of {shares} shares for {member["full_name"]}', 'success')
         return redirect(url_for('shares_admin.member_shares_detail', member_id=member_id))
         
+    except PostingError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('shares_admin.members_shares'))
     except Exception as e:
         print(f"Error in manual share purchase: {e}")
         flash('Error recording share purchase', 'error')
@@ -459,9 +443,11 @@ def share_reports():
         
         if report_type == 'monthly':
             # Monthly share purchase report
-            monthly_stats = get_monthly_share_statistics(detailed=True)
+            months = parse_report_months(request.args.get('months', '12'))
+            monthly_stats = get_monthly_share_statistics(months)
             return render_template('admin/shares/reports/monthly.html',
                                  monthly_stats=monthly_stats,
+                                 months=months or 'all',
                                  report_type=report_type)
         
         elif report_type == 'member_summary':
@@ -526,6 +512,45 @@ def share_reports():
         flash('Error generating reports', 'error')
         return redirect(url_for('shares_admin.manage_shares'))
 
+@shares_admin_bp.route('/reports/monthly/<month>/transactions')
+@admin_login_required
+def monthly_share_transactions(month):
+    """Paged purchase transactions for one month of the monthly report (YYYY-MM)"""
+    try:
+        try:
+            month_start = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return jsonify({'error': 'Month must be in YYYY-MM format'}), 400
+        
+        next_month = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = min(max(1, request.args.get('per_page', 50, type=int)), 200)
+        from_index = (page - 1) * per_page
+        
+        transactions_res = supabase.table('share_transactions')\
+            .select('id, shares, price_per_share, total_amount, payment_method, reference, transaction_date, '
+                    'members(full_name, member_number)', count='exact')\
+            .eq('transaction_type', 'purchase')\
+            .gte('transaction_date', month_start.isoformat())\
+            .lt('transaction_date', next_month.isoformat())\
+            .order('transaction_date', desc=True)\
+            .range(from_index, from_index + per_page - 1)\
+            .execute()
+        
+        total = transactions_res.count or 0
+        return jsonify({
+            'month': month,
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'total_pages': (total + per_page - 1) // per_page,
+            'transactions': transactions_res.data or []
+        })
+        
+    except Exception as e:
+        print(f"Error loading share transactions for {month}: {e}")
+        return jsonify({'error': 'Failed to load transactions'}), 500
+
 @shares_admin_bp.route('/export-report')
 @admin_login_required
 def export_report():
@@ -534,7 +559,7 @@ def export_report():
         report_type = request.args.get('type', 'monthly')
         
         if report_type == 'monthly':
-            monthly_stats = get_monthly_share_statistics(detailed=True)
+            monthly_stats = get_monthly_share_statistics(parse_report_months(request.args.get('months', '12')))
             
             # Create CSV
             import csv
@@ -571,58 +596,194 @@ def export_report():
         flash('Error exporting report', 'error')
         return redirect(url_for('shares_admin.share_reports'))
 
-def get_monthly_share_statistics(detailed=False):
-    """Get monthly share purchase statistics"""
+@shares_admin_bp.route('/dividends', methods=['GET', 'POST'])
+@admin_login_required
+def dividends():
+    """Dividend declarations; POST declares a new one and computes its allocations"""
+    if request.method == 'POST':
+        try:
+            declaration = declare_dividend(
+                supabase,
+                title=request.form.get('title', '').strip() or 'Dividend',
+                period_start=request.form.get('period_start', ''),
+                period_end=request.form.get('period_end', ''),
+                total_amount=Decimal(request.form.get('total_amount', '0') or '0'),
+                method=request.form.get('method', 'time_weighted'),
+                payout=request.form.get('payout', 'savings'),
+                declared_by=session.get('admin_id')
+            )
+            compute_dividend(supabase, declaration['id'])
+            flash('Dividend declared. Review the allocations before posting.', 'success')
+            return redirect(url_for('shares_admin.dividend_detail', declaration_id=declaration['id']))
+        except DividendError as e:
+            flash(str(e), 'error')
+        except Exception as e:
+            print(f"Error declaring dividend: {e}")
+            flash('Error declaring dividend', 'error')
+        return redirect(url_for('shares_admin.dividends'))
+    
     try:
-        # Get transactions for the last 12 months
-        one_year_ago = datetime.now().replace(year=datetime.now().year - 1).isoformat()
-        
-        transactions_res = supabase.table('share_transactions')\
+        declarations_res = supabase.table('dividend_declarations')\
             .select('*')\
-            .gte('transaction_date', one_year_ago)\
-            .eq('transaction_type', 'purchase')\
+            .order('created_at', desc=True)\
+            .limit(50)\
+            .execute()
+        declarations = declarations_res.data if declarations_res.data else []
+    except Exception as e:
+        print(f"Error loading dividend declarations: {e}")
+        flash('Error loading dividend declarations', 'error')
+        declarations = []
+    
+    last_year = date.today().year - 1
+    return render_template('admin/shares/dividends.html',
+                         declarations=declarations,
+                         methods=DIVIDEND_METHODS,
+                         payouts=DIVIDEND_PAYOUTS,
+                         default_start=date(last_year, 1, 1).isoformat(),
+                         default_end=date(last_year, 12, 31).isoformat())
+
+@shares_admin_bp.route('/dividends/<declaration_id>')
+@admin_login_required
+def dividend_detail(declaration_id):
+    """Preview (or review) a declaration's allocations"""
+    try:
+        declaration_res = supabase.table('dividend_declarations')\
+            .select('*')\
+            .eq('id', declaration_id)\
             .execute()
         
-        transactions = transactions_res.data if transactions_res.data else []
+        if not declaration_res.data:
+            flash('Dividend declaration not found', 'error')
+            return redirect(url_for('shares_admin.dividends'))
         
-        # Group by month
-        monthly_stats = {}
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = 50
+        allocations, total_allocations = dividend_allocations(supabase, declaration_id, page, per_page)
+        declaration = declaration_res.data[0]
+        waiting = unpaid_remainders(supabase, declaration_id) if declaration['status'] == 'posted' else 0
+        
+        return render_template('admin/shares/dividend_detail.html',
+                             declaration=declaration,
+                             unpaid_remainders=waiting,
+                             allocations=allocations,
+                             page=page,
+                             per_page=per_page,
+                             total_pages=(total_allocations + per_page - 1) // per_page,
+                             total_allocations=total_allocations,
+                             methods=DIVIDEND_METHODS,
+                             payouts=DIVIDEND_PAYOUTS)
         
-        for transaction in transactions:
-            trans_date = datetime.fromisoformat(transaction['transaction_date'].replace('Z', '+00:00'))
-            month_key = trans_date.strftime('%Y-%m')
-            
-            if month_key not in monthly_stats:
-                monthly_stats[month_key] = {
-                    'total_shares': 0,
-                    'total_amount': Decimal('0'),
-                    'transaction_count': 0,
-                    'transactions': [] if detailed else None
-                }
-            
-            monthly_stats[month_key]['total_shares'] += transaction.get('shares', 0)
-            monthly_stats[month_key]['total_amount'] += Decimal(str(transaction.get('total_amount', '0')))
-            monthly_stats[month_key]['transaction_count'] += 1
-            
-            if detailed and 'transactions' in monthly_stats[month_key]:
-                monthly_stats[month_key]['transactions'].append(transaction)
+    except Exception as e:
+        print(f"Error loading dividend declaration: {e}")
+        flash('Error loading dividend declaration', 'error')
+        return redirect(url_for('shares_admin.dividends'))
+
+@shares_admin_bp.route('/dividends/<declaration_id>/compute', methods=['POST'])
+@admin_login_required
+def recompute_dividend(declaration_id):
+    """Recompute allocations (e.g. after late share transactions were recorded)"""
+    try:
+        compute_dividend(supabase, declaration_id)
+        flash('Dividend allocations recomputed', 'success')
+    except DividendError as e:
+        flash(str(e), 'error')
+    except Exception as e:
+        print(f"Error computing dividend: {e}")
+        flash('Error computing dividend', 'error')
+    return redirect(url_for('shares_admin.dividend_detail', declaration_id=declaration_id))
+
+@shares_admin_bp.route('/dividends/<declaration_id>/post', methods=['POST'])
+@admin_login_required
+def post_dividend_declaration(declaration_id):
+    """Pay a computed declaration to all shareholders"""
+    try:
+        admin_id = session.get('admin_id')
+        result = post_dividend(supabase, declaration_id, admin_id)
+        kpi_service.invalidate()
+        if result['share_top_ups']:
+            for member_id in share_award_members(supabase, declaration_id):
+                invalidate_member_profile(member_id)
+        
+        log_admin_activity(admin_id, 'dividend_posted',
+                          f"Posted dividend {declaration_id}: {result['savings_credits']} savings credits "
+                          f"(UGX {Decimal(str(result['savings_amount'] or 0)):,.0f}), {result['share_top_ups']} share top-ups")
+        
+        flash(f"Dividend posted: {result['savings_credits']} savings credits and "
+              f"{result['share_top_ups']} share top-ups", 'success')
+        if result.get('unpaid_remainders'):
+            flash(f"{result['unpaid_remainders']} members have no savings account; their cash is held until "
+                  f"they open one", 'info')
+    except DividendError as e:
+        flash(str(e), 'error')
+    except Exception as e:
+        print(f"Error posting dividend: {e}")
+        flash('Error posting dividend', 'error')
+    return redirect(url_for('shares_admin.dividend_detail', declaration_id=declaration_id))
+
+@shares_admin_bp.route('/dividends/<declaration_id>/pay-remainders', methods=['POST'])
+@admin_login_required
+def pay_dividend_remainders_route(declaration_id):
+    """Pay held-back dividend cash to members who now have a savings account"""
+    try:
+        admin_id = session.get('admin_id')
+        result = pay_dividend_remainders(supabase, declaration_id, admin_id)
+        kpi_service.invalidate()
         
-        # Calculate average price for each month
-        for month, stats in monthly_stats.items():
-            if stats['total_shares'] > 0:
-                stats['average_price'] = stats['total_amount'] / stats['total_shares']
-            else:
-                stats['average_price'] = Decimal('0')
+        log_admin_activity(admin_id, 'dividend_remainders_paid',
+                          f"Paid {result['savings_credits']} held-back dividend credits for {declaration_id} "
+                          f"(UGX {Decimal(str(result['savings_amount'] or 0)):,.0f})")
         
-        # Sort by month descending
-        sorted_stats = dict(sorted(monthly_stats.items(), reverse=True))
+        flash(f"{result['savings_credits']} held-back payments credited; "
+              f"{result['unpaid_remainders']} members still have no savings account", 'success')
+    except DividendError as e:
+        flash(str(e), 'error')
+    except Exception as e:
+        print(f"Error paying dividend remainders: {e}")
+        flash('Error paying dividend remainders', 'error')
+    return redirect(url_for('shares_admin.dividend_detail', declaration_id=declaration_id))
+
+def get_monthly_share_statistics(months=12):
+    """Monthly share purchase statistics, newest month first (all history when months is None).
+
+    Grouped by month in the database (monthly_share_statistics() in supabase_functions.sql), so
+    only one row per month is transferred; use monthly_share_transactions() to drill into a month.
+    """
+    try:
+        since = None
+        if months:
+            today = date.today()
+            year, month = divmod(today.year * 12 + today.month - months, 12)
+            since = date(year, month + 1, 1).isoformat()
+        
+        stats_res = supabase.rpc('monthly_share_statistics', {
+            'p_since': since,
+            'p_transaction_type': 'purchase'
+        }).execute()
+        
+        monthly_stats = {}
+        for row in stats_res.data or []:
+            monthly_stats[row['month']] = {
+                'total_shares': int(row['total_shares'] or 0),
+                'total_amount': Decimal(str(row['total_amount'] or 0)),
+                'transaction_count': int(row['transaction_count'] or 0),
+                'average_price': Decimal(str(row['average_price'] or 0)).quantize(Decimal('0.01'))
+            }
         
-        return sorted_stats
+        return monthly_stats
         
     except Exception as e:
         print(f"Error getting monthly statistics: {e}")
         return {}
 
+def parse_report_months(value):
+    """?months= for the monthly report: a number of months, or 'all'"""
+    if value == 'all':
+        return None
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 12
+
 def log_admin_activity(admin_id, action, description):
     """Log admin activity"""
     try:
@@ -8,6 +8,7 @@ import json
 from decimal import Decimal
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from document_numbers import next_expense_numbers, next_income_numbers
 
 load_dotenv()
 
@@ -32,112 +33,12 @@ def admin_login_required(f):
 
 # Helper functions
 def generate_expense_number():
-    """Generate a unique expense number"""
-    try:
-        # Get current year and month
-        now = datetime.now()
-        year = now.strftime('%Y')
-        month = now.strftime('%m')
-        
-        # Get the last expense number for this month/year
-        prefix = f"EXP-{year}{month}"
-        
-        # Query to find the last expense number
-        # Wrap this in a try-catch to handle connection issues
-        try:
-            result = supabase.table('expenses')\
-                .select('expense_number')\
-                .like('expense_number', f'{prefix}%')\
-                .order('expense_number', desc=True)\
-                .limit(1)\
-                .execute()
-            
-            if result.data:
-                last_number = result.data[0]['expense_number']
-                # Extract the numeric part and increment
-                last_seq = int(last_number.split('-')[-1])
-                new_seq = last_seq + 1
-            else:
-                new_seq = 1
-                
-        except Exception as query_error:
-            print(f"Error querying for last expense number: {query_error}")
-            # Fallback: use timestamp-based number
-            timestamp = int(datetime.now().timestamp())
-            return f"EXP-{timestamp}"
-        
-        # Format with leading zeros
-        return f"{prefix}-{new_seq:04d}"
-        
-    except Exception as e:
-        print(f"Error generating expense number: {e}")
-        # Ultimate fallback
-        timestamp = int(datetime.now().timestamp())
-        return f"EXP-{timestamp}"
+    """Generate a unique expense number from the reserved counter block (raises if none can be reserved)"""
+    return next_expense_numbers(supabase)[0]
+
 def generate_income_number():
-    """Generate a unique income number"""
-    try:
-        # Get current year and month
-        now = datetime.now()
-        year = now.strftime('%Y')
-        month = now.strftime('%m')
-        day = now.strftime('%d')
-        
-        # Option 1: Year-Month-Day format (like your current pattern)
-        prefix = f"INC-{year}{month}{day}"
-        
-        # Option 2: Year-Month format (like expense pattern)
-        # prefix = f"INC-{year}{month}"
-        
-        # Query to find the last income number
-        try:
-            result = supabase.table('other_incomes')\
-                .select('income_number')\
-                .like('income_number', f'{prefix}%')\
-                .order('income_number', desc=True)\
-                .limit(1)\
-                .execute()
-            
-            if result.data and result.data[0]['income_number']:
-                last_number = result.data[0]['income_number']
-                # Extract the numeric part and increment
-                # Handle different formats: INC-20251223-001 or INC-20251223-1
-                parts = last_number.split('-')
-                if len(parts) >= 3:
-                    try:
-                        last_seq = int(parts[-1])
-                        new_seq = last_seq + 1
-                    except ValueError:
-                        # If the last part isn't a number, start from 1
-                        new_seq = 1
-                else:
-                    new_seq = 1
-            else:
-                new_seq = 1
-                
-        except Exception as query_error:
-            print(f"Error querying for last income number: {query_error}")
-            # Fallback 1: Use your existing count-based method
-            try:
-                count_res = supabase.table('other_incomes')\
-                    .select('id', count='exact')\
-                    .like('income_number', f'INC-{year}{month}{day}%')\
-                    .execute()
-                count = count_res.count or 0
-                return f'INC-{year}{month}{day}-{str(count + 1).zfill(3)}'
-            except Exception:
-                # Fallback 2: Use timestamp-based number
-                timestamp = int(datetime.now().timestamp())
-                return f"INC-{timestamp}"
-        
-        # Format with leading zeros (3 digits)
-        return f"{prefix}-{new_seq:03d}"
-        
-    except Exception as e:
-        print(f"Error generating income number: {e}")
-        # Ultimate fallback - timestamp
-        timestamp = int(datetime.now().timestamp())
-        return f"INC-{timestamp}"
+    """Generate a unique income number from the reserved counter block (raises if none can be reserved)"""
+    return next_income_numbers(supabase)[0]
     
 def calculate_daily_profit(start_date=None, end_date=None):
     """Calculate profit for a given date range"""
@@ -988,14 +889,8 @@ def add_expense():
                 return render_template('admin/expense_incomes/add_expense.html',
                                      categories=categories)
             
-            # Generate expense number (with error handling)
-            try:
-                expense_number = generate_expense_number()
-            except Exception as e:
-                print(f"Error generating expense number: {e}")
-                # Use a simple timestamp-based number as fallback
-                import time
-                expense_number = f"EXP-{int(time.time())}"
+            # Generate expense number
+            expense_number = generate_expense_number()
             
             # Create expense record
             expense_data = {
@@ -0,0 +1,284 @@
+#server.py
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import threading
+from dotenv import load_dotenv
+from waitress.server import create_server, BaseWSGIServer
+from waitress.channel import HTTPChannel
+
+load_dotenv()
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    if value in (None, ''):
+        return default
+    if value == 'auto':
+        return os.cpu_count() or 1
+    return int(value)
+
+
+def load_server_config():
+    """Production server settings from the environment"""
+    return {
+        'host': os.getenv('HOST', '0.0.0.0'),
+        'port': _env_int('PORT', 5000),
+        # waitress
+        'threads': _env_int('WAITRESS_THREADS', 8),
+        'connection_limit': _env_int('WAITRESS_CONNECTION_LIMIT', 200),
+        'channel_timeout': _env_int('WAITRESS_CHANNEL_TIMEOUT', 120),
+        'backlog': _env_int('WAITRESS_BACKLOG', 1024),
+        'cleanup_interval': _env_int('WAITRESS_CLEANUP_INTERVAL', 30),
+        # processes
+        'workers': _env_int('WEB_WORKERS', 1),
+        'max_requests': _env_int('WORKER_MAX_REQUESTS', 0),
+        'max_requests_jitter': _env_int('WORKER_MAX_REQUESTS_JITTER', 0),
+        'graceful_timeout': _env_int('GRACEFUL_TIMEOUT', 30)
+    }
+
+
+# Functions to run in every worker right after fork (e.g. to start background threads)
+_post_fork_hooks = []
+
+
+def register_post_fork(func):
+    """Run func in each worker process after it is forked"""
+    _post_fork_hooks.append(func)
+    return func
+
+
+# Functions to run in every pre-fork worker just before it exits; workers leave with
+# os._exit(), which skips atexit handlers (e.g. the mail queue flush)
+_worker_exit_hooks = []
+
+
+def register_worker_exit(func):
+    """Run func in each worker process before it exits"""
+    _worker_exit_hooks.append(func)
+    return func
+
+
+def run_worker_exit_hooks():
+    for hook in _worker_exit_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"❌ Worker {os.getpid()} exit hook {getattr(hook, '__name__', hook)} failed: {e}")
+
+
+class RequestCounter:
+    """WSGI middleware counting in-flight and completed requests for recycling"""
+    def __init__(self, app, max_requests=0, on_limit=None):
+        self.app = app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.handled = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self.lock:
+                self.handled += 1
+                reached = self.max_requests and self.handled == self.max_requests
+            if reached and self.on_limit:
+                self.on_limit()
+
+
+def _listeners(server):
+    """The listening dispatchers of a waitress server"""
+    socket_map = getattr(server, 'map', None) or getattr(server, '_map', {})
+    return [d for d in list(socket_map.values()) if isinstance(d, BaseWSGIServer)]
+
+
+def _channels(server):
+    socket_map = getattr(server, 'map', None) or getattr(server, '_map', {})
+    return [d for d in list(socket_map.values()) if isinstance(d, HTTPChannel)]
+
+
+def _busy_channels(server):
+    """Channels still running a request or flushing a response"""
+    return [c for c in _channels(server) if c.requests or c.total_outbufs_len]
+
+
+def run_worker(app, config, sockets=None):
+    """Run one waitress server; SIGTERM (or the request limit) drains it gracefully"""
+    worker_id = os.getpid()
+    state = {'draining': False, 'drained': False}
+
+    max_requests = config['max_requests']
+    if max_requests and config['max_requests_jitter']:
+        max_requests += random.randint(0, config['max_requests_jitter'])
+
+    def request_drain():
+        os.kill(worker_id, signal.SIGTERM)
+
+    wsgi_app = RequestCounter(app, max_requests, on_limit=request_drain)
+
+    server_options = {
+        'threads': config['threads'],
+        'connection_limit': config['connection_limit'],
+        'channel_timeout': config['channel_timeout'],
+        'backlog': config['backlog'],
+        'cleanup_interval': config['cleanup_interval'],
+        'asyncore_use_poll': True,
+        'ident': 'LUNSERK SACCO'
+    }
+    if sockets:
+        server_options['sockets'] = sockets
+    else:
+        server_options['host'] = config['host']
+        server_options['port'] = config['port']
+
+    server = create_server(wsgi_app, **server_options)
+
+    def drain():
+        # Wait for running requests to finish, closing idle keep-alive connections
+        deadline = time.time() + config['graceful_timeout']
+        while time.time() < deadline:
+            for channel in _channels(server):
+                if not channel.requests and not channel.total_outbufs_len:
+                    channel.will_close = True
+            if not _busy_channels(server):
+                break
+            # Wake the asyncore loop so it notices the closing channels
+            for listener in _listeners(server)[:1]:
+                listener.pull_trigger()
+            time.sleep(0.1)
+        else:
+            print(f"⚠️ Worker {worker_id}: {len(_busy_channels(server))} request(s) still running after "
+                  f"{config['graceful_timeout']}s, exiting anyway")
+
+        # Wake the main thread so its handler breaks the asyncore loop
+        state['drained'] = True
+        os.kill(worker_id, signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        if state['drained']:
+            # waitress catches this and shuts its thread pool down
+            raise KeyboardInterrupt
+        if state['draining']:
+            return
+        state['draining'] = True
+        print(f"🔄 Worker {worker_id}: draining after {wsgi_app.handled} requests")
+        for listener in _listeners(server):
+            listener.accepting = False
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGINT, handle_sigterm)
+
+    print(f"✅ Worker {worker_id} serving with {config['threads']} threads")
+    server.run()
+    print(f"✓ Worker {worker_id} stopped")
+
+
+def run_prefork(app, config):
+    """Pre-fork master: shares one listening socket across worker processes"""
+    listener = socket.socket(socket.AF_INET6 if ':' in config['host'] else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((config['host'], config['port']))
+    listener.listen(config['backlog'])
+    listener.set_inheritable(True)
+
+    workers = {}
+    state = {'stopping': False, 'stop_deadline': None}
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                for hook in _post_fork_hooks:
+                    hook()
+                random.seed()
+                run_worker(app, config, sockets=[listener])
+            except Exception as e:
+                print(f"❌ Worker {os.getpid()} crashed: {e}")
+                exit_code = 1
+            finally:
+                run_worker_exit_hooks()
+                sys.stdout.flush()
+                os._exit(exit_code)
+        workers[pid] = time.time()
+
+    def signal_workers(signum):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                workers.pop(pid, None)
+
+    def handle_stop(signum, frame):
+        if not state['stopping']:
+            print(f"🔄 Master {os.getpid()}: shutting down {len(workers)} worker(s)")
+            state['stopping'] = True
+            state['stop_deadline'] = time.time() + config['graceful_timeout'] + 5
+            signal_workers(signal.SIGTERM)
+
+    def handle_reload(signum, frame):
+        # Rolling restart: each worker drains and is replaced as it exits
+        print(f"🔄 Master {os.getpid()}: recycling workers")
+        signal_workers(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGHUP, handle_reload)
+
+    print(f"✅ Master {os.getpid()} listening on {config['host']}:{config['port']} "
+          f"with {config['workers']} workers x {config['threads']} threads")
+    for _ in range(config['workers']):
+        spawn_worker()
+
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+
+        if pid == 0:
+            if state['stopping'] and time.time() > state['stop_deadline']:
+                print(f"⚠️ Master: killing {len(workers)} worker(s) that did not stop in time")
+                signal_workers(signal.SIGKILL)
+            time.sleep(0.2)
+            continue
+
+        started = workers.pop(pid, None)
+        if state['stopping'] or started is None:
+            continue
+
+        # Back off if workers die straight after starting (e.g. import errors)
+        if time.time() - started < 1:
+            time.sleep(1)
+        print(f"🔄 Master: worker {pid} exited ({os.waitstatus_to_exitcode(status)}), starting a replacement")
+        spawn_worker()
+
+    listener.close()
+    print("✓ Master stopped")
+
+
+def run_server(app, config=None):
+    """Production entry point used by app.py"""
+    config = config or load_server_config()
+
+    if config['workers'] > 1 and not hasattr(os, 'fork'):
+        print("⚠️ Multi-process mode needs os.fork(); running a single worker")
+        config['workers'] = 1
+
+    if config['workers'] > 1:
+        run_prefork(app, config)
+    else:
+        for hook in _post_fork_hooks:
+            hook()
+        run_worker(app, config)
+
+
+if __name__ == "__main__":
+    from app import app
+    run_server(app)
@@ -0,0 +1,188 @@
+#session_store.py
+# Server-side Flask sessions plus a cached member/admin profile.
+# The cookie only carries a signed session id; session data and profiles live in a TTL store
+# (credential_store backends: in-process, sqlite:///path shared by workers, or redis://).
+#   SESSION_STORE_URL unset -> same backend as CREDENTIAL_STORE_URL
+#   SESSION_STORE_URL=cookie -> Flask's default signed-cookie sessions (profiles still use CREDENTIAL_STORE_URL)
+# Several workers (WEB_WORKERS > 1) need a shared backend, otherwise profile invalidation would not reach them.
+import os
+import time
+import secrets
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import Signer, BadSignature
+from dotenv import load_dotenv
+from credential_store import create_store, MemoryTTLStore
+
+load_dotenv()
+
+SESSION_TTL = int(os.getenv('SESSION_TTL_SECONDS', str(12 * 3600)))  # idle lifetime of browser sessions
+PROFILE_TTL = int(os.getenv('PROFILE_TTL_SECONDS', '900'))
+
+# Profile fields the member pages and PesaPal orders need
+MEMBER_PROFILE_FIELDS = 'id, email, full_name, member_number, phone_number, account_status, shares_owned, ' \
+                        'default_password_used, created_at, updated_at'
+ADMIN_PROFILE_FIELDS = 'id, email, name, role, status, otp_enabled'
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id and whether it changed"""
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.retired_sid = None
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface keeping session data in a TTL store"""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=SESSION_TTL, key_prefix='session:'):
+        self.store = store
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def lifetime(self, app, session):
+        if session.permanent:
+            return int(app.permanent_session_lifetime.total_seconds())
+        return self.ttl
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.signer(app).unsign(cookie).decode()
+                raw = self.store.get(self.key_prefix + sid)
+                if raw is not None:
+                    return ServerSideSession(self.serializer.loads(raw), sid=sid)
+            except (BadSignature, ValueError) as e:
+                print(f"⚠️ Discarding bad session cookie: {e}")
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.retired_sid:
+            self.store.delete(self.key_prefix + session.retired_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        ttl = self.lifetime(app, session)
+        now = time.time()
+        # Unchanged sessions are only re-written now and then, to push their expiry forward
+        stale = now - session.get('_touched', 0) > ttl / 4
+        if session.modified or session.new or stale:
+            session['_touched'] = now
+            self.store.set(self.key_prefix + session.sid, self.serializer.dumps(dict(session)), ttl)
+
+        if session.new or session.permanent:
+            response.set_cookie(
+                name,
+                self.signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
+
+
+def regenerate_session(session, keep=False):
+    """Give the session a new id, e.g. at login and when privileges change, so a planted id is worthless.
+    Clears the session unless keep=True."""
+    data = dict(session) if keep else {}
+    session.clear()
+    if isinstance(session, ServerSideSession):
+        if not session.new:
+            session.retired_sid = session.sid
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+    session.update(data)
+
+
+# Profiles stay in-process until init_session_store() picks the configured backend
+profile_store = MemoryTTLStore()
+
+
+def init_session_store(app):
+    """Switch the app to server-side sessions (unless SESSION_STORE_URL=cookie)"""
+    global profile_store
+    url = os.getenv('SESSION_STORE_URL')
+    cookie = url == 'cookie'
+    store = create_store(None if cookie else url)
+    if isinstance(store, MemoryTTLStore) and os.getenv('WEB_WORKERS', '1') not in ('', '1'):
+        raise RuntimeError("WEB_WORKERS > 1 needs a shared SESSION_STORE_URL or CREDENTIAL_STORE_URL "
+                           "(sqlite:///... or redis://...) for sessions and cached profiles")
+    profile_store = store
+    if cookie:
+        return
+    app.session_interface = ServerSideSessionInterface(store)
+    print(f"✓ Server-side sessions ({type(store).__name__})")
+
+
+# ---------------------------------------------------------------------------
+# Cached profiles
+# ---------------------------------------------------------------------------
+
+def get_member_profile(supabase, member_id):
+    """Compact member profile, read from the members table at most once per PROFILE_TTL"""
+    profile = profile_store.get(f"profile:member:{member_id}")
+    if profile is None:
+        response = supabase.table('members')\
+            .select(MEMBER_PROFILE_FIELDS)\
+            .eq('id', member_id)\
+            .single()\
+            .execute()
+        profile = response.data
+        if profile:
+            profile_store.set(f"profile:member:{member_id}", profile, PROFILE_TTL)
+    return profile
+
+
+def cache_member_profile(member):
+    """Store an already-fetched members row as the profile (e.g. at login)"""
+    fields = [f.strip() for f in MEMBER_PROFILE_FIELDS.split(',')]
+    if all(f in member for f in fields):
+        profile_store.set(f"profile:member:{member['id']}", {f: member[f] for f in fields}, PROFILE_TTL)
+
+
+def invalidate_member_profile(member_id):
+    """Call after changing a member's profile, status or shares"""
+    profile_store.delete(f"profile:member:{member_id}")
+
+
+def get_admin_profile(supabase, admin_id):
+    profile = profile_store.get(f"profile:admin:{admin_id}")
+    if profile is None:
+        response = supabase.table('admins')\
+            .select(ADMIN_PROFILE_FIELDS)\
+            .eq('id', admin_id)\
+            .execute()
+        profile = response.data[0] if response.data else None
+        if profile:
+            profile_store.set(f"profile:admin:{admin_id}", profile, PROFILE_TTL)
+    return profile
+
+
+def cache_admin_profile(admin):
+    fields = [f.strip() for f in ADMIN_PROFILE_FIELDS.split(',')]
+    profile_store.set(f"profile:admin:{admin['id']}", {f: admin.get(f) for f in fields}, PROFILE_TTL)
+
+
+def invalidate_admin_profile(admin_id):
+    profile_store.delete(f"profile:admin:{admin_id}")
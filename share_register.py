@@ -0,0 +1,79 @@
+#share_register.py
+# Share register totals for the shares dashboard: total shares, number of shareholders and members,
+# and the top-N holdings, kept in a single share_register row by the members triggers in
+# supabase_functions.sql (post_share_entry() in ledger.py for purchases and sales). Reading it is
+# one query however many members there are; capital is valued at the current share price.
+import os
+from decimal import Decimal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SHARE_REGISTER_TOP_N = int(os.getenv('SHARE_REGISTER_TOP_N', '10'))
+
+
+def refresh_share_register(client, top_n=SHARE_REGISTER_TOP_N):
+    """Rebuild the register from members (first use, or after changing SHARE_REGISTER_TOP_N)"""
+    register = client.rpc('refresh_share_register', {'p_top_n': top_n}).execute().data
+    return register[0] if isinstance(register, list) else register
+
+
+def get_share_register(client, value_per_share=None):
+    """{total_shares, shareholders, total_members, top_shareholders, share_capital, updated_at}"""
+    response = client.table('share_register')\
+        .select('total_shares, shareholders, total_members, top_n, top_shareholders, updated_at')\
+        .eq('id', 1)\
+        .limit(1)\
+        .execute()
+    register = response.data[0] if response.data else None
+    if register is None or register['top_n'] != SHARE_REGISTER_TOP_N or register.get('total_members') is None:
+        register = refresh_share_register(client)
+
+    total_shares = int(register['total_shares'] or 0)
+    price = Decimal(str(value_per_share)) if value_per_share is not None else Decimal('0')
+    return {
+        'total_shares': total_shares,
+        'shareholders': int(register['shareholders'] or 0),
+        'total_members': int(register['total_members'] or 0),
+        'top_shareholders': register['top_shareholders'] or [],
+        'share_capital': total_shares * price,
+        'updated_at': register['updated_at']
+    }
+
+
+def test_share_register():
+    """Self-test against the local stand-in: incremental totals match a full rebuild"""
+    import random
+    from local_supabase import LocalSupabase, generate_sacco_data
+    from ledger import post_share_entry, PostingError
+    client = LocalSupabase()
+    generate_sacco_data(client, members=80, savings_transactions=100)
+    members = client.table('members').select('id, shares_owned').execute().data
+
+    register = get_share_register(client, 1000)
+    assert register['total_shares'] == sum(m['shares_owned'] or 0 for m in members)
+    assert register['share_capital'] == register['total_shares'] * 1000
+    assert register['total_members'] == len(members)
+    assert len(register['top_shareholders']) == min(SHARE_REGISTER_TOP_N, register['shareholders'])
+
+    rng = random.Random(7)
+    for _ in range(200):
+        member = rng.choice(members)
+        try:
+            post_share_entry(client, member['id'], rng.randint(-60, 60), {'transaction_type': 'purchase'})
+        except PostingError:
+            pass
+    # A new largest holder goes straight to the top of the list
+    post_share_entry(client, members[0]['id'], 100000)
+
+    incremental = get_share_register(client)
+    rebuilt = refresh_share_register(client)
+    assert incremental['total_shares'] == rebuilt['total_shares']
+    assert incremental['shareholders'] == rebuilt['shareholders']
+    assert incremental['top_shareholders'] == rebuilt['top_shareholders']
+    assert incremental['top_shareholders'][0]['id'] == members[0]['id']
+    print("✅ share_register self-test passed")
+
+
+if __name__ == "__main__":
+    test_share_register()
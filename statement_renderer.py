@@ -0,0 +1,408 @@
+#statement_renderer.py
+# Member statement PDFs with a choice of backend, set per deployment with STATEMENT_RENDERER:
+#   xhtml2pdf  renders templates/member/statement_pdf.html through pisa (the original output;
+#              slow and memory hungry once a statement has thousands of rows)
+#   platypus   draws the same sections straight onto reportlab platypus tables
+# statement_context() computes the totals and the balances once, so both backends print the
+# same numbers. download_statement() and statement_run.py both render through render_statement().
+#   python statement_renderer.py --rows 100 1000 10000   -> render time and peak memory per backend
+import os
+import time
+import logging
+import argparse
+import tracemalloc
+from io import BytesIO
+from decimal import Decimal
+from xml.sax.saxutils import escape
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STATEMENT_RENDERER = os.getenv('STATEMENT_RENDERER', 'xhtml2pdf')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Loaded on first use, once per process
+_template = None
+
+
+def _amount(value):
+    return Decimal(str(value or 0))
+
+
+def _running_rows(transactions, current_balance, credit_type, sign):
+    """Newest first, each with the balance after it; returns (rows, balance before the oldest row).
+
+    The balances are the ones recorded on each transaction when it was posted. A row without them
+    works back from the newer row (from current_balance for the newest), so a statement for an
+    earlier period doesn't start from today's balance.
+    sign(transaction) is what the transaction added to the balance; credit_type is the type shown in green.
+    """
+    balance = current_balance
+    rows = []
+    for transaction in sorted(transactions, key=lambda t: t.get('created_at') or '', reverse=True):
+        amount = _amount(transaction.get('amount'))
+        if transaction.get('balance_after') is not None:
+            balance = _amount(transaction['balance_after'])
+        rows.append({
+            'date': (transaction.get('created_at') or '')[:10],
+            'reference': transaction.get('reference_number') or '',
+            'description': transaction.get('description') or 'Transaction',
+            'type': transaction.get('transaction_type') or '',
+            'credit': transaction.get('transaction_type') == credit_type,
+            'amount': amount,
+            'balance': balance
+        })
+        if transaction.get('balance_before') is not None:
+            balance = _amount(transaction['balance_before'])
+        else:
+            balance -= sign(transaction) * amount
+    return rows, balance
+
+
+def statement_context(data):
+    """Everything a backend draws, from the context download_statement() builds.
+
+    Missing keys get defaults; period totals already in data (from statement_activity()) are kept,
+    otherwise they are summed from the transactions.
+    """
+    context = dict(data)
+    for key in ('member', 'savings_account', 'loan_account'):
+        context[key] = context.get(key) or {}
+    for key in ('savings_transactions', 'loan_transactions', 'repayments'):
+        context[key] = context.get(key) or []
+    context.setdefault('statement_type', 'combined')
+    context.setdefault('generated_date', '')
+
+    savings, loans = context['savings_transactions'], context['loan_transactions']
+    totals = {
+        'total_deposits': (savings, 'deposit'),
+        'total_withdrawals': (savings, 'withdrawal'),
+        'total_repayments': (loans, 'repayment'),
+        'total_disbursements': (loans, 'disbursement')
+    }
+    for key, (transactions, transaction_type) in totals.items():
+        if context.get(key) is None:
+            context[key] = sum((_amount(t.get('amount')) for t in transactions
+                                if t.get('transaction_type') == transaction_type), Decimal('0'))
+        else:
+            context[key] = _amount(context[key])
+
+    # Opening and closing balances are the period's, not the account's balance today
+    context['savings_rows'], context['savings_opening_balance'] = _running_rows(
+        savings, _amount(context['savings_account'].get('current_balance')), 'deposit',
+        lambda t: 1 if t.get('transaction_type') == 'deposit' else -1)
+    context['loan_rows'], context['loan_opening_balance'] = _running_rows(
+        loans, _amount(context['loan_account'].get('current_balance')), 'repayment',
+        lambda t: -1 if t.get('transaction_type') == 'repayment' else 1)
+    context['savings_closing_balance'] = (context['savings_rows'][0]['balance'] if context['savings_rows']
+                                          else context['savings_opening_balance'])
+    context['loan_closing_balance'] = (context['loan_rows'][0]['balance'] if context['loan_rows']
+                                       else context['loan_opening_balance'])
+    context['repayments'] = sorted(context['repayments'], key=lambda r: r.get('due_date') or '')
+    context['show_savings'] = context['statement_type'] in ('combined', 'savings') and bool(context['savings_account'])
+    context['show_loan'] = context['statement_type'] in ('combined', 'loan') and bool(context['loan_account'])
+    return context
+
+
+def render_xhtml2pdf(context):
+    global _template
+    from xhtml2pdf import pisa
+    if _template is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        # xhtml2pdf warns about the same unsupported CSS on every statement
+        logging.getLogger('xhtml2pdf').setLevel(logging.ERROR)
+        environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+        _template = environment.get_template('member/statement_pdf.html')
+    pdf = BytesIO()
+    pisa_status = pisa.CreatePDF(_template.render(**context), dest=pdf)
+    if pisa_status.err:
+        raise Exception(f"PDF generation error: {pisa_status.err}")
+    return pdf.getvalue()
+
+
+def _money(value):
+    return f"UGX {float(value or 0):,.2f}"
+
+
+def render_platypus(context):
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import cm
+    from reportlab.platypus import (SimpleDocTemplate, Paragraph, Table, LongTable, TableStyle, Spacer, PageBreak,
+                                    KeepTogether)
+    from reportlab.platypus.flowables import HRFlowable
+
+    blue, dark_blue, grey, border = (colors.HexColor('#2563eb'), colors.HexColor('#1e40af'),
+                                     colors.HexColor('#6b7280'), colors.HexColor('#d1d5db'))
+    green, red = colors.HexColor('#059669'), colors.HexColor('#dc2626')
+    body = ParagraphStyle('body', fontName='Helvetica', fontSize=10, leading=13, textColor=colors.HexColor('#333333'))
+    logo = ParagraphStyle('logo', parent=body, fontName='Helvetica-Bold', fontSize=24, leading=28,
+                          textColor=blue, alignment=TA_CENTER)
+    subtitle = ParagraphStyle('subtitle', parent=body, fontSize=12, textColor=grey, alignment=TA_CENTER)
+    small_right = ParagraphStyle('small_right', parent=body, fontSize=9, textColor=grey, alignment=TA_RIGHT)
+    section_title = ParagraphStyle('section_title', parent=body, fontName='Helvetica-Bold', fontSize=14,
+                                   leading=18, textColor=dark_blue, spaceBefore=6, spaceAfter=6)
+    footer = ParagraphStyle('footer', parent=body, fontSize=9, leading=12, textColor=grey, alignment=TA_CENTER)
+    width = A4[0] - 4 * cm
+
+    def info_grid(items, background):
+        # Paragraph text is markup; a member named 'Sam <i' must print as typed
+        cells = [f"<b>{label}:</b> {escape(str(value))}" for label, value in items]
+        rows = [[Paragraph(a, body), Paragraph(b, body) if b else '']
+                for a, b in zip(cells[0::2], cells[1::2] + [''] * (len(cells) % 2))]
+        grid = Table(rows, colWidths=[width / 2] * 2)
+        grid.setStyle(TableStyle([('BACKGROUND', (0, 0), (-1, -1), background),
+                                  ('TOPPADDING', (0, 0), (-1, -1), 4), ('BOTTOMPADDING', (0, 0), (-1, -1), 4)]))
+        return grid
+
+    def transaction_table(rows, totals_label, closing_label, closing):
+        # Plain strings and fixed row heights (no Paragraph per cell, nothing re-measured when the
+        # table splits across pages) keep statements with thousands of rows fast
+        columns = [2 * cm, 2.6 * cm, 4.2 * cm, 2 * cm, 3.3 * cm, 2.9 * cm]
+        data = [['Date', 'Reference', 'Description', 'Type', 'Amount', 'Balance']]
+        style = [('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 9), ('FONT', (0, 1), (-1, -1), 'Helvetica', 8),
+                 ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f1f5f9')),
+                 ('GRID', (0, 0), (-1, -1), 0.5, border), ('ALIGN', (4, 0), (5, -1), 'RIGHT'),
+                 ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+                 ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f9fafb')])]
+        for index, row in enumerate(rows, start=1):
+            data.append([row['date'], row['reference'][:18], row['description'][:30], row['type'].title(),
+                         f"{'+' if row['credit'] else '-'}{_money(row['amount'])}", _money(row['balance'])])
+            style.append(('TEXTCOLOR', (4, index), (4, index), green if row['credit'] else red))
+        table = LongTable(data, colWidths=columns, rowHeights=[18] + [15] * len(rows), repeatRows=1)
+        table.setStyle(TableStyle(style))
+
+        totals = Table([['Total for Period', totals_label, f"{closing_label}:\n{_money(closing)}"]],
+                       colWidths=[sum(columns[:4])] + columns[4:])
+        totals.setStyle(TableStyle([('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 8),
+                                    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#e0f2fe')),
+                                    ('GRID', (0, 0), (-1, -1), 0.5, border), ('ALIGN', (1, 0), (2, 0), 'RIGHT'),
+                                    ('VALIGN', (0, 0), (-1, -1), 'TOP')]))
+        return [table, totals]
+
+    member, savings_account, loan_account = context['member'], context['savings_account'], context['loan_account']
+    story = [
+        Paragraph('LUNSERK SACCO', logo),
+        Paragraph('Account Statement', subtitle),
+        Paragraph(f"Generated: {escape(str(context['generated_date']))}", small_right),
+        HRFlowable(width='100%', thickness=2, color=blue, spaceBefore=6, spaceAfter=14),
+        info_grid([('Member Name', member.get('full_name') or ''),
+                   ('Member Number', member.get('member_number') or ''),
+                   ('Statement Period', f"{context.get('start_date')} to {context.get('end_date')}"),
+                   ('Statement Type', context['statement_type'].title())], colors.HexColor('#f8fafc')),
+        Spacer(1, 18)
+    ]
+
+    if context['show_savings']:
+        story += [
+            Paragraph('Savings Account Statement', section_title),
+            info_grid([('Account Number', savings_account.get('account_number') or ''),
+                       ('Account Type', (savings_account.get('account_type') or 'Regular').title()),
+                       ('Opening Balance', _money(context['savings_opening_balance'])),
+                       ('Interest Rate', f"{float(savings_account.get('interest_rate') or 3):.2f}% p.a.")],
+                      colors.HexColor('#f0f9ff')),
+            Spacer(1, 10)
+        ]
+        if context['savings_rows']:
+            story.extend(transaction_table(
+                context['savings_rows'],
+                f"Deposits: {_money(context['total_deposits'])}\nWithdrawals: {_money(context['total_withdrawals'])}",
+                'Closing Balance', context['savings_closing_balance']))
+        else:
+            story.append(Paragraph('No savings transactions found for this period.', body))
+        story.append(Spacer(1, 18))
+
+    if context['show_loan']:
+        if context['statement_type'] == 'combined':
+            story.append(PageBreak())
+        story += [
+            Paragraph('Loan Account Statement', section_title),
+            info_grid([('Account Number', loan_account.get('account_number') or ''),
+                       ('Credit Limit', _money(loan_account.get('credit_limit'))),
+                       ('Current Balance', _money(loan_account.get('current_balance'))),
+                       ('Available Limit', _money(loan_account.get('available_limit'))),
+                       ('Interest Rate', f"{float(loan_account.get('interest_rate') or 12):.2f}% p.a."),
+                       ('Credit Score', loan_account.get('credit_score') or 700)], colors.HexColor('#f0f9ff')),
+            Spacer(1, 10)
+        ]
+        if context['loan_rows']:
+            story.extend(transaction_table(
+                context['loan_rows'],
+                f"Repayments: {_money(context['total_repayments'])}\n"
+                f"Disbursements: {_money(context['total_disbursements'])}",
+                'Closing Balance', context['loan_closing_balance']))
+        else:
+            story.append(Paragraph('No loan transactions found for this period.', body))
+
+        if context['repayments']:
+            data = [['#', 'Due Date', 'Due Amount', 'Paid Amount', 'Balance', 'Status', 'Paid Date']]
+            for repayment in context['repayments']:
+                due, paid = _amount(repayment.get('due_amount')), _amount(repayment.get('paid_amount'))
+                data.append([repayment.get('installment_number') or '', repayment.get('due_date') or '',
+                             _money(due), _money(paid), _money(due - paid), (repayment.get('status') or '').title(),
+                             repayment.get('paid_date') or 'Pending'])
+            table = Table(data, colWidths=[0.8 * cm, 2.2 * cm, 3.1 * cm, 3.1 * cm, 3.1 * cm, 1.8 * cm, 2.9 * cm],
+                          repeatRows=1)
+            table.setStyle(TableStyle([('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 8),
+                                       ('FONT', (0, 1), (-1, -1), 'Helvetica', 8),
+                                       ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f1f5f9')),
+                                       ('GRID', (0, 0), (-1, -1), 0.5, border), ('ALIGN', (2, 0), (4, -1), 'RIGHT')]))
+            story += [Spacer(1, 18), Paragraph('Repayment Schedule', section_title), table]
+
+    story.append(KeepTogether([
+        HRFlowable(width='100%', thickness=1, color=colors.HexColor('#e5e7eb'), spaceBefore=30, spaceAfter=10),
+        Paragraph('LUNSERK SACCO - Member Portal Statement', footer),
+        Paragraph('This is a computer-generated statement. No signature is required.', footer),
+        Paragraph('For inquiries, contact: support@lunserksacco.com | +256 XXX XXX XXX', footer),
+        Paragraph('Address: LUNSERK SACCO, Kampala, Uganda', footer),
+        Spacer(1, 20),
+        Paragraph('Authorized Signatory:', body),
+        Spacer(1, 36),
+        HRFlowable(width=200, thickness=1, color=colors.HexColor('#4b5563'), hAlign='LEFT'),
+        Paragraph('LUNSERK SACCO Management', ParagraphStyle('signature', parent=body, fontSize=9))
+    ]))
+
+    def decorate(canvas, doc):
+        canvas.saveState()
+        canvas.setFillColor(colors.Color(0.15, 0.39, 0.92, alpha=0.1))
+        canvas.setFont('Helvetica-Bold', 60)
+        canvas.translate(A4[0] / 2, A4[1] / 2.6)
+        canvas.rotate(45)
+        canvas.drawCentredString(0, 0, 'LUNSERK SACCO')
+        canvas.restoreState()
+        canvas.saveState()
+        canvas.setFont('Helvetica', 10)
+        canvas.setFillColor(grey)
+        canvas.drawCentredString(A4[0] / 2, 1.2 * cm, f"Page {doc.page}")
+        canvas.restoreState()
+
+    pdf = BytesIO()
+    document = SimpleDocTemplate(pdf, pagesize=A4, leftMargin=2 * cm, rightMargin=2 * cm, topMargin=2 * cm,
+                                 bottomMargin=2 * cm, title='Account Statement',
+                                 author='LUNSERK SACCO')
+    document.build(story, onFirstPage=decorate, onLaterPages=decorate)
+    return pdf.getvalue()
+
+
+RENDERERS = {'xhtml2pdf': render_xhtml2pdf, 'platypus': render_platypus}
+
+
+def render_statement(data, backend=None):
+    """PDF bytes for a statement context; backend defaults to STATEMENT_RENDERER"""
+    backend = backend or STATEMENT_RENDERER
+    if backend not in RENDERERS:
+        raise ValueError(f"Unknown statement renderer {backend!r} (expected one of {', '.join(RENDERERS)})")
+    return RENDERERS[backend](statement_context(data))
+
+
+def sample_statement(rows):
+    """Combined statement context with `rows` savings transactions, a tenth as many loan transactions"""
+    savings = [{'created_at': f"2025-01-{1 + n % 28:02d}T10:{n % 60:02d}:00", 'reference_number': f"TXN{n:09d}",
+                'description': 'Deposit transaction' if n % 4 else 'Withdrawal transaction',
+                'transaction_type': 'deposit' if n % 4 else 'withdrawal', 'amount': 10000 + n % 50 * 1000}
+               for n in range(rows)]
+    loans = [{'created_at': f"2025-01-{1 + n % 28:02d}T12:00:00", 'reference_number': f"REP-{n:06d}",
+              'transaction_type': 'repayment' if n else 'disbursement', 'amount': 2000000 if not n else 50000}
+             for n in range(max(1, rows // 10))]
+    return {
+        'member': {'full_name': 'Sample Member', 'member_number': 'MEM000001'},
+        'savings_account': {'account_number': 'SAV00000001', 'account_type': 'regular', 'current_balance': 5000000,
+                            'interest_rate': 3},
+        'loan_account': {'account_number': 'LOAN00000001', 'credit_limit': 5000000, 'current_balance': 1500000,
+                         'available_limit': 3500000, 'interest_rate': 12, 'credit_score': 700},
+        'savings_transactions': savings,
+        'loan_transactions': loans,
+        'repayments': [{'installment_number': m + 1, 'due_date': f"2025-{m + 1:02d}-15", 'due_amount': 186667,
+                        'paid_amount': 186667 if m < 1 else 0, 'status': 'paid' if m < 1 else 'pending',
+                        'paid_date': '2025-01-15' if m < 1 else None} for m in range(12)],
+        'start_date': '2025-01-01',
+        'end_date': '2025-01-31',
+        'statement_type': 'combined',
+        'generated_date': '2025-02-01 06:00:00'
+    }
+
+
+def benchmark_renderers(row_counts, backends=None):
+    """Render time and Python peak memory (tracemalloc) per backend and statement size"""
+    results = []
+    for rows in row_counts:
+        data = sample_statement(rows)
+        for backend in backends or RENDERERS:
+            render_statement(sample_statement(5), backend)  # template and font loading
+            start = time.perf_counter()
+            pdf = render_statement(data, backend)
+            seconds = time.perf_counter() - start
+            tracemalloc.start()
+            render_statement(data, backend)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append({'backend': backend, 'rows': rows, 'seconds': round(seconds, 2),
+                            'peak_mb': round(peak / 1048576, 1), 'pdf_kb': round(len(pdf) / 1024)})
+    return results
+
+
+def test_statement_renderer():
+    """Both backends render the same sections and totals"""
+    from pypdf import PdfReader
+    data = sample_statement(40)
+    context = statement_context(data)
+    deposits = sum(Decimal(str(t['amount'])) for t in data['savings_transactions'] if t['transaction_type'] == 'deposit')
+    assert context['total_deposits'] == deposits
+    assert context['savings_rows'][0]['balance'] == 5000000
+    assert context['savings_rows'][-1]['balance'] == context['savings_rows'][-2]['balance'] - (
+        context['savings_rows'][-2]['amount'] if context['savings_rows'][-2]['credit'] else
+        -context['savings_rows'][-2]['amount'])
+
+    # A past period prints the balances recorded on its rows, not today's account balance
+    past = dict(data, savings_account=dict(data['savings_account'], current_balance=9999999), savings_transactions=[
+        {'created_at': '2025-01-03T09:00:00', 'transaction_type': 'deposit', 'amount': 20000,
+         'balance_before': 100000, 'balance_after': 120000},
+        {'created_at': '2025-01-09T09:00:00', 'transaction_type': 'withdrawal', 'amount': 5000,
+         'balance_before': 120000, 'balance_after': 115000}])
+    past_context = statement_context(past)
+    assert [row['balance'] for row in past_context['savings_rows']] == [115000, 120000]
+    assert past_context['savings_opening_balance'] == 100000 and past_context['savings_closing_balance'] == 115000
+
+    expected = [f"{float(context[key]):,.2f}" for key in ('total_deposits', 'total_withdrawals', 'total_repayments',
+                                                           'total_disbursements')]
+    expected += ['Savings Account Statement', 'Loan Account Statement', 'Repayment Schedule',
+                 f"{float(context['savings_rows'][-1]['balance']):,.2f}"]
+    for backend in RENDERERS:
+        pdf = render_statement(data, backend)
+        assert pdf.startswith(b'%PDF')
+        text = ' '.join(page.extract_text() for page in PdfReader(BytesIO(pdf)).pages)
+        missing = [value for value in expected if value not in text]
+        assert not missing, (backend, missing)
+        text = ' '.join(page.extract_text() for page in PdfReader(BytesIO(render_statement(past, backend))).pages)
+        assert '100,000.00' in text and '115,000.00' in text and '9,999,999.00' not in text, backend
+    markup = dict(data, member={'full_name': 'Sam <i', 'member_number': 'MEM&1'})
+    for backend in RENDERERS:
+        text = ' '.join(page.extract_text() for page in PdfReader(BytesIO(render_statement(markup, backend))).pages)
+        assert 'Sam <i' in text and 'MEM&1' in text, backend
+    try:
+        render_statement(data, 'wkhtmltopdf')
+        assert False, 'unknown renderer accepted'
+    except ValueError:
+        pass
+    print("✅ statement_renderer self-test passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Statement renderer self-test and benchmark')
+    parser.add_argument('--rows', type=int, nargs='*', help='Benchmark statements of these sizes, e.g. 100 1000 10000')
+    parser.add_argument('--backends', nargs='*', choices=list(RENDERERS))
+    args = parser.parse_args()
+
+    if not args.rows:
+        test_statement_renderer()
+        return
+    print(f"\n{'Backend':<12}{'Rows':>8}{'Seconds':>10}{'Peak MB':>10}{'PDF KB':>10}")
+    print('-' * 50)
+    for r in benchmark_renderers(args.rows, args.backends):
+        print(f"{r['backend']:<12}{r['rows']:>8}{r['seconds']:>10}{r['peak_mb']:>10}{r['pdf_kb']:>10}")
+
+
+if __name__ == "__main__":
+    main()
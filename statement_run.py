@@ -0,0 +1,261 @@
+#statement_run.py
+# Month-end statements for every active member, written as PDFs with a manifest.
+# statement_activity() in supabase_functions.sql returns a page of active members with their
+# accounts and the period's savings and loan activity grouped by member (and the period totals),
+# so a run reads the database in a few dozen queries. Rendering (statement_renderer.py, CPU-bound)
+# runs in a multiprocessing pool; each worker writes its own files.
+#   python statement_run.py --month 2025-01 --output statements/2025-01
+#   python statement_run.py --month 2025-01 --output statements-2025-01.zip --processes 8
+#   python statement_run.py --month 2025-01 --renderer platypus
+#   python statement_run.py --benchmark --members 2000   -> timing against the local stand-in
+import os
+import csv
+import time
+import hashlib
+import zipfile
+import argparse
+from io import StringIO
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from multiprocessing import Pool
+from dotenv import load_dotenv
+from statement_renderer import RENDERERS, STATEMENT_RENDERER, render_statement
+
+load_dotenv()
+
+STATEMENT_PAGE_SIZE = int(os.getenv('STATEMENT_PAGE_SIZE', '500'))
+STATEMENT_PROCESSES = int(os.getenv('STATEMENT_PROCESSES', '0')) or os.cpu_count() or 1
+
+MANIFEST_COLUMNS = ['member_number', 'full_name', 'email', 'file', 'savings_transactions', 'loan_transactions',
+                    'total_deposits', 'total_withdrawals', 'total_repayments', 'total_disbursements', 'bytes',
+                    'sha256', 'status', 'error']
+
+
+def month_period(month=None):
+    """First and last day of a YYYY-MM month (default: last month)"""
+    if month:
+        start = datetime.strptime(month, '%Y-%m').date()
+    else:
+        start = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+    end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return start, end
+
+
+def statement_filename(member, start_date, end_date):
+    """Same name download_statement() gives a member's own statement"""
+    return f"statement_{member.get('member_number', 'member')}_{start_date}_to_{end_date}.pdf"
+
+
+def statement_pages(client, start_date, end_date, page_size=STATEMENT_PAGE_SIZE):
+    """Yield lists of statement_activity() rows, one page of active members at a time"""
+    after = None
+    while True:
+        response = client.rpc('statement_activity', {
+            'p_start': str(start_date),
+            'p_end': str(end_date),
+            'p_after': after,
+            'p_limit': page_size
+        }).execute()
+        rows = response.data or []
+        if rows and isinstance(rows[0], list):
+            rows = rows[0]
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]['member']['id']
+
+
+def statement_data(activity, start_date, end_date, generated_date):
+    """Template context for one member, as download_statement() builds it for a combined statement"""
+    return {
+        'member': activity['member'],
+        'savings_account': activity.get('savings_account') or {},
+        'loan_account': activity.get('loan_account') or {},
+        'savings_transactions': activity.get('savings_transactions') or [],
+        'loan_transactions': activity.get('loan_transactions') or [],
+        'repayments': activity.get('repayments') or [],
+        'total_deposits': Decimal(str(activity.get('total_deposits') or 0)),
+        'total_withdrawals': Decimal(str(activity.get('total_withdrawals') or 0)),
+        'total_repayments': Decimal(str(activity.get('total_repayments') or 0)),
+        'total_disbursements': Decimal(str(activity.get('total_disbursements') or 0)),
+        'start_date': str(start_date),
+        'end_date': str(end_date),
+        'statement_type': 'combined',
+        'generated_date': generated_date
+    }
+
+
+def _init_worker(backend):
+    # Load the template and fonts once per worker rather than on its first statement
+    render_statement(statement_data({'member': {}}, '', '', ''), backend)
+
+
+def _render_statement(job):
+    """Pool task: render one statement; writes it to output_dir, or returns the bytes when it is None"""
+    data, output_dir, backend = job
+    member = data['member']
+    entry = {
+        'member_number': member.get('member_number'),
+        'full_name': member.get('full_name'),
+        'email': member.get('email'),
+        'file': statement_filename(member, data['start_date'], data['end_date']),
+        'savings_transactions': len(data['savings_transactions']),
+        'loan_transactions': len(data['loan_transactions']),
+        'total_deposits': str(data['total_deposits']),
+        'total_withdrawals': str(data['total_withdrawals']),
+        'total_repayments': str(data['total_repayments']),
+        'total_disbursements': str(data['total_disbursements']),
+        'bytes': 0,
+        'sha256': '',
+        'status': 'rendered',
+        'error': ''
+    }
+    try:
+        pdf = render_statement(data, backend)
+    except Exception as e:
+        entry.update({'status': 'failed', 'error': str(e)})
+        return entry, None
+    entry.update({'bytes': len(pdf), 'sha256': hashlib.sha256(pdf).hexdigest()})
+    if output_dir is None:
+        return entry, pdf
+    with open(os.path.join(output_dir, entry['file']), 'wb') as f:
+        f.write(pdf)
+    return entry, None
+
+
+def manifest_csv(entries):
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=MANIFEST_COLUMNS)
+    writer.writeheader()
+    writer.writerows(sorted(entries, key=lambda e: e['member_number'] or ''))
+    return output.getvalue()
+
+
+def run_statements(client, start_date, end_date, output, processes=STATEMENT_PROCESSES,
+                   page_size=STATEMENT_PAGE_SIZE, progress=None, backend=None):
+    """Render statements for every active member into output (a directory, or a .zip archive).
+
+    Both get a manifest.csv with one row per member (file, counts, totals, size, sha256, status);
+    a member whose PDF fails to render is recorded as failed and the run carries on.
+    Returns {'statements', 'failed', 'bytes', 'seconds', 'output'}.
+    """
+    started = time.perf_counter()
+    backend = backend or STATEMENT_RENDERER
+    generated_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    archive = None
+    if output.lower().endswith('.zip'):
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        output_dir = None
+    else:
+        os.makedirs(output, exist_ok=True)
+        output_dir = output
+
+    entries = []
+    try:
+        with Pool(processes, initializer=_init_worker, initargs=(backend,)) as pool:
+            for page in statement_pages(client, start_date, end_date, page_size):
+                jobs = [(statement_data(activity, start_date, end_date, generated_date), output_dir, backend)
+                        for activity in page]
+                chunksize = max(1, len(jobs) // (processes * 4))
+                for entry, pdf in pool.imap_unordered(_render_statement, jobs, chunksize):
+                    if pdf is not None:
+                        archive.writestr(entry['file'], pdf)
+                    entries.append(entry)
+                if progress:
+                    progress(len(entries))
+        manifest = manifest_csv(entries)
+        if archive is not None:
+            archive.writestr('manifest.csv', manifest)
+        else:
+            with open(os.path.join(output_dir, 'manifest.csv'), 'w', newline='') as f:
+                f.write(manifest)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    return {
+        'statements': sum(1 for e in entries if e['status'] == 'rendered'),
+        'failed': sum(1 for e in entries if e['status'] == 'failed'),
+        'bytes': sum(e['bytes'] for e in entries),
+        'seconds': time.perf_counter() - started,
+        'output': output
+    }
+
+
+def test_statement_run(members=100, transactions=3000, processes=2, verbose=False, backend=None):
+    """Self-test against the local stand-in; returns the run summary"""
+    import tempfile
+    from local_supabase import LocalSupabase, generate_sacco_data
+    client = LocalSupabase()
+    generate_sacco_data(client, members=members, savings_transactions=transactions, months=3)
+    start_date, end_date = month_period(date.today().strftime('%Y-%m'))
+    start_date = start_date - timedelta(days=31)
+
+    active = client.table('members').select('id, member_number').eq('account_status', 'active').execute().data
+    pages = list(statement_pages(client, start_date, end_date, page_size=max(1, len(active) // 3)))
+    rows = [row for page in pages for row in page]
+    assert [r['member']['id'] for r in rows] == sorted(m['id'] for m in active)
+
+    # Totals match what download_statement() would add up for the same member
+    busiest = max(rows, key=lambda r: len(r['savings_transactions']))
+    direct = client.table('savings_transactions').select('amount, transaction_type')\
+        .eq('member_id', busiest['member']['id']).gte('created_at', start_date.isoformat())\
+        .lt('created_at', (end_date + timedelta(days=1)).isoformat()).execute().data
+    assert len(direct) == len(busiest['savings_transactions']) > 0
+    assert Decimal(str(busiest['total_deposits'])) == sum(Decimal(str(t['amount'])) for t in direct
+                                                          if t['transaction_type'] == 'deposit')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = run_statements(client, start_date, end_date, os.path.join(tmp, 'out'), processes, backend=backend)
+        assert summary['statements'] == len(active) and summary['failed'] == 0, summary
+        with open(os.path.join(tmp, 'out', 'manifest.csv'), newline='') as f:
+            manifest = list(csv.DictReader(f))
+        assert len(manifest) == len(active)
+        with open(os.path.join(tmp, 'out', manifest[0]['file']), 'rb') as f:
+            pdf = f.read()
+        assert pdf.startswith(b'%PDF') and hashlib.sha256(pdf).hexdigest() == manifest[0]['sha256']
+
+        zipped = run_statements(client, start_date, end_date, os.path.join(tmp, 'run.zip'), processes,
+                                backend=backend)
+        with zipfile.ZipFile(os.path.join(tmp, 'run.zip')) as archive:
+            assert len(archive.namelist()) == len(active) + 1 and 'manifest.csv' in archive.namelist()
+    if verbose:
+        print(f"{len(active):,} statements in {summary['seconds']:.1f} s "
+              f"({summary['seconds'] / len(active) * 1000:.0f} ms each, {processes} processes, "
+              f"{backend or STATEMENT_RENDERER}); "
+              f"zip run {zipped['seconds']:.1f} s")
+    print("✅ statement_run self-test passed")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Month-end statements for all active members')
+    parser.add_argument('--month', help='YYYY-MM, defaults to last month')
+    parser.add_argument('--output', help='Output directory, or a .zip archive')
+    parser.add_argument('--processes', type=int, default=STATEMENT_PROCESSES)
+    parser.add_argument('--page-size', type=int, default=STATEMENT_PAGE_SIZE)
+    parser.add_argument('--renderer', choices=list(RENDERERS), default=STATEMENT_RENDERER)
+    parser.add_argument('--benchmark', action='store_true', help='Self-test and timing against local data')
+    parser.add_argument('--members', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        test_statement_run(args.members, args.members * 30, args.processes, verbose=True, backend=args.renderer)
+        return
+
+    from supabase import create_client
+    client = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+    start_date, end_date = month_period(args.month)
+    output = args.output or f"statements/{start_date.strftime('%Y-%m')}"
+    print(f"🔄 Statements for {start_date} to {end_date} -> {output}")
+    summary = run_statements(client, start_date, end_date, output, args.processes, args.page_size,
+                             progress=lambda done: print(f"   ✓ {done:,} statements"), backend=args.renderer)
+    print(f"✅ {summary['statements']:,} statements ({summary['failed']} failed, "
+          f"{summary['bytes'] / 1048576:.1f} MB) in {summary['seconds']:.0f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1429 @@
+-- supabase_functions.sql
+-- Database functions and supporting tables used by the app through supabase.rpc().
+-- Run in the Supabase SQL editor (safe to re-run). local_supabase.py has Python twins
+-- of these functions for offline benchmarks and load tests.
+
+
+-- ---------------------------------------------------------------------------
+-- Document number counters (document_numbers.py)
+-- ---------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS document_counters (
+    scope VARCHAR(40) PRIMARY KEY,          -- e.g. EXP-202501, INC-20250115
+    last_value BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Reserve p_count consecutive numbers for p_scope; returns the last one reserved
+CREATE OR REPLACE FUNCTION reserve_document_numbers(p_scope TEXT, p_count INTEGER DEFAULT 1)
+RETURNS BIGINT
+LANGUAGE sql
+AS $$
+    INSERT INTO document_counters AS c (scope, last_value)
+    VALUES (p_scope, p_count)
+    ON CONFLICT (scope) DO UPDATE
+        SET last_value = c.last_value + EXCLUDED.last_value,
+            updated_at = NOW()
+    RETURNING last_value;
+$$;
+
+-- Start counters after the numbers already issued by the old lookup-based generators
+INSERT INTO document_counters (scope, last_value)
+SELECT substring(expense_number FROM '^(EXP-[0-9]{6})-'), MAX(substring(expense_number FROM '-([0-9]+)$')::BIGINT)
+FROM expenses
+WHERE expense_number ~ '^EXP-[0-9]{6}-[0-9]+$'
+GROUP BY 1
+ON CONFLICT (scope) DO UPDATE SET last_value = GREATEST(document_counters.last_value, EXCLUDED.last_value);
+
+INSERT INTO document_counters (scope, last_value)
+SELECT substring(income_number FROM '^(INC-[0-9]{8})-'), MAX(substring(income_number FROM '-([0-9]+)$')::BIGINT)
+FROM other_incomes
+WHERE income_number ~ '^INC-[0-9]{8}-[0-9]+$'
+GROUP BY 1
+ON CONFLICT (scope) DO UPDATE SET last_value = GREATEST(document_counters.last_value, EXCLUDED.last_value);
+
+
+-- ---------------------------------------------------------------------------
+-- Processed PesaPal orders (processed_orders.py)
+-- ---------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS processed_orders (
+    order_tracking_id VARCHAR(100) PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,              -- deposit, repayment, balance, shares
+    member_id UUID,
+    amount DECIMAL(15,2),
+    status VARCHAR(20) NOT NULL DEFAULT 'processing' CHECK (status IN ('processing', 'settled')),
+    claimed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Claim an order for settlement; true for exactly one caller per order.
+-- A claim left in 'processing' for longer than p_stale_seconds (a worker crashed between
+-- claim and settle) is taken over by the next caller.
+DROP FUNCTION IF EXISTS claim_processed_order(TEXT, TEXT, UUID, DECIMAL);
+
+CREATE OR REPLACE FUNCTION claim_processed_order(
+    p_order_tracking_id TEXT,
+    p_kind TEXT,
+    p_member_id UUID DEFAULT NULL,
+    p_amount DECIMAL DEFAULT NULL,
+    p_stale_seconds INTEGER DEFAULT 900
+)
+RETURNS BOOLEAN
+LANGUAGE sql
+AS $$
+    WITH claimed AS (
+        INSERT INTO processed_orders AS po (order_tracking_id, kind, member_id, amount)
+        VALUES (p_order_tracking_id, p_kind, p_member_id, p_amount)
+        ON CONFLICT (order_tracking_id) DO UPDATE
+            SET kind = EXCLUDED.kind, member_id = EXCLUDED.member_id, amount = EXCLUDED.amount, claimed_at = NOW()
+            WHERE po.status = 'processing'
+              AND po.claimed_at < NOW() - make_interval(secs => p_stale_seconds)
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM claimed);
+$$;
+
+-- Orders settled before the index existed
+INSERT INTO processed_orders (order_tracking_id, kind, member_id, amount, status, processed_at)
+SELECT DISTINCT ON (pesapal_order_id) pesapal_order_id, 'deposit', member_id, amount, 'settled', updated_at
+FROM savings_transactions
+WHERE pesapal_order_id IS NOT NULL AND status = 'completed'
+ON CONFLICT (order_tracking_id) DO NOTHING;
+
+INSERT INTO processed_orders (order_tracking_id, kind, member_id, amount, status, processed_at)
+SELECT order_tracking_id, 'repayment', member_id, amount, 'settled', updated_at
+FROM loan_payment_sessions
+WHERE order_tracking_id IS NOT NULL AND status = 'completed'
+ON CONFLICT (order_tracking_id) DO NOTHING;
+
+INSERT INTO processed_orders (order_tracking_id, kind, member_id, amount, status, processed_at)
+SELECT order_tracking_id, 'shares', member_id, total_amount, 'settled', updated_at
+FROM share_payment_sessions
+WHERE order_tracking_id IS NOT NULL AND status = 'completed'
+ON CONFLICT (order_tracking_id) DO NOTHING;
+
+
+-- ---------------------------------------------------------------------------
+-- Loan approval (routes/loans.py approve_application)
+-- ---------------------------------------------------------------------------
+-- Approves a pending application, stores the installment totals, inserts the repayment
+-- schedule computed by calculate_loan_schedule() and logs the activity in one transaction.
+-- p_schedule: [{installment_number, due_date, due_amount, principal_amount, interest_amount}, ...]
+CREATE OR REPLACE FUNCTION approve_loan_application(
+    p_application_id UUID,
+    p_approved_by UUID,
+    p_remarks TEXT,
+    p_monthly_installment DECIMAL,
+    p_total_repayable DECIMAL,
+    p_schedule JSONB,
+    p_description TEXT,
+    p_ip_address TEXT DEFAULT NULL,
+    p_user_agent TEXT DEFAULT NULL
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_member_id UUID;
+    v_installments INTEGER;
+BEGIN
+    UPDATE loan_applications
+    SET status = 'approved',
+        approved_by = p_approved_by,
+        approved_at = NOW(),
+        remarks = p_remarks,
+        monthly_installment = p_monthly_installment,
+        total_repayable = p_total_repayable,
+        updated_at = NOW()
+    WHERE id = p_application_id AND status = 'pending'
+    RETURNING member_id INTO v_member_id;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Application already processed';
+    END IF;
+
+    INSERT INTO loan_repayments (loan_application_id, member_id, installment_number, due_date,
+                                 due_amount, principal_amount, interest_amount, status, created_at, updated_at)
+    SELECT p_application_id, v_member_id, s.installment_number, s.due_date,
+           s.due_amount, s.principal_amount, s.interest_amount, 'pending', NOW(), NOW()
+    FROM jsonb_to_recordset(p_schedule) AS s(installment_number INTEGER, due_date DATE, due_amount DECIMAL,
+                                             principal_amount DECIMAL, interest_amount DECIMAL);
+    GET DIAGNOSTICS v_installments = ROW_COUNT;
+
+    INSERT INTO loan_activity_log (loan_application_id, action, description, performed_by, ip_address, user_agent, created_at)
+    VALUES (p_application_id, 'application_approved', p_description, p_approved_by, p_ip_address, p_user_agent, NOW());
+
+    RETURN v_installments;
+END;
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Balance postings (ledger.py)
+-- ---------------------------------------------------------------------------
+-- The generic JSONB row helpers write to any table, so they live in a schema the API does not
+-- expose (PostgREST only serves public); the posting functions below call them internally.
+CREATE SCHEMA IF NOT EXISTS private;
+REVOKE ALL ON SCHEMA private FROM PUBLIC;
+GRANT USAGE ON SCHEMA private TO anon, authenticated, service_role;
+
+DROP FUNCTION IF EXISTS public.insert_jsonb_row(REGCLASS, JSONB);
+DROP FUNCTION IF EXISTS public.update_jsonb_row(REGCLASS, UUID, JSONB);
+DROP FUNCTION IF EXISTS public.insert_jsonb_rows(REGCLASS, JSONB);
+
+-- Insert a row given as JSONB; only the keys present are written, so column defaults still apply
+CREATE OR REPLACE FUNCTION private.insert_jsonb_row(p_table REGCLASS, p_row JSONB)
+RETURNS UUID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_columns TEXT;
+    v_id UUID;
+BEGIN
+    SELECT string_agg(quote_ident(key), ', ') INTO v_columns FROM jsonb_object_keys(p_row) AS key;
+    EXECUTE format('INSERT INTO %s (%s) SELECT %s FROM jsonb_populate_record(NULL::%s, $1) RETURNING id',
+                   p_table, v_columns, v_columns, p_table)
+    USING p_row INTO v_id;
+    RETURN v_id;
+END;
+$$;
+
+-- Update the keys present in p_row on the row with the given id
+CREATE OR REPLACE FUNCTION private.update_jsonb_row(p_table REGCLASS, p_id UUID, p_row JSONB)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_columns TEXT;
+BEGIN
+    SELECT string_agg(quote_ident(key), ', ') INTO v_columns FROM jsonb_object_keys(p_row) AS key;
+    EXECUTE format('UPDATE %s SET (%s) = (SELECT %s FROM jsonb_populate_record(NULL::%s, $1)) WHERE id = $2',
+                   p_table, v_columns, v_columns, p_table)
+    USING p_row, p_id;
+END;
+$$;
+
+-- Add p_amount (negative for withdrawals) to a savings account and insert the savings_transactions
+-- row, or complete an existing one when p_transaction_id is given. That row is locked and must be
+-- a pending row of the same account, so a replayed completion never moves the balance twice.
+CREATE OR REPLACE FUNCTION post_savings_entry(
+    p_account_id UUID,
+    p_amount DECIMAL,
+    p_transaction JSONB,
+    p_transaction_id UUID DEFAULT NULL,
+    p_require_funds BOOLEAN DEFAULT FALSE
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_before DECIMAL;
+    v_available DECIMAL;
+    v_id UUID := p_transaction_id;
+    v_row JSONB;
+    v_owner UUID;
+    v_status TEXT;
+BEGIN
+    SELECT current_balance, available_balance INTO v_before, v_available
+    FROM savings_accounts
+    WHERE id = p_account_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Savings account not found';
+    END IF;
+    IF v_id IS NOT NULL THEN
+        SELECT savings_account_id, status INTO v_owner, v_status
+        FROM savings_transactions
+        WHERE id = v_id
+        FOR UPDATE;
+
+        IF NOT FOUND OR v_owner IS DISTINCT FROM p_account_id THEN
+            RAISE EXCEPTION 'Savings transaction not found for this account';
+        END IF;
+        IF v_status IS DISTINCT FROM 'pending' THEN
+            RAISE EXCEPTION 'Savings transaction is already %', COALESCE(v_status, 'posted');
+        END IF;
+    END IF;
+    IF p_require_funds AND v_available + p_amount < 0 THEN
+        RAISE EXCEPTION 'Insufficient funds. Available: UGX %', to_char(v_available, 'FM999,999,999,990');
+    END IF;
+
+    UPDATE savings_accounts
+    SET current_balance = current_balance + p_amount,
+        available_balance = available_balance + p_amount,
+        updated_at = NOW()
+    WHERE id = p_account_id;
+
+    v_row := p_transaction || jsonb_build_object(
+        'savings_account_id', p_account_id,
+        'balance_before', v_before,
+        'balance_after', v_before + p_amount
+    );
+    IF v_id IS NULL THEN
+        v_id := private.insert_jsonb_row('savings_transactions', v_row);
+    ELSE
+        PERFORM private.update_jsonb_row('savings_transactions', v_id, v_row);
+    END IF;
+
+    RETURN jsonb_build_object('transaction_id', v_id, 'balance_before', v_before, 'balance_after', v_before + p_amount);
+END;
+$$;
+
+-- Add p_amount (negative for repayments) to a loan account, found by id or member, and insert
+-- the loan_transactions row, or complete an existing one when p_transaction_id is given. That row
+-- is locked and must be a pending PesaPal row of the same account (loan_transactions keep the
+-- payment state in payment_method). available_limit is kept at credit_limit - current_balance.
+DROP FUNCTION IF EXISTS post_loan_entry(DECIMAL, JSONB, UUID, UUID, BOOLEAN, BOOLEAN);
+
+CREATE OR REPLACE FUNCTION post_loan_entry(
+    p_amount DECIMAL,
+    p_transaction JSONB,
+    p_account_id UUID DEFAULT NULL,
+    p_member_id UUID DEFAULT NULL,
+    p_floor_zero BOOLEAN DEFAULT FALSE,
+    p_require_balance BOOLEAN DEFAULT FALSE,
+    p_transaction_id UUID DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_account_id UUID;
+    v_before DECIMAL;
+    v_after DECIMAL;
+    v_id UUID := p_transaction_id;
+    v_row JSONB;
+    v_owner UUID;
+    v_payment_method TEXT;
+BEGIN
+    SELECT id, COALESCE(current_balance, 0) INTO v_account_id, v_before
+    FROM loan_accounts
+    WHERE (p_account_id IS NOT NULL AND id = p_account_id)
+       OR (p_account_id IS NULL AND member_id = p_member_id)
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Member does not have a loan account';
+    END IF;
+    IF v_id IS NOT NULL THEN
+        SELECT loan_account_id, payment_method INTO v_owner, v_payment_method
+        FROM loan_transactions
+        WHERE id = v_id
+        FOR UPDATE;
+
+        IF NOT FOUND OR v_owner IS DISTINCT FROM v_account_id THEN
+            RAISE EXCEPTION 'Loan transaction not found for this account';
+        END IF;
+        IF v_payment_method IS NULL OR v_payment_method NOT IN ('pesapal', 'pesapal_pending') THEN
+            RAISE EXCEPTION 'Loan transaction is not pending (%)', COALESCE(v_payment_method, 'posted');
+        END IF;
+    END IF;
+
+    v_after := v_before + p_amount;
+    IF p_floor_zero THEN
+        v_after := GREATEST(v_after, 0);
+    END IF;
+    IF p_require_balance AND v_after < 0 THEN
+        RAISE EXCEPTION 'Repayment amount (%) exceeds current balance (%)', -p_amount, v_before;
+    END IF;
+
+    UPDATE loan_accounts
+    SET current_balance = v_after,
+        available_limit = COALESCE(credit_limit, 0) - v_after,
+        updated_at = NOW()
+    WHERE id = v_account_id;
+
+    v_row := p_transaction || jsonb_build_object(
+        'loan_account_id', v_account_id,
+        'balance_before', v_before,
+        'balance_after', v_after
+    );
+    IF v_id IS NULL THEN
+        v_id := private.insert_jsonb_row('loan_transactions', v_row);
+    ELSE
+        PERFORM private.update_jsonb_row('loan_transactions', v_id, v_row);
+    END IF;
+
+    RETURN jsonb_build_object('transaction_id', v_id, 'balance_before', v_before, 'balance_after', v_after);
+END;
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Admin overview counters (kpi_service.py)
+-- ---------------------------------------------------------------------------
+-- One grouped query per table; dates are passed in so the app decides what "this month" means
+CREATE OR REPLACE FUNCTION admin_kpis(p_today DATE, p_month_start DATE, p_last_month_start DATE)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT m.kpis || l.kpis || r.kpis || s.kpis || e.kpis
+    FROM (
+        SELECT jsonb_build_object(
+            'total_members', COUNT(*),
+            'active_members', COUNT(*) FILTER (WHERE account_status = 'active'),
+            'pending_members', COUNT(*) FILTER (WHERE account_status = 'pending'),
+            'new_members_this_month', COUNT(*) FILTER (WHERE created_at >= p_month_start),
+            'new_members_last_month', COUNT(*) FILTER (WHERE created_at >= p_last_month_start AND created_at < p_month_start),
+            'total_shares', COALESCE(SUM(shares_owned), 0),
+            'shareholders', COUNT(*) FILTER (WHERE shares_owned > 0)
+        ) AS kpis
+        FROM members
+    ) m, (
+        SELECT jsonb_build_object(
+            'active_loans', COUNT(*) FILTER (WHERE status = 'disbursed'),
+            'total_loan_amount', COALESCE(SUM(loan_amount) FILTER (WHERE status = 'disbursed'), 0),
+            'pending_loans', COUNT(*) FILTER (WHERE status = 'pending')
+        ) AS kpis
+        FROM loan_applications
+    ) l, (
+        SELECT jsonb_build_object(
+            'total_due', COALESCE(SUM(due_amount), 0),
+            'total_paid', COALESCE(SUM(paid_amount), 0),
+            'today_income', COALESCE(SUM(paid_amount) FILTER (WHERE paid_date = p_today), 0),
+            'month_income', COALESCE(SUM(paid_amount) FILTER (WHERE paid_date >= p_month_start), 0),
+            'last_month_income', COALESCE(SUM(paid_amount) FILTER (WHERE paid_date >= p_last_month_start AND paid_date < p_month_start), 0)
+        ) AS kpis
+        FROM loan_repayments
+    ) r, (
+        SELECT jsonb_build_object(
+            'savings_accounts', COUNT(*),
+            'total_savings', COALESCE(SUM(current_balance), 0)
+        ) AS kpis
+        FROM savings_accounts
+    ) s, (
+        SELECT jsonb_build_object('month_expenses', COALESCE(SUM(amount), 0)) AS kpis
+        FROM expenses
+        WHERE status = 'approved' AND payment_date >= p_month_start
+    ) e;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Status facets for admin list pages (facet_counts.py)
+-- ---------------------------------------------------------------------------
+-- {status: count} for one list page, under the same search the page applies to its rows
+CREATE OR REPLACE FUNCTION status_facets(p_list TEXT, p_search TEXT DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    v_all BOOLEAN := COALESCE(p_search, '') = '';
+    v_pattern TEXT := '%' || COALESCE(p_search, '') || '%';
+    v_counts JSONB;
+BEGIN
+    IF p_list = 'loan_applications' THEN
+        SELECT jsonb_object_agg(status, total) INTO v_counts
+        FROM (
+            SELECT COALESCE(a.status, 'unknown') AS status, COUNT(*) AS total
+            FROM loan_applications a
+            LEFT JOIN members m ON m.id = a.member_id
+            WHERE v_all OR a.account_number ILIKE v_pattern OR m.full_name ILIKE v_pattern
+            GROUP BY 1
+        ) f;
+    ELSIF p_list = 'loan_repayments' THEN
+        SELECT jsonb_object_agg(status, total) INTO v_counts
+        FROM (
+            SELECT COALESCE(r.status, 'unknown') AS status, COUNT(*) AS total
+            FROM loan_repayments r
+            LEFT JOIN members m ON m.id = r.member_id
+            LEFT JOIN loan_applications a ON a.id = r.loan_application_id
+            WHERE v_all OR m.full_name ILIKE v_pattern OR a.account_number ILIKE v_pattern
+            GROUP BY 1
+        ) f;
+    ELSIF p_list = 'members' THEN
+        SELECT jsonb_object_agg(status, total) INTO v_counts
+        FROM (
+            SELECT COALESCE(account_status, 'unknown') AS status, COUNT(*) AS total
+            FROM members
+            WHERE v_all OR full_name ILIKE v_pattern OR email ILIKE v_pattern
+               OR phone_number ILIKE v_pattern OR member_number ILIKE v_pattern
+            GROUP BY 1
+        ) f;
+    ELSE
+        RAISE EXCEPTION 'Unknown facet list %', p_list;
+    END IF;
+    RETURN COALESCE(v_counts, '{}'::JSONB);
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Share register (share_register.py, ledger.py post_share_entry)
+-- ---------------------------------------------------------------------------
+-- One row with the totals the shares dashboard shows (including the member count) and its
+-- top-N shareholder list. The members triggers below keep it current.
+CREATE TABLE IF NOT EXISTS share_register (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    total_shares BIGINT NOT NULL DEFAULT 0,
+    shareholders INTEGER NOT NULL DEFAULT 0,
+    total_members INTEGER NOT NULL DEFAULT 0,
+    top_n INTEGER NOT NULL DEFAULT 10,
+    top_shareholders JSONB NOT NULL DEFAULT '[]'::JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE share_register ADD COLUMN IF NOT EXISTS total_members INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_members_shares_owned ON members (shares_owned DESC NULLS LAST);
+
+-- Largest holdings first: [{id, full_name, member_number, shares_owned}, ...]
+CREATE OR REPLACE FUNCTION share_register_top(p_limit INTEGER)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE(jsonb_agg(to_jsonb(t) ORDER BY t.shares_owned DESC, t.member_number), '[]'::JSONB)
+    FROM (
+        SELECT id, full_name, member_number, shares_owned
+        FROM members
+        WHERE shares_owned > 0
+        ORDER BY shares_owned DESC NULLS LAST, member_number
+        LIMIT p_limit
+    ) t;
+$$;
+
+-- Rebuild the register from members (first use, bulk imports, or to change top_n)
+CREATE OR REPLACE FUNCTION refresh_share_register(p_top_n INTEGER DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_top_n INTEGER := COALESCE(p_top_n, (SELECT top_n FROM share_register WHERE id = 1), 10);
+    v_register share_register;
+BEGIN
+    INSERT INTO share_register (id, total_shares, shareholders, total_members, top_n, top_shareholders, updated_at)
+    SELECT 1, COALESCE(SUM(shares_owned), 0), COUNT(*) FILTER (WHERE shares_owned > 0), COUNT(*), v_top_n,
+           share_register_top(v_top_n), NOW()
+    FROM members
+    ON CONFLICT (id) DO UPDATE
+    SET total_shares = EXCLUDED.total_shares,
+        shareholders = EXCLUDED.shareholders,
+        total_members = EXCLUDED.total_members,
+        top_n = EXCLUDED.top_n,
+        top_shareholders = EXCLUDED.top_shareholders,
+        updated_at = EXCLUDED.updated_at
+    RETURNING * INTO v_register;
+    RETURN to_jsonb(v_register);
+END;
+$$;
+
+-- Apply a statement's member changes to the totals in one UPDATE, from the transition tables
+-- (new_rows/old_rows). The top-N list is re-read (an index scan of top_n rows) only when a changed
+-- member is on it or now qualifies for it. Bulk inserts and updates cost one pass, not one per row.
+CREATE OR REPLACE FUNCTION share_register_sync()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_changes JSONB;
+    v_members INTEGER := 0;
+    v_shares BIGINT;
+    v_holders INTEGER;
+    v_max_after BIGINT;
+    v_register share_register;
+BEGIN
+    -- v_changes: [{id, before, after}] for members whose holding, name or number changed
+    IF TG_OP = 'INSERT' THEN
+        SELECT COUNT(*), jsonb_agg(jsonb_build_object('id', id, 'before', 0, 'after', COALESCE(shares_owned, 0)))
+        INTO v_members, v_changes
+        FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT -COUNT(*), jsonb_agg(jsonb_build_object('id', id, 'before', COALESCE(shares_owned, 0), 'after', 0))
+        INTO v_members, v_changes
+        FROM old_rows;
+    ELSE
+        SELECT jsonb_agg(jsonb_build_object('id', n.id, 'before', COALESCE(o.shares_owned, 0),
+                                            'after', COALESCE(n.shares_owned, 0)))
+        INTO v_changes
+        FROM new_rows n
+        JOIN old_rows o ON o.id = n.id
+        WHERE (o.shares_owned, o.full_name, o.member_number) IS DISTINCT FROM (n.shares_owned, n.full_name, n.member_number);
+    END IF;
+
+    IF v_changes IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT COALESCE(SUM(c.after - c.before), 0),
+           COALESCE(SUM((c.after > 0)::INTEGER - (c.before > 0)::INTEGER), 0),
+           MAX(c.after)
+    INTO v_shares, v_holders, v_max_after
+    FROM jsonb_to_recordset(v_changes) AS c(id UUID, before BIGINT, after BIGINT);
+
+    UPDATE share_register
+    SET total_shares = total_shares + v_shares,
+        shareholders = shareholders + v_holders,
+        total_members = total_members + v_members,
+        updated_at = NOW()
+    WHERE id = 1
+    RETURNING * INTO v_register;
+
+    IF NOT FOUND THEN
+        PERFORM refresh_share_register();
+    ELSIF EXISTS (
+            SELECT 1
+            FROM jsonb_array_elements(v_register.top_shareholders) t
+            JOIN jsonb_to_recordset(v_changes) AS c(id UUID) ON c.id = (t ->> 'id')::UUID
+        )
+       OR (v_max_after > 0 AND (jsonb_array_length(v_register.top_shareholders) < v_register.top_n
+           OR v_max_after >= (v_register.top_shareholders -> -1 ->> 'shares_owned')::BIGINT)) THEN
+        UPDATE share_register SET top_shareholders = share_register_top(top_n) WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- Transition tables need one trigger per event (and no column list on UPDATE)
+DROP TRIGGER IF EXISTS members_share_register ON members;
+DROP TRIGGER IF EXISTS members_share_register_insert ON members;
+DROP TRIGGER IF EXISTS members_share_register_update ON members;
+DROP TRIGGER IF EXISTS members_share_register_delete ON members;
+
+CREATE TRIGGER members_share_register_insert
+AFTER INSERT ON members
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION share_register_sync();
+
+CREATE TRIGGER members_share_register_update
+AFTER UPDATE ON members
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION share_register_sync();
+
+CREATE TRIGGER members_share_register_delete
+AFTER DELETE ON members
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION share_register_sync();
+
+-- Add p_shares (negative for sales) to a member's holding and insert the share_transactions row
+-- when p_transaction is given, or post an existing one (a PesaPal purchase) when p_transaction_id
+-- is given. posted_at marks the rows whose shares were added, so a replayed purchase is refused.
+-- Holdings never go below zero.
+ALTER TABLE share_transactions ADD COLUMN IF NOT EXISTS posted_at TIMESTAMPTZ;
+
+DROP FUNCTION IF EXISTS post_share_entry(UUID, INTEGER, JSONB);
+
+CREATE OR REPLACE FUNCTION post_share_entry(p_member_id UUID, p_shares INTEGER, p_transaction JSONB DEFAULT NULL,
+                                            p_transaction_id UUID DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_before INTEGER;
+    v_id UUID := p_transaction_id;
+    v_owner UUID;
+    v_posted_at TIMESTAMPTZ;
+BEGIN
+    SELECT COALESCE(shares_owned, 0) INTO v_before
+    FROM members
+    WHERE id = p_member_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Member not found';
+    END IF;
+    IF v_id IS NOT NULL THEN
+        SELECT member_id, posted_at INTO v_owner, v_posted_at
+        FROM share_transactions
+        WHERE id = v_id
+        FOR UPDATE;
+
+        IF NOT FOUND OR v_owner IS DISTINCT FROM p_member_id THEN
+            RAISE EXCEPTION 'Share transaction not found for this member';
+        END IF;
+        IF v_posted_at IS NOT NULL THEN
+            RAISE EXCEPTION 'Share transaction was already posted';
+        END IF;
+    END IF;
+    IF v_before + p_shares < 0 THEN
+        RAISE EXCEPTION 'Member only owns % shares', v_before;
+    END IF;
+
+    UPDATE members
+    SET shares_owned = v_before + p_shares,
+        updated_at = NOW()
+    WHERE id = p_member_id;
+
+    IF v_id IS NOT NULL THEN
+        PERFORM private.update_jsonb_row('share_transactions', v_id,
+                                         COALESCE(p_transaction, '{}'::JSONB) || jsonb_build_object('posted_at', NOW()));
+    ELSIF p_transaction IS NOT NULL THEN
+        v_id := private.insert_jsonb_row('share_transactions', p_transaction || jsonb_build_object(
+            'member_id', p_member_id, 'posted_at', NOW()));
+    END IF;
+
+    RETURN jsonb_build_object('transaction_id', v_id, 'shares_before', v_before, 'shares_after', v_before + p_shares);
+END;
+$$;
+
+SELECT refresh_share_register();
+
+-- ---------------------------------------------------------------------------
+-- Monthly share statistics (routes/shares.py get_monthly_share_statistics)
+-- ---------------------------------------------------------------------------
+CREATE INDEX IF NOT EXISTS idx_share_transactions_type_date ON share_transactions (transaction_type, transaction_date);
+
+-- One row per month with totals, count and average price; all history when p_since is NULL
+CREATE OR REPLACE FUNCTION monthly_share_statistics(
+    p_since TIMESTAMPTZ DEFAULT NULL,
+    p_transaction_type TEXT DEFAULT 'purchase'
+)
+RETURNS TABLE (month TEXT, total_shares BIGINT, total_amount DECIMAL, transaction_count BIGINT, average_price DECIMAL)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT to_char(date_trunc('month', transaction_date), 'YYYY-MM') AS month,
+           COALESCE(SUM(shares), 0) AS total_shares,
+           COALESCE(SUM(COALESCE(total_amount, shares * price_per_share)), 0) AS total_amount,
+           COUNT(*) AS transaction_count,
+           CASE WHEN SUM(shares) > 0
+                THEN SUM(COALESCE(total_amount, shares * price_per_share)) / SUM(shares)
+                ELSE 0 END AS average_price
+    FROM share_transactions
+    WHERE transaction_type = p_transaction_type
+      AND (p_since IS NULL OR transaction_date >= p_since)
+    GROUP BY date_trunc('month', transaction_date)
+    ORDER BY 1 DESC;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Batch savings postings (dividends.py, ledger.py)
+-- ---------------------------------------------------------------------------
+-- Insert rows given as a JSONB array in one statement; returns the number inserted
+CREATE OR REPLACE FUNCTION private.insert_jsonb_rows(p_table REGCLASS, p_rows JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_columns TEXT;
+    v_count INTEGER;
+BEGIN
+    SELECT string_agg(quote_ident(key), ', ') INTO v_columns
+    FROM (SELECT DISTINCT jsonb_object_keys(r) AS key FROM jsonb_array_elements(p_rows) r) k;
+    IF v_columns IS NULL THEN
+        RETURN 0;
+    END IF;
+    EXECUTE format('INSERT INTO %s (%s) SELECT %s FROM jsonb_populate_recordset(NULL::%s, $1)',
+                   p_table, v_columns, v_columns, p_table)
+    USING p_rows;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+-- Post many entries at once: p_entries = [{savings_account_id, amount, transaction}, ...].
+-- Each account is locked and updated once with its total; every entry gets a savings_transactions
+-- row whose balance_before/balance_after run in entry order.
+CREATE OR REPLACE FUNCTION post_savings_batch(p_entries JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_accounts INTEGER;
+    v_rows JSONB;
+BEGIN
+    IF p_entries IS NULL OR jsonb_array_length(p_entries) = 0 THEN
+        RETURN jsonb_build_object('accounts', 0, 'transactions', 0, 'total_amount', 0);
+    END IF;
+
+    SELECT COUNT(DISTINCT e->>'savings_account_id') INTO v_accounts FROM jsonb_array_elements(p_entries) e;
+    PERFORM 1 FROM savings_accounts
+    WHERE id IN (SELECT (e->>'savings_account_id')::UUID FROM jsonb_array_elements(p_entries) e)
+    ORDER BY id
+    FOR UPDATE;
+    IF NOT FOUND OR (SELECT COUNT(*) FROM savings_accounts
+                     WHERE id IN (SELECT (e->>'savings_account_id')::UUID FROM jsonb_array_elements(p_entries) e)) <> v_accounts THEN
+        RAISE EXCEPTION 'Savings account not found';
+    END IF;
+
+    WITH entries AS (
+        SELECT (e->>'savings_account_id')::UUID AS account_id, (e->>'amount')::DECIMAL AS amount,
+               COALESCE(e->'transaction', '{}'::JSONB) AS tx, n
+        FROM jsonb_array_elements(p_entries) WITH ORDINALITY AS x(e, n)
+    ), running AS (
+        SELECT en.*, sa.current_balance + COALESCE(SUM(en.amount) OVER (
+                   PARTITION BY en.account_id ORDER BY en.n ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS balance_before
+        FROM entries en
+        JOIN savings_accounts sa ON sa.id = en.account_id
+    )
+    SELECT jsonb_agg(tx || jsonb_build_object(
+               'savings_account_id', account_id,
+               'amount', amount,
+               'balance_before', balance_before,
+               'balance_after', balance_before + amount
+           ) ORDER BY n) INTO v_rows
+    FROM running;
+    PERFORM private.insert_jsonb_rows('savings_transactions', v_rows);
+
+    UPDATE savings_accounts sa
+    SET current_balance = sa.current_balance + t.total,
+        available_balance = sa.available_balance + t.total,
+        updated_at = NOW()
+    FROM (
+        SELECT (e->>'savings_account_id')::UUID AS account_id, SUM((e->>'amount')::DECIMAL) AS total
+        FROM jsonb_array_elements(p_entries) e
+        GROUP BY 1
+    ) t
+    WHERE sa.id = t.account_id;
+
+    RETURN jsonb_build_object(
+        'accounts', v_accounts,
+        'transactions', jsonb_array_length(v_rows),
+        'total_amount', (SELECT SUM((e->>'amount')::DECIMAL) FROM jsonb_array_elements(p_entries) e)
+    );
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Dividends (dividends.py)
+-- ---------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS dividend_declarations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    title TEXT NOT NULL,
+    period_start DATE NOT NULL,
+    period_end DATE NOT NULL,
+    total_amount DECIMAL(15, 2) NOT NULL CHECK (total_amount > 0),
+    method TEXT NOT NULL DEFAULT 'time_weighted' CHECK (method IN ('pro_rata', 'time_weighted')),
+    payout TEXT NOT NULL DEFAULT 'savings' CHECK (payout IN ('savings', 'shares')),
+    status TEXT NOT NULL DEFAULT 'draft' CHECK (status IN ('draft', 'computed', 'posted')),
+    share_price DECIMAL(15, 2),
+    shareholders INTEGER NOT NULL DEFAULT 0,
+    total_weight DECIMAL(20, 4) NOT NULL DEFAULT 0,
+    allocated_amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    declared_by UUID,
+    posted_by UUID,
+    computed_at TIMESTAMPTZ,
+    posted_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CHECK (period_end >= period_start)
+);
+
+CREATE TABLE IF NOT EXISTS dividend_allocations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    declaration_id UUID NOT NULL REFERENCES dividend_declarations (id) ON DELETE CASCADE,
+    member_id UUID NOT NULL REFERENCES members (id),
+    savings_account_id UUID REFERENCES savings_accounts (id),
+    weight DECIMAL(20, 4) NOT NULL,
+    amount DECIMAL(15, 2) NOT NULL,
+    shares_awarded INTEGER NOT NULL DEFAULT 0,
+    cash_amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'paid', 'no_account')),
+    paid_at TIMESTAMPTZ,
+    UNIQUE (declaration_id, member_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_dividend_allocations_declaration ON dividend_allocations (declaration_id, amount DESC);
+
+-- Dividend credits are savings transactions of their own type
+ALTER TABLE savings_transactions DROP CONSTRAINT IF EXISTS savings_transactions_transaction_type_check;
+ALTER TABLE savings_transactions ADD CONSTRAINT savings_transactions_transaction_type_check
+    CHECK (transaction_type IN ('deposit', 'withdrawal', 'transfer', 'interest', 'fee', 'dividend'));
+
+-- Allocate a declaration's pool to every shareholder in one set-based pass.
+-- Holdings are rebuilt backwards from members.shares_owned using share_transactions (purchases of
+-- unfinished PesaPal sessions excluded). pro_rata weighs the holding on period_end; time_weighted
+-- weighs the average daily holding over the period. Amounts are rounded down to whole UGX; with
+-- the 'shares' payout they are converted to whole shares at the period_end price and the
+-- remainder is paid to savings. Re-running replaces the allocations until the dividend is posted.
+CREATE OR REPLACE FUNCTION compute_dividend(p_declaration_id UUID)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    d dividend_declarations;
+    v_days INTEGER;
+    v_price DECIMAL;
+BEGIN
+    SELECT * INTO d FROM dividend_declarations WHERE id = p_declaration_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Dividend declaration not found';
+    END IF;
+    IF d.status = 'posted' THEN
+        RAISE EXCEPTION 'Dividend has already been posted';
+    END IF;
+
+    v_days := d.period_end - d.period_start + 1;
+    SELECT value_per_share INTO v_price FROM share_value
+    WHERE effective_date <= d.period_end
+    ORDER BY effective_date DESC
+    LIMIT 1;
+    IF d.payout = 'shares' AND COALESCE(v_price, 0) <= 0 THEN
+        RAISE EXCEPTION 'No share price on or before %', d.period_end;
+    END IF;
+
+    DELETE FROM dividend_allocations WHERE declaration_id = d.id;
+
+    INSERT INTO dividend_allocations (declaration_id, member_id, savings_account_id, weight, amount,
+                                      shares_awarded, cash_amount, status)
+    WITH moves AS (
+        SELECT t.member_id, t.transaction_date::DATE AS day,
+               CASE WHEN t.transaction_type = 'sale' THEN -ABS(t.shares) ELSE t.shares END AS delta
+        FROM share_transactions t
+        WHERE t.transaction_date::DATE > d.period_start
+          AND NOT EXISTS (SELECT 1 FROM share_payment_sessions s
+                          WHERE s.reference_id = t.reference AND s.status <> 'completed')
+    ), held AS (
+        SELECT m.id AS member_id,
+               COALESCE(m.shares_owned, 0) - COALESCE(SUM(mv.delta) FILTER (WHERE mv.day > d.period_end), 0) AS closing,
+               COALESCE(SUM(mv.delta * (mv.day - d.period_start)) FILTER (WHERE mv.day <= d.period_end), 0) AS shift
+        FROM members m
+        LEFT JOIN moves mv ON mv.member_id = m.id
+        GROUP BY m.id, m.shares_owned
+    ), weighted AS (
+        SELECT member_id,
+               GREATEST(CASE WHEN d.method = 'pro_rata' THEN closing
+                             ELSE (closing * v_days - shift)::DECIMAL / v_days END, 0) AS weight
+        FROM held
+    ), shared AS (
+        SELECT w.member_id, w.weight, FLOOR(d.total_amount * w.weight / SUM(w.weight) OVER ()) AS amount
+        FROM weighted w
+        WHERE w.weight > 0
+    ), accounts AS (
+        SELECT DISTINCT ON (member_id) member_id, id
+        FROM savings_accounts
+        ORDER BY member_id, created_at
+    ), paid AS (
+        SELECT s.*, a.id AS savings_account_id,
+               CASE WHEN d.payout = 'shares' THEN FLOOR(s.amount / v_price)::INTEGER ELSE 0 END AS shares_awarded
+        FROM shared s
+        LEFT JOIN accounts a ON a.member_id = s.member_id
+    )
+    SELECT d.id, member_id, savings_account_id, weight, amount, shares_awarded,
+           amount - shares_awarded * COALESCE(v_price, 0),
+           CASE WHEN amount - shares_awarded * COALESCE(v_price, 0) > 0 AND savings_account_id IS NULL
+                THEN 'no_account' ELSE 'pending' END
+    FROM paid
+    WHERE amount > 0;
+
+    UPDATE dividend_declarations
+    SET status = 'computed',
+        share_price = v_price,
+        shareholders = s.shareholders,
+        total_weight = s.total_weight,
+        allocated_amount = s.allocated_amount,
+        computed_at = NOW()
+    FROM (
+        SELECT COUNT(*) AS shareholders, COALESCE(SUM(weight), 0) AS total_weight, COALESCE(SUM(amount), 0) AS allocated_amount
+        FROM dividend_allocations
+        WHERE declaration_id = d.id
+    ) s
+    WHERE id = d.id
+    RETURNING * INTO d;
+
+    RETURN to_jsonb(d);
+END;
+$$;
+
+-- Pay a computed declaration: savings credits through post_savings_batch(), share top-ups as one
+-- members update plus share_transactions rows. The status change to 'posted' is the claim, so a
+-- declaration is paid exactly once however often this is called. Members without a savings
+-- account still get their shares; their cash stays 'no_account' until pay_dividend_remainders().
+CREATE OR REPLACE FUNCTION post_dividend(p_declaration_id UUID, p_posted_by UUID DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    d dividend_declarations;
+    v_reference TEXT;
+    v_savings JSONB;
+    v_shares INTEGER;
+BEGIN
+    UPDATE dividend_declarations
+    SET status = 'posted', posted_by = p_posted_by, posted_at = NOW()
+    WHERE id = p_declaration_id AND status = 'computed'
+    RETURNING * INTO d;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Dividend has already been posted or has not been computed';
+    END IF;
+    v_reference := 'DIV-' || upper(left(d.id::TEXT, 8));
+
+    v_savings := post_savings_batch(COALESCE((
+        SELECT jsonb_agg(jsonb_build_object(
+            'savings_account_id', a.savings_account_id,
+            'amount', a.cash_amount,
+            'transaction', jsonb_build_object(
+                'member_id', a.member_id,
+                'transaction_type', 'dividend',
+                'currency', 'UGX',
+                'reference_number', 'DIV-' || upper(replace(a.id::TEXT, '-', '')),
+                'description', 'Dividend: ' || d.title,
+                'processed_by', p_posted_by,
+                'status', 'completed',
+                'created_at', NOW()
+            )
+        ) ORDER BY a.savings_account_id)
+        FROM dividend_allocations a
+        WHERE a.declaration_id = d.id AND a.status = 'pending' AND a.cash_amount > 0
+    ), '[]'::JSONB));
+
+    UPDATE members m
+    SET shares_owned = COALESCE(m.shares_owned, 0) + a.shares_awarded,
+        updated_at = NOW()
+    FROM dividend_allocations a
+    WHERE a.declaration_id = d.id AND a.status IN ('pending', 'no_account') AND a.shares_awarded > 0
+      AND m.id = a.member_id;
+    GET DIAGNOSTICS v_shares = ROW_COUNT;
+
+    INSERT INTO share_transactions (member_id, shares, price_per_share, currency, transaction_type, reference,
+                                    notes, payment_method, transaction_date, processed_by, created_at, updated_at)
+    SELECT a.member_id, a.shares_awarded, d.share_price, 'UGX', 'dividend', v_reference,
+           'Dividend: ' || d.title, 'dividend', NOW(), p_posted_by, NOW(), NOW()
+    FROM dividend_allocations a
+    WHERE a.declaration_id = d.id AND a.status IN ('pending', 'no_account') AND a.shares_awarded > 0;
+
+    UPDATE dividend_allocations
+    SET status = 'paid', paid_at = NOW()
+    WHERE declaration_id = d.id AND status = 'pending';
+
+    RETURN jsonb_build_object(
+        'declaration_id', d.id,
+        'savings_credits', v_savings->'transactions',
+        'savings_amount', v_savings->'total_amount',
+        'share_top_ups', v_shares,
+        'unpaid_remainders', (SELECT COUNT(*) FROM dividend_allocations WHERE declaration_id = d.id AND status = 'no_account')
+    );
+END;
+$$;
+
+-- Pay the cash of a posted declaration that was held back for members without a savings account,
+-- to the accounts they have opened since. Allocations still without an account stay 'no_account'.
+CREATE OR REPLACE FUNCTION pay_dividend_remainders(p_declaration_id UUID, p_paid_by UUID DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    d dividend_declarations;
+    v_savings JSONB;
+BEGIN
+    SELECT * INTO d FROM dividend_declarations WHERE id = p_declaration_id FOR UPDATE;
+    IF NOT FOUND OR d.status <> 'posted' THEN
+        RAISE EXCEPTION 'Dividend has not been posted';
+    END IF;
+
+    WITH payable AS (
+        UPDATE dividend_allocations a
+        SET savings_account_id = s.id, status = 'paid', paid_at = NOW()
+        FROM (
+            SELECT DISTINCT ON (member_id) member_id, id
+            FROM savings_accounts
+            ORDER BY member_id, created_at
+        ) s
+        WHERE a.declaration_id = d.id AND a.status = 'no_account' AND s.member_id = a.member_id
+        RETURNING a.*
+    )
+    SELECT post_savings_batch(COALESCE(jsonb_agg(jsonb_build_object(
+        'savings_account_id', p.savings_account_id,
+        'amount', p.cash_amount,
+        'transaction', jsonb_build_object(
+            'member_id', p.member_id,
+            'transaction_type', 'dividend',
+            'currency', 'UGX',
+            'reference_number', 'DIV-' || upper(replace(p.id::TEXT, '-', '')),
+            'description', 'Dividend: ' || d.title,
+            'processed_by', p_paid_by,
+            'status', 'completed',
+            'created_at', NOW()
+        )
+    ) ORDER BY p.savings_account_id), '[]'::JSONB))
+    INTO v_savings
+    FROM payable p;
+
+    RETURN jsonb_build_object(
+        'declaration_id', d.id,
+        'savings_credits', v_savings->'transactions',
+        'savings_amount', v_savings->'total_amount',
+        'unpaid_remainders', (SELECT COUNT(*) FROM dividend_allocations WHERE declaration_id = d.id AND status = 'no_account')
+    );
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Bulk deposit imports (deposit_import.py)
+-- ---------------------------------------------------------------------------
+-- One row per uploaded sheet. file_hash stops the same sheet being posted twice; results holds
+-- the per-row outcome used for the downloadable report. Deposits themselves go through
+-- post_savings_batch() in chunks.
+CREATE TABLE IF NOT EXISTS deposit_imports (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    filename TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'processing' CHECK (status IN ('processing', 'completed', 'failed')),
+    total_rows INTEGER NOT NULL DEFAULT 0,
+    posted_rows INTEGER NOT NULL DEFAULT 0,
+    rejected_rows INTEGER NOT NULL DEFAULT 0,
+    total_amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    results JSONB NOT NULL DEFAULT '[]'::JSONB,
+    imported_by UUID,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_deposit_imports_file_hash ON deposit_imports (file_hash);
+CREATE INDEX IF NOT EXISTS idx_savings_accounts_account_number ON savings_accounts (account_number);
+
+-- ---------------------------------------------------------------------------
+-- Bulk member onboarding (member_onboarding.py)
+-- ---------------------------------------------------------------------------
+-- An import is staged as one member_import_rows row per register line (pending, duplicate or
+-- rejected). onboard_member_batch() turns the next pending rows into members with their savings
+-- and loan accounts, so an interrupted import resumes from the first row still pending.
+CREATE TABLE IF NOT EXISTS member_imports (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    filename TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'processing' CHECK (status IN ('processing', 'completed', 'failed')),
+    total_rows INTEGER NOT NULL DEFAULT 0,
+    created_rows INTEGER NOT NULL DEFAULT 0,
+    duplicate_rows INTEGER NOT NULL DEFAULT 0,
+    rejected_rows INTEGER NOT NULL DEFAULT 0,
+    documents_total INTEGER NOT NULL DEFAULT 0,
+    documents_uploaded INTEGER NOT NULL DEFAULT 0,
+    documents_failed INTEGER NOT NULL DEFAULT 0,
+    fee_paid BOOLEAN NOT NULL DEFAULT TRUE,
+    imported_by UUID,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_member_imports_file_hash ON member_imports (file_hash);
+
+CREATE TABLE IF NOT EXISTS member_import_rows (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    import_id UUID NOT NULL REFERENCES member_imports (id) ON DELETE CASCADE,
+    row_number INTEGER NOT NULL,
+    status TEXT NOT NULL CHECK (status IN ('pending', 'created', 'duplicate', 'rejected')),
+    message TEXT,
+    full_name TEXT,
+    email TEXT,
+    phone_number TEXT,
+    member_data JSONB,
+    documents JSONB NOT NULL DEFAULT '{}'::JSONB,
+    documents_status TEXT NOT NULL DEFAULT 'none' CHECK (documents_status IN ('none', 'pending', 'uploaded', 'failed')),
+    member_id UUID REFERENCES members (id),
+    member_number TEXT,
+    UNIQUE (import_id, row_number)
+);
+
+CREATE INDEX IF NOT EXISTS idx_member_import_rows_status ON member_import_rows (import_id, status, row_number);
+CREATE INDEX IF NOT EXISTS idx_members_email ON members (email);
+CREATE INDEX IF NOT EXISTS idx_members_phone_number ON members (phone_number);
+
+-- Existing members sharing any of the emails or phone numbers: [{email, phone_number, member_number}]
+CREATE OR REPLACE FUNCTION member_contact_matches(p_emails TEXT[], p_phones TEXT[])
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE(jsonb_agg(jsonb_build_object(
+        'email', LOWER(email), 'phone_number', phone_number, 'member_number', member_number
+    )), '[]'::JSONB)
+    FROM members
+    WHERE LOWER(email) = ANY(p_emails) OR phone_number = ANY(p_phones);
+$$;
+
+-- Create members, savings and loan accounts for the next p_limit pending rows of an import.
+-- Rows are claimed with SKIP LOCKED, so two workers resuming the same import never create a
+-- member twice. Contacts registered since the import was staged (by another import or on the
+-- members page) are checked again and those rows marked duplicate. The batch first takes a
+-- transaction advisory lock per email and phone number, so two imports onboarding the same
+-- contact at once run the check one after the other. Returns {created, duplicates, remaining}.
+CREATE OR REPLACE FUNCTION onboard_member_batch(p_import_id UUID, p_limit INTEGER DEFAULT 200,
+                                                p_performed_by UUID DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_batch JSONB;
+    v_created INTEGER := 0;
+    v_duplicates INTEGER;
+BEGIN
+    SELECT jsonb_agg(jsonb_build_object('row_id', b.id, 'member_id', gen_random_uuid(),
+                                        'member_data', b.member_data) ORDER BY b.row_number)
+    INTO v_batch
+    FROM (
+        SELECT id, row_number, member_data
+        FROM member_import_rows
+        WHERE import_id = p_import_id AND status = 'pending'
+        ORDER BY row_number
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ) b;
+
+    IF v_batch IS NULL THEN
+        RETURN jsonb_build_object('created', 0, 'duplicates', 0, 'remaining',
+            (SELECT COUNT(*) FROM member_import_rows WHERE import_id = p_import_id AND status = 'pending'));
+    END IF;
+
+    -- Sorted, so two batches sharing several contacts lock them in the same order
+    PERFORM pg_advisory_xact_lock(hashtext(c.contact))
+    FROM (
+        SELECT DISTINCT v.contact
+        FROM member_import_rows r
+        CROSS JOIN LATERAL (VALUES ('email:' || LOWER(r.email)), ('phone:' || r.phone_number)) AS v(contact)
+        WHERE r.id IN (SELECT (e->>'row_id')::UUID FROM jsonb_array_elements(v_batch) e)
+          AND v.contact IS NOT NULL
+        ORDER BY v.contact
+    ) c;
+
+    WITH taken AS (
+        SELECT r.id,
+               (SELECT m.member_number FROM members m WHERE LOWER(m.email) = LOWER(r.email) LIMIT 1) AS by_email,
+               (SELECT m.member_number FROM members m WHERE m.phone_number = r.phone_number LIMIT 1) AS by_phone
+        FROM member_import_rows r
+        WHERE r.id IN (SELECT (e->>'row_id')::UUID FROM jsonb_array_elements(v_batch) e)
+    )
+    UPDATE member_import_rows r
+    SET status = 'duplicate',
+        message = CASE WHEN t.by_email IS NOT NULL THEN 'Email already registered (' || t.by_email || ')'
+                       ELSE 'Phone number already registered (' || t.by_phone || ')' END
+    FROM taken t
+    WHERE r.id = t.id AND (t.by_email IS NOT NULL OR t.by_phone IS NOT NULL);
+    GET DIAGNOSTICS v_duplicates = ROW_COUNT;
+
+    IF v_duplicates > 0 THEN
+        SELECT jsonb_agg(x.e ORDER BY x.n)
+        INTO v_batch
+        FROM jsonb_array_elements(v_batch) WITH ORDINALITY AS x(e, n)
+        JOIN member_import_rows r ON r.id = (x.e->>'row_id')::UUID
+        WHERE r.status = 'pending';
+
+        UPDATE member_imports
+        SET duplicate_rows = duplicate_rows + v_duplicates,
+            updated_at = NOW()
+        WHERE id = p_import_id;
+
+        IF v_batch IS NULL THEN
+            RETURN jsonb_build_object('created', 0, 'duplicates', v_duplicates, 'remaining',
+                (SELECT COUNT(*) FROM member_import_rows WHERE import_id = p_import_id AND status = 'pending'));
+        END IF;
+    END IF;
+
+    v_created := private.insert_jsonb_rows('members', (
+        SELECT jsonb_agg(e->'member_data' || jsonb_build_object('id', e->'member_id'))
+        FROM jsonb_array_elements(v_batch) e
+    ));
+
+    -- Same numbering and defaults as create_member_accounts() in routes/members.py
+    INSERT INTO savings_accounts (member_id, account_number, account_name, account_type, current_balance,
+                                  available_balance, minimum_balance, interest_rate, status, opened_at,
+                                  created_at, updated_at)
+    SELECT (e->>'member_id')::UUID,
+           'SAV' || UPPER(LEFT(e->>'member_id', 8)) || TO_CHAR(NOW(), 'HH24MISS'),
+           'Savings - ' || (e->'member_data'->>'full_name'),
+           'regular', 0, 0, 1000, 3, 'active', NOW(), NOW(), NOW()
+    FROM jsonb_array_elements(v_batch) e;
+
+    INSERT INTO loan_accounts (member_id, account_number, credit_limit, current_balance, available_limit,
+                               interest_rate, max_loan_amount, min_loan_amount, repayment_period_months,
+                               status, credit_score, opened_at, created_at, updated_at)
+    SELECT (e->>'member_id')::UUID,
+           'LOAN' || UPPER(LEFT(e->>'member_id', 8)) || TO_CHAR(NOW(), 'HH24MISS'),
+           100000, 0, 100000, 12, 5000000, 10000, 12, 'active', 700, NOW(), NOW(), NOW()
+    FROM jsonb_array_elements(v_batch) e;
+
+    INSERT INTO member_audit_log (member_id, action, description, performed_by, created_at)
+    SELECT (e->>'member_id')::UUID, 'bulk_onboarded',
+           'Member and accounts created by bulk import ' || p_import_id, p_performed_by, NOW()
+    FROM jsonb_array_elements(v_batch) e;
+
+    UPDATE member_import_rows r
+    SET status = 'created',
+        member_id = m.id,
+        member_number = m.member_number
+    FROM jsonb_array_elements(v_batch) e
+    JOIN members m ON m.id = (e->>'member_id')::UUID
+    WHERE r.id = (e->>'row_id')::UUID;
+
+    UPDATE member_imports
+    SET created_rows = created_rows + v_created,
+        updated_at = NOW()
+    WHERE id = p_import_id;
+
+    RETURN jsonb_build_object('created', v_created, 'duplicates', v_duplicates, 'remaining',
+        (SELECT COUNT(*) FROM member_import_rows WHERE import_id = p_import_id AND status = 'pending'));
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Month-end statement runs (statement_run.py)
+-- ---------------------------------------------------------------------------
+-- statement_activity() returns a page of active members (keyset on members.id) with their
+-- accounts and the period's savings transactions, loan transactions and repayments grouped by
+-- member, plus the period totals. A run over 20k members reads the database in a few dozen
+-- queries instead of five per member.
+CREATE INDEX IF NOT EXISTS idx_savings_transactions_member_created ON savings_transactions (member_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_loan_transactions_member_created ON loan_transactions (member_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_loan_repayments_member_paid ON loan_repayments (member_id, paid_date);
+CREATE INDEX IF NOT EXISTS idx_members_status_id ON members (account_status, id);
+
+-- [{member, savings_account, loan_account, savings_transactions, loan_transactions, repayments,
+--   total_deposits, total_withdrawals, total_repayments, total_disbursements}] for members after p_after
+CREATE OR REPLACE FUNCTION statement_activity(p_start DATE, p_end DATE, p_after UUID DEFAULT NULL,
+                                              p_limit INTEGER DEFAULT 500)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH page AS (
+        SELECT id, full_name, member_number, email, phone_number
+        FROM members
+        WHERE account_status = 'active' AND (p_after IS NULL OR id > p_after)
+        ORDER BY id
+        LIMIT p_limit
+    ),
+    savings AS (
+        SELECT t.member_id,
+               jsonb_agg(to_jsonb(t) ORDER BY t.created_at DESC) AS transactions,
+               SUM(t.amount) FILTER (WHERE t.transaction_type = 'deposit') AS deposits,
+               SUM(t.amount) FILTER (WHERE t.transaction_type = 'withdrawal') AS withdrawals
+        FROM savings_transactions t
+        JOIN page ON page.id = t.member_id
+        WHERE t.created_at >= p_start AND t.created_at < p_end + 1
+        GROUP BY t.member_id
+    ),
+    loans AS (
+        SELECT t.member_id,
+               jsonb_agg(to_jsonb(t) ORDER BY t.created_at DESC) AS transactions,
+               SUM(t.amount) FILTER (WHERE t.transaction_type = 'repayment') AS repayments,
+               SUM(t.amount) FILTER (WHERE t.transaction_type = 'disbursement') AS disbursements
+        FROM loan_transactions t
+        JOIN page ON page.id = t.member_id
+        WHERE t.created_at >= p_start AND t.created_at < p_end + 1
+        GROUP BY t.member_id
+    ),
+    repayments AS (
+        SELECT r.member_id,
+               jsonb_agg(to_jsonb(r) || jsonb_build_object('loan_applications', jsonb_build_object(
+                   'loan_amount', a.loan_amount, 'purpose', a.purpose)) ORDER BY r.paid_date DESC) AS rows
+        FROM loan_repayments r
+        JOIN page ON page.id = r.member_id
+        LEFT JOIN loan_applications a ON a.id = r.loan_application_id
+        WHERE r.paid_date BETWEEN p_start AND p_end
+        GROUP BY r.member_id
+    )
+    SELECT COALESCE(jsonb_agg(jsonb_build_object(
+        'member', to_jsonb(p),
+        'savings_account', (SELECT to_jsonb(sa) FROM savings_accounts sa WHERE sa.member_id = p.id LIMIT 1),
+        'loan_account', (SELECT to_jsonb(la) FROM loan_accounts la WHERE la.member_id = p.id LIMIT 1),
+        'savings_transactions', COALESCE(s.transactions, '[]'::JSONB),
+        'loan_transactions', COALESCE(l.transactions, '[]'::JSONB),
+        'repayments', COALESCE(r.rows, '[]'::JSONB),
+        'total_deposits', COALESCE(s.deposits, 0),
+        'total_withdrawals', COALESCE(s.withdrawals, 0),
+        'total_repayments', COALESCE(l.repayments, 0),
+        'total_disbursements', COALESCE(l.disbursements, 0)
+    ) ORDER BY p.id), '[]'::JSONB)
+    FROM page p
+    LEFT JOIN savings s ON s.member_id = p.id
+    LEFT JOIN loans l ON l.member_id = p.id
+    LEFT JOIN repayments r ON r.member_id = p.id;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Statement API (member_statements.py, routes/member.py statements)
+-- ---------------------------------------------------------------------------
+-- statement_summary() returns a member's accounts and the period totals in one aggregate query
+-- (optionally with the newest p_sample rows of each list, for the preview). statement_transactions()
+-- returns one keyset page of a list, newest first, after the (date, id) of the last row the
+-- browser already has, so long ranges never ship every row at once. Both use the member/date
+-- indexes added for statement runs above.
+-- One page of statement rows: p_kind is savings, loan, all (savings and loan merged) or repayments.
+-- p_before/p_before_id are the sort value and id of the last row of the previous page.
+CREATE OR REPLACE FUNCTION statement_transactions(p_member_id UUID, p_kind TEXT, p_start DATE, p_end DATE,
+                                                  p_before TEXT DEFAULT NULL, p_before_id UUID DEFAULT NULL,
+                                                  p_limit INTEGER DEFAULT 50)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    v_rows JSONB;
+BEGIN
+    IF p_kind = 'repayments' THEN
+        SELECT COALESCE(jsonb_agg(to_jsonb(r) ORDER BY r.paid_date DESC, r.id DESC), '[]'::JSONB)
+        INTO v_rows
+        FROM (
+            SELECT lr.id, lr.installment_number, lr.due_date, lr.paid_date, lr.due_amount, lr.paid_amount,
+                   lr.status, la.purpose
+            FROM loan_repayments lr
+            LEFT JOIN loan_applications la ON la.id = lr.loan_application_id
+            WHERE lr.member_id = p_member_id
+              AND lr.paid_date BETWEEN p_start AND p_end
+              AND (p_before IS NULL OR (lr.paid_date, lr.id) < (p_before::DATE, p_before_id))
+            ORDER BY lr.paid_date DESC, lr.id DESC
+            LIMIT p_limit
+        ) r;
+        RETURN v_rows;
+    END IF;
+
+    IF p_kind NOT IN ('savings', 'loan', 'all') THEN
+        RAISE EXCEPTION 'Unknown statement list %', p_kind;
+    END IF;
+
+    SELECT COALESCE(jsonb_agg(to_jsonb(t) ORDER BY t.created_at DESC, t.id DESC), '[]'::JSONB)
+    INTO v_rows
+    FROM (
+        SELECT * FROM (
+            SELECT id, created_at, transaction_type, amount, description, reference_number, 'savings' AS source
+            FROM savings_transactions
+            WHERE p_kind IN ('savings', 'all') AND member_id = p_member_id
+              AND created_at >= p_start AND created_at < p_end + 1
+              AND (p_before IS NULL OR (created_at, id) < (p_before::TIMESTAMPTZ, p_before_id))
+            UNION ALL
+            SELECT id, created_at, transaction_type, amount, description, reference_number, 'loan' AS source
+            FROM loan_transactions
+            WHERE p_kind IN ('loan', 'all') AND member_id = p_member_id
+              AND created_at >= p_start AND created_at < p_end + 1
+              AND (p_before IS NULL OR (created_at, id) < (p_before::TIMESTAMPTZ, p_before_id))
+        ) u
+        ORDER BY created_at DESC, id DESC
+        LIMIT p_limit
+    ) t;
+    RETURN v_rows;
+END;
+$$;
+
+-- {savings_account, loan_account, savings: {count, deposits, withdrawals},
+--  loan: {count, repayments, disbursements}, repayments: {count, paid}, samples}
+CREATE OR REPLACE FUNCTION statement_summary(p_member_id UUID, p_start DATE, p_end DATE, p_sample INTEGER DEFAULT 0)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'savings_account', (SELECT to_jsonb(sa) FROM savings_accounts sa WHERE sa.member_id = p_member_id LIMIT 1),
+        'loan_account', (SELECT to_jsonb(la) FROM loan_accounts la WHERE la.member_id = p_member_id LIMIT 1),
+        'savings', (
+            SELECT jsonb_build_object(
+                'count', COUNT(*),
+                'deposits', COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'deposit'), 0),
+                'withdrawals', COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'withdrawal'), 0))
+            FROM savings_transactions
+            WHERE member_id = p_member_id AND created_at >= p_start AND created_at < p_end + 1),
+        'loan', (
+            SELECT jsonb_build_object(
+                'count', COUNT(*),
+                'repayments', COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'repayment'), 0),
+                'disbursements', COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'disbursement'), 0))
+            FROM loan_transactions
+            WHERE member_id = p_member_id AND created_at >= p_start AND created_at < p_end + 1),
+        'repayments', (
+            SELECT jsonb_build_object('count', COUNT(*), 'paid', COALESCE(SUM(paid_amount), 0))
+            FROM loan_repayments
+            WHERE member_id = p_member_id AND paid_date BETWEEN p_start AND p_end),
+        'samples', CASE WHEN p_sample > 0 THEN jsonb_build_object(
+            'savings', statement_transactions(p_member_id, 'savings', p_start, p_end, NULL, NULL, p_sample),
+            'loan', statement_transactions(p_member_id, 'loan', p_start, p_end, NULL, NULL, p_sample),
+            'repayments', statement_transactions(p_member_id, 'repayments', p_start, p_end, NULL, NULL, p_sample)
+        ) END
+    );
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Registration document retries (routes/members.py save_member_documents)
+-- ---------------------------------------------------------------------------
+-- A processed registration whose documents did not all upload keeps the failed files in
+-- files_metadata and their staged copies on disk; member_id ties it to the member it created.
+ALTER TABLE temp_registrations ADD COLUMN IF NOT EXISTS member_id UUID;
+CREATE INDEX IF NOT EXISTS idx_temp_registrations_member ON temp_registrations (member_id);
@@ -0,0 +1,217 @@
+#upload_staging.py
+# Staging area for registration files waiting on payment (temp_uploads/<registration_id>).
+# A small SQLite index (shared by all workers) tracks size and expiry of every staged
+# registration, so the janitor evicts expired entries without walking the directory tree.
+import os
+import time
+import shutil
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TEMP_UPLOAD_DIR = os.getenv('TEMP_UPLOAD_DIR', 'temp_uploads')
+TEMP_UPLOAD_TTL = int(os.getenv('TEMP_UPLOAD_TTL_SECONDS', str(24 * 3600)))
+TEMP_UPLOAD_MAX_BYTES = int(os.getenv('TEMP_UPLOAD_MAX_BYTES', str(2 * 1024 ** 3)))  # 2 GB in total
+TEMP_UPLOAD_MAX_REGISTRATIONS = int(os.getenv('TEMP_UPLOAD_MAX_REGISTRATIONS', '2000'))
+JANITOR_INTERVAL = int(os.getenv('TEMP_UPLOAD_JANITOR_INTERVAL', '300'))
+JANITOR_BATCH = 50
+CHUNK_SIZE = 64 * 1024
+RESERVE_STEP = 1024 * 1024  # quota is reserved in steps of this size while a file is copied
+
+
+class TempUploadQuotaError(Exception):
+    """Raised when staging a file would exceed the size or count quota"""
+
+
+class TempUploadStore:
+    def __init__(self, base_dir=TEMP_UPLOAD_DIR, ttl=TEMP_UPLOAD_TTL,
+                 max_bytes=TEMP_UPLOAD_MAX_BYTES, max_registrations=TEMP_UPLOAD_MAX_REGISTRATIONS):
+        self.base_dir = base_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_registrations = max_registrations
+        self.local = threading.local()
+        self.janitor_pid = None
+        os.makedirs(base_dir, exist_ok=True)
+
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS staged (registration_id TEXT PRIMARY KEY, '
+                     'created_at REAL, expires_at REAL, bytes INTEGER DEFAULT 0, files INTEGER DEFAULT 0)')
+        conn.execute('CREATE INDEX IF NOT EXISTS staged_expires_at ON staged (expires_at)')
+        self.adopt_legacy_directories()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.base_dir, 'index.sqlite'), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def adopt_legacy_directories(self):
+        """One-off: index directories staged before the index existed"""
+        conn = self.connect()
+        if conn.execute('SELECT COUNT(*) FROM staged').fetchone()[0]:
+            return
+        for entry in os.scandir(self.base_dir):
+            if entry.is_dir():
+                created = entry.stat().st_mtime
+                conn.execute('INSERT OR IGNORE INTO staged (registration_id, created_at, expires_at) VALUES (?, ?, ?)',
+                             (entry.name, created, created + self.ttl))
+
+    def path(self, registration_id, filename=None):
+        directory = os.path.join(self.base_dir, registration_id)
+        return os.path.join(directory, filename) if filename else directory
+
+    def usage(self):
+        count, total = self.connect().execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM staged').fetchone()
+        return {'registrations': count, 'bytes': total}
+
+    def stage(self, registration_id):
+        """Reserve a directory for a new registration, enforcing the count quota"""
+        if self.usage()['registrations'] >= self.max_registrations:
+            self.evict_expired()
+            if self.usage()['registrations'] >= self.max_registrations:
+                raise TempUploadQuotaError('Too many registrations are waiting for payment. Please try again later.')
+        os.makedirs(self.path(registration_id), exist_ok=True)
+        now = time.time()
+        self.connect().execute('INSERT OR REPLACE INTO staged (registration_id, created_at, expires_at) VALUES (?, ?, ?)',
+                               (registration_id, now, now + self.ttl))
+        return self.path(registration_id)
+
+    def reserve(self, registration_id, size):
+        """Add size bytes to a registration if the total stays within the quota.
+        A single UPDATE holds SQLite's write lock, so concurrent requests and workers cannot overshoot."""
+        cursor = self.connect().execute(
+            'UPDATE staged SET bytes = bytes + ? WHERE registration_id = ? '
+            'AND (SELECT COALESCE(SUM(bytes), 0) FROM staged) + ? <= ?',
+            (size, registration_id, size, self.max_bytes))
+        if cursor.rowcount != 1:
+            raise TempUploadQuotaError('Temporary upload storage is full. Please try again later.')
+
+    def release(self, registration_id, size):
+        if size:
+            self.connect().execute('UPDATE staged SET bytes = MAX(bytes - ?, 0) WHERE registration_id = ?',
+                                   (size, registration_id))
+
+    def save_file(self, registration_id, filename, stream):
+        """Copy an upload stream to disk in chunks, reserving quota ahead of the copy;
+        returns the stored path and size"""
+        filepath = self.path(registration_id, filename)
+        written = 0
+        reserved = 0
+        try:
+            with open(filepath, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > reserved:
+                        step = max(RESERVE_STEP, written - reserved)
+                        try:
+                            self.reserve(registration_id, step)
+                        except TempUploadQuotaError:
+                            # Near the limit: try for exactly what is needed
+                            step = written - reserved
+                            self.reserve(registration_id, step)
+                        reserved += step
+                    out.write(chunk)
+        except Exception:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            self.release(registration_id, reserved)
+            raise
+        self.release(registration_id, reserved - written)
+        self.connect().execute('UPDATE staged SET files = files + 1 WHERE registration_id = ?', (registration_id,))
+        return filepath, written
+
+    def open_file(self, registration_id, filename):
+        return open(self.path(registration_id, filename), 'rb')
+
+    def discard(self, registration_id):
+        """Remove a registration's files (after upload, on error or on expiry)"""
+        shutil.rmtree(self.path(registration_id), ignore_errors=True)
+        self.connect().execute('DELETE FROM staged WHERE registration_id = ?', (registration_id,))
+
+    def evict_expired(self, batch=JANITOR_BATCH):
+        """Remove up to `batch` expired registrations, oldest first; returns how many"""
+        rows = self.connect().execute('SELECT registration_id FROM staged WHERE expires_at <= ? '
+                                      'ORDER BY expires_at LIMIT ?', (time.time(), batch)).fetchall()
+        for (registration_id,) in rows:
+            self.discard(registration_id)
+            print(f"Cleaned up expired temp upload: {registration_id}")
+        return len(rows)
+
+    def janitor(self):
+        while True:
+            time.sleep(JANITOR_INTERVAL)
+            try:
+                while self.evict_expired() == JANITOR_BATCH:
+                    time.sleep(0.1)  # let request threads in between large backlogs
+            except Exception as e:
+                print(f"Error in temp upload janitor: {e}")
+
+    def start_janitor(self):
+        """Start the background janitor once per process (again after a fork)"""
+        if self.janitor_pid != os.getpid():
+            self.janitor_pid = os.getpid()
+            threading.Thread(target=self.janitor, name='temp-upload-janitor', daemon=True).start()
+
+
+temp_uploads = TempUploadStore()
+
+
+def test_upload_staging():
+    """Self-test in a scratch directory"""
+    import io
+    import tempfile
+    store = TempUploadStore(base_dir=tempfile.mkdtemp(), ttl=0.2, max_bytes=1000, max_registrations=2)
+    store.stage('r1')
+    path, size = store.save_file('r1', 'id_front.jpg', io.BytesIO(b'x' * 600))
+    assert size == 600 and os.path.getsize(path) == 600
+    assert store.usage() == {'registrations': 1, 'bytes': 600}
+
+    store.stage('r2')
+    try:
+        store.save_file('r2', 'id_back.jpg', io.BytesIO(b'y' * 600))
+        raise AssertionError('size quota not enforced')
+    except TempUploadQuotaError:
+        assert not os.path.exists(store.path('r2', 'id_back.jpg'))
+    assert store.usage() == {'registrations': 2, 'bytes': 600}
+
+    # Concurrent copies share the quota: only one 300-byte file fits next to r1's 600 bytes
+    store.max_registrations = 3
+    store.stage('r3')
+    results = []
+    def copy(name):
+        try:
+            results.append(store.save_file('r3', name, io.BytesIO(b'z' * 300))[1])
+        except TempUploadQuotaError:
+            results.append(None)
+    threads = [threading.Thread(target=copy, args=(f'f{i}.jpg',)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(300) == 1 and store.usage()['bytes'] == 900, (results, store.usage())
+    store.discard('r3')
+    store.max_registrations = 2
+    try:
+        store.stage('r3')
+        raise AssertionError('count quota not enforced')
+    except TempUploadQuotaError:
+        pass
+
+    time.sleep(0.3)
+    assert store.evict_expired() == 2
+    assert not os.path.exists(store.path('r1'))
+    assert store.usage() == {'registrations': 0, 'bytes': 0}
+    print("✅ upload_staging self-test passed")
+
+
+if __name__ == "__main__":
+    test_upload_staging()